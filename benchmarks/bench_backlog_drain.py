@@ -0,0 +1,70 @@
+"""Benchmark for delivering a large backlog to a client that logs in.
+
+Queues a backlog of messages for an account, then connects a client, logs it in and times how long the server's
+delivery loop takes until the client has read and acknowledged every message. The backlog is either cold, so it
+is read from disk first, or already cached in memory, which leaves only the cost of delivering it.
+
+Run from the project root with
+    python -m benchmarks.bench_backlog_drain [num_messages]
+"""
+import contextlib
+import io
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.outbound_queue import OutboundLimits
+
+
+def drain(num_messages, warm):
+    directory = tempfile.mkdtemp()
+    try:
+        server = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance,
+                        FileStorage(directory), OutboundLimits(max_queued_messages=num_messages))
+        server.account_list.create_account("reader")
+        for i in range(num_messages):
+            server.undelivered_msg.add_message("reader", f"user{i % 100}", f"message number {i}")
+        if warm:
+            server.undelivered_msg.get_recipient_messages("reader")
+
+        received = [0]
+
+        def count(client_socket, metadata, msg, id_accum):
+            args = protocol_instance.parse_data(metadata.operation_code.value, msg)
+            if metadata.operation_code.name == 'RECV_MESSAGES':
+                message_infos = protocol_instance.unpack_messages(args['messages'])
+                received[0] += len(message_infos)
+                protocol_instance.send(client_socket, protocol_instance.encode('ACK_MESSAGES', 0, {
+                    'recipient': "reader", 'message_id': int(args['first_id']) + len(message_infos) - 1}))
+
+        (server_socket, client_socket) = socket.socketpair()
+        socket_lock = threading.Lock()
+        threading.Thread(target=protocol_instance.read_packets, args=(client_socket, count), daemon=True).start()
+        server.process_new_client({'uuid': "reader-uuid"}, server_socket, socket_lock)
+        # The server logs every replication step, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            threading.Thread(target=server.handle_client, args=(server_socket, socket_lock), daemon=True).start()
+            start = time.perf_counter()
+            server.logged_in.login("reader", "reader-uuid")
+            threading.Thread(target=server.send_messages, daemon=True).start()
+            while server.undelivered_msg.has_messages("reader"):
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - start
+        print(f"{'cached' if warm else 'cold'} backlog: {received[0]} messages delivered in {elapsed:.2f}s, "
+              f"{num_messages / elapsed:.0f} messages/s")
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(num_messages):
+    for warm in (False, True):
+        drain(num_messages, warm)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
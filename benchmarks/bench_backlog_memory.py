@@ -0,0 +1,58 @@
+"""Benchmark for the memory used by queued messages.
+
+Builds in-memory backlogs for many recipients, once as lists of (sender, message) tuples like the message store
+used to keep, and once as Backlogs with interned senders, each in a fresh process. Reports the growth of the peak
+resident set size divided by the number of messages.
+
+Run from the project root with
+    python -m benchmarks.bench_backlog_memory [num_messages]
+"""
+import resource
+import subprocess
+import sys
+import time
+from utils.undelivered_messages import Backlog
+
+NUM_SENDERS = 1000
+MESSAGES_PER_RECIPIENT = 10
+
+
+def build(num_messages, compact):
+    """Build the backlogs in this process and print the build time and peak RSS growth in KB."""
+    senders = [f"user{i}" for i in range(NUM_SENDERS)]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    backlogs = {}
+    sender_ids = {}
+    for i in range(num_messages):
+        recipient = i // MESSAGES_PER_RECIPIENT
+        # Messages are decoded from the log, so every message gets its own copy of the sender string
+        sender = ''.join(senders[i % NUM_SENDERS])
+        message = f"hello there, this is queued message number {i}"
+        if compact:
+            if recipient not in backlogs:
+                backlogs[recipient] = Backlog()
+            sender_id = sender_ids.setdefault(sender, len(sender_ids))
+            backlogs[recipient].append(sender_id, message.encode('utf-8'))
+        else:
+            if recipient not in backlogs:
+                backlogs[recipient] = []
+            backlogs[recipient].append((sender, message))
+    elapsed = time.perf_counter() - start
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def main(num_messages):
+    for compact in (False, True):
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_backlog_memory', '--build',
+                                 str(num_messages), str(compact)], capture_output=True, text=True, check=True).stdout
+        elapsed, growth = output.split()
+        print(f"{'Backlog' if compact else 'list of tuples'}: {num_messages} messages built in {float(elapsed):.1f}s, "
+              f"{int(growth) * 1024 / num_messages:.1f} bytes per message")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--build':
+        build(int(sys.argv[2]), sys.argv[3] == 'True')
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
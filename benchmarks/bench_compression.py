@@ -0,0 +1,65 @@
+"""Benchmark for the bytes on the wire and the CPU cost of compressed messages.
+
+Encodes a LIST_ACCOUNTS_RESPONSE of many accounts, RECV_MESSAGES batches of a backlog of chat messages, and the
+UPDATE_MESSAGE_STATE updates a primary replicates for each of those messages, in version 2 packets written without
+compression, with zlib, and with zlib and the replication dictionary. Reports the bytes written and the CPU time
+taken to encode and read back the messages of each.
+
+Run from the project root with
+    python -m benchmarks.bench_compression [accounts] [messages]
+"""
+import random
+import sys
+import time
+from benchmarks.bench_header_versions import StreamSocket
+from protocol import protocol_instance
+
+WORDS = ("the be to of and a in that have I it for not on with he as you do at this but his by from they we say "
+         "her she or an will my one all would there their what so up out if about who get which go me when make "
+         "can like time no just him know take people into year your good some could them see other than then now "
+         "look only come its over think also back after use two how our work first well way even new want because "
+         "any these give day most us meeting tomorrow lunch thanks sounds great see you later").split()
+
+
+def chat_message(rng):
+    words = rng.choices(WORDS, k=rng.randint(4, 40))
+    return ' '.join(words).capitalize() + rng.choice(['.', '!', '?', ''])
+
+
+def measure(encoder, messages, repeat):
+    """Return the bytes of the encoded messages, and the CPU seconds taken to encode them and read them back."""
+    start = time.process_time()
+    for _ in range(repeat):
+        packets = [packet for (operation, args) in messages for packet in encoder.encode(operation, 0, args)]
+    encoded = (time.process_time() - start) / repeat
+    stream = b''.join(packets)
+    start = time.process_time()
+    for _ in range(repeat):
+        protocol_instance.read_packets(StreamSocket(stream), lambda *_: None)
+    return (len(stream), encoded, (time.process_time() - start) / repeat)
+
+
+def main(accounts, messages):
+    rng = random.Random(262)
+    names = [f"{rng.choice(WORDS)}_{rng.choice(WORDS)}{rng.randint(0, 999)}" for _ in range(accounts)]
+    backlog = [(rng.choice(names), chat_message(rng)) for _ in range(messages)]
+    cases = [
+        (f"LIST_ACCOUNTS_RESPONSE of {accounts} accounts",
+         [('LIST_ACCOUNTS_RESPONSE', {'status': 'Success', 'accounts': ';'.join(names)})]),
+        (f"RECV_MESSAGES batches of {messages} messages",
+         [('RECV_MESSAGES', {'recipient': 'kevin', 'first_id': 0, 'messages': packed})
+          for (_, packed) in protocol_instance.pack_messages(backlog)]),
+        (f"{messages} replicated UPDATE_MESSAGE_STATE",
+         [('UPDATE_MESSAGE_STATE', {'add_one': 'True', 'recipient': 'kevin', 'sender': sender, 'message': message})
+          for (sender, message) in backlog]),
+    ]
+    v2 = protocol_instance.with_version(2)
+    for (name, encoded_messages) in cases:
+        for compression in [None, 'zlib', 'zlib-dict']:
+            (size, encoded, read) = measure(v2.with_compression(compression), encoded_messages, 5)
+            print(f"{name}, {compression or 'uncompressed'}: {size} bytes, "
+                  f"encode {encoded * 1e3:.2f} ms, read {read * 1e3:.2f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
@@ -0,0 +1,77 @@
+"""Benchmark for a delivery pass as the number of online users grows.
+
+Logs in a growing number of clients and gives a fixed number of them one undelivered message each, then times a
+pass of handle_undelivered_messages, which finds the client of every recipient through the session registry.
+For comparison, also times finding the same clients with the scan over every connected client that the delivery
+pass used to make.
+
+Run from the project root with
+    python -m benchmarks.bench_delivery_pass [max_online_users]
+"""
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.record_file import Durability
+
+NUM_RECIPIENTS = 100
+NUM_PASSES = 10
+
+
+class NullSocket:
+    """Client socket which accepts every packet."""
+    def sendmsg(self, buffers, *args):
+        return sum(map(len, buffers))
+
+
+def measure(num_online, directory):
+    """Return the time of a delivery pass, and of the scans it used to make, with num_online users logged in."""
+    server = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance,
+                    FileStorage(directory, Durability('none')))
+    for i in range(num_online):
+        server.account_list.create_account(f"user{i}")
+        server.process_new_client({'uuid': f"{i:032x}"}, NullSocket(), threading.Lock())
+        server.logged_in.login(f"user{i}", f"{i:032x}")
+    step = num_online // NUM_RECIPIENTS
+    recipients = [f"user{i * step}" for i in range(NUM_RECIPIENTS)]
+
+    elapsed = 0
+    for _ in range(NUM_PASSES):
+        for recipient in recipients:
+            server.undelivered_msg.add_message(recipient, "sender", "hello")
+        # The server logs every replication step, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            server.handle_undelivered_messages()
+            elapsed += time.perf_counter() - start
+
+    clients = server.clients
+    start = time.perf_counter()
+    for recipient in recipients:
+        uuid = server.logged_in.get_uuid_from_username(recipient)
+        [k for k, v in clients.items() if v == uuid][0]
+    scan = time.perf_counter() - start
+    return elapsed / NUM_PASSES, scan
+
+
+def main(max_online):
+    num_online = NUM_RECIPIENTS
+    while num_online <= max_online:
+        directory = tempfile.mkdtemp()
+        try:
+            elapsed, scan = measure(num_online, directory)
+        finally:
+            shutil.rmtree(directory)
+        print(f"{num_online} online: delivery pass to {NUM_RECIPIENTS} recipients in {elapsed * 1e3:.2f} ms, "
+              f"scanning for their clients would take {scan * 1e3:.2f} ms")
+        num_online *= 10
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,81 @@
+"""Benchmark for message delivery as the number of delivery workers grows.
+
+Logs in a number of clients, each connected through a socket pair whose other end is drained by a thread of its
+own, queues a backlog of messages for every client and starts the primary's delivery workers. Reports the
+messages per second delivered until every backlog has been written to its client's socket. Every number of
+workers is measured in a process of its own, since the delivery workers of a server never stop.
+
+Run from the project root with
+    python -m benchmarks.bench_delivery_workers [num_clients] [messages_per_client] [max_workers]
+"""
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.outbound_queue import OutboundLimits
+from utils.record_file import Durability
+
+
+def drain(client_socket):
+    while client_socket.recv(1 << 20):
+        pass
+
+
+def measure(num_clients, messages_per_client, workers, directory):
+    """Return the messages per second delivered by the given number of workers."""
+    server = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance,
+                    FileStorage(directory, Durability('none')), OutboundLimits(max_queued_messages=64),
+                    delivery_workers=workers)
+    sockets = []
+    for i in range(num_clients):
+        (server_socket, client_socket) = socket.socketpair()
+        sockets.append((server_socket, client_socket))
+        threading.Thread(target=drain, args=(client_socket,), daemon=True).start()
+        server.account_list.create_account(f"user{i}")
+        server.process_new_client({'uuid': f"{i:032x}"}, server_socket, threading.Lock())
+        server.logged_in.login(f"user{i}", f"{i:032x}")
+        for j in range(messages_per_client):
+            server.undelivered_msg.add_message(f"user{i}", f"user{j % num_clients}", f"message number {j}")
+        # The backlogs start out cached, so only the cost of delivering them is measured
+        server.undelivered_msg.get_recipient_messages(f"user{i}")
+
+    start = time.perf_counter()
+    server.become_primary()
+    while any(server.in_flight.get(f"user{i}", 0) < server.undelivered_msg.queued_ids(f"user{i}").stop
+              for i in range(num_clients)):
+        time.sleep(0.001)
+    for queue in list(server.outbound.values()):
+        queue.wait_until_empty()
+    elapsed = time.perf_counter() - start
+    for (server_socket, client_socket) in sockets:
+        server_socket.close()
+    return num_clients * messages_per_client / elapsed
+
+
+def main(num_clients, messages_per_client, max_workers):
+    workers = 1
+    while workers <= max_workers:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_delivery_workers', '--measure',
+                                 str(num_clients), str(messages_per_client), str(workers)],
+                                capture_output=True, text=True, check=True).stdout
+        throughput = float(output.split()[-1])
+        print(f"{workers} delivery workers: {throughput:.0f} messages/s to {num_clients} clients")
+        workers *= 2
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        directory = tempfile.mkdtemp()
+        try:
+            print(measure(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), directory))
+        finally:
+            shutil.rmtree(directory)
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+             int(sys.argv[3]) if len(sys.argv) > 3 else 8)
@@ -0,0 +1,44 @@
+"""Benchmark for the durability modes of record files.
+
+Appends num_writes single message records, one per write as the server does, for every durability mode and reports
+throughput and write latency. Group fsync is measured with the interval from the command line.
+
+Run from the project root with
+    python -m benchmarks.bench_durability [num_writes] [group_interval_ms]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from utils.record_file import DURABILITY_MODES, Durability
+from utils.undelivered_messages import UndeliveredMessages
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main(num_writes, group_interval_ms):
+    print(f"{'mode':<16} {'writes/s':>10} {'mean us':>9} {'p50 us':>8} {'p99 us':>8}")
+    for mode in DURABILITY_MODES:
+        directory = tempfile.mkdtemp()
+        try:
+            store = UndeliveredMessages(directory, durability=Durability(mode, group_interval_ms))
+            latencies = []
+            start = time.perf_counter()
+            for i in range(num_writes):
+                write_start = time.perf_counter()
+                store.add_message(f"user{i % 1000}", "sender", "hello there, this is a queued message")
+                latencies.append(time.perf_counter() - write_start)
+            elapsed = time.perf_counter() - start
+            store.log.close()
+        finally:
+            shutil.rmtree(directory)
+        latencies.sort()
+        print(f"{mode:<16} {num_writes / elapsed:>10.0f} {elapsed / num_writes * 1e6:>9.1f} "
+              f"{percentile(latencies, 0.5) * 1e6:>8.1f} {percentile(latencies, 0.99) * 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,79 @@
+"""Benchmark for sending one message to many recipients.
+
+Runs a primary and one replica as bench_throughput does, creates the recipients' accounts, and has one client send
+the same message to all of them, either as one SEND_MESSAGE per recipient or as a single SEND_GROUP_MESSAGE.
+Reports the time until the primary answers, and the bytes the primary wrote to its log and sent to the replica.
+
+Run from the project root with
+    python -m benchmarks.bench_group_send [num_recipients] [latency_ms]
+"""
+import contextlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.bench_throughput import request, start_servers
+from protocol import protocol_instance
+
+MESSAGE = "x" * 1000
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for (root, _, names) in os.walk(directory) for name in names)
+
+
+def measure(num_recipients, latency, group):
+    directory = tempfile.mkdtemp()
+    try:
+        primary = start_servers(directory, latency)
+        sent = [0]
+        channel = primary.other_server_sockets_connected[2]
+        original_send = channel.send
+
+        def counting_send(packets):
+            sent[0] += sum(map(len, packets))
+            return original_send(packets)
+        channel.send = counting_send
+        recipients = [f"user{i}" for i in range(num_recipients)]
+        for recipient in recipients:
+            primary.account_list.create_account(recipient)
+        (client_socket, server_socket) = socket.socketpair()
+        socket_lock = threading.Lock()
+        primary.process_new_client({'uuid': f"{0:032x}"}, server_socket, socket_lock)
+        threading.Thread(target=primary.handle_client, args=(server_socket, socket_lock), daemon=True).start()
+        request(client_socket, 'CREATE_ACCOUNT', {'username': "sender"})
+        log_size = directory_size(f"{directory}/1")
+        start = time.perf_counter()
+        if group:
+            (md, msg) = request(client_socket, 'SEND_GROUP_MESSAGE',
+                                {'recipients': ';'.join(recipients), 'message': MESSAGE})
+            assert protocol_instance.parse_data(md.operation_code.value, msg)['status'] == 'Success'
+        else:
+            for recipient in recipients:
+                (md, msg) = request(client_socket, 'SEND_MESSAGE', {'recipient': recipient, 'message': MESSAGE})
+                assert protocol_instance.parse_data(md.operation_code.value, msg)['status'] == 'Success'
+        elapsed = time.perf_counter() - start
+        log_written = directory_size(f"{directory}/1") - log_size
+        client_socket.close()
+        return (elapsed, log_written, sent[0])
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(num_recipients, latency):
+    # The servers log every request, which would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for group in (False, True):
+            (elapsed, log_written, replicated) = measure(num_recipients, latency, group)
+            print(f"{'one group message' if group else 'one message per recipient'} to {num_recipients} recipients: "
+                  f"{elapsed:.3f}s, {log_written} bytes logged, {replicated} bytes replicated",
+                  file=sys.__stdout__)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, (float(sys.argv[2]) if len(sys.argv) > 2 else 1) / 1000)
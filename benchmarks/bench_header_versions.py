@@ -0,0 +1,59 @@
+"""Benchmark for the packets of large messages with header versions 1 and 2.
+
+Encodes a LIST_ACCOUNTS_RESPONSE listing many accounts and RECV_MESSAGES batches of a long backlog with each
+version, and reads them back with read_packets. Reports the packets, the header bytes and the total bytes of each
+message, and the time taken to encode and read them.
+
+Run from the project root with
+    python -m benchmarks.bench_header_versions [accounts] [messages] [message_bytes]
+"""
+import sys
+import time
+from protocol import METADATA_LENGTHS, RECV_SIZE, protocol_instance
+
+
+class StreamSocket:
+    """Stands in for a socket, returning an encoded stream RECV_SIZE bytes at a time."""
+    def __init__(self, stream: bytes):
+        self.stream = stream
+        self.offset = 0
+
+    def recv(self, size):
+        data = self.stream[self.offset:self.offset + min(size, RECV_SIZE)]
+        self.offset += len(data)
+        return data
+
+
+def measure(encoder, operation, args, repeat):
+    """Return the packets of an encoded message, and the seconds taken to encode it and read it back."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        packets = encoder.encode(operation, 0, args)
+    encoded = time.perf_counter() - start
+    stream = b''.join(packets)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        protocol_instance.read_packets(StreamSocket(stream), lambda *_: None)
+    return (packets, encoded / repeat, (time.perf_counter() - start) / repeat)
+
+
+def main(accounts, messages, message_bytes):
+    listing = ','.join(f"user{i}" for i in range(accounts))
+    [(count, packed), *_] = protocol_instance.pack_messages(
+        [(f"user{i % 100}", 'x' * message_bytes) for i in range(messages)])
+    cases = [(f"LIST_ACCOUNTS_RESPONSE of {accounts} accounts", 'LIST_ACCOUNTS_RESPONSE',
+              {'status': 'Success', 'accounts': listing}),
+             (f"RECV_MESSAGES batch of {count} messages", 'RECV_MESSAGES',
+              {'recipient': 'kevin', 'first_id': 0, 'messages': packed})]
+    for (name, operation, args) in cases:
+        for version in [1, 2]:
+            (packets, encoded, read) = measure(protocol_instance.with_version(version), operation, args, 20)
+            total = sum(map(len, packets))
+            print(f"{name}, version {version}: {len(packets)} packets, "
+                  f"{len(packets) * METADATA_LENGTHS[version]} header bytes of {total}, "
+                  f"encode {encoded * 1e6:.0f} us, read {read * 1e6:.0f} us")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 100)
@@ -0,0 +1,82 @@
+"""Benchmark for heartbeat latency while a replica is busy applying updates.
+
+Runs a replica in this process with two connections from the primary, as servers have: one for replicated updates
+and one for heartbeats. Threads standing in for the primary's requests keep the update connection full of
+pipelined message updates, while another thread sends a heartbeat every few milliseconds, either on the update
+connection or on the heartbeat connection. Reports the round trip time of the heartbeats both ways.
+
+Run from the project root with
+    python -m benchmarks.bench_heartbeat [senders] [message_bytes]
+"""
+import contextlib
+import io
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.replica_channel import ReplicaChannel
+
+DURATION = 3
+HEARTBEAT_INTERVAL = 0.005
+CONFIG = [{"host": "127.0.0.1", "port": 6000, "id": 1}, {"host": "127.0.0.1", "port": 6001, "id": 2}]
+
+
+def connect(replica):
+    (primary_end, replica_end) = socket.socketpair()
+    threading.Thread(target=replica.handle_replica, args=(replica_end, threading.Lock()), daemon=True).start()
+    return ReplicaChannel(primary_end, protocol_instance)
+
+
+def measure(senders, message_bytes, shared):
+    """Return the median and 99th percentile heartbeat round trip in seconds, and the updates applied per second."""
+    directory = tempfile.mkdtemp()
+    try:
+        replica = Server(CONFIG, 2, protocol_instance, FileStorage(directory))
+        updates = connect(replica)
+        heartbeats = updates if shared else connect(replica)
+        running = threading.Event()
+        running.set()
+        applied = [0] * senders
+
+        def send_updates(i):
+            args = {'add_one': 'True', 'recipient': f"user{i}", 'sender': 'sender', 'message': 'x' * message_bytes}
+            while running.is_set():
+                updates.request('UPDATE_MESSAGE_STATE', args)
+                applied[i] += 1
+
+        threads = [threading.Thread(target=send_updates, args=(i,), daemon=True) for i in range(senders)]
+        for thread in threads:
+            thread.start()
+        round_trips = []
+        deadline = time.perf_counter() + DURATION
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            heartbeats.request('HEARTBEAT', {'id': '1'})
+            round_trips.append(time.perf_counter() - start)
+            time.sleep(HEARTBEAT_INTERVAL)
+        running.clear()
+        for thread in threads:
+            thread.join()
+        round_trips.sort()
+        return (statistics.median(round_trips), round_trips[int(len(round_trips) * 0.99)], sum(applied) / DURATION)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(senders, message_bytes):
+    for (name, shared) in [("shared with updates", True), ("own connection", False)]:
+        # The replica logs every request, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            (median, p99, applied) = measure(senders, message_bytes, shared)
+        print(f"Heartbeats on {name}: median {median * 1e3:.2f} ms, p99 {p99 * 1e3:.2f} ms, "
+              f"{applied:.0f} updates/s")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,94 @@
+"""Benchmark for paged reads of the message history as it grows.
+
+Appends messages to random conversations of a fixed set, in either direction, to the history store of a storage
+backend, with a timestamp a microsecond apart. At every power of ten of stored messages it reads random pages: the
+newest page of a random conversation, and the page before a random point of one. Reports the time per page read
+and the messages read per page, the append rate, the memory of the process and the size of the store on disk.
+Retention is turned off so every message is kept.
+
+Reading a page should take the same time however many messages are stored, as long as the pages read are in the
+page cache. The default run stores 1M messages in about a minute; storing 100M with the flat file backend takes
+about half an hour, 7.7 GB of disk and 2.8 GB of memory for its index.
+
+Run from the project root with
+    python -m benchmarks.bench_history [file|sqlite] [messages] [conversations] [page size]
+"""
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from benchmarks.bench_compression import WORDS
+from utils.file_storage import FileStorage
+from utils.record_file import Durability
+from utils.sqlite_storage import SqliteStorage
+from utils.storage import HistoryRetention
+
+BATCH = 10000
+READS = 1000
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for (directory, _, names) in os.walk(path) for name in names)
+
+
+def main(backend, messages, conversations, page_size):
+    directory = tempfile.mkdtemp()
+    retention = HistoryRetention(max_messages=None, max_age_seconds=None)
+    try:
+        if backend == 'sqlite':
+            storage = SqliteStorage(os.path.join(directory, 'state.db'), Durability('none'), retention=retention)
+        else:
+            storage = FileStorage(directory, Durability('none'), retention=retention)
+        history = storage.message_history(1)
+        rng = random.Random(262)
+        names = [f"user{i}" for i in range(conversations // 10 + 2)]
+        pairs = [rng.sample(names, 2) for _ in range(conversations)]
+        bodies = [' '.join(rng.choices(WORDS, k=rng.randint(4, 12))) for _ in range(1024)]
+        start_timestamp = int(time.time() * 1_000_000)
+
+        stored = 0
+        checkpoint = 10_000
+        append_time = 0
+        while stored < messages:
+            count = min(BATCH, messages - stored)
+            batch = [rng.choice(pairs) for _ in range(count)]
+            directions = [rng.getrandbits(1) for _ in range(count)]
+            start = time.perf_counter()
+            with storage.transaction():
+                for i in range(count):
+                    (sender, recipient) = batch[i] if directions[i] else reversed(batch[i])
+                    history.add_message([recipient], sender, bodies[(stored + i) % len(bodies)],
+                                        start_timestamp + stored + i)
+            append_time += time.perf_counter() - start
+            stored += count
+            if stored >= checkpoint or stored == messages:
+                checkpoint *= 10
+                read_pairs = rng.choices(pairs, k=READS)
+                start = time.perf_counter()
+                for (username, peer) in read_pairs:
+                    history.get_page(username, peer, limit=page_size)
+                newest = (time.perf_counter() - start) / READS
+                cursors = [start_timestamp + rng.randrange(stored) for _ in range(READS)]
+                start = time.perf_counter()
+                read = 0
+                for ((username, peer), before) in zip(read_pairs, cursors):
+                    read += len(history.get_page(username, peer, before, page_size)[0])
+                deep = (time.perf_counter() - start) / READS
+                memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                path = os.path.join(directory, 'state.db') if backend == 'sqlite' else directory
+                print(f"{stored} messages: newest page {newest * 1e6:.0f} us, page before a random point "
+                      f"{deep * 1e6:.0f} us ({read / READS:.0f} messages), {stored / append_time:.0f} appends/s, "
+                      f"{memory:.0f} MB peak memory, {disk_usage(path) / 2 ** 20:.0f} MB on disk", flush=True)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'file', int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 10_000, int(sys.argv[4]) if len(sys.argv) > 4 else 50)
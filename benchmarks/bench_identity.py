@@ -0,0 +1,85 @@
+"""Benchmark for keying account state by interned ids.
+
+Loads an account list and logged in sessions for many accounts, once keyed by strings like the stores used to
+be (a list of usernames and a map of username to uuid), and once with the stores keyed by ids from a shared
+identity table, each in a fresh process. Reports the growth of the peak resident set size per account, and the
+time of the account and session lookups the server makes for every send request. The identity table packs the
+names into one arena, so the ids cost less memory per account than the strings they replace.
+
+Run from the project root with
+    python -m benchmarks.bench_identity [num_accounts]
+"""
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from utils.file_storage import FileStorage
+from utils.record_file import Durability
+
+NUM_LOOKUPS = 1000
+
+
+def load(num_accounts, interned, directory):
+    """Load the accounts in this process and print the load time, lookup time and peak RSS growth in KB."""
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    # Logins come from separate requests than account creations, so their usernames are separate strings
+    if interned:
+        storage = FileStorage(directory, Durability('none'))
+        account_list = storage.account_list(1)
+        logged_in = storage.logged_in_accounts(1)
+        for i in range(num_accounts):
+            username = f"user{i}"
+            account_list.create_account(username)
+            if i % 2 == 0:
+                logged_in.login(f"user{i}", f"{i:032x}")
+        contains = account_list.contains
+        username_is_logged_in = logged_in.username_is_logged_in
+        get_uuid_from_username = logged_in.get_uuid_from_username
+    else:
+        accounts = []
+        sessions = {}
+        for i in range(num_accounts):
+            username = f"user{i}"
+            accounts.append(username)
+            if i % 2 == 0:
+                sessions[f"user{i}"] = f"{i:032x}"
+        contains = accounts.__contains__
+        username_is_logged_in = sessions.__contains__
+        get_uuid_from_username = sessions.__getitem__
+    load_time = time.perf_counter() - start
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+    rng = random.Random(262)
+    recipients = [f"user{rng.randrange(num_accounts) // 2 * 2}" for _ in range(NUM_LOOKUPS)]
+    start = time.perf_counter()
+    for recipient in recipients:
+        # The checks of a send request and of a delivery pass for the recipient
+        if contains(recipient) and username_is_logged_in(recipient):
+            get_uuid_from_username(recipient)
+    lookup_time = time.perf_counter() - start
+    print(load_time, lookup_time, growth)
+
+
+def main(num_accounts):
+    for interned in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_identity', '--load', str(num_accounts),
+                                     str(interned), directory], capture_output=True, text=True, check=True).stdout
+        finally:
+            shutil.rmtree(directory)
+        load_time, lookup_time, growth = output.split()
+        print(f"{'ids' if interned else 'strings'}: {num_accounts} accounts loaded in {float(load_time):.1f}s, "
+              f"{int(growth) * 1024 / num_accounts:.0f} bytes per account, "
+              f"{float(lookup_time) / NUM_LOOKUPS * 1e6:.1f} us of lookups per request")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--load':
+        load(int(sys.argv[2]), sys.argv[3] == 'True', sys.argv[4])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,63 @@
+"""Benchmark for restarting with a large undelivered message backlog.
+
+Queues backlogs of increasing size, then restarts the message store in a fresh process and reports the startup
+time and peak resident set size. Startup only indexes the recipient of every message; the "load all" rows also
+read every backlog into memory, which is what startup used to do.
+
+Run from the project root with
+    python -m benchmarks.bench_lazy_loading [max_messages]
+"""
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from utils.undelivered_messages import UndeliveredMessages
+
+MESSAGES_PER_RECIPIENT = 10
+
+
+def restart(directory, load_all):
+    """Restart the store in this process and print the startup time and peak RSS in KB."""
+    start = time.perf_counter()
+    store = UndeliveredMessages(directory)
+    if load_all:
+        store.get_messages()
+    elapsed = time.perf_counter() - start
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def measure(directory, load_all):
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_lazy_loading', '--restart', directory,
+                             str(load_all)], capture_output=True, text=True, check=True).stdout
+    elapsed, max_rss = output.split()
+    return float(elapsed), int(max_rss)
+
+
+def main(max_messages):
+    num_messages = 10000
+    while num_messages <= max_messages:
+        directory = tempfile.mkdtemp()
+        try:
+            store = UndeliveredMessages(directory)
+            for i in range(num_messages):
+                store.add_message(f"user{i // MESSAGES_PER_RECIPIENT}", "sender",
+                                  "hello there, this is a queued message")
+            store.log.close()
+            store.cursor_file.close()
+
+            for load_all in (False, True):
+                elapsed, max_rss = measure(directory, load_all)
+                print(f"{num_messages} messages, {'load all' if load_all else 'lazy'}: "
+                      f"started in {elapsed:.2f}s with {max_rss / 1024:.1f} MB peak RSS")
+        finally:
+            shutil.rmtree(directory)
+        num_messages *= 10
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--restart':
+        restart(sys.argv[2], sys.argv[3] == 'True')
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
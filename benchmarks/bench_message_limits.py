@@ -0,0 +1,56 @@
+"""Benchmark for the message limits under an adversarial send pattern.
+
+Floods the message store: half of the messages go to a single recipient who never logs in, and the rest are spread
+over many recipients while every delivery pass reads the backlogs of a few of them. Reports how many messages were
+refused, what the store keeps in memory, and the peak resident set size.
+
+Run from the project root with
+    python -m benchmarks.bench_message_limits [num_messages] [limited|unlimited] [file|sqlite]
+"""
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from utils.sqlite_storage import SqliteStorage
+from utils.storage import MessageLimits
+from utils.undelivered_messages import UndeliveredMessages
+
+NUM_RECIPIENTS = 10000
+
+
+def main(num_messages, limited, backend):
+    limits = MessageLimits(max_messages_per_recipient=1000, max_messages=200000, ttl_seconds=3600,
+                           max_cached_bytes=8 * 1024 * 1024) if limited else MessageLimits(max_cached_bytes=None)
+    rng = random.Random(262)
+    directory = tempfile.mkdtemp()
+    try:
+        if backend == 'sqlite':
+            store = SqliteStorage(os.path.join(directory, 'state.db'), limits=limits).undelivered_messages(1)
+        else:
+            store = UndeliveredMessages(directory, limits=limits)
+        refused = 0
+        start = time.perf_counter()
+        for i in range(num_messages):
+            recipient = "victim" if i % 2 == 0 else f"user{rng.randrange(NUM_RECIPIENTS)}"
+            if not store.add_message(recipient, "attacker", f"spam message number {i} " + "x" * 100):
+                refused += 1
+            if i % 1000 == 0:
+                # A delivery pass reads a few backlogs, which fills the cache
+                for _ in range(10):
+                    store.get_recipient_messages(f"user{rng.randrange(NUM_RECIPIENTS)}")
+                store.get_recipient_messages("victim")
+        elapsed = time.perf_counter() - start
+        print(f"{backend}, {'limited' if limited else 'unlimited'}: sent {num_messages} messages in {elapsed:.1f}s, "
+              f"{refused} refused, {store.message_count} queued, {len(store.cache)} backlogs cached in "
+              f"{store.cached_bytes / 1e6:.1f} MB, "
+              f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB peak RSS")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, not (len(sys.argv) > 2 and sys.argv[2] == 'unlimited'),
+         sys.argv[3] if len(sys.argv) > 3 else 'file')
@@ -0,0 +1,102 @@
+"""Benchmark for the primary under twice the load it can answer.
+
+Runs a primary and one replica as bench_throughput does, and first measures how many requests per second the
+primary answers when every client waits for each answer. Then every client sends messages at a fixed rate, without
+waiting for the answers, so that together they offer twice that many requests per second. Reports the requests
+answered and turned away as busy per second, and the latency of the answered ones, once with the default admission
+limits and once with a request queue that never fills, as if there were no admission control.
+
+Run from the project root with
+    python -m benchmarks.bench_overload [num_clients] [latency_ms]
+"""
+import contextlib
+import io
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.bench_throughput import measure, request, start_servers
+from protocol import protocol_instance
+from utils.request_pool import AdmissionLimits, RequestPool
+
+DURATION = 3
+UNBOUNDED = AdmissionLimits(max_queued_requests=10 ** 9, max_in_flight_per_client=10 ** 9)
+
+
+def client(primary, i, num_clients, interval, running, results):
+    (client_socket, server_socket) = socket.socketpair()
+    socket_lock = threading.Lock()
+    primary.process_new_client({'uuid': f"{i:032x}"}, server_socket, socket_lock)
+    threading.Thread(target=primary.handle_client, args=(server_socket, socket_lock), daemon=True).start()
+    request(client_socket, 'CREATE_ACCOUNT', {'username': f"user{i}"})
+    # Every request is answered once in order
+    sent_at = []
+    latencies = []
+    busy = [0]
+
+    def read():
+        while (response := protocol_instance.read_small_packets(client_socket)) is not None:
+            (md, msg) = response
+            if md.operation_code.name == 'BUSY':
+                busy[0] += 1
+            else:
+                latencies.append(time.perf_counter() - sent_at[len(latencies) + busy[0]])
+    reader = threading.Thread(target=read, daemon=True)
+    results[i] = (latencies, busy)
+    running.wait()
+    reader.start()
+    message = protocol_instance.encode('SEND_MESSAGE', 0, {'recipient': f"user{(i + 1) % num_clients}",
+                                                           'message': "hello"})
+    due = time.perf_counter()
+    while running.is_set():
+        sent_at.append(time.perf_counter())
+        protocol_instance.send(client_socket, message)
+        due += interval
+        time.sleep(max(due - time.perf_counter(), 0))
+    client_socket.shutdown(socket.SHUT_WR)
+
+
+def overload(num_clients, latency, rate, limits):
+    """Return the answered and busy requests per second, and the median and 99th percentile latency in seconds."""
+    directory = tempfile.mkdtemp()
+    try:
+        primary = start_servers(directory, latency)
+        primary.requests = RequestPool(limits)
+        running = threading.Event()
+        results = {}
+        threads = [threading.Thread(target=client, args=(primary, i, num_clients, num_clients / rate, running,
+                                                         results), daemon=True)
+                   for i in range(num_clients)]
+        for thread in threads:
+            thread.start()
+        while len(results) < num_clients:
+            time.sleep(0.01)
+        running.set()
+        time.sleep(DURATION)
+        latencies = sorted(latency for (client_latencies, _) in results.values() for latency in client_latencies)
+        busy = sum(client_busy[0] for (_, client_busy) in results.values())
+        running.clear()
+        for thread in threads:
+            thread.join()
+        return (len(latencies) / DURATION, busy / DURATION, statistics.median(latencies),
+                latencies[int(len(latencies) * 0.99)])
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(num_clients, latency):
+    # The servers log every request, which would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        capacity = measure(num_clients, latency)
+        print(f"{num_clients} clients waiting for answers: {capacity:.0f} requests/s", file=sys.__stdout__)
+        for (name, limits) in [("admission control", AdmissionLimits()), ("unbounded queue", UNBOUNDED)]:
+            (answered, busy, median, p99) = overload(num_clients, latency, 2 * capacity, limits)
+            print(f"{name} at {2 * capacity:.0f} requests/s offered: {answered:.0f} answered/s, {busy:.0f} busy/s, "
+                  f"latency median {median * 1e3:.1f} ms, p99 {p99 * 1e3:.1f} ms", file=sys.__stdout__)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32, (float(sys.argv[2]) if len(sys.argv) > 2 else 1) / 1000)
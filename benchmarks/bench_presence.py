@@ -0,0 +1,87 @@
+"""Benchmark for the CPU cost on the primary of clients polling LIST_ACCOUNTS, against pushing presence events.
+
+Runs a server in this process with many accounts. Measures the CPU time of answering a LIST_ACCOUNTS of every
+account, which is what each polling client costs every time it polls. Then subscribes as many clients, either all
+to one pattern matching every account or each to a few usernames, and measures the CPU time of a login and logoff
+with the events pushed to the subscribers. Queues that only count their messages stand in for the clients'
+outbound queues.
+
+Run from the project root with
+    python -m benchmarks.bench_presence [accounts] [clients] [usernames_per_client]
+"""
+import itertools
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+
+CONFIG = [{"host": "127.0.0.1", "port": 6000, "id": 1}]
+
+
+class CountingQueue:
+    def __init__(self):
+        self.count = 0
+
+    def put(self, message):
+        self.count += 1
+        return True
+
+
+def cpu_per_call(function, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        function()
+    return (time.process_time() - start) / repeat
+
+
+def main(accounts, clients, usernames_per_client):
+    directory = tempfile.mkdtemp()
+    try:
+        server = Server(CONFIG, 1, protocol_instance, FileStorage(directory))
+        names = [f"user{i}" for i in range(accounts)]
+        for name in names:
+            server.account_list.create_account(name)
+
+        def poll():
+            protocol_instance.encode('LIST_ACCOUNTS_RESPONSE', 0, server.process_list_accounts({'query': '.*'}))
+        poll_cost = cpu_per_call(poll, 20)
+        print(f"LIST_ACCOUNTS of {accounts} accounts: {poll_cost * 1e3:.2f} ms, so {clients} clients polling once "
+              f"a second take {poll_cost * clients:.2f} s of CPU a second")
+
+        rng = random.Random(262)
+        for (name, subscribe) in [
+                ("to a pattern matching every account",
+                 lambda client, queue: server.presence.subscribe(client, queue, protocol_instance, [],
+                                                                 re.compile('.*', flags=re.IGNORECASE))),
+                (f"to {usernames_per_client} usernames each",
+                 lambda client, queue: server.presence.subscribe(
+                     client, queue, protocol_instance, rng.sample(names, usernames_per_client)))]:
+            queues = [CountingQueue() for _ in range(clients)]
+            for (i, queue) in enumerate(queues):
+                subscribe((i, None), queue)
+            users = itertools.cycle(names)
+
+            def event():
+                user = next(users)
+                with server.logged_in_lock:
+                    server.logged_in.login(user, user)
+                    server.logged_in.logoff(user)
+            repeat = 200
+            cost = cpu_per_call(event, repeat) / 2
+            pushed = sum(queue.count for queue in queues) / (2 * repeat)
+            print(f"{clients} clients subscribed {name}: {cost * 1e6:.0f} us per event, pushed to {pushed:.1f} "
+                  f"clients on average")
+            for i in range(clients):
+                server.presence.unsubscribe((i, None))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 20)
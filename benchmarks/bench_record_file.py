@@ -0,0 +1,42 @@
+"""Benchmark for loading persisted state from record files.
+
+Writes num_records account records, then times a raw scan of the file through mmap and a full AccountList load.
+
+Run from the project root with
+    python -m benchmarks.bench_record_file [num_records]
+"""
+import os
+import sys
+import tempfile
+import time
+from utils.account_list import AccountList
+from utils.record_file import RecordFile
+
+BATCH_SIZE = 100000
+
+
+def main(num_records):
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        record_file = RecordFile(filename)
+        start = time.perf_counter()
+        for batch_start in range(0, num_records, BATCH_SIZE):
+            record_file.append_many(('+', f"user{i}")
+                                    for i in range(batch_start, min(num_records, batch_start + BATCH_SIZE)))
+        print(f"wrote {num_records} records ({os.path.getsize(filename) / 1e6:.0f} MB) "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        count = sum(1 for _ in record_file.read())
+        print(f"scanned {count} records in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        accounts = AccountList(filename)
+        print(f"loaded {len(accounts.account_list)} accounts in {time.perf_counter() - start:.2f}s")
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
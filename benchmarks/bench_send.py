@@ -0,0 +1,105 @@
+"""Benchmark for writing encoded messages to a socket.
+
+Writes a stream of small responses to a connection through its outbound queue, as the server does, and then has
+several threads write large multi-packet messages to one socket at once. Reports the messages per second, the
+socket send calls per message, and whether any message arrived with packets of another message in between.
+
+Run from the project root with
+    python -m benchmarks.bench_send [num_messages]
+"""
+import socket
+import sys
+import threading
+import time
+from protocol import protocol_instance
+from utils.outbound_queue import OutboundQueue
+
+NUM_WRITERS = 4
+
+
+class CountingSocket:
+    """Wraps a socket to count the calls that write to it."""
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.calls = 0
+
+    def send(self, *args):
+        self.calls += 1
+        return self.wrapped.send(*args)
+
+    def sendmsg(self, *args):
+        self.calls += 1
+        return self.wrapped.sendmsg(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+
+def read_all(client_socket, messages):
+    """Collect the (message id, packet number) of every packet read."""
+    while (response := protocol_instance.read_small_packets(client_socket)) is not None:
+        messages.append((response[0].message_id, response[1]))
+
+
+def measure_small(num_messages):
+    (server_socket, client_socket) = socket.socketpair()
+    counting_socket = CountingSocket(server_socket)
+    received = []
+    reader = threading.Thread(target=read_all, args=(client_socket, received))
+    reader.start()
+    queue = OutboundQueue(counting_socket, threading.Lock(), protocol_instance)
+    message = protocol_instance.encode('SEND_MESSAGE_RESPONSE', 0, {'status': 'Success'})
+    start = time.perf_counter()
+    for _ in range(num_messages):
+        while not queue.has_room():
+            time.sleep(0.0001)
+        queue.put(message)
+    queue.wait_until_empty()
+    elapsed = time.perf_counter() - start
+    server_socket.shutdown(socket.SHUT_RDWR)
+    reader.join()
+    print(f"small responses: {num_messages / elapsed:.0f} messages/s, "
+          f"{counting_socket.calls / num_messages:.3f} send calls per message")
+    server_socket.close()
+    client_socket.close()
+
+
+def measure_concurrent(num_messages):
+    (server_socket, client_socket) = socket.socketpair()
+    counting_socket = CountingSocket(server_socket)
+    socket_lock = threading.Lock()
+    received = []
+    reader = threading.Thread(target=read_all, args=(client_socket, received))
+    reader.start()
+    per_writer = num_messages // NUM_WRITERS // 10
+    # Each message spans several packets, and every packet of a writer's messages holds the writer's number
+    messages = [protocol_instance.encode('RECV_MESSAGE', i, {'sender': 'kevin', 'message': str(i) * 6000})
+                for i in range(NUM_WRITERS)]
+
+    def write(i):
+        for _ in range(per_writer):
+            protocol_instance.send(counting_socket, messages[i], socket_lock)
+
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(NUM_WRITERS)]
+    start = time.perf_counter()
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    elapsed = time.perf_counter() - start
+    server_socket.shutdown(socket.SHUT_RDWR)
+    reader.join()
+    packets_per_message = len(messages[0])
+    interleaved = sum(1 for i in range(0, len(received), packets_per_message)
+                      if len({message_id for (message_id, _) in received[i:i + packets_per_message]}) > 1)
+    total = per_writer * NUM_WRITERS
+    print(f"{packets_per_message}-packet messages from {NUM_WRITERS} threads: {total / elapsed:.0f} messages/s, "
+          f"{counting_socket.calls / total:.3f} send calls per message, {interleaved} interleaved")
+    server_socket.close()
+    client_socket.close()
+
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure_small(num_messages)
+    measure_concurrent(num_messages)
@@ -0,0 +1,41 @@
+"""Benchmark for the write throughput of accounts sharded across replica groups.
+
+Runs every replica group, a primary and one replica as in bench_throughput, in a process of its own, as separate
+machines would. Each group has the same number of clients logged into its accounts, sending messages to other
+accounts of the group as fast as its primary answers. Reports the requests per second answered by all the primaries
+together, for a growing number of groups.
+
+Run from the project root with
+    python -m benchmarks.bench_shards [max_groups] [clients_per_group] [latency_ms]
+"""
+import contextlib
+import io
+import multiprocessing
+import sys
+from benchmarks.bench_throughput import measure
+
+
+def run_group(clients, latency, results):
+    # The servers log every request, which would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.put(measure(clients, latency))
+
+
+def main(max_groups, clients, latency):
+    groups = 1
+    while groups <= max_groups:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_group, args=(clients, latency, results))
+                     for _ in range(groups)]
+        for process in processes:
+            process.start()
+        throughput = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        print(f"{groups} groups of {clients} clients: {throughput:.0f} requests per second")
+        groups *= 2
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4, int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+         (float(sys.argv[3]) if len(sys.argv) > 3 else 1) / 1000)
@@ -0,0 +1,73 @@
+"""Benchmark for message delivery while some clients stop reading their sockets.
+
+Connects many clients to a server, a few of which never read what the server sends them, and has every client
+receive a stream of messages. Reports the messages per second delivered to the clients that do read, which
+shouldn't depend on the slow clients, and the outbound queue metrics of the server.
+
+Run from the project root with
+    python -m benchmarks.bench_slow_consumer [num_clients] [num_slow_clients] [drop|disconnect]
+"""
+import contextlib
+import io
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.outbound_queue import OutboundLimits
+from utils.record_file import Durability
+
+DURATION = 3
+MESSAGES_PER_PASS = 10
+
+
+def read_all(client_socket, received, i):
+    """Count the messages a client receives."""
+    while protocol_instance.read_small_packets(client_socket) is not None:
+        received[i] += 1
+
+
+def main(num_clients, num_slow, policy):
+    directory = tempfile.mkdtemp()
+    try:
+        server = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance,
+                        FileStorage(directory, Durability('none')),
+                        OutboundLimits(send_timeout_seconds=1, slow_consumer_policy=policy))
+        received = [0] * num_clients
+        sockets = []
+        for i in range(num_clients):
+            (server_socket, client_socket) = socket.socketpair()
+            sockets.extend([server_socket, client_socket])
+            server.account_list.create_account(f"user{i}")
+            server.process_new_client({'uuid': f"{i:032x}"}, server_socket, threading.Lock())
+            server.logged_in.login(f"user{i}", f"{i:032x}")
+            if i >= num_slow:
+                threading.Thread(target=read_all, args=(client_socket, received, i), daemon=True).start()
+
+        passes = 0
+        start = time.perf_counter()
+        # The server logs every replication step, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            while time.perf_counter() - start < DURATION:
+                for i in range(num_clients):
+                    for j in range(MESSAGES_PER_PASS):
+                        server.undelivered_msg.add_message(f"user{i}", "sender", f"message {passes} {j}")
+                server.handle_undelivered_messages()
+                passes += 1
+        elapsed = time.perf_counter() - start
+        metrics = server.outbound_metrics()
+        print(f"{num_slow} of {num_clients} clients slow ({policy}): {sum(received) / elapsed:.0f} messages/s "
+              f"delivered to the others over {passes} passes, {metrics}")
+        for client_socket in sockets:
+            client_socket.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100, int(sys.argv[2]) if len(sys.argv) > 2 else 1,
+         sys.argv[3] if len(sys.argv) > 3 else 'disconnect')
@@ -0,0 +1,61 @@
+"""Throughput comparison of the flat file and SQLite storage backends.
+
+For each backend, creates num_users accounts and logs each one in within a single transaction (as a create account
+request does), queues num_users * 10 messages, then delivers every backlog.
+
+Run from the project root with
+    python -m benchmarks.bench_storage [num_users] [durability mode]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from utils.file_storage import FileStorage
+from utils.record_file import Durability
+from utils.sqlite_storage import SqliteStorage
+
+MESSAGES_PER_USER = 10
+
+
+def run(name, storage, num_users):
+    account_list = storage.account_list(1)
+    logged_in = storage.logged_in_accounts(1)
+    undelivered_msg = storage.undelivered_messages(1)
+
+    start = time.perf_counter()
+    for i in range(num_users):
+        with storage.transaction():
+            account_list.create_account(f"user{i}")
+            logged_in.login(f"user{i}", str(i))
+    create_rate = num_users / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(num_users * MESSAGES_PER_USER):
+        undelivered_msg.add_message(f"user{i % num_users}", "sender", "hello there, this is a queued message")
+    send_rate = num_users * MESSAGES_PER_USER / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for recipient, message_infos in undelivered_msg.get_messages():
+        undelivered_msg.update_messages(recipient, [])
+    deliver_rate = num_users * MESSAGES_PER_USER / (time.perf_counter() - start)
+
+    print(f"{name:<8} {create_rate:>16.0f} {send_rate:>14.0f} {deliver_rate:>17.0f}")
+
+
+def main(num_users, mode):
+    durability = Durability(mode)
+    print(f"{'backend':<8} {'create+login/s':>16} {'messages/s':>14} {'delivered msg/s':>17}")
+    directory = tempfile.mkdtemp()
+    try:
+        run('file', FileStorage(os.path.join(directory, 'files'), durability), num_users)
+        storage = SqliteStorage(os.path.join(directory, 'state.db'), durability)
+        run('sqlite', storage, num_users)
+        storage.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+         sys.argv[2] if len(sys.argv) > 2 else 'os-buffered')
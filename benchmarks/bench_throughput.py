@@ -0,0 +1,145 @@
+"""Benchmark for the request throughput of the primary as the number of clients grows.
+
+Runs a primary and one replica in this process. Every client is a thread with its own connection to the primary,
+logged into its own account, sending messages to other clients' accounts as fast as the primary answers. The
+primary's updates reach the replica through a link that delays them by a fixed latency, like a network round trip
+would. Reports the requests per second the primary answers for every number of clients.
+
+Run from the project root with
+    python -m benchmarks.bench_throughput [max_clients] [latency_ms]
+"""
+import contextlib
+import heapq
+import io
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.replica_channel import ReplicaChannel
+
+DURATION = 2
+CONFIG = [{"host": "127.0.0.1", "port": 6000, "id": 1}, {"host": "127.0.0.1", "port": 6001, "id": 2}]
+
+
+def delayed_link(source, destination, latency):
+    """Forward everything read from source to destination after a delay, without limiting the throughput."""
+    pending = []
+    condition = threading.Condition()
+
+    def read():
+        while True:
+            data = source.recv(65536)
+            with condition:
+                heapq.heappush(pending, (time.perf_counter() + latency, len(pending), data))
+                condition.notify()
+            if not data:
+                return
+
+    def write():
+        while True:
+            with condition:
+                while not pending:
+                    condition.wait()
+                (due, _, data) = pending[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    condition.wait(wait)
+                    continue
+                heapq.heappop(pending)
+            if not data:
+                destination.shutdown(socket.SHUT_WR)
+                return
+            destination.sendall(data)
+
+    threading.Thread(target=read, daemon=True).start()
+    threading.Thread(target=write, daemon=True).start()
+
+
+def start_servers(directory, latency):
+    """Return a primary connected to a replica through a delayed link."""
+    primary = Server(CONFIG, 1, protocol_instance, FileStorage(f"{directory}/1"))
+    replica = Server(CONFIG, 2, protocol_instance, FileStorage(f"{directory}/2"))
+    (primary_end, link_in) = socket.socketpair()
+    (link_out, replica_end) = socket.socketpair()
+    delayed_link(link_in, link_out, latency)
+    # Acks come straight back, so a round trip takes the latency once
+    threading.Thread(target=forward, args=(link_out, link_in), daemon=True).start()
+    threading.Thread(target=replica.handle_replica, args=(replica_end, threading.Lock()), daemon=True).start()
+    primary.other_server_sockets_connected[2] = ReplicaChannel(primary_end, protocol_instance)
+    primary.primary_id = 1
+    return primary
+
+
+def forward(source, destination):
+    """Forward everything read from source to destination right away."""
+    while True:
+        data = source.recv(65536)
+        if not data:
+            return
+        destination.sendall(data)
+
+
+def request(client_socket, operation, args):
+    protocol_instance.send(client_socket, protocol_instance.encode(operation, 0, args))
+    return protocol_instance.read_small_packets(client_socket)
+
+
+def client(primary, i, num_clients, running, counts):
+    (client_socket, server_socket) = socket.socketpair()
+    socket_lock = threading.Lock()
+    primary.process_new_client({'uuid': f"{i:032x}"}, server_socket, socket_lock)
+    threading.Thread(target=primary.handle_client, args=(server_socket, socket_lock), daemon=True).start()
+    request(client_socket, 'CREATE_ACCOUNT', {'username': f"user{i}"})
+    counts[i] = 0
+    running.wait()
+    while running.is_set():
+        (md, msg) = request(client_socket, 'SEND_MESSAGE',
+                            {'recipient': f"user{(i + 1) % num_clients}", 'message': "hello"})
+        assert protocol_instance.parse_data(md.operation_code.value, msg)['status'] == 'Success'
+        counts[i] += 1
+    client_socket.close()
+
+
+def measure(num_clients, latency):
+    """Return the requests per second answered by a primary serving num_clients clients."""
+    directory = tempfile.mkdtemp()
+    try:
+        primary = start_servers(directory, latency)
+        running = threading.Event()
+        counts = {}
+        threads = [threading.Thread(target=client, args=(primary, i, num_clients, running, counts), daemon=True)
+                   for i in range(num_clients)]
+        for thread in threads:
+            thread.start()
+        while len(counts) < num_clients:
+            time.sleep(0.01)
+        running.set()
+        start = time.perf_counter()
+        time.sleep(DURATION)
+        total = sum(counts.values())
+        elapsed = time.perf_counter() - start
+        running.clear()
+        for thread in threads:
+            thread.join()
+        return total / elapsed
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(max_clients, latency):
+    num_clients = 1
+    # The servers log every request, which would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        while num_clients <= max_clients:
+            throughput = measure(num_clients, latency)
+            print(f"{num_clients} clients: {throughput:.0f} requests per second", file=sys.__stdout__)
+            num_clients *= 2
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32, (float(sys.argv[2]) if len(sys.argv) > 2 else 1) / 1000)
@@ -0,0 +1,76 @@
+"""Benchmark for the replication round trip over a Unix domain socket and over loopback TCP.
+
+Runs a replica in this process listening on either transport, connects to it the way a primary does, and sends it
+one request at a time: heartbeats, and message updates as the primary replicates them. Reports the median and 99th
+percentile round trip of each.
+
+Run from the project root with
+    python -m benchmarks.bench_transport [requests] [message_bytes]
+"""
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from protocol import protocol_instance
+from server import Server
+from utils import transport
+from utils.file_storage import FileStorage
+from utils.replica_channel import ReplicaChannel
+
+
+def round_trips(channel, requests, operation, args):
+    """Return the sorted round trips of requests sent one at a time, in seconds."""
+    times = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        channel.request(operation, args)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def measure(host, port, requests, message_bytes):
+    """Return the heartbeat and update round trips of a replica listening on host and port."""
+    directory = tempfile.mkdtemp()
+    try:
+        replica = Server([{"host": host, "port": port, "id": 2}], 2, protocol_instance, FileStorage(directory))
+        listener = transport.listen(host, port)
+        port = None if transport.is_unix(host) else listener.getsockname()[1]
+
+        def accept():
+            (connection, _) = listener.accept()
+            replica.handle_replica(connection, threading.Lock())
+        threading.Thread(target=accept, daemon=True).start()
+        channel = ReplicaChannel(transport.connect(host, port), protocol_instance)
+        heartbeats = round_trips(channel, requests, 'HEARTBEAT', {'id': '1'})
+        updates = round_trips(channel, requests, 'UPDATE_MESSAGE_STATE', {
+            'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': 'x' * message_bytes})
+        channel.socket.close()
+        listener.close()
+        return (heartbeats, updates)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(requests, message_bytes):
+    directory = tempfile.mkdtemp()
+    try:
+        for (name, host, port) in [("Unix domain socket", transport.UNIX_PREFIX + os.path.join(directory, "s.sock"),
+                                    None),
+                                   ("loopback TCP", "127.0.0.1", 0)]:
+            # The replica logs every request, which would drown the results
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = measure(host, port, requests, message_bytes)
+            for (operation, times) in zip(["heartbeat", "update"], results):
+                print(f"{name} {operation}: median {statistics.median(times) * 1e6:.0f} us, "
+                      f"p99 {times[int(len(times) * 0.99)] * 1e6:.0f} us")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
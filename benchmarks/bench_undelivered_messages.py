@@ -0,0 +1,63 @@
+"""Benchmark for the undelivered message store.
+
+Queues messages for many recipients with mixed backlog sizes (most recipients have one or two messages, a few
+have hundreds), then delivers every backlog the way the server's delivery loop does.
+
+Run from the project root with
+    python -m benchmarks.bench_undelivered_messages [num_recipients]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from utils.undelivered_messages import UndeliveredMessages
+
+
+def backlog_size(rng):
+    roll = rng.random()
+    if roll < 0.80:
+        return rng.randint(1, 2)
+    if roll < 0.98:
+        return rng.randint(3, 20)
+    return rng.randint(100, 500)
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def main(num_recipients):
+    rng = random.Random(262)
+    directory = tempfile.mkdtemp()
+    try:
+        store = UndeliveredMessages(directory)
+        sends = []
+        for i in range(num_recipients):
+            sends.extend([f"user{i}"] * backlog_size(rng))
+        rng.shuffle(sends)
+
+        start = time.perf_counter()
+        for recipient in sends:
+            store.add_message(recipient, "sender", "hello there, this is a queued message")
+        elapsed = time.perf_counter() - start
+        print(f"queued {len(sends)} messages for {num_recipients} recipients in {elapsed:.2f}s "
+              f"({len(sends) / elapsed:.0f} msg/s), {directory_size(directory) / 1e6:.1f} MB on disk")
+
+        start = time.perf_counter()
+        store = UndeliveredMessages(directory)
+        print(f"reloaded backlog in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        for recipient, message_infos in store.get_messages():
+            store.update_messages(recipient, [])
+        elapsed = time.perf_counter() - start
+        print(f"delivered every backlog in {elapsed:.2f}s ({num_recipients / elapsed:.0f} recipients/s), "
+              f"{len(store.log.segments)} segment(s) and {directory_size(directory) / 1e6:.2f} MB left on disk")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
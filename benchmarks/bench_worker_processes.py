@@ -0,0 +1,156 @@
+"""Benchmark for the request throughput of a primary with worker processes sharing its port.
+
+Runs a primary without replicas in this process, with no worker processes and then with a growing number of them.
+The clients run in processes of their own, as other machines would. Every client has its own connection and
+account, and sends requests as fast as the primary answers them, either messages to an account nobody is logged
+into (send), which the server process runs, or searches of the account list (list), which the workers answer.
+
+Reports the requests per second answered, and the CPU time the server process and the workers spend per request.
+The server process runs under one GIL, so one core's worth of its CPU time bounds the throughput, and each worker
+is bounded the same way, so the reported ceiling on a number of cores is the lowest of those bounds and of the
+cores divided by the CPU time of a request. The requests/s measured are only that high on a machine with enough
+cores for the server process, the workers and the clients.
+
+Run from the project root with
+    python -m benchmarks.bench_worker_processes [max_workers] [num_clients] [send|list] [cores]
+"""
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.bench_throughput import request
+from protocol import protocol_instance
+from server import Server
+from utils.file_storage import FileStorage
+from utils.worker_processes import WorkerProcesses
+
+DURATION = 3
+CLIENT_PROCESSES = 2
+HOST = "127.0.0.1"
+# Accounts besides the clients' own, for the searches of the list workload to go through
+NUM_ACCOUNTS = 1000
+
+
+def run_clients(address, first, count, workload, start, stop, results):
+    """Main function of a process running count clients, which puts the number of answered requests in results."""
+    answered = [0] * count
+
+    def client(i):
+        client_socket = socket.create_connection(address)
+        protocol_instance.send(client_socket, protocol_instance.encode(
+            'REGISTER_CLIENT_UUID', 0, {'uuid': f"{first + i:032x}"}))
+        request(client_socket, 'CREATE_ACCOUNT', {'username': f"user{first + i}"})
+        if workload == 'send':
+            message = protocol_instance.encode('SEND_MESSAGE', 0, {'recipient': 'sink', 'message': "hello"})
+        else:
+            message = protocol_instance.encode('LIST_ACCOUNTS', 0, {'query': "account1.*"})
+        start.wait()
+        while not stop.is_set():
+            protocol_instance.send(client_socket, message)
+            protocol_instance.read_small_packets(client_socket)
+            answered[i] += 1
+        client_socket.close()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(sum(answered))
+
+
+def accept(listener, primary):
+    while True:
+        try:
+            (connection, _) = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=primary.handle_connection, args=(connection, threading.Lock()), daemon=True).start()
+
+
+def process_cpu(pid):
+    """Return the CPU seconds a process has used, read from /proc."""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rpartition(')')[2].split()
+    # utime and stime are the 14th and 15th fields, counted from the pid
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def measure(workers, num_clients, workload):
+    """Return the requests per second answered, and the CPU seconds per request of this process and of the
+    workers together."""
+    directory = tempfile.mkdtemp()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((HOST, 0))
+    address = listener.getsockname()
+    primary = Server([{"host": HOST, "port": address[1], "id": 1}], 1, protocol_instance, FileStorage(directory))
+    primary.primary_id = 1
+    primary.account_list.create_account('sink')
+    for i in range(NUM_ACCOUNTS):
+        primary.account_list.create_account(f"account{i}")
+    processes = None
+    try:
+        if workers:
+            # Every connection goes to a worker, since this socket doesn't listen
+            processes = WorkerProcesses(primary, workers)
+            processes.start(HOST, address[1])
+        else:
+            listener.listen()
+            threading.Thread(target=accept, args=(listener, primary), daemon=True).start()
+        context = multiprocessing.get_context('spawn')
+        (start, stop, results) = (context.Event(), context.Event(), context.Queue())
+        per_process = num_clients // CLIENT_PROCESSES
+        clients = [context.Process(target=run_clients, args=(address, i * per_process, per_process, workload, start,
+                                                            stop, results))
+                   for i in range(CLIENT_PROCESSES)]
+        for process in clients:
+            process.start()
+        # Let every client create its account first
+        while not primary.account_list.contains(f"user{CLIENT_PROCESSES * per_process - 1}") or \
+                len(primary.clients) < CLIENT_PROCESSES * per_process:
+            time.sleep(0.1)
+        pids = [process.pid for process in processes.processes] if processes is not None else []
+        cpu = time.process_time()
+        worker_cpu = sum(map(process_cpu, pids))
+        start.set()
+        time.sleep(DURATION)
+        stop.set()
+        cpu = time.process_time() - cpu
+        worker_cpu = sum(map(process_cpu, pids)) - worker_cpu
+        answered = sum(results.get() for _ in clients)
+        for process in clients:
+            process.join()
+        return (answered / DURATION, cpu / answered, worker_cpu / answered)
+    finally:
+        if processes is not None:
+            processes.stop()
+        else:
+            listener.shutdown(socket.SHUT_RDWR)
+        listener.close()
+        shutil.rmtree(directory)
+
+
+def main(max_workers, num_clients, workload, cores):
+    print(f"{workload} requests, {os.cpu_count()} cores here, ceilings on {cores} cores")
+    workers = 0
+    while workers <= max_workers:
+        # The server logs every request, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            (throughput, cpu, worker_cpu) = measure(workers, num_clients, workload)
+        # The server process and every worker use at most one core each, and all of them share the cores
+        ceiling = min(1 / cpu, workers / worker_cpu if worker_cpu else float('inf'), cores / (cpu + worker_cpu))
+        print(f"{workers} worker processes: {throughput:.0f} requests/s, {cpu * 1e6:.0f} us of server process CPU "
+              f"and {worker_cpu * 1e6:.0f} us of worker CPU per request, at most {ceiling:.0f} requests/s")
+        workers = workers * 2 if workers else 1
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4, int(sys.argv[2]) if len(sys.argv) > 2 else 32,
+         sys.argv[3] if len(sys.argv) > 3 else 'send', int(sys.argv[4]) if len(sys.argv) > 4 else 8)
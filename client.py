@@ -1,4 +1,5 @@
 import socket
+from datetime import datetime
 from time import sleep
 import time
 import protocol
@@ -9,6 +10,10 @@ import uuid
 import client_replica_library
 
 std_out_lock = threading.Lock()
+# Descriptions of the events of PRESENCE_EVENT
+PRESENCE_EVENTS = {'created': 'a new account', 'removed': 'deleted', 'online': 'online', 'offline': 'offline'}
+# Messages in one page of message history
+HISTORY_PAGE_SIZE = 20
 
 
 class Client:
@@ -19,6 +24,9 @@ class Client:
         self.message_counter = 0
         self.uuid = str(uuid.uuid4())
         self.username = None
+        # Map of the peer of every conversation paged through to the cursor of its next older page, '' once there
+        # are no older messages
+        self.history_cursors = {}
 
     def connect(self):
         """
@@ -61,7 +69,7 @@ class Client:
             match user_input:
                 case 'help':
                     atomic_print(
-                        std_out_lock, 'Enter one of the following command numbers: \n1 - Create account \n2 - Login \n3 - List accounts \n4 - Send message \n5 - Logoff \n6 - Delete account')
+                        std_out_lock, 'Enter one of the following command numbers: \n1 - Create account \n2 - Login \n3 - List accounts \n4 - Send message \n5 - Logoff \n6 - Delete account \n7 - Send group message \n8 - Watch accounts \n9 - Show message history')
                 case '1' | 'create account':
                     self._login_or_create_account('CREATE_ACCOUNT')
                 case '2' | 'login':
@@ -74,6 +82,12 @@ class Client:
                     self._logoff()
                 case '6' | 'delete account':
                     self._delete_account()
+                case '7' | 'send group message':
+                    self._send_group_message()
+                case '8' | 'watch accounts':
+                    self._subscribe_presence()
+                case '9' | 'show message history':
+                    self._get_history()
                 case _:
                     atomic_print(std_out_lock, 'Invalid command')
             sleep(0.2)
@@ -91,7 +105,7 @@ class Client:
             message = self.protocol.encode(
                 action, self.message_counter, {'username': username})
             self.message_counter += 1
-            self.client_library.send(message)
+            self.client_library.send(message, username)
         else:
             atomic_print(
                 std_out_lock, 'Invalid username. Username must be between 5 and 20 characters and only contain letters and numbers.')
@@ -106,7 +120,7 @@ class Client:
         message = self.protocol.encode(
             'LIST_ACCOUNTS', self.message_counter, {'query': query})
         self.message_counter += 1
-        self.client_library.send(message)
+        self.client_library.send(message, self.username)
 
     def _send_message(self):
         """
@@ -118,7 +132,47 @@ class Client:
         message = self.protocol.encode(
             'SEND_MESSAGE', self.message_counter, {'recipient': user, 'message': user_msg})
         self.message_counter += 1
-        self.client_library.send(message)
+        self.client_library.send(message, self.username)
+
+    def _send_group_message(self):
+        """
+        Handles sending a send group message request to the server
+        """
+        # Get recipient usernames and message and send
+        users = input('Enter recipient usernames, separated by commas: ')
+        user_msg = input('Enter message: ')
+        recipients = ';'.join(user.strip() for user in users.split(',') if user.strip())
+        message = self.protocol.encode(
+            'SEND_GROUP_MESSAGE', self.message_counter, {'recipients': recipients, 'message': user_msg})
+        self.message_counter += 1
+        self.client_library.send(message, self.username)
+
+    def _subscribe_presence(self):
+        """
+        Handles subscribing to the accounts created, deleted, logging in and logging off, which the servers push
+        instead of having to list accounts again. A new subscription replaces the previous one.
+        """
+        users = input('Enter usernames to watch, separated by commas: ')
+        query = input('Enter query of accounts to watch (blank for none): ')
+        usernames = ';'.join(user.strip() for user in users.split(',') if user.strip())
+        message = self.protocol.encode(
+            'SUBSCRIBE_PRESENCE', self.message_counter, {'usernames': usernames, 'query': query})
+        self.message_counter += 1
+        self.client_library.subscribe(message)
+
+    def _get_history(self):
+        """
+        Handles requesting a page of the history of a conversation. Showing the history of the same conversation
+        again shows the next older page, until there are no older messages.
+        """
+        peer = input('Enter username of the conversation: ')
+        before = self.history_cursors.get(peer, '')
+        if before and input('Show older messages? (y/n): ').strip().lower() != 'y':
+            before = ''
+        message = self.protocol.encode(
+            'GET_HISTORY', self.message_counter, {'peer': peer, 'before': before, 'limit': HISTORY_PAGE_SIZE})
+        self.message_counter += 1
+        self.client_library.send(message, self.username)
 
     def _logoff(self):
         """
@@ -127,7 +181,7 @@ class Client:
         message = self.protocol.encode(
             'LOG_OFF', self.message_counter)
         self.message_counter += 1
-        self.client_library.send(message)
+        self.client_library.send(message, self.username)
 
     def _delete_account(self):
         """
@@ -136,7 +190,7 @@ class Client:
         message = self.protocol.encode(
             'DELETE_ACCOUNT', self.message_counter)
         self.message_counter += 1
-        self.client_library.send(message)
+        self.client_library.send(message, self.username)
 
     def process_operation_curry(self, out_lock):
         """Processes the operation. This is a curried function to work with the
@@ -202,6 +256,50 @@ class Client:
                 case 13:  # Receive message
                     atomic_print(
                         out_lock, f"Message from {args['sender']}: {args['message']} \n\n{self._get_prompt()}")
+                case 25:  # Receive a batch of messages
+                    recipient = args['recipient']
+                    new_messages = self.client_library.receive_messages(
+                        recipient, int(args['first_id']), self.protocol.unpack_messages(args['messages']))
+                    if new_messages:
+                        received = [f"Message from {sender}: {message} \n" for (sender, message) in new_messages]
+                        atomic_print(out_lock, f"{''.join(received)}\n{self._get_prompt()}")
+                    # Acknowledge every message received so far, once it has been shown
+                    message = self.protocol.encode('ACK_MESSAGES', self.message_counter, {
+                        'recipient': recipient, 'message_id': self.client_library.received_ids[recipient]})
+                    self.message_counter += 1
+                    self.client_library.send(message, recipient)
+                case 29:  # Send group message response
+                    if not args['status'] == "Success":
+                        atomic_print(out_lock, args['status'])
+                    elif args['failed']:
+                        failed = ', '.join(args['failed'].split(';'))
+                        atomic_print(out_lock, f"Message could not be sent to: {failed}")
+                case 31:  # Server busy
+                    atomic_print(out_lock, args['status'])
+                case 36:  # Subscribe presence response, from every replica group
+                    if args['status'] == "Success":
+                        online = set(args['online'].split(';'))
+                        watched = [f"{account} ({'online' if account in online else 'offline'})"
+                                   for account in args['accounts'].split(';') if account]
+                        if watched:
+                            atomic_print(out_lock, "Watching:\n" + '\n'.join(watched))
+                    else:
+                        atomic_print(out_lock, args['status'])
+                case 37:  # Presence event
+                    atomic_print(
+                        out_lock, f"{args['username']} is {PRESENCE_EVENTS.get(args['event'], args['event'])} \n\n{self._get_prompt()}")
+                case 39:  # Message history response
+                    if args['status'] == "Success":
+                        self.history_cursors[args['peer']] = args['next']
+                        timestamps = [int(timestamp) for timestamp in args['timestamps'].split(',') if timestamp]
+                        lines = [f"[{datetime.fromtimestamp(timestamp / 1_000_000):%Y-%m-%d %H:%M:%S}] {sender}: {message}"
+                                 for (timestamp, (sender, message))
+                                 in zip(timestamps, self.protocol.unpack_messages(args['messages']))]
+                        if args['next']:
+                            lines.insert(0, "(older messages: show the history again)")
+                        atomic_print(out_lock, '\n'.join(lines) if lines else f"No messages with {args['peer']}.")
+                    else:
+                        atomic_print(out_lock, args['status'])
         return process_operation
 
 
@@ -1,33 +1,62 @@
 
 from uuid import uuid4
 import socket
+import threading
 import protocol
+from utils import transport
+from utils.sharding import shard_of
 
 
 class ClientReplicaLibrary:
     def __init__(self, protocol, server_configs):
+        """
+        Args:
+            protocol (Protocol): Protocol used to talk to the servers.
+            server_configs (list): Configs of the servers of one replica group, or a list of them for every
+                replica group when accounts are sharded across several.
+        """
         self.sockets = {}
-        self.primary = None
+        # Map of replica group index to the socket of its primary
+        self.primaries = {}
         self.protocol = protocol
+        # Requests and acknowledgements are sent from different threads
+        self.send_lock = threading.Lock()
+        # Map of recipient username to the id of the newest message received for it
+        self.received_ids = {}
+        # The encoded presence subscription, sent again to new primaries
+        self.subscription = None
 
-        self.config = [(config['host'], config['port'], config['id'])
-                       for config in server_configs]
+        if server_configs and isinstance(server_configs[0], dict):
+            server_configs = [server_configs]
+        self.groups = [[(config['host'], config.get('port'), config['id']) for config in servers]
+                       for servers in server_configs]
+
+    @property
+    def config(self):
+        """(host, port, id) of every server of every replica group."""
+        return [server for servers in self.groups for server in servers]
+
+    @property
+    def primary(self):
+        """Socket of the primary of the first replica group, which gets the requests of clients not logged in."""
+        return self.primaries.get(0)
 
     def connect_to_service(self, msg_counter, uuid):
         """Connect to each server in the config and register the client."""
         msg_count = msg_counter
         print("Connecting...")
         for host, port, id in self.config:
-            this_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            this_socket = transport.create_socket(host)
             try:
-                this_socket.connect((host, port))
+                this_socket.connect(transport.socket_address(host, port))
             except:
-                print(f"Couldn't connect to server at {host}:{port}.")
+                print(f"Couldn't connect to server at {transport.describe(host, port)}.")
             try:
                 self.protocol.send(this_socket, self.protocol.encode(
-                    'REGISTER_CLIENT_UUID', msg_count, {'uuid': uuid}))
+                    'REGISTER_CLIENT_UUID', msg_count, {'uuid': uuid, 'versions': protocol.ADVERTISED_VERSIONS,
+                                                        'compression': protocol.ADVERTISED_COMPRESSION}))
             except:
-                print(f"Couldn't register client to server at {host}:{port}.")
+                print(f"Couldn't register client to server at {transport.describe(host, port)}.")
                 continue
             msg_count += 1
 
@@ -35,35 +64,55 @@ class ClientReplicaLibrary:
             # Set primary correctly
         if (len(self.sockets) == 0):
             raise ConnectionError("Connection Failed")
-        return self._get_primary(msg_count)
+        for group in range(len(self.groups)):
+            msg_count = self._get_primary(group, msg_count)
+        return msg_count
 
     def disconnect(self):
-        for socket in self.sockets.values:
+        for socket in self.sockets.values():
             socket.close()
 
     def readFromServer(self, process_operation):
-        while not self.primary is None:
-            value = self.protocol.read_packets(self.primary, process_operation)
+        """Read the messages from the primary of every replica group, each group on a thread of its own, until
+        they are all gone."""
+        threads = [threading.Thread(target=self._read_group, args=(group, process_operation), daemon=True)
+                   for group in range(1, len(self.groups))]
+        for thread in threads:
+            thread.start()
+        self._read_group(0, process_operation)
+        for thread in threads:
+            thread.join()
+        self.disconnect()
+        print("Disconnected from server")
+
+    def _read_group(self, group, process_operation):
+        group_sockets = [self.sockets[id] for (_, _, id) in self.groups[group] if id in self.sockets]
+        while not self.primaries.get(group) is None:
+            value = self.protocol.read_packets(self.primaries[group], process_operation)
             print(value)
             if (value is None):
                 print("Changing primary")
-                self.primary = None
-                for socket in self.sockets.values():
+                self.primaries[group] = None
+                for socket in group_sockets:
                     ack = self.protocol.read_small_packets(socket)
                     if (ack is None):
                         continue
                     else:
                         (md, msg) = ack
-                        self.primary = self.sockets[int(
+                        self.primaries[group] = self.sockets[int(
                             self.protocol.parse_data(md.operation_code, msg)['id'])]
-                        print(f"New primary {self.primary}")
+                        print(f"New primary {self.primaries[group]}")
+                        # Subscriptions are kept by the server they were made on
+                        if self.subscription is not None:
+                            self.protocol.send(self.primaries[group], self.subscription, self.send_lock)
                         break
-        self.disconnect()
-        print("Disconnected from server")
 
-    def _get_primary(self, msg_counter):
+    def _get_primary(self, group, msg_counter):
         msg_count = msg_counter
-        for socket in self.sockets.values():
+        for (_, _, id) in self.groups[group]:
+            if id not in self.sockets:
+                continue
+            socket = self.sockets[id]
             self.protocol.send(socket, self.protocol.encode(
                 'GET_PRIMARY', msg_count))
             msg_count += 1
@@ -72,12 +121,47 @@ class ClientReplicaLibrary:
                 continue
             else:
                 (md, msg) = ack
-                self.primary = self.sockets[int(
+                self.primaries[group] = self.sockets[int(
                     self.protocol.parse_data(md.operation_code, msg)['id'])]
                 print(int(self.protocol.parse_data(
                     md.operation_code, msg)['id']))
                 break
         return msg_count
 
-    def send(self, message):
-        self.protocol.send(self.primary, message)
+    def send(self, message, username=None):
+        """Send a request to the primary of the replica group holding an account.
+
+        Args:
+            message (List[bytes]): The encoded request.
+            username (str, optional): The account the request is about: the account logging in or being created,
+                or else the account logged in. Requests of clients not logged in go to the first replica group.
+        """
+        group = shard_of(username, len(self.groups)) if username else 0
+        self.protocol.send(self.primaries.get(group), message, self.send_lock)
+
+    def subscribe(self, message):
+        """Send a presence subscription to the primary of every replica group, each of which pushes the events of
+        its own accounts, and again to every new primary.
+
+        Args:
+            message (List[bytes]): The encoded SUBSCRIBE_PRESENCE request.
+        """
+        self.subscription = message
+        for group in range(len(self.groups)):
+            self.protocol.send(self.primaries.get(group), message, self.send_lock)
+
+    def receive_messages(self, recipient, first_id, message_infos):
+        """Record a batch of messages received for an account, and drop the ones received before. Messages not
+        acknowledged yet are sent again when the account logs in again and when a new primary takes over.
+
+        Args:
+            recipient (str): The account the messages are for.
+            first_id (int): The message id of the first message of the batch, the others following on from it.
+            message_infos (List[Tuple[str, str]]): The (sender, message) pairs of the batch.
+
+        Returns:
+            List[Tuple[str, str]]: The messages not received before.
+        """
+        received_id = self.received_ids.get(recipient, -1)
+        self.received_ids[recipient] = max(received_id, first_id + len(message_infos) - 1)
+        return message_infos[max(received_id + 1 - first_id, 0):]
@@ -1,8 +1,12 @@
+import collections
 from enum import Enum
 import errno
+import itertools
 import select
 import socket
-from typing import Callable, Dict, List
+import time
+import zlib
+from typing import Callable, Dict, Iterator, List, Tuple
 import logging
 
 METADATA_SIZES = {
@@ -13,10 +17,52 @@ METADATA_SIZES = {
     "payload_size": 2,
     "message_id": 2,
 }
+# Header of version 2, with wide ids and sizes for large packets, and flags describing the payload
+METADATA_SIZES_V2 = {
+    "version": 1,
+    "header_length": 1,
+    "operation_code": 1,
+    "flags": 1,
+    "message_size": 4,
+    "payload_size": 4,
+    "message_id": 8,
+}
+# Header layout of every version this module reads. Fields are on the wire in the order of their layout
+HEADER_LAYOUTS = {1: METADATA_SIZES, 2: METADATA_SIZES_V2}
+# Versions advertised to the other side of a connection, as the 'versions' argument of REGISTER_CLIENT_UUID or
+# HEARTBEAT
+ADVERTISED_VERSIONS = ','.join(map(str, HEADER_LAYOUTS))
 
 METADATA_LENGTH = sum(METADATA_SIZES.values())
+METADATA_LENGTHS = {version: sum(sizes.values()) for (version, sizes) in HEADER_LAYOUTS.items()}
+# Size of the packets of version 1, header included
 MAX_PACKET_SIZE = 2048
 MAX_PAYLOAD_SIZE = MAX_PACKET_SIZE - METADATA_LENGTH
+# Default and largest size of the packets of version 2 and later, header included. Packets are read up to the
+# largest size whatever the size the reader writes
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+MAX_FRAME_SIZE_LIMIT = 16 * 1024 * 1024
+# Bytes read from a socket at once
+RECV_SIZE = 64 * 1024
+# Flags of version 2 headers. Compressed messages are zlib streams of message_size bytes, set on every packet of
+# the message, and the dictionary flag marks the ones compressed with REPLICATION_DICTIONARY
+FLAG_COMPRESSED = 0x01
+FLAG_DICTIONARY = 0x02
+# Compression methods in the order they are picked when the other side reads several, written in the 'compression'
+# argument next to 'versions'. Only headers of version 2 and later can flag compressed messages
+COMPRESSION_METHODS = ['zlib-dict', 'zlib']
+# Compression advertised by clients, and by the replica channels between servers
+ADVERTISED_COMPRESSION = 'zlib'
+REPLICATION_COMPRESSION = 'zlib-dict,zlib'
+# Encoded messages shorter than this are written as they are
+DEFAULT_COMPRESSION_THRESHOLD = 64
+COMPRESSION_LEVEL = 1
+# Largest message a compressed message may decompress to
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+# Characters of packed messages in one RECV_MESSAGES message, which is split into packets like any other message
+MAX_BATCH_SIZE = 64 * 1024
+# Buffers passed to one sendmsg call, within the IOV_MAX of every common platform
+MAX_SEND_BUFFERS = 1024
 VERSION = 1
 
 
@@ -45,6 +91,22 @@ class OperationCode(Enum):
     ACK = 22
     HEARTBEAT = 23
     GET_PRIMARY_RESPONSE = 24
+    RECV_MESSAGES = 25
+    ACK_MESSAGES = 26
+    UPDATE_MESSAGE_ACK = 27
+    SEND_GROUP_MESSAGE = 28
+    SEND_GROUP_MESSAGE_RESPONSE = 29
+    UPDATE_GROUP_MESSAGE_STATE = 30
+    BUSY = 31
+    FORWARD_MESSAGE = 32
+    FORWARD_GROUP_MESSAGE = 33
+    LIST_LOCAL_ACCOUNTS = 34
+    SUBSCRIBE_PRESENCE = 35
+    SUBSCRIBE_PRESENCE_RESPONSE = 36
+    PRESENCE_EVENT = 37
+    GET_HISTORY = 38
+    GET_HISTORY_RESPONSE = 39
+    GET_LOCAL_HISTORY = 40
 
 
 # Necessary arguments needed for each operation
@@ -73,7 +135,52 @@ OPERATION_ARGS = {
     'ACK': [],
     'HEARTBEAT': [],
     'GET_PRIMARY_RESPONSE': ['id'],
+    'RECV_MESSAGES': ['recipient', 'first_id', 'messages'],
+    'ACK_MESSAGES': ['recipient', 'message_id'],
+    'UPDATE_MESSAGE_ACK': ['recipient', 'message_id'],
+    'SEND_GROUP_MESSAGE': ['recipients', 'message'],
+    'SEND_GROUP_MESSAGE_RESPONSE': ['status', 'failed'],
+    'UPDATE_GROUP_MESSAGE_STATE': ['recipients', 'sender', 'message'],
+    'BUSY': ['operation', 'status'],
+    'FORWARD_MESSAGE': ['recipient', 'sender', 'message'],
+    'FORWARD_GROUP_MESSAGE': ['recipients', 'sender', 'message'],
+    'LIST_LOCAL_ACCOUNTS': ['query'],
+    'SUBSCRIBE_PRESENCE': ['usernames', 'query'],
+    'SUBSCRIBE_PRESENCE_RESPONSE': ['status', 'accounts', 'online'],
+    'PRESENCE_EVENT': ['event', 'username'],
+    'GET_HISTORY': ['peer', 'before', 'limit'],
+    'GET_HISTORY_RESPONSE': ['status', 'peer', 'timestamps', 'messages', 'next'],
+    'GET_LOCAL_HISTORY': ['username', 'peer', 'before', 'limit'],
 }
+# Arguments an operation may go without. Peers that don't know them ignore them
+OPTIONAL_OPERATION_ARGS = {
+    'REGISTER_CLIENT_UUID': ['versions', 'compression'],
+    'HEARTBEAT': ['versions', 'compression', 'names'],
+    'ACK': ['compression', 'names'],
+    'UPDATE_MESSAGE_STATE': ['timestamp'],
+    'UPDATE_GROUP_MESSAGE_STATE': ['timestamp'],
+}
+# Arguments of the replicated updates holding account names, with the separator of the names of a list. Once a
+# replication connection negotiated it with the 'names' argument of HEARTBEAT, they are sent as ids, see
+# utils.replicated_names
+NAME_ARGS = {
+    'UPDATE_ACCOUNT_STATE': {'username': None},
+    'UPDATE_LOGIN_STATE': {'username': None},
+    'UPDATE_MESSAGE_STATE': {'recipient': None, 'sender': '\r'},
+    'UPDATE_MESSAGE_ACK': {'recipient': None},
+    'UPDATE_GROUP_MESSAGE_STATE': {'recipients': ';', 'sender': None},
+}
+
+# Preset dictionary of the 'zlib-dict' compression, made of the arguments of the replicated updates. Replicated
+# messages are compressed one at a time, so without it every message would start from an empty window. zlib finds
+# the end of the dictionary cheapest to refer to, so the most common strings come last
+REPLICATION_DICTIONARY = '\r'.join(
+    [f"{key}=" for operation in ['UPDATE_ACCOUNT_STATE', 'UPDATE_LOGIN_STATE', 'UPDATE_MESSAGE_ACK',
+                                 'UPDATE_GROUP_MESSAGE_STATE', 'FORWARD_MESSAGE', 'SEND_GROUP_MESSAGE_RESPONSE']
+     for key in OPERATION_ARGS[operation]]
+    + ['status=Success', 'add_flag=True', 'add_flag=False', 'add_one=False',
+       'add_one=True\rrecipient=', '\rsender=', '\rmessage=', ' the ', ' you ', ' to ', ' and ', '. ', ', ', '? ']
+).encode('ascii')
 
 
 class Message:
@@ -91,8 +198,9 @@ class Message:
 
 class Metadata:
     def __init__(self, version: bytes, header_length: bytes, operation_code: bytes,
-                 message_size: bytes, payload_size: bytes, message_id: bytes) -> None:
+                 message_size: bytes, payload_size: bytes, message_id: bytes, flags: bytes = b'') -> None:
         self.version = int.from_bytes(version, 'big')
+        self.flags = int.from_bytes(flags, 'big')
         self.header_length = int.from_bytes(header_length, 'big')
         self.operation_code = OperationCode(
             int.from_bytes(operation_code, 'big'))
@@ -102,18 +210,83 @@ class Metadata:
 
 
 class Protocol:
-    def __init__(self, version: int, metadata_sizes: Dict[str, int]) -> None:
+    """Encoding of messages into packets of one version of the header, and decoding of packets of any version.
+
+    Every packet starts with its version and the length of the rest of its header, so a connection may carry
+    packets of different versions. Each side writes version 1 until the other side advertises a later version it
+    reads, in the 'versions' argument of REGISTER_CLIENT_UUID or HEARTBEAT, and the side that advertised may write
+    the later version once it has received a packet of it. Compression is advertised the same way in the
+    'compression' argument, and the answer to a HEARTBEAT names the method picked for the connection."""
+    def __init__(self, version: int, metadata_sizes: Dict[str, int],
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, compression: str = None,
+                 compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD) -> None:
+        """
+        Args:
+            version (int): Version of the packets written.
+            metadata_sizes (Dict[str, int]): Header layout of the version.
+            max_frame_size (int, optional): Size of the packets written with version 2 and later, header included.
+                Packets of version 1 are MAX_PACKET_SIZE.
+            compression (str, optional): Method of COMPRESSION_METHODS messages are compressed with, which needs
+                the flags of version 2 headers. Defaults to None, for no compression.
+            compression_threshold (int, optional): Size from which encoded messages are compressed. None never
+                negotiates compression, though compressed messages are still read.
+        """
+        if not METADATA_LENGTHS[2] < max_frame_size <= MAX_FRAME_SIZE_LIMIT:
+            raise ValueError(f"max_frame_size must be between {METADATA_LENGTHS[2] + 1} and {MAX_FRAME_SIZE_LIMIT}")
+        if compression is not None and (compression not in COMPRESSION_METHODS or 'flags' not in metadata_sizes):
+            raise ValueError(f"Can't compress with {compression} in packets of version {version}")
         self.version = version
         self.metadata_sizes = metadata_sizes
         self.header_length = self._get_header_length()
+        self.max_frame_size = max_frame_size
+        packet_size = MAX_PACKET_SIZE if version == 1 else max_frame_size
+        self.max_payload_size = packet_size - sum(metadata_sizes.values())
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        # Protocols of the other versions and compression methods with the same frame size and threshold
+        self.variants = {(version, compression): self}
 
         self.separator = '\r'
 
     def _get_header_length(self) -> int:
-        return self.metadata_sizes['operation_code'] + \
-            self.metadata_sizes['message_size'] + \
-            self.metadata_sizes['payload_size'] + \
-            self.metadata_sizes['message_id']
+        # Bytes of the header after the version and header length
+        return sum(size for (component, size) in self.metadata_sizes.items()
+                   if component not in ('version', 'header_length'))
+
+    def _variant(self, version: int, compression: str) -> 'Protocol':
+        if (version, compression) not in self.variants:
+            variant = Protocol(version, HEADER_LAYOUTS[version], self.max_frame_size, compression,
+                               self.compression_threshold)
+            variant.variants = self.variants
+            self.variants[(version, compression)] = variant
+        return self.variants[(version, compression)]
+
+    def with_version(self, version: int) -> 'Protocol':
+        """Return the protocol writing packets of a version, with the same frame size and compression. Version 1
+        packets are never compressed."""
+        return self._variant(version, self.compression if 'flags' in HEADER_LAYOUTS[version] else None)
+
+    def with_compression(self, compression: str) -> 'Protocol':
+        """Return the protocol compressing messages with a method of COMPRESSION_METHODS, or None for no
+        compression, in packets of the same version. Packets without flags are never compressed."""
+        if compression not in COMPRESSION_METHODS or 'flags' not in self.metadata_sizes:
+            compression = None
+        return self._variant(self.version, compression)
+
+    def negotiate(self, versions: str, compression: str = '') -> 'Protocol':
+        """Return the protocol to write to the other side of a connection, of the latest version both sides read,
+        and compressing with the first method the other side reads if the version can flag compressed messages.
+
+        Args:
+            versions (str): The versions the other side advertised, separated by commas.
+            compression (str, optional): The compression methods the other side advertised, separated by commas.
+        """
+        common = set(HEADER_LAYOUTS).intersection(int(version) for version in versions.split(',') if version)
+        protocol = self.with_version(max(common, default=1))
+        methods = [method for method in compression.split(',') if method in COMPRESSION_METHODS]
+        if self.compression_threshold is None or not methods:
+            return protocol.with_compression(None)
+        return protocol.with_compression(methods[0])
 
     def encode(self, operation: OperationCode, message_id: int, operation_args={}) -> List[bytes]:
         """Encode an operation into a list of byte packets to be sent to the server.
@@ -137,8 +310,9 @@ class Protocol:
             raise ValueError(
                 f"Missing arguments for operation {operation}. Required arguments: {OPERATION_ARGS[operation]}")
         # Join keyword arguments with separator
+        known_args = OPERATION_ARGS[operation] + OPTIONAL_OPERATION_ARGS.get(operation, [])
         data = self.separator.join(
-            [f"{key}={value}" if key in OPERATION_ARGS[operation] else "" for key, value in operation_args.items()])
+            [f"{key}={value}" if key in known_args else "" for key, value in operation_args.items()])
         data += '\n'
 
         # Encode metadata and data into byte packets (may be multiple packets for large messages)
@@ -159,18 +333,26 @@ class Protocol:
         """
         # Encode data
         encoded_data = self._encode_data(data)
+        flags = 0
+        if self.compression is not None and len(encoded_data) >= self.compression_threshold:
+            (compressed, compression_flags) = self._compress(encoded_data)
+            # Data that doesn't shrink is written as it is
+            if len(compressed) < len(encoded_data):
+                (encoded_data, flags) = (compressed, compression_flags)
         # Encode metadata
         bytes = bytearray(self._encode_component('version', self.version))
         bytes.extend(self._encode_component(
             'header_length', self.header_length))
         bytes.extend(self._encode_component('operation_code', operation))
+        if 'flags' in self.metadata_sizes:
+            bytes.extend(self._encode_component('flags', flags))
         bytes.extend(self._encode_component('message_size', len(encoded_data)))
 
         encoded_payloads = []
 
-        # Split into payloads of MAX_PAYLOAD_SIZE bytes, all with same common metadata
-        for i in range(0, len(encoded_data), MAX_PAYLOAD_SIZE):
-            payload = encoded_data[i:i+MAX_PAYLOAD_SIZE]
+        # Split into payloads of max_payload_size bytes, all with same common metadata
+        for i in range(0, len(encoded_data), self.max_payload_size):
+            payload = encoded_data[i:i+self.max_payload_size]
             # Calculate payload size for this specific payload
             payload_bytes = bytes + \
                 self._encode_component('payload_size', len(payload))
@@ -184,93 +366,204 @@ class Protocol:
         return encoded_payloads
 
     def _encode_component(self, component: str, value: int) -> bytes:
+        if component == 'message_id':
+            # Ids wrap around to fit the header
+            value %= 1 << (8 * self.metadata_sizes[component])
         return value.to_bytes(self.metadata_sizes[component], byteorder='big')
 
     def _encode_data(self, data: str) -> bytes:
         return data.encode('ascii')
 
-    def send(self, client_socket, message: List[bytes], socket_lock=None) -> bool:
-        """Send a list of encoded packets to the client_socket
+    def _compress(self, data: bytes) -> Tuple[bytes, int]:
+        """Compress encoded data with the protocol's compression method.
+
+        Returns:
+            Tuple[bytes, int]: The compressed data and the flags of its packets.
+        """
+        if self.compression == 'zlib-dict':
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=REPLICATION_DICTIONARY)
+            return (compressor.compress(data) + compressor.flush(), FLAG_COMPRESSED | FLAG_DICTIONARY)
+        return (zlib.compress(data, COMPRESSION_LEVEL), FLAG_COMPRESSED)
+
+    def _decode_message(self, metadata: Metadata, payload: bytes) -> str:
+        """Decode the whole payload of a message, decompressing it first if its packets are flagged compressed.
+
+        Raises:
+            ValueError: The payload is not ascii, or decompresses to more than MAX_DECOMPRESSED_SIZE.
+            zlib.error: The payload is not a valid compressed stream.
+        """
+        if metadata.flags & FLAG_COMPRESSED:
+            if metadata.flags & FLAG_DICTIONARY:
+                decompressor = zlib.decompressobj(zdict=REPLICATION_DICTIONARY)
+            else:
+                decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError("Invalid compressed message")
+        return payload.decode('ascii')
+
+    def send(self, client_socket, message: List[bytes], socket_lock=None, timeout: float = None) -> bool:
+        """Send a list of encoded packets to the client_socket. The lock is held until every packet is written, so
+        packets of messages sent by other threads never come between them.
 
         Args:
             client_socket (socket.socket): The socket to send the packets to
             message (List[bytes]): List of bytes to send to the client_socket, each representing a packet
             socket_lock (threading.Lock, optional): Thread lock for client if needed. Defaults to None.
+            timeout (float, optional): Seconds to wait for the socket to accept all the packets. Defaults to None,
+                which waits forever.
 
         Returns:
             bool: True if all packets were sent successfully, False otherwise
         """
-        for packet in message:
-            status = self._send_one_packet(
-                client_socket, packet, socket_lock)
-            if not status:
-                return False
-        return True
+        return self.send_many(client_socket, [message], socket_lock, timeout)
+
+    def send_many(self, client_socket, messages: List[List[bytes]], socket_lock=None, timeout: float = None) -> bool:
+        """Send several encoded messages to the client_socket in order, holding the lock once for all of them. The
+        packets are written together with vectored sends, so a batch of small messages takes a single system call.
+
+        Args:
+            client_socket (socket.socket): The socket to send the messages to
+            messages (List[List[bytes]]): Messages to send, each a list of packets as returned by encode
+            socket_lock (threading.Lock, optional): Thread lock for client if needed. Defaults to None.
+            timeout (float, optional): Seconds to wait for the socket to accept every message. Defaults to None,
+                which waits forever.
+
+        Returns:
+            bool: True if every message was sent successfully, False otherwise
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        packets = [packet for message in messages for packet in message]
+        if socket_lock is None:
+            return self._send_packets(client_socket, packets, deadline)
+        with socket_lock:
+            return self._send_packets(client_socket, packets, deadline)
 
     def read_small_packets(self, client_socket):
+        """Read a message that fits in a single packet, of any version.
+
+        Returns:
+            tuple: (metadata, message), or None if the connection was lost or the packet is invalid.
+        """
         try:
-            md = bytes()
-            while (len(md) < METADATA_LENGTH):
-                if (METADATA_LENGTH - len(md) > 0):
-                    mdToAdd = client_socket.recv(METADATA_LENGTH - len(md))
-                    if (int.from_bytes(mdToAdd, 'big') <= 0):
-                        # Socket disconnected
-                        return None
-                    md += mdToAdd
-            packet_md = self.parse_metadata(md)
-            payload = bytes()
-            while (len(payload) < packet_md.payload_size):
-                if (packet_md.payload_size - len(payload) > 0):
-                    payloadToAdd = client_socket.recv(
-                        packet_md.payload_size - len(payload))
-                    if (int.from_bytes(payloadToAdd, 'big') <= 0):
-                        # Socket disconnected
-                        return None
-                    payload += payloadToAdd
-            return (packet_md, payload.decode('ascii')[:-1])
+            md = self._recv_exactly(client_socket, 1)
+            if md is None or md[0] not in HEADER_LAYOUTS:
+                return None
+            rest = self._recv_exactly(client_socket, METADATA_LENGTHS[md[0]] - 1)
+            if rest is None:
+                return None
+            packet_md = self.parse_metadata(md + rest)
+            if packet_md.payload_size > MAX_FRAME_SIZE_LIMIT:
+                return None
+            payload = self._recv_exactly(client_socket, packet_md.payload_size)
+            if payload is None:
+                return None
+            return (packet_md, self._decode_message(packet_md, payload)[:-1])
         except:
             return None
 
-    def _send_one_packet(self, client_socket, packet: bytes, socket_lock=None) -> bool:
-        """Send a single of encoded packet to the client_socket
+    def _recv_exactly(self, client_socket, size: int):
+        """Read size bytes off the socket, or return None if the connection was lost first."""
+        received = bytearray()
+        while len(received) < size:
+            data = client_socket.recv(size - len(received))
+            if not data:
+                # Socket disconnected
+                return None
+            received += data
+        return bytes(received)
+
+    def _send_packets(self, client_socket, packets: List[bytes], deadline: float = None) -> bool:
+        """Write packets to the client_socket with as few system calls as possible. Call with the socket's lock held.
 
         Args:
             client_socket (socket.socket): The socket to send the packets to
-            packet (bytes): Bytes to send to the client_socket, representing a packet
-            socket_lock (threading.Lock, optional): Thread lock for client if needed. Defaults to None.
+            packets (List[bytes]): Packets to send, in order
+            deadline (float, optional): time.monotonic() by which the packets must be sent. Defaults to None.
 
         Returns:
-            bool: True if the packet was sent successfully, False otherwise
+            bool: True if the packets were sent successfully, False otherwise
         """
-        if socket_lock is not None:
-            socket_lock.acquire()
-        total_sent = 0
-        # Send the packet in chunks until all bytes are sent
-        while total_sent < len(packet):
+        if not hasattr(client_socket, 'sendmsg'):
+            # Sockets without scatter-gather sends, such as on Windows, get the packets joined into one buffer
+            packets = [b''.join(packets)]
+        buffers = collections.deque(memoryview(packet) for packet in packets if packet)
+        # Never block in send with a deadline, so a full socket buffer is waited on below with the time left
+        flags = 0 if deadline is None else getattr(socket, 'MSG_DONTWAIT', 0)
+        # Send the buffers until all bytes are sent, dropping the ones written by each call
+        while buffers:
             try:
-                bytes_sent = client_socket.send(packet, MAX_PACKET_SIZE)
+                if hasattr(client_socket, 'sendmsg'):
+                    bytes_sent = client_socket.sendmsg(list(itertools.islice(buffers, MAX_SEND_BUFFERS)), (), flags)
+                else:
+                    bytes_sent = client_socket.send(buffers[0], flags)
                 if bytes_sent == 0:
                     # Socket connection broken
-                    if socket_lock is not None:
-                        socket_lock.release()
                     return False
-                total_sent += bytes_sent
+                while buffers and bytes_sent >= len(buffers[0]):
+                    bytes_sent -= len(buffers.popleft())
+                if bytes_sent:
+                    buffers[0] = buffers[0][bytes_sent:]
             except socket.error as e:
-                # For nonblocking sockets, EAGAIN and EWOULDBLOCK are raised when there is no data to write
-                # so we just need to wait for more data This code actually will never run because we are now using
-                # blocking sockets.
+                # For nonblocking sends, EAGAIN and EWOULDBLOCK are raised when the socket buffer is full
+                # so we just need to wait for it to drain. The sockets are blocking, so this only happens when
+                # sending with a deadline.
                 if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
                     # Socket connection broken, unknown error
-                    if socket_lock is not None:
-                        socket_lock.release()
                     return False
                 # Wait for client_socket until ready for writing
-                select.select([], [client_socket], [])
+                if deadline is None:
+                    select.select([], [client_socket], [])
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([], [client_socket], [], remaining)[1]:
+                        # Timed out, the packets may be partly sent
+                        return False
+        return True
 
-        if socket_lock is not None:
-            socket_lock.release()
+    def pack_messages(self, message_infos: List[Tuple[str, str]],
+                      max_size: int = MAX_BATCH_SIZE) -> Iterator[Tuple[int, str]]:
+        """Pack (sender, message) pairs into the messages argument of RECV_MESSAGES. A batch is the comma separated
+        lengths of its senders and messages, a colon, and then the senders and messages themselves one after another,
+        so nothing in a message can be mistaken for the next one and unpacking needs no per-character scanning.
+        Every pair is packed, even an empty one, so the message ids of a batch follow on from its first_id.
 
-        return True
+        Args:
+            message_infos (List[Tuple[str, str]]): The (sender, message) pairs in delivery order.
+            max_size (int, optional): Characters of senders and messages in one batch. A pair longer than this
+                gets a batch of its own.
+
+        Yields:
+            Tuple[int, str]: (count, packed) for every batch, where the batch holds the next count pairs.
+        """
+        lengths = []
+        fields = []
+        size = 0
+        count = 0
+        for (sender, message) in message_infos:
+            if fields and size + len(sender) + len(message) > max_size:
+                yield (count, f"{','.join(lengths)}:{''.join(fields)}")
+                lengths = []
+                fields = []
+                size = 0
+                count = 0
+            lengths.append(str(len(sender)))
+            lengths.append(str(len(message)))
+            fields.append(sender)
+            fields.append(message)
+            size += len(sender) + len(message)
+            count += 1
+        if count > 0:
+            yield (count, f"{','.join(lengths)}:{''.join(fields)}")
+
+    def unpack_messages(self, packed: str) -> List[Tuple[str, str]]:
+        """Unpack the messages argument of RECV_MESSAGES into (sender, message) pairs."""
+        if packed == "":
+            return []
+        (lengths, _, body) = packed.partition(':')
+        ends = list(itertools.accumulate(map(int, lengths.split(','))))
+        fields = [body[start:end] for (start, end) in zip([0] + ends, ends)]
+        return list(zip(fields[0::2], fields[1::2]))
 
     def parse_data(self, op: int, data: str) -> Dict[str, str]:
         """Parses the data string into a dictionary of keyword arguments for the given operation.
@@ -282,16 +575,20 @@ class Protocol:
         Returns:
             Dict[str, str]: Key-value pairs of keyword arguments
         """
+        operation = OperationCode(op).name
         kv_pairs = data.split(
-            self.separator, len(OPERATION_ARGS[OperationCode(op).name]))
+            self.separator, len(OPERATION_ARGS[operation]) + len(OPTIONAL_OPERATION_ARGS.get(operation, [])))
         kv_pairs = [kv_pair for kv_pair in kv_pairs if kv_pair]
         return dict(map(lambda x: tuple(x.split("=", 1)), kv_pairs))
 
     def parse_metadata(self, bytes: bytes) -> Metadata:
         """
-            Takes in a bytes object and parses the metadata at the beginning according to the specifications.
+            Takes in a bytes object and parses the metadata at the beginning according to the specifications of
+            the version in its first byte.
         """
-        return Metadata(bytes[0:1], bytes[1:2], bytes[2:3], bytes[3:6], bytes[6:8], bytes[8:10])
+        if bytes[0] == 1:
+            return Metadata(bytes[0:1], bytes[1:2], bytes[2:3], bytes[3:6], bytes[6:8], bytes[8:10])
+        return Metadata(bytes[0:1], bytes[1:2], bytes[2:3], bytes[4:8], bytes[8:12], bytes[12:20], bytes[3:4])
 
     def read_packets(self, client: socket.socket, message_processor: Callable) -> None:
         """Continuously reads packets from the client and calls message_processor on each completed message.
@@ -310,69 +607,61 @@ class Protocol:
         curr_op = -1
         msg_id_accum = 0
 
-        # Leftover bytes after the last complete packet in the last recv call.
-        # ALWAYS starts with a header (though may be incomplete).
-        left_over_packet = bytes()
-        running_msg = ""
+        # Bytes received and not parsed yet, which ALWAYS start with a header (though may be incomplete).
+        # Packets are parsed in place, and the parsed ones dropped once per recv call
+        buffer = bytearray()
+        running_msg = bytearray()
 
         # Infinite loop to read packets
         while True:
             try:
-                received_data = client.recv(MAX_PACKET_SIZE)
-                if (int.from_bytes(received_data, 'big') <= 0):
+                received_data = client.recv(RECV_SIZE)
+                if not received_data:
                     # Socket disconnected
                     return None
-                curr_msg_to_parse = left_over_packet + received_data
-                if (len(curr_msg_to_parse) < METADATA_LENGTH):
-                    left_over_packet = curr_msg_to_parse
-                else:
-                    # Keeps track of whether we should continue reading the next packet in this recv output
-                    # Set to false if we don't have the whole packet yet and need to wait for the rest
-                    continue_packet_iteration = True
-
-                    while continue_packet_iteration and len(curr_msg_to_parse) > METADATA_LENGTH:
-                        # Invariant here is that we at least have the metadata available
-                        packet_metadata = self.parse_metadata(
-                            curr_msg_to_parse)
-                        if packet_metadata.version != VERSION:
-                            return None
-                        else:
-                            # Read current packet's payload and add it to the running message
-                            curr_payload_size = packet_metadata.payload_size
-
-                            # Check if we have the whole packet
-                            if (len(curr_msg_to_parse[METADATA_LENGTH:]) < curr_payload_size):
-                                # We don't have the whole payload yet, so we need to wait to receive the next packet
-                                continue_packet_iteration = False
-                            else:
-                                # Whole packet available, parse payload size of the built up msg starting from after the metadata
-                                packet_to_parse = curr_msg_to_parse[METADATA_LENGTH:
-                                                                    curr_payload_size + METADATA_LENGTH]
-                                incomplete_msg = packet_to_parse.decode(
-                                    'ascii')
-                                # Check if this is a continuation of the current running message
-                                if (curr_msg_id == packet_metadata.message_id and curr_op == packet_metadata.operation_code):
-                                    running_msg += incomplete_msg
-                                else:
-                                    # Else this is a new message
-                                    running_msg = incomplete_msg
-                                    curr_msg_id = packet_metadata.message_id
-                                    curr_op = packet_metadata.operation_code
-                                # If running msg is done, then do something based on metadata
-                                if (running_msg[-1] == '\n'):
-                                    message_processor(client, packet_metadata, running_msg[:-1],
-                                                      msg_id_accum)
-                                    msg_id_accum += 1
-                                    curr_msg_id = -1
-                                    curr_op = -1
-                                    running_msg = ''
-                                # Once we've processed the current packet, we want to set the curr_msg_to_parse
-                                # to be the rest of the received, and then continue iterating to process the rest of the packets
-                                curr_msg_to_parse = curr_msg_to_parse[curr_payload_size +
-                                                                      METADATA_LENGTH:]
-                    left_over_packet = curr_msg_to_parse
+                buffer += received_data
+                offset = 0
+                while offset < len(buffer):
+                    # The version in the first byte of the header gives the length of the header
+                    if buffer[offset] not in METADATA_LENGTHS:
+                        return None
+                    metadata_length = METADATA_LENGTHS[buffer[offset]]
+                    if len(buffer) - offset <= metadata_length:
+                        # We don't have the whole header yet
+                        break
+                    packet_metadata = self.parse_metadata(buffer[offset:offset + metadata_length])
+                    if packet_metadata.payload_size > MAX_FRAME_SIZE_LIMIT:
+                        return None
+                    payload_end = offset + metadata_length + packet_metadata.payload_size
+                    if len(buffer) < payload_end:
+                        # We don't have the whole payload yet, so we need to wait to receive the next packet
+                        break
+                    incomplete_msg = buffer[offset + metadata_length:payload_end]
+                    # Check if this is a continuation of the current running message
+                    if (curr_msg_id == packet_metadata.message_id and curr_op == packet_metadata.operation_code):
+                        running_msg += incomplete_msg
+                    else:
+                        # Else this is a new message
+                        running_msg = incomplete_msg
+                        curr_msg_id = packet_metadata.message_id
+                        curr_op = packet_metadata.operation_code
+                    # If running msg is done, then do something based on metadata. Compressed messages are done
+                    # once all message_size bytes are in, and others end with a newline
+                    if packet_metadata.flags & FLAG_COMPRESSED:
+                        done = len(running_msg) >= packet_metadata.message_size
+                    else:
+                        done = running_msg[-1] == ord('\n')
+                    if done:
+                        message_processor(client, packet_metadata,
+                                          self._decode_message(packet_metadata, running_msg)[:-1], msg_id_accum)
+                        msg_id_accum += 1
+                        curr_msg_id = -1
+                        curr_op = -1
+                        running_msg = bytearray()
+                    # Continue with the rest of the received bytes
+                    offset = payload_end
+                del buffer[:offset]
             except:
                 return None
 
-
 protocol_instance = Protocol(VERSION, METADATA_SIZES)
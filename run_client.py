@@ -2,13 +2,14 @@ import client
 import protocol
 import sys
 import json
+from utils.sharding import group_configs
 
 if __name__ == '__main__':
     config_file = sys.argv[1]
     with open(config_file, 'r') as f:
         config = json.load(f)
     client_instance = client.Client(
-        protocol.protocol_instance, config['servers'])
+        protocol.protocol_instance, group_configs(config))
     try:
         client_instance.connect()
         client_instance.run()
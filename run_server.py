@@ -2,6 +2,13 @@ import server
 import json
 import protocol
 import sys
+from utils import file_storage
+from utils import record_file
+from utils import sqlite_storage
+from utils.storage import HistoryRetention, MessageLimits
+from utils.outbound_queue import OutboundLimits
+from utils.request_pool import AdmissionLimits
+from utils.sharding import group_configs, group_of_server
 
 
 if __name__ == '__main__':
@@ -9,8 +16,26 @@ if __name__ == '__main__':
     id = int(sys.argv[2])
     with open(config_file, 'r') as f:
         config = json.load(f)
+    durability = record_file.Durability(**config.get("durability", {}))
+    limits = MessageLimits(**config.get("message_limits", {}))
+    retention = HistoryRetention(**config.get("history_retention", {}))
+    outbound_limits = OutboundLimits(**config.get("outbound", {}))
+    admission_limits = AdmissionLimits(**config.get("admission", {}))
+    if config.get("storage", "file") == "sqlite":
+        storage = sqlite_storage.SqliteStorage(f"logs/server_{id}.db", durability, limits, retention)
+    else:
+        storage = file_storage.FileStorage("logs", durability, limits, retention)
+    groups = group_configs(config)
+    # Packets of the connections that negotiate header version 2 are up to max_frame_size bytes, and messages from
+    # compression_threshold bytes are compressed if the other side reads compressed messages. null turns it off
+    server_protocol = protocol.Protocol(protocol.VERSION, protocol.METADATA_SIZES,
+                                        config.get("max_frame_size", protocol.DEFAULT_MAX_FRAME_SIZE),
+                                        compression_threshold=config.get("compression_threshold",
+                                                                         protocol.DEFAULT_COMPRESSION_THRESHOLD))
     server = server.Server(
-        config["servers"], id, protocol.protocol_instance)
+        groups[group_of_server(groups, id)], id, server_protocol, storage, outbound_limits,
+        config.get("delivery_workers", server.DEFAULT_DELIVERY_WORKERS), admission_limits, groups,
+        config.get("worker_processes", server.DEFAULT_WORKER_PROCESSES))
     try:
         server.run()
     except KeyboardInterrupt:
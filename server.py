@@ -1,62 +1,168 @@
-import socket
 from time import sleep
 import time
 import protocol
 import threading
 import re
+import itertools
 import logging
-from utils import account_list
-from utils import logged_in_accounts
-from utils import undelivered_messages
+from utils import file_storage
+from utils import transport
+from utils.outbound_queue import DEFAULT_OUTBOUND_LIMITS, OutboundQueue, OutboundStats
+from utils.partitioned_messages import PartitionedMessages
+from utils.presence import PresenceHub
+from utils.replica_channel import ReplicaChannel
+from utils.replicated_names import NameDecoder
+from utils.request_pool import DEFAULT_ADMISSION_LIMITS, RequestPool
+from utils.sharding import ShardRouter, group_of_server, shard_of
+from utils.striped_lock import DEFAULT_STRIPES, StripedLock
+from utils.worker_processes import WorkerProcesses
+
+DEFAULT_DELIVERY_WORKERS = 1
+# Processes owning client connections besides the server's own, see WorkerProcesses
+DEFAULT_WORKER_PROCESSES = 0
+# Client requests run by the request pool. Everything else, such as registering a connection, finding the
+# primary and acknowledging messages, is cheap and runs on the thread reading the connection
+POOLED_OPERATIONS = {'CREATE_ACCOUNT', 'LIST_ACCOUNTS', 'SEND_MESSAGE', 'DELETE_ACCOUNT', 'LOG_IN', 'LOG_OFF',
+                     'SEND_GROUP_MESSAGE', 'SUBSCRIBE_PRESENCE', 'GET_HISTORY'}
+# Most messages in one page of GET_HISTORY
+MAX_HISTORY_PAGE = 100
 
 
 class Server:
-    def __init__(self, servers_config, server_id, protocol):
+    """Chat server, either the primary serving clients or a replica following it.
+
+    Locks are always taken in this order, and a lock is never held while waiting for a lock earlier in it:
+        1. user_locks, the stripes of every username a request reads and updates, through user_locks.hold.
+           They serialize the requests about a user, and are held while the update is replicated so every
+           replica applies a user's updates in the same order as this server.
+        2. account_list_lock, then logged_in_lock, then undelivered_msg_locks, the lock of each partition of the
+           message store taken through undelivered_msg_locks.hold, then history_lock. These guard the stores and
+           are only held around calls to them, never while replicating or writing to a socket. The lock of the
+           presence hub is taken by the listeners of the stores, inside their locks.
+        3. other_server_lock, which only guards the maps of replica channels.
+    Requests about different users only meet at the short store locks, so they proceed in parallel, and their
+    replicated updates are pipelined on the replica channels."""
+    def __init__(self, servers_config, server_id, protocol, storage=None, outbound_limits=DEFAULT_OUTBOUND_LIMITS,
+                 delivery_workers=DEFAULT_DELIVERY_WORKERS, admission_limits=DEFAULT_ADMISSION_LIMITS, groups=None,
+                 worker_processes=DEFAULT_WORKER_PROCESSES):
+        # Partitions then split the user lock stripes evenly, see delivery_worker_of
+        if delivery_workers <= 0 or DEFAULT_STRIPES % delivery_workers:
+            raise ValueError(f"delivery_workers must divide {DEFAULT_STRIPES}, got {delivery_workers}")
+        if worker_processes < 0:
+            raise ValueError("worker_processes must not be negative")
         self.other_server_configs = []
         for server_config in servers_config:
             if int(server_config["id"]) == int(server_id):
+                # The host is either a TCP host, or 'unix:' and the path of a Unix domain socket without a port
                 self.host = str(server_config["host"])
-                self.port = int(server_config["port"])
+                self.port = int(server_config["port"]) if server_config.get("port") is not None else None
             else:
                 self.other_server_configs.append(server_config)
+        if worker_processes and transport.is_unix(self.host):
+            raise ValueError("worker_processes need a TCP address to share")
 
         # List of socket objects that we are listening to
         self.other_server_sockets_accepted = []
-        # Map of server_id to (socket, socket_lock) for servers listening to us
+        # Map of server_id to ReplicaChannel for servers listening to us, carrying replicated updates
         self.other_server_sockets_connected = {}
+        # Map of server_id to a second ReplicaChannel to the same server, carrying heartbeats and primary
+        # assignment. The other server reads it on a thread of its own, so heartbeats are never answered behind
+        # a backlog of updates
+        self.heartbeat_channels = {}
         self.other_server_lock = threading.Lock()
 
         self.primary_id = -1  # The id of the primary server
         self.server_id = int(server_id)
 
-        self.msg_counter = 0
-        # Lock for the recognition of acks from replicas
-        self.acknowledgement_lock = threading.Lock()
+        # Accounts are sharded across replica groups by username, and servers_config is this server's own group.
+        # Requests about accounts of other groups are forwarded to their primaries
+        groups = groups if groups is not None else [servers_config]
+        self.shard = group_of_server(groups, server_id)
+        self.num_shards = len(groups)
+        self.shard_router = ShardRouter(groups, self.shard, protocol)
 
-        self.clients = {}  # map of (client socket, socket_lock) to uuid
-        self.clients_lock = threading.Lock()
+        # Ids of the messages this server sends, shared by every thread. They wrap around to fit the header of
+        # the connection they are written to
+        self.msg_counter = itertools.count()
 
-        self.account_list = account_list.AccountList(
-            f"logs/account_list_{server_id}.log")  # Manages account list
+        # Storage backend holding the persistent state, flat files under logs/ by default
+        self.storage = storage if storage is not None else file_storage.FileStorage()
+
+        # Locks of the users, see the lock order above
+        self.user_locks = StripedLock()
+
+        self.account_list = self.storage.account_list(server_id)  # Manages account list
         self.account_list_lock = threading.Lock()
 
-        self.logged_in = logged_in_accounts.LoggedInAccounts(
-            f"logs/logged_in_accounts_{server_id}.log")  # Manages usernames and uuids that are logged in
-        self.logged_in_lock = threading.Lock()
+        self.logged_in = self.storage.logged_in_accounts(server_id)  # Manages usernames and uuids that are logged in
 
-        # Map of recipient username to list of (sender, message) for that recipient
-        self.undelivered_msg = undelivered_messages.UndeliveredMessages(
-            f"logs/undelivered_messages_{server_id}.log")  # Manages undelivered messag
-        self.undelivered_msg_lock = threading.Lock()
+        # Registry of the connected (client socket, socket_lock) pairs and their uuids, shared with the logged in
+        # accounts so the client of a uuid and the account of a uuid are found without scanning.
+        # logged_in_lock guards both
+        self.sessions = self.logged_in.registry
+        self.logged_in_lock = threading.Lock()
 
-        self.message_delivery_thread = None
+        # Map of connected (client socket, socket_lock) to the OutboundQueue its messages are written through,
+        # guarded by logged_in_lock
+        self.outbound = {}
+        self.outbound_limits = outbound_limits
+        self.outbound_stats = OutboundStats()
+        # Map of (socket, socket_lock) to the Protocol of the header version negotiated with the other side of the
+        # connection. Connections without an entry are written with self.protocol. Guarded by logged_in_lock for
+        # writes
+        self.connection_protocols = {}
+        # Map of (socket, socket_lock) of a replication connection to the NameDecoder of the names its updates send
+        # as ids, for the connections that negotiated it. Guarded by logged_in_lock for writes
+        self.name_decoders = {}
+
+        # Presence subscriptions of the clients, which get the events of the account and session stores
+        self.presence = PresenceHub(self.msg_counter)
+        self.account_list.add_listener(self.presence.publish)
+        self.logged_in.add_listener(self.presence.publish)
+
+        # Bounded pool running client requests, which answers BUSY to the ones it has no room for
+        self.requests = RequestPool(admission_limits)
+
+        # Map of recipient username to list of (sender, message) for that recipient, split into one partition per
+        # delivery worker. Each partition has its own lock, the stripe of its recipients in undelivered_msg_locks,
+        # so the workers never wait for each other
+        self.undelivered_msg_locks = StripedLock(delivery_workers)
+        self.undelivered_msg = PartitionedMessages(self.storage.undelivered_message_partitions(
+            server_id, delivery_workers, self.undelivered_msg_locks.stripe), self.undelivered_msg_locks.stripe)
+        # Map of recipient username to the id of the next message to send to the client logged into the account.
+        # Messages sent but not acknowledged yet are sent again once the account logs in again, from this server or
+        # a new primary. Each entry is guarded by its recipient's user lock
+        self.in_flight = {}
+        # Map of recipient username to the id of its newest message whose time to live has passed, until the
+        # messages are dropped, one per partition of the message store. Only the primary drops expired messages,
+        # and replicates it like an acknowledgement. Each map is guarded by the lock of its partition
+        self.expired = [{} for _ in range(delivery_workers)]
+
+        # History of the messages sent to the accounts of this server's replica group, kept after their delivery
+        self.history = self.storage.message_history(server_id)
+        self.history_lock = threading.Lock()
+
+        # Threads delivering undelivered messages as the primary, each to its own share of the recipients
+        self.delivery_workers = delivery_workers
+        self.message_delivery_threads = []
         self.heartbeat_thread = None
 
+        # Processes sharing the listening port that own client connections, started by run
+        self.worker_processes = worker_processes
+        self.workers = None
+
         self.protocol = protocol
 
         self.separator = '\r'
 
+    @property
+    def clients(self):
+        """Map of every connected (client socket, socket_lock) to its uuid."""
+        return self.sessions.connected()
+
     def disconnect(self):
+        if self.workers is not None:
+            self.workers.stop()
         self.socket.close()
 
     def handle_connection(self, client_socket, socket_lock):
@@ -76,18 +182,31 @@ class Server:
             socket_lock (threading.Lock): Lock to prevent concurrent socket read
         """
         value = self.protocol.read_packets(
-            client, self.process_operation_curried(socket_lock))
+            client, self.admit_operation_curried(socket_lock))
         if value is None:
             client.close()
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client, socket_lock)]
-        self.clients.pop((client, socket_lock))
-        username = self.logged_in.get_username(uuid)
-        if username is not None:
-            self.logged_in.logoff(username)
-        self.logged_in_lock.release()
-        self.clients_lock.release()
+        self.disconnect_client(client, socket_lock)
+
+    def disconnect_client(self, client, socket_lock):
+        """Logs off the account of a client whose connection ended and forgets the client.
+
+        Args:
+            client (socket.socket): The socket of the client.
+            socket_lock (threading.Lock): The socket's associated lock
+        """
+        # A login still running would otherwise log the client in after it is logged off
+        self.requests.cancel((client, socket_lock))
+        with self.logged_in_lock:
+            uuid = self.sessions.uuid_of((client, socket_lock))
+            username = self.logged_in.get_username(uuid)
+            if username is not None:
+                self.logged_in.logoff(username)
+            self.sessions.disconnect((client, socket_lock))
+            queue = self.outbound.pop((client, socket_lock), None)
+            self.connection_protocols.pop((client, socket_lock), None)
+        self.presence.unsubscribe((client, socket_lock))
+        if queue is not None:
+            queue.close()
         print("Closing client.")
 
     def handle_replica(self, client, socket_lock):
@@ -96,40 +215,37 @@ class Server:
             client, self.process_operation_curried(socket_lock))
         if value is None:
             client.close()
+        with self.logged_in_lock:
+            self.connection_protocols.pop((client, socket_lock), None)
+            decoder = self.name_decoders.pop((client, socket_lock), None)
+        if decoder is not None:
+            decoder.close()
         print("Closing replica.")
 
-    def atomicIsLoggedIn(self, client_socket, socket_lock):
-        """Atomically checks if the client is logged in 
+    def get_logged_in_username(self, client_socket, socket_lock):
+        """Atomically finds the account a client is logged into
 
         Args:
             client (socket.socket): The client socket
             socket_lock (threading.Lock): The socket's associated lock
+
+        Returns:
+            (str, str): The uuid of the client, and the username it is logged into or None.
         """
-        ret = True
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        if not self.logged_in.is_logged_in(uuid):
-            ret = False
-        self.logged_in_lock.release()
-        self.clients_lock.release()
-        return ret
+        with self.logged_in_lock:
+            uuid = self.sessions.uuid_of((client_socket, socket_lock))
+            return uuid, self.logged_in.get_username(uuid)
 
-    def atomicLogIn(self, client_socket, socket_lock, account_name):
-        """Atomically logs client in with the account name
+    def atomicIsLoggedIn(self, client_socket, socket_lock):
+        """Atomically checks if the client is logged in 
 
         Args:
             client (socket.socket): The client socket
             socket_lock (threading.Lock): The socket's associated lock
-            account_name (str): The account name to log in
         """
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        self.wait_for_update_login_ack("True", account_name, uuid)
-        self.logged_in.login(account_name, uuid)
-        self.logged_in_lock.release()
-        self.clients_lock.release()
+        with self.logged_in_lock:
+            uuid = self.sessions.uuid_of((client_socket, socket_lock))
+            return self.logged_in.is_logged_in(uuid)
 
     def atomicIsAccountCreated(self, recipient):
         """Atomically checks if an account is created
@@ -137,11 +253,12 @@ class Server:
         Args:
             recipient (str): The account name to check
         """
-        ret = True
-        self.account_list_lock.acquire()
-        ret = self.account_list.contains(recipient)
-        self.account_list_lock.release()
-        return ret
+        with self.account_list_lock:
+            return self.account_list.contains(recipient)
+
+    def holds_account(self, username):
+        """Check if an account belongs to this server's replica group."""
+        return shard_of(username, self.num_shards) == self.shard
 
     def process_create_account(self, args, client_socket, socket_lock):
         """Processes a create account request. We require that the requester is not 
@@ -153,27 +270,26 @@ class Server:
             socket_lock (threading.Lock): The socket's associated lock
         """
         account_name = args["username"]
-        if self.atomicIsLoggedIn(client_socket, socket_lock):
-            response = {
-                'status': 'Error: User can\'t create an account while logged in.', 'username': account_name}
-        else:
-            self.account_list_lock.acquire()
-            if self.account_list.contains(account_name):
-                self.account_list_lock.release()
-                response = {
-                    'status': 'Error: Account already exists.', 'username': account_name}
-            else:
-                # Communicate update to replicas
-                self.wait_for_update_accounts_ack("True", account_name)
-
+        # Only this client's own requests log it in or off, and they are processed one at a time
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is not None:
+            return {'status': 'Error: User can\'t create an account while logged in.', 'username': account_name}
+        if not self.holds_account(account_name):
+            return {'status': 'Error: The account belongs to another server.', 'username': account_name}
+        # The user lock keeps anyone else from creating the same account or logging into it meanwhile
+        with self.user_locks.hold(account_name):
+            if self.atomicIsAccountCreated(account_name):
+                return {'status': 'Error: Account already exists.', 'username': account_name}
+            # Communicate update to replicas
+            self.wait_for_update_accounts_ack("True", account_name)
+            self.wait_for_update_login_ack("True", account_name, uuid)
+            # The account and the login are committed together
+            with self.account_list_lock, self.logged_in_lock, self.storage.transaction():
                 self.account_list.create_account(account_name)
-                self.atomicLogIn(client_socket, socket_lock,
-                                 account_name)  # accountLock > login
-                # if we release the lock earlier, someone else can create the same acccount and try to log in while we wait for the log in lock
-                self.account_list_lock.release()
-                print("Account created: " + account_name)
-                response = {'status': 'Success', 'username': account_name}
-        return response
+                self.logged_in.login(account_name, uuid)
+            self.in_flight.pop(account_name, None)
+        print("Account created: " + account_name)
+        return {'status': 'Success', 'username': account_name}
 
     def process_list_accounts(self, args):
         """Processes a list account request. We don't require the requester to be logged in.
@@ -182,18 +298,77 @@ class Server:
             account_name (str): The args object for creating an account parsed from the received message
         """
         logging.info('Received', time.time())
+        response = self.process_list_local_accounts(args)
+        if response['status'] != 'Success':
+            return response
+        # The other replica groups search their own accounts
+        accounts = [response['accounts']] if response['accounts'] else []
+        for shard in range(self.num_shards):
+            if shard == self.shard:
+                continue
+            shard_response = self.shard_router.request(shard, 'LIST_LOCAL_ACCOUNTS', {'query': args['query']})
+            if shard_response is None:
+                return {'status': 'Error: Some accounts are unavailable, please try again later.', 'accounts': ''}
+            shard_args = self.protocol.parse_data(shard_response[0].operation_code.value, shard_response[1])
+            if shard_args['accounts']:
+                accounts.append(shard_args['accounts'])
+        return {'status': 'Success', 'accounts': ";".join(accounts)}
+
+    def process_list_local_accounts(self, args):
+        """Processes a list account request for the accounts of this server's replica group only.
+
+        Args:
+            args (dict): The args object for listing accounts, with the 'query' regex
+        """
         try:
             pattern = re.compile(
                 fr"{args['query']}", flags=re.IGNORECASE)
-            self.account_list_lock.acquire()
-            result = self.account_list.search_accounts(pattern)
-            self.account_list_lock.release()
+            with self.account_list_lock:
+                result = self.account_list.search_accounts(pattern)
             response = {'status': 'Success', 'accounts': ";".join(result)}
         except:
             response = {'status': 'Error: regex is malformed.', 'accounts': ''}
         finally:
             return response
 
+    def process_subscribe_presence(self, args, client_socket, socket_lock, request_id):
+        """Processes a presence subscription, which replaces the client's previous one, instead of polling the
+        account list. The client gets the accounts of this server's replica group it subscribed to and which of them
+        are logged in, and from then on a PRESENCE_EVENT whenever one of them is created, removed, logs in or logs
+        off. Subscriptions are kept by the server they were made on, so clients subscribe again on a new primary.
+
+        The response is queued with the stores locked, so no event comes before it or is missed after it.
+
+        Args:
+            args (dict): The ';' separated 'usernames' and the 'query' regex to subscribe to, either may be empty
+            client (socket.socket): The client socket
+            socket_lock (threading.Lock): The socket's associated lock
+            request_id (int): The message id of the request
+
+        Returns:
+            The encoded response if it isn't queued already, else None.
+        """
+        client = (client_socket, socket_lock)
+        encoder = self.protocol_of(client_socket, socket_lock)
+        usernames = [username for username in args['usernames'].split(';') if username]
+        try:
+            pattern = re.compile(fr"{args['query']}", flags=re.IGNORECASE) if args['query'] else None
+        except re.error:
+            return encoder.encode('SUBSCRIBE_PRESENCE_RESPONSE', request_id, {
+                'status': 'Error: regex is malformed.', 'accounts': '', 'online': ''})
+        queue = self.outbound.get(client)
+        if queue is None:
+            return encoder.encode('SUBSCRIBE_PRESENCE_RESPONSE', request_id, {
+                'status': 'Error: Only clients can subscribe.', 'accounts': '', 'online': ''})
+        with self.account_list_lock, self.logged_in_lock:
+            accounts = self.account_list.search_accounts(pattern) if pattern is not None else []
+            accounts = list(dict.fromkeys(accounts + [name for name in usernames if self.account_list.contains(name)]))
+            online = [account for account in accounts if self.logged_in.username_is_logged_in(account)]
+            self.presence.subscribe(client, queue, encoder, usernames, pattern)
+            queue.put(encoder.encode('SUBSCRIBE_PRESENCE_RESPONSE', request_id, {
+                'status': 'Success', 'accounts': ';'.join(accounts), 'online': ';'.join(online)}))
+        return None
+
     def process_send_msg(self, args, client_socket, socket_lock):
         """Processes a send message request. We require that the requester is 
         logged in and the recipient exists.
@@ -204,38 +379,240 @@ class Server:
             socket_lock (threading.Lock): The socket's associated lock
         """
         print("Processing send message")
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        if not self.logged_in.is_logged_in(uuid):
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            response = {
-                'status': 'Error: Need to be logged in to send a message.'}
-        else:
-            print("logged in")
-            username = self.logged_in.get_username(uuid)
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            recipient = args["recipient"]
-            message = args["message"]
-            print("sending message", recipient, message)
-            self.account_list_lock.acquire()
-            if not self.account_list.contains(recipient):
-                self.account_list_lock.release()
-                response = {
-                    'status': 'Error: The recipient of the message does not exist.'}
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is None:
+            return {'status': 'Error: Need to be logged in to send a message.'}
+        print("logged in")
+        recipient = args["recipient"]
+        message = args["message"]
+        print("sending message", recipient, message)
+        if not self.holds_account(recipient):
+            return self.forward('FORWARD_MESSAGE', recipient,
+                                {'recipient': recipient, 'sender': username, 'message': message})
+        return self.queue_message(recipient, username, message)
+
+    def process_forward_message(self, args):
+        """Processes a message forwarded by the primary of another replica group, whose sender it checked.
+
+        Args:
+            args (dict): The args object for forwarding a message, with 'recipient', 'sender' and 'message'
+        """
+        if not self.holds_account(args['recipient']):
+            return {'status': 'Error: The recipient of the message does not exist.'}
+        return self.queue_message(args['recipient'], args['sender'], args['message'])
+
+    def forward(self, operation, recipient, args):
+        """Forwards a message to the primary of the replica group holding its recipient, and returns the args of
+        the response."""
+        response = self.shard_router.request(shard_of(recipient, self.num_shards), operation, args)
+        if response is None:
+            status = {'status': 'Error: The recipient\'s server is unavailable, please try again later.'}
+            if operation == 'FORWARD_GROUP_MESSAGE':
+                status['failed'] = args['recipients']
+            return status
+        return self.protocol.parse_data(response[0].operation_code.value, response[1])
+
+    def queue_message(self, recipient, sender, message):
+        """Replicates and stores a message for a recipient of this server's replica group, and adds it to the
+        history with a timestamp replicated along with it.
+
+        Args:
+            recipient (str): The username of the recipient
+            sender (str): The username of the sender
+            message (str): The message
+        """
+        # The recipient's lock keeps its account from being deleted and its backlog from being delivered meanwhile
+        with self.user_locks.hold(recipient):
+            if not self.atomicIsAccountCreated(recipient):
+                return {'status': 'Error: The recipient of the message does not exist.'}
+            # Senders to other recipients may pass the check at the same time, so the global cap can be
+            # exceeded by up to one message per concurrent sender
+            with self.undelivered_msg_locks.hold(recipient):
+                has_room = self.undelivered_msg.has_room(recipient)
+            if not has_room:
+                return {'status': 'Error: The recipient has too many undelivered messages.'}
+            with self.history_lock:
+                timestamp = self.history.next_timestamp()
+            # Notify replicas of update
+            self.wait_for_update_message_ack(
+                "True", recipient, sender, message, timestamp)
+            # The replicas queued the message without checking the limits, and so does the primary. Its time to
+            # live counts from the replicated timestamp, so it expires at the same time everywhere
+            with self.undelivered_msg_locks.hold(recipient):
+                self.undelivered_msg.add_message(recipient, sender, message, enforce_limits=False,
+                                                 queued_at=timestamp / 1_000_000)
+            with self.history_lock:
+                self.history.add_message([recipient], sender, message, timestamp)
+        return {'status': 'Success'}
+
+    def process_send_group_message(self, args, client_socket, socket_lock):
+        """Processes a request to send one message to several recipients. We require that the requester is logged
+        in. The message is replicated and stored once for every recipient that exists and has room for it, and
+        the others are listed in the response.
+
+        Args:
+            args (dict): The args object for sending a message. 'recipients' holds the usernames separated by ';'.
+            client (socket.socket): The client socket
+            socket_lock (threading.Lock): The socket's associated lock
+        """
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is None:
+            return {'status': 'Error: Need to be logged in to send a message.', 'failed': ''}
+        recipients = list(dict.fromkeys(recipient for recipient in args["recipients"].split(';') if recipient))
+        message = args["message"]
+        # The recipients of every replica group get the message once, through its primary
+        shards = {}
+        for recipient in recipients:
+            shards.setdefault(shard_of(recipient, self.num_shards), []).append(recipient)
+        responses = []
+        for (shard, shard_recipients) in shards.items():
+            if shard == self.shard:
+                responses.append(self.queue_group_message(shard_recipients, username, message))
             else:
-                self.undelivered_msg_lock.acquire()
-                # Notify replicas of update
-                self.wait_for_update_message_ack(
-                    "True", recipient, username, message)
+                responses.append(self.forward('FORWARD_GROUP_MESSAGE', shard_recipients[0], {
+                    'recipients': ';'.join(shard_recipients), 'sender': username, 'message': message}))
+        failed = set(recipient for response in responses for recipient in response['failed'].split(';'))
+        status = 'Success' if any(response['status'] == 'Success' for response in responses) \
+            else 'Error: None of the recipients can receive the message.'
+        return {'status': status, 'failed': ';'.join(recipient for recipient in recipients if recipient in failed)}
+
+    def process_forward_group_message(self, args):
+        """Processes a message to several recipients forwarded by the primary of another replica group, whose
+        sender it checked.
 
-                self.undelivered_msg.add_message(recipient, username, message)
-                self.undelivered_msg_lock.release()
-                self.account_list_lock.release()
-                response = {'status': 'Success'}
-        return response
+        Args:
+            args (dict): The args object for forwarding a message, with 'recipients' separated by ';', 'sender'
+                and 'message'
+        """
+        recipients = args['recipients'].split(';')
+        return self.queue_group_message([recipient for recipient in recipients if self.holds_account(recipient)],
+                                        args['sender'], args['message'], recipients)
+
+    def queue_group_message(self, recipients, sender, message, requested=None):
+        """Replicates and stores a message once for the recipients of this server's replica group that exist and
+        have room for it, and adds it once to the history of their conversations with the sender.
+
+        Args:
+            recipients (List[str]): The usernames of the recipients, without duplicates
+            sender (str): The username of the sender
+            message (str): The message
+            requested (List[str], optional): Every recipient asked for, to list the ones skipped. Defaults to
+                recipients.
+        """
+        requested = requested if requested is not None else recipients
+        # The recipients' locks keep their accounts from being deleted and their backlogs from being delivered
+        # meanwhile. A large group takes most of the stripes, so it is serialized with most other requests
+        with self.user_locks.hold(*recipients):
+            with self.account_list_lock:
+                existing = [recipient for recipient in recipients if self.account_list.contains(recipient)]
+            with self.undelivered_msg_locks.hold(*existing):
+                accepted = self.undelivered_msg.recipients_with_room(existing)
+            accepted_set = set(accepted)
+            failed = ';'.join(recipient for recipient in requested if recipient not in accepted_set)
+            if not accepted:
+                return {'status': 'Error: None of the recipients can receive the message.', 'failed': failed}
+            with self.history_lock:
+                timestamp = self.history.next_timestamp()
+            # Notify replicas of update, once for the whole group
+            self.replicate('UPDATE_GROUP_MESSAGE_STATE', {
+                'recipients': ';'.join(accepted), 'sender': sender, 'message': message, 'timestamp': timestamp})
+            with self.undelivered_msg_locks.hold(*accepted):
+                self.undelivered_msg.add_group_message(accepted, sender, message, enforce_limits=False,
+                                                       queued_at=timestamp / 1_000_000)
+            with self.history_lock:
+                self.history.add_message(accepted, sender, message, timestamp)
+        return {'status': 'Success', 'failed': failed}
+
+    def process_get_history(self, args, client_socket, socket_lock):
+        """Processes a request for a page of the history of the conversation between the requester and another
+        account. We require that the requester is logged in. The messages the requester received are kept by this
+        server's replica group, and the ones the peer received by the peer's group, which is asked for its page
+        when it is another group.
+
+        Args:
+            args (dict): The args object for getting history. Should contain the 'peer' username, the 'before'
+                cursor of the page, empty for the newest messages, and the 'limit' on the messages of the page.
+            client (socket.socket): The client socket
+            socket_lock (threading.Lock): The socket's associated lock
+        """
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is None:
+            return self.history_response('Error: Need to be logged in to get message history.', args['peer'])
+        peer_shard = shard_of(args['peer'], self.num_shards)
+        try:
+            local_args = dict(args, username=username, before=self.history_before(args['before'], self.shard))
+            peer_args = dict(local_args, before=self.history_before(args['before'], peer_shard))
+        except ValueError:
+            return self.history_response('Error: before and limit must be integers.', args['peer'])
+        response = self.process_get_local_history(local_args)
+        if response['status'] != 'Success' or peer_shard == self.shard:
+            return response
+        shard_response = self.shard_router.request(peer_shard, 'GET_LOCAL_HISTORY', peer_args)
+        if shard_response is None:
+            return self.history_response('Error: Some messages are unavailable, please try again later.', args['peer'])
+        shard_args = self.protocol.parse_data(shard_response[0].operation_code.value, shard_response[1])
+        if shard_args['status'] != 'Success':
+            return shard_args
+        # The newest messages of both pages make the page, and there are older ones if either group has more or
+        # some of its messages were left out. Both groups may have a message with the same timestamp, so messages
+        # are ordered by timestamp and then group, and the page ends at a cursor of both
+        (page, more) = ([], False)
+        for (shard, page_args) in [(self.shard, response), (peer_shard, shard_args)]:
+            timestamps = [int(timestamp) for timestamp in page_args['timestamps'].split(',') if timestamp]
+            page.extend((timestamp, shard, sender, message) for (timestamp, (sender, message))
+                        in zip(timestamps, self.protocol.unpack_messages(page_args['messages'])))
+            more = more or page_args['next'] != ''
+        page.sort()
+        limit = min(int(args['limit']), MAX_HISTORY_PAGE)
+        more = more or len(page) > limit
+        page = page[-limit:]
+        return self.history_response('Success', args['peer'],
+                                     [(timestamp, sender, message) for (timestamp, _, sender, message) in page],
+                                     f"{page[0][0]}:{page[0][1]}" if more and page else None)
+
+    def history_before(self, cursor, shard):
+        """Return the timestamp before which the page of a group starts, for the 'before' cursor of GET_HISTORY.
+        A cursor is a timestamp, or for pages merged from two groups the timestamp and group of the oldest message
+        of the page, separated by ':'. The group's messages with the cursor's timestamp are older than the cursor
+        when its group comes first.
+
+        Args:
+            cursor (str): The 'before' cursor, empty for the newest messages.
+            shard (int): The index of the group.
+
+        Raises:
+            ValueError: If the cursor is not one.
+        """
+        if ':' not in cursor:
+            return cursor
+        (timestamp, cursor_shard) = (int(part) for part in cursor.split(':'))
+        return str(timestamp + 1 if shard < cursor_shard else timestamp)
+
+    def process_get_local_history(self, args):
+        """Processes a request for a page of the history of a conversation kept by this server's replica group,
+        made by the primary of another group for a client logged in there, or by process_get_history.
+
+        Args:
+            args (dict): The args object of GET_HISTORY, and the 'username' of the requester
+        """
+        try:
+            before = int(args['before']) if args['before'] else None
+            limit = min(int(args['limit']), MAX_HISTORY_PAGE)
+        except ValueError:
+            return self.history_response('Error: before and limit must be integers.', args['peer'])
+        if limit <= 0:
+            return self.history_response('Error: limit must be positive.', args['peer'])
+        with self.history_lock:
+            (page, next_before) = self.history.get_page(args['username'], args['peer'], before, limit)
+        return self.history_response('Success', args['peer'], page, next_before)
+
+    def history_response(self, status, peer, page=(), next_before=None):
+        """Return the args of GET_HISTORY_RESPONSE for a page of (timestamp, sender, message), oldest first. The
+        messages are packed like the ones of RECV_MESSAGES, in a single batch."""
+        packed = [packed for (_, packed) in self.protocol.pack_messages(
+            [(sender, message) for (_, sender, message) in page], max_size=float('inf'))]
+        return {'status': status, 'peer': peer, 'timestamps': ','.join(str(timestamp) for (timestamp, _, _) in page),
+                'messages': packed[0] if packed else '', 'next': '' if next_before is None else next_before}
 
     def process_delete_account(self, client_socket, socket_lock):
         """Processes a delete account request. We require that the requester is 
@@ -245,27 +622,18 @@ class Server:
             client (socket.socket): The client socket
             socket_lock (threading.Lock): The socket's associated lock
         """
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        if self.logged_in.is_logged_in(uuid):
-            username = self.logged_in.get_username(uuid)
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is None:
+            return {'status': 'Error: Need to be logged in to delete your account.'}
+        with self.user_locks.hold(username):
             # Notify replicas of update
             self.wait_for_update_login_ack("False", username, uuid)
-            self.logged_in.logoff(username)
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            self.account_list_lock.acquire()
+            with self.logged_in_lock:
+                self.logged_in.logoff(username)
             self.wait_for_update_accounts_ack("False", username)
-            self.account_list.remove(username)
-            self.account_list_lock.release()
-            response = {'status': 'Success'}
-        else:
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            response = {
-                'status': 'Error: Need to be logged in to delete your account.'}
-        return response
+            with self.account_list_lock:
+                self.account_list.remove(username)
+        return {'status': 'Success'}
 
     def process_login(self, args, client_socket, socket_lock):
         """Processes a login request. We require that the requester is 
@@ -276,35 +644,24 @@ class Server:
             client (socket.socket): The client socket
             socket_lock (threading.Lock): The socket's associated lock
         """
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        if self.logged_in.is_logged_in(uuid):
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            response = {
-                'status': 'Error: Already logged into an account, please log off first.', 'username': ''}
-        else:
-            account_name = args['username']
-            if (not self.atomicIsAccountCreated(account_name)):
-                self.logged_in_lock.release()
-                self.clients_lock.release()
-                response = {
-                    'status': 'Error: Account does not exist.', 'username': account_name}
-            elif self.logged_in.username_is_logged_in(account_name):
-                self.logged_in_lock.release()
-                self.clients_lock.release()
-                response = {
-                    'status': 'Error: Someone else is logged into that account.', 'username': account_name}
-            else:
-                # Notify replicas of update
-                self.wait_for_update_login_ack("True", account_name, uuid)
-
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is not None:
+            return {'status': 'Error: Already logged into an account, please log off first.', 'username': ''}
+        account_name = args['username']
+        with self.user_locks.hold(account_name):
+            if not self.atomicIsAccountCreated(account_name):
+                return {'status': 'Error: Account does not exist.', 'username': account_name}
+            with self.logged_in_lock:
+                taken = self.logged_in.username_is_logged_in(account_name)
+            if taken:
+                return {'status': 'Error: Someone else is logged into that account.', 'username': account_name}
+            # Notify replicas of update
+            self.wait_for_update_login_ack("True", account_name, uuid)
+            with self.logged_in_lock:
                 self.logged_in.login(account_name, uuid)
-                self.logged_in_lock.release()
-                self.clients_lock.release()
-                response = {'status': 'Success', 'username': account_name}
-        return response
+            # The new session gets every unacknowledged message, including the ones sent to the previous one
+            self.in_flight.pop(account_name, None)
+        return {'status': 'Success', 'username': account_name}
 
     def process_logoff(self, client_socket, socket_lock):
         """Processes a logoff request. We require that the requester is 
@@ -314,33 +671,149 @@ class Server:
             client (socket.socket): The client socket
             socket_lock (threading.Lock): The socket's associated lock
         """
-        self.clients_lock.acquire()
-        self.logged_in_lock.acquire()
-        uuid = self.clients[(client_socket, socket_lock)]
-        if self.logged_in.is_logged_in(uuid):
-            username = self.logged_in.get_username(uuid)
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        if username is None:
+            return {'status': 'Error: Need to be logged in to log out of your account.'}
+        with self.user_locks.hold(username):
             # Notify replicas of update
             self.wait_for_update_login_ack("False", username, uuid)
+            with self.logged_in_lock:
+                self.logged_in.logoff(username)
+        return {'status': 'Success'}
 
-            self.logged_in.logoff(username)
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            response = {'status': 'Success'}
-        else:
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-            response = {
-                'status': 'Error: Need to be logged in to log out of your account.'}
-        return response
+    def process_ack_messages(self, args, client_socket, socket_lock):
+        """Processes a client's acknowledgement that it received every message of its account up to and including
+        message_id. The messages are removed once the replicas have removed them too. Acknowledgements get no
+        response, and ones for an account the client isn't logged into are ignored.
+
+        Args:
+            args (dict): The args object for acknowledging messages. Should contain 'recipient' and 'message_id'.
+            client (socket.socket): The client socket
+            socket_lock (threading.Lock): The socket's associated lock
+        """
+        uuid, username = self.get_logged_in_username(client_socket, socket_lock)
+        recipient = args['recipient']
+        if username != recipient:
+            return None
+        # The recipient's lock keeps the backlog from being delivered while its oldest messages are removed
+        with self.user_locks.hold(recipient):
+            self.drop_messages(recipient, int(args['message_id']))
+        return None
+
+    def drop_messages(self, recipient, message_id):
+        """Replicates and removes every queued message of a recipient up to and including message_id. The caller
+        holds the recipient's user lock, so the replicas remove the same messages before any other update of the
+        recipient's backlog.
+
+        Args:
+            recipient (str): The username of the recipient
+            message_id (int): The id of the newest message to remove
+        """
+        with self.undelivered_msg_locks.hold(recipient):
+            queued_ids = self.undelivered_msg.queued_ids(recipient)
+        message_id = min(message_id, queued_ids.stop - 1)
+        if message_id < queued_ids.start:
+            return
+        # Notify replicas of update
+        self.replicate('UPDATE_MESSAGE_ACK', {'recipient': recipient, 'message_id': message_id})
+        with self.undelivered_msg_locks.hold(recipient):
+            self.undelivered_msg.acknowledge_messages(recipient, message_id)
+            if not self.undelivered_msg.queued_ids(recipient):
+                self.in_flight.pop(recipient, None)
+            expired = self.expired[self.delivery_worker_of(recipient)]
+            if expired.get(recipient, message_id + 1) <= message_id:
+                del expired[recipient]
+
+    def note_expired_messages(self, worker=None):
+        """Adds the messages whose time to live has passed to the expired messages waiting to be dropped, and
+        forgets the ones removed meanwhile. Replicas only note them, so that they are dropped once the replica
+        becomes primary unless its primary drops them first.
+
+        Args:
+            worker (int, optional): Number of the delivery worker whose partition of the message store to look
+                at. Every partition is looked at by default.
+
+        Returns:
+            dict: The expired messages waiting to be dropped, see self.expired.
+        """
+        noted = {}
+        for index in range(self.delivery_workers) if worker is None else [worker]:
+            with self.undelivered_msg_locks.locks[index]:
+                partition = self.undelivered_msg.partitions[index]
+                expired = self.expired[index]
+                for (recipient, message_id) in partition.expired_messages().items():
+                    expired[recipient] = max(message_id, expired.get(recipient, -1))
+                self.expired[index] = {recipient: message_id for (recipient, message_id) in expired.items()
+                                       if message_id in partition.queued_ids(recipient)}
+                noted.update(self.expired[index])
+        return noted
+
+    def expire_messages(self, worker=None):
+        """Drops the messages whose time to live has passed as the primary. Dropping them is replicated like an
+        acknowledgement, so the replicas keep the same messages with the same ids, instead of expiring them on
+        their own clock.
+
+        Args:
+            worker (int, optional): Number of the delivery worker whose partition of the message store to drop
+                from. Every partition is dropped from by default.
+        """
+        for (recipient, message_id) in self.note_expired_messages(worker).items():
+            with self.user_locks.hold(recipient):
+                self.drop_messages(recipient, message_id)
 
     def process_new_client(self, args, client_socket, socket_lock):
         """Processes a new client request for replication."""
         uuid = args['uuid']
-        self.clients_lock.acquire()
-        self.clients[(client_socket, socket_lock)] = uuid
-        self.clients_lock.release()
+        with self.logged_in_lock:
+            self.sessions.connect(uuid, (client_socket, socket_lock))
+            # Connections of worker processes are attached with their queue when they open
+            if (client_socket, socket_lock) not in self.outbound:
+                self.outbound[(client_socket, socket_lock)] = OutboundQueue(
+                    client_socket, socket_lock, self.protocol, self.outbound_limits, self.outbound_stats)
         return None
 
+    def attach_connection(self, client_socket, socket_lock, queue, encoder):
+        """Registers a connection whose messages are queued and encoded by someone else, such as a connection of a
+        worker process, before any of its requests is processed.
+
+        Args:
+            client_socket: Stands in for the socket of the connection.
+            socket_lock (threading.Lock): The socket's associated lock
+            queue: Queue the responses and messages to the connection are put in, like an OutboundQueue.
+            encoder: Encodes the messages to the connection, like the Protocol of the connection.
+        """
+        with self.logged_in_lock:
+            self.outbound[(client_socket, socket_lock)] = queue
+            self.connection_protocols[(client_socket, socket_lock)] = encoder
+
+    def negotiate(self, args, client_socket, socket_lock):
+        """Records the header version and compression to write to a connection whose other side advertised the
+        versions and compression methods it reads, in the arguments of REGISTER_CLIENT_UUID or HEARTBEAT."""
+        connection_protocol = self.protocol.negotiate(args['versions'], args.get('compression', ''))
+        with self.logged_in_lock:
+            self.connection_protocols[(client_socket, socket_lock)] = connection_protocol
+            if args.get('names') == 'ids' and (client_socket, socket_lock) not in self.name_decoders:
+                self.name_decoders[(client_socket, socket_lock)] = NameDecoder(self.storage.identities)
+
+    def protocol_of(self, client_socket, socket_lock):
+        """Return the Protocol messages to a connection are encoded with."""
+        return self.connection_protocols.get((client_socket, socket_lock), self.protocol)
+
+    def outbound_metrics(self) -> dict:
+        """Return the depth and counters of the outbound queues of the connected clients."""
+        with self.logged_in_lock:
+            depths = [len(queue) for queue in self.outbound.values()]
+        metrics = self.outbound_stats.snapshot()
+        metrics.update({'connections': len(depths), 'max_depth': max(depths, default=0)})
+        return metrics
+
+    def admission_metrics(self) -> dict:
+        """Return the counters of the client requests admitted and turned away, and the requests waiting for a
+        worker of the request pool."""
+        metrics = self.requests.stats.snapshot()
+        metrics['queued'] = self.requests.depth()
+        return metrics
+
     def process_update_accounts(self, args):
         """Processes an update to the account list for replication
 
@@ -351,12 +824,11 @@ class Server:
         """
         add = args['add_flag']
         username = args['username']
-        self.account_list_lock.acquire()
-        if (add == 'True'):
-            self.account_list.create_account(username)
-        else:
-            self.account_list.remove(username)
-        self.account_list_lock.release()
+        with self.account_list_lock:
+            if (add == 'True'):
+                self.account_list.create_account(username)
+            else:
+                self.account_list.remove(username)
 
     def process_update_login(self, args):
         """Processes an update to the logged in list for replication.
@@ -369,12 +841,11 @@ class Server:
         add = args['add_flag']
         username = args['username']
         uuid = args['uuid']
-        self.logged_in_lock.acquire()
-        if (add == 'True'):
-            self.logged_in.login(username, uuid)
-        else:
-            self.logged_in.logoff(username)
-        self.logged_in_lock.release()
+        with self.logged_in_lock:
+            if (add == 'True'):
+                self.logged_in.login(username, uuid)
+            else:
+                self.logged_in.logoff(username)
 
     def process_update_message_state(self, args):
         """Processes an update to undelivered messages for replication.
@@ -387,20 +858,74 @@ class Server:
                 'recipient' should be the username of the recipient. 
                 'sender' should be the username of the sender or a concatenation of the usernames of the senders separated by '\r'.
                 'message' should be the message or a concatenation of the messages separated by '\r'.
+                'timestamp', if present, is the history timestamp of the one message added.
         """
         add = args['add_one']
         recipient = args['recipient']
         sender = args['sender']
         message = args['message']
-        self.undelivered_msg_lock.acquire()
-        if (add == "True"):  # Append one message for a recipient
-            self.undelivered_msg.add_message(recipient, sender, message)
-        else:  # In this case we are trying to replace the list of messages for a recipient
-            sender_list = sender.split(self.separator)
-            message_list = message.split(self.separator)
-            tupleList = list(zip(sender_list, message_list))
-            self.undelivered_msg.update_messages(recipient, tupleList)
-        self.undelivered_msg_lock.release()
+        # The primary checked the message limits, so the message is queued even if the replica is over them
+        with self.undelivered_msg_locks.hold(recipient):
+            if (add == "True"):  # Append one message for a recipient
+                self.undelivered_msg.add_message(recipient, sender, message, enforce_limits=False,
+                                                 queued_at=self.queued_at(args))
+            else:  # In this case we are trying to replace the list of messages for a recipient
+                sender_list = sender.split(self.separator)
+                message_list = message.split(self.separator)
+                tupleList = list(zip(sender_list, message_list))
+                self.undelivered_msg.update_messages(recipient, tupleList)
+        # Updates from primaries that keep no history have no timestamp
+        if add == "True" and args.get('timestamp'):
+            with self.history_lock:
+                self.history.add_message([recipient], sender, message, int(args['timestamp']))
+
+    def process_update_group_message_state(self, args):
+        """Processes a message sent to several recipients for replication.
+
+        Args:
+            args (dict): The args object for sending a message. Should contain 'recipients', the usernames of the
+                recipients separated by ';', 'sender' and 'message', and may contain the history 'timestamp'.
+        """
+        recipients = args['recipients'].split(';')
+        with self.undelivered_msg_locks.hold(*recipients):
+            self.undelivered_msg.add_group_message(recipients, args['sender'], args['message'], enforce_limits=False,
+                                                   queued_at=self.queued_at(args))
+        if args.get('timestamp'):
+            with self.history_lock:
+                self.history.add_message(recipients, args['sender'], args['message'], int(args['timestamp']))
+
+    def queued_at(self, args):
+        """Return the time a replicated message was queued at by its primary, from its history timestamp in
+        microseconds, or None for the current time if the update has no timestamp.
+
+        Args:
+            args (dict): The args object of the update, which may contain the history 'timestamp'.
+        """
+        return int(args['timestamp']) / 1_000_000 if args.get('timestamp') else None
+
+    def process_update_message_ack(self, args):
+        """Processes an acknowledgement of undelivered messages for replication.
+
+        Args:
+            args (dict): The args object for sending a message. Should contain 'recipient' and 'message_id', the id
+                of the newest message of the recipient to remove.
+        """
+        with self.undelivered_msg_locks.hold(args['recipient']):
+            self.undelivered_msg.acknowledge_messages(args['recipient'], int(args['message_id']))
+
+    def replicate(self, operation: str, args: dict):
+        """Sends an update to every replica and waits for all of them to acknowledge it. The update is sent to
+        all the replicas before waiting for any ack, and other threads' updates are pipelined with it.
+
+        args:
+            operation (str): The update operation.
+            args (dict): The arguments of the update.
+        """
+        with self.other_server_lock:
+            replicas = list(self.other_server_sockets_connected.values())
+        tickets = [(replica, replica.send(operation, args)) for replica in replicas]
+        for (replica, ticket) in tickets:
+            replica.wait(ticket)
 
     def wait_for_update_accounts_ack(self, add_flag: str, username: str):
         """Sends message to replicas notifying of an update to accounts,
@@ -411,21 +936,7 @@ class Server:
                 and 'False' means we are removing an account. 
             username (str): The username of the account.
         """
-        print(f"waiting for ack lock for accounts {self.server_id} ")
-        print(self.primary_id)
-        self.acknowledgement_lock.acquire()
-        print("acquired ack lock for accounts")
-        print("waiting for other lock for accounts")
-        self.other_server_lock.acquire()
-        print("acquired other lock for accounts")
-        for (replica, socket_lock) in self.other_server_sockets_connected.values():
-            response = self.protocol.encode('UPDATE_ACCOUNT_STATE', self.msg_counter, {
-                                            'add_flag': add_flag, 'username': username})
-            self.protocol.send(replica, response, socket_lock)
-            self.msg_counter = self.msg_counter + 1
-            ack = self.protocol.read_small_packets(replica)
-        self.other_server_lock.release()
-        self.acknowledgement_lock.release()
+        self.replicate('UPDATE_ACCOUNT_STATE', {'add_flag': add_flag, 'username': username})
 
     def wait_for_update_login_ack(self, add_flag: str, username: str, uuid: str):
         """Sends message to replicas notifying of an update to logged in accounts,
@@ -437,23 +948,10 @@ class Server:
             username (str): The username of the account.
             uuid (str): The uuid of the account.
         """
-        print(f"waiting for ack lock for login {self.server_id} ")
-        print(self.primary_id)
-        self.acknowledgement_lock.acquire()
-        print("acquired ack lock for login")
-        print("waiting for other lock for login")
-        self.other_server_lock.acquire()
-        print("acquired other lock for login")
-        for (replica, socket_lock) in self.other_server_sockets_connected.values():
-            response = self.protocol.encode('UPDATE_LOGIN_STATE', self.msg_counter, {
-                                            'add_flag': add_flag, 'username': username, 'uuid': uuid})
-            self.protocol.send(replica, response, socket_lock)
-            self.msg_counter = self.msg_counter + 1
-            ack = self.protocol.read_small_packets(replica)
-        self.other_server_lock.release()
-        self.acknowledgement_lock.release()
+        self.replicate('UPDATE_LOGIN_STATE', {'add_flag': add_flag, 'username': username, 'uuid': uuid})
 
-    def wait_for_update_message_ack(self, add_flag: str, recipient: str, sender: str, message: str):
+    def wait_for_update_message_ack(self, add_flag: str, recipient: str, sender: str, message: str,
+                                    timestamp: int = None):
         """Sends message to replicas notifying of an update to undelivered messages,
         and waits for acknowledgement from all replicas that they have updated their undelivered messages.
 
@@ -463,30 +961,22 @@ class Server:
             recipient (str): The recipient of the message.
             sender (str): The sender of the message or a concatenation of the usernames of the senders separated by '\r'..
             message (str): The message or a concatenation of the messages separated by '\r'.
+            timestamp (int, optional): The history timestamp of the one message added.
         """
-        print(f"waiting for ack lock for messages {self.server_id} ")
-        print(self.primary_id)
-        self.acknowledgement_lock.acquire()
-        print("acquired ack lock for for msg")
-        print("waiting for other lock for msg ")
-        self.other_server_lock.acquire()
-        print("acquired other lock for msg")
-        for (replica, socket_lock) in self.other_server_sockets_connected.values():
-            response = self.protocol.encode('UPDATE_MESSAGE_STATE', self.msg_counter, {
-                                            'add_one': add_flag, 'recipient': recipient, 'sender': sender, 'message': message})
-            self.protocol.send(replica, response, socket_lock)
-            self.msg_counter = self.msg_counter + 1
-            ack = self.protocol.read_small_packets(replica)
-        self.other_server_lock.release()
-        self.acknowledgement_lock.release()
+        args = {'add_one': add_flag, 'recipient': recipient, 'sender': sender, 'message': message}
+        if timestamp is not None:
+            args['timestamp'] = timestamp
+        self.replicate('UPDATE_MESSAGE_STATE', args)
 
-    def process_operation_curried(self, socket_lock):
+    def process_operation_curried(self, socket_lock, parsed=False):
         """Processes the operation. This is a curried function to work with the 
         read packets api provided in protocol. See the relevant process functions
         for functionality.
 
         Args:
             socket_lock (threading.Lock): The socket's associated lock
+            parsed (bool, optional): Whether operations come with their arguments already parsed into a dict
+                instead of a message, as worker processes pass them
         """
         def process_operation(client_socket, metadata: protocol.Metadata, msg, id_accum):
             """Processes the operation. See the relevant process functions
@@ -496,100 +986,201 @@ class Server:
                 client (socket.socket): The client socket
                 metadata (protocol.Metadata): The metadata parsed from the message
                 msg (str): message to parse for operation arguments
-                id_accum (it): integer accumulator for message 
+                id_accum (int): Number of the message on the connection. Responses carry the message id of the
+                    request instead
             """
             operation_code = metadata.operation_code.value
-            args = self.protocol.parse_data(operation_code, msg)
+            args = msg if parsed else self.protocol.parse_data(operation_code, msg)
+            if 'versions' in args:
+                self.negotiate(args, client_socket, socket_lock)
+            # Replicated updates of connections that negotiated it refer to names by the ids of the primary
+            decoder = self.name_decoders.get((client_socket, socket_lock))
+            if decoder is not None:
+                args = decoder.decode(metadata.operation_code.name, args)
+            # Responses are written with the header version of the connection, and carry the message id of their
+            # request for the sender to match them to it
+            encoder = self.protocol_of(client_socket, socket_lock)
+            request_id = metadata.message_id
             print(operation_code)
             match operation_code:
                 case 1:  # CREATE_ACCOUNT
-                    response = self.protocol.encode(
-                        'CREATE_ACCOUNT_RESPONSE', id_accum, self.process_create_account(args, client_socket, socket_lock))
+                    response = encoder.encode(
+                        'CREATE_ACCOUNT_RESPONSE', request_id, self.process_create_account(args, client_socket, socket_lock))
                 case 3:  # LIST ACCOUNTS
-                    response = self.protocol.encode(
-                        'LIST_ACCOUNTS_RESPONSE', id_accum, self.process_list_accounts(args))
+                    response = encoder.encode(
+                        'LIST_ACCOUNTS_RESPONSE', request_id, self.process_list_accounts(args))
                 case 5:  # SENDMSG
                     # in this case we want to add to undelivered messages, which the server iterator will figure out i think
                     # here we check the person sending is logged in and the recipient account has been created
-                    response = self.protocol.encode(
-                        'SEND_MESSAGE_RESPONSE', id_accum, self.process_send_msg(args, client_socket, socket_lock))
+                    response = encoder.encode(
+                        'SEND_MESSAGE_RESPONSE', request_id, self.process_send_msg(args, client_socket, socket_lock))
                 case 7:  # DELETE
-                    response = self.protocol.encode(
-                        'DELETE_ACCOUNT_RESPONSE', id_accum, self.process_delete_account(client_socket, socket_lock))
+                    response = encoder.encode(
+                        'DELETE_ACCOUNT_RESPONSE', request_id, self.process_delete_account(client_socket, socket_lock))
                 case 9:  # LOGIN
-                    response = self.protocol.encode(
-                        'LOG_IN_RESPONSE', id_accum, self.process_login(args, client_socket, socket_lock))
+                    response = encoder.encode(
+                        'LOG_IN_RESPONSE', request_id, self.process_login(args, client_socket, socket_lock))
                 case 11:  # LOGOFF
-                    response = self.protocol.encode(
-                        'LOG_OFF_RESPONSE', id_accum, self.process_logoff(client_socket, socket_lock))
+                    response = encoder.encode(
+                        'LOG_OFF_RESPONSE', request_id, self.process_logoff(client_socket, socket_lock))
                 case 15:
-                    response = self.protocol.encode(
-                        'GET_PRIMARY_RESPONSE', id_accum, {'id': self.primary_id})
+                    response = encoder.encode(
+                        'GET_PRIMARY_RESPONSE', request_id, {'id': self.primary_id})
                 case 16:
-                    response = self.protocol.encode(
-                        'ASSIGN_PRIMARY_RESPONSE', id_accum, {'id': self.server_id})
+                    response = encoder.encode(
+                        'ASSIGN_PRIMARY_RESPONSE', request_id, {'id': self.server_id})
                 case 18:  # UPDATE_ACCOUNT_STATE
                     self.process_update_accounts(args)
-                    response = self.protocol.encode('ACK', id_accum)
+                    response = encoder.encode('ACK', request_id)
                 case 19:  # UPDATE_LOGIN_STATE
                     self.process_update_login(args)
-                    response = self.protocol.encode('ACK', id_accum)
+                    response = encoder.encode('ACK', request_id)
                 case 20:  # UPDATE_MESSAGE_STATE
                     self.process_update_message_state(args)
-                    response = self.protocol.encode('ACK', id_accum)
+                    response = encoder.encode('ACK', request_id)
                 case 21:  # NEW_CLIENT
                     response = self.process_new_client(
                         args, client_socket, socket_lock)
                 case 23:  # HEARTBEAT
-                    response = self.protocol.encode('ACK', id_accum)
+                    # The answer to an advertisement names the compression picked for the connection, and agrees to
+                    # read names as ids
+                    answer = {'compression': encoder.compression or ''} if 'versions' in args else {}
+                    if args.get('names') == 'ids':
+                        answer['names'] = 'ids'
+                    response = encoder.encode('ACK', request_id, answer)
+                case 26:  # ACK_MESSAGES
+                    response = self.process_ack_messages(args, client_socket, socket_lock)
+                case 27:  # UPDATE_MESSAGE_ACK
+                    self.process_update_message_ack(args)
+                    response = encoder.encode('ACK', request_id)
+                case 28:  # SEND_GROUP_MESSAGE
+                    response = encoder.encode(
+                        'SEND_GROUP_MESSAGE_RESPONSE', request_id,
+                        self.process_send_group_message(args, client_socket, socket_lock))
+                case 30:  # UPDATE_GROUP_MESSAGE_STATE
+                    self.process_update_group_message_state(args)
+                    response = encoder.encode('ACK', request_id)
+                case 32:  # FORWARD_MESSAGE
+                    response = encoder.encode(
+                        'SEND_MESSAGE_RESPONSE', request_id, self.process_forward_message(args))
+                case 33:  # FORWARD_GROUP_MESSAGE
+                    response = encoder.encode(
+                        'SEND_GROUP_MESSAGE_RESPONSE', request_id, self.process_forward_group_message(args))
+                case 34:  # LIST_LOCAL_ACCOUNTS
+                    response = encoder.encode(
+                        'LIST_ACCOUNTS_RESPONSE', request_id, self.process_list_local_accounts(args))
+                case 35:  # SUBSCRIBE_PRESENCE
+                    response = self.process_subscribe_presence(args, client_socket, socket_lock, request_id)
+                case 38:  # GET_HISTORY
+                    response = encoder.encode(
+                        'GET_HISTORY_RESPONSE', request_id, self.process_get_history(args, client_socket, socket_lock))
+                case 40:  # GET_LOCAL_HISTORY
+                    response = encoder.encode(
+                        'GET_HISTORY_RESPONSE', request_id, self.process_get_local_history(args))
                 case _:
                     response = None
             if not response is None:
-                self.protocol.send(client_socket, response, socket_lock)
+                self.respond(client_socket, socket_lock, response)
         return process_operation
 
-    def handle_undelivered_messages(self):
-        """Sends any undelivered messages to the recipients. If the recipient is not logged in
-        or sending fails, the undelivered message remains on the work queue. 
-        """
-        self.undelivered_msg_lock.acquire()
-        for recipient, message_infos in self.undelivered_msg.get_messages():
-            self.clients_lock.acquire()
-            self.logged_in_lock.acquire()
-            if message_infos and self.logged_in.username_is_logged_in(recipient):
-                uuid = self.logged_in.get_uuid_from_username(recipient)
-                (client_socket, socket_lock) = [
-                    k for k, v in self.clients.items() if v == uuid][0]
-                undelivered_messages = []
-                for (sender, msg) in message_infos:
-                    if (not (sender == "" or msg == "")):
-                        response = self.protocol.encode(
-                            "RECV_MESSAGE", self.msg_counter, {"sender": sender, "message": msg})
-                        status = self.protocol.send(
-                            client_socket, response, socket_lock)
-                        if not status:
-                            undelivered_messages.append((sender, msg))
-                        self.msg_counter = self.msg_counter + 1
-
-                # Notify replicas of update to undelivered messages
-                senders_string = self.separator.join(
-                    [msg_info[0] for msg_info in undelivered_messages])
-                msgs_string = self.separator.join(
-                    [msg_info[1] for msg_info in undelivered_messages])
-                self.wait_for_update_message_ack(
-                    "False", recipient, senders_string, msgs_string)
-                self.undelivered_msg.update_messages(
-                    recipient, undelivered_messages)
-            self.logged_in_lock.release()
-            self.clients_lock.release()
-        self.undelivered_msg_lock.release()
-
-    def send_messages(self):
+    def admit_operation_curried(self, socket_lock, parsed=False):
+        """Curried function for reading a client connection with read_packets. Client requests are submitted to
+        the request pool, and answered with BUSY if it turns them away, while other operations are processed
+        right away. See process_operation_curried for the arguments.
+
+        Args:
+            socket_lock (threading.Lock): The socket's associated lock
+            parsed (bool, optional): See process_operation_curried
+        """
+        process_operation = self.process_operation_curried(socket_lock, parsed)
+
+        def admit_operation(client_socket, metadata: protocol.Metadata, msg, id_accum):
+            operation = metadata.operation_code.name
+            if operation not in POOLED_OPERATIONS:
+                process_operation(client_socket, metadata, msg, id_accum)
+            elif not self.requests.submit((client_socket, socket_lock), operation,
+                                          lambda: process_operation(client_socket, metadata, msg, id_accum)):
+                encoder = self.protocol_of(client_socket, socket_lock)
+                self.respond(client_socket, socket_lock, encoder.encode('BUSY', metadata.message_id, {
+                    'operation': operation, 'status': 'Error: The server is busy, please try again later.'}))
+        return admit_operation
+
+    def respond(self, client_socket, socket_lock, response):
+        """Send an encoded response. Clients get their responses through their queue, replicas straight away."""
+        queue = self.outbound.get((client_socket, socket_lock))
+        if queue is not None:
+            queue.put(response)
+        else:
+            self.protocol.send(client_socket, response, socket_lock)
+
+    def delivery_worker_of(self, recipient):
+        """Return the number of the delivery worker that delivers a recipient's messages, which is also the index
+        of the recipient's partition of the message store. Partitions and user lock stripes hash usernames alike,
+        and the number of workers divides the number of stripes, so no two workers ever wait for each other's
+        user locks."""
+        return self.undelivered_msg_locks.stripe(recipient)
+
+    def handle_undelivered_messages(self, worker=None):
+        """Sends the undelivered messages that haven't been sent yet to the recipients logged in from a client of
+        this server. Messages stay undelivered until the recipient's client acknowledges them, and if the recipient
+        is not logged in or its queue is full, they are sent on a later pass.
+
+        Args:
+            worker (int, optional): Number of the delivery worker making the pass, to only deliver to the
+                recipients of its partition of the message store. Every recipient is delivered to by default.
+        """
+        self.expire_messages(worker)
+        # The history only needs expiring once per round of passes
+        if not worker:
+            with self.history_lock:
+                self.history.expire_messages()
+        recipients = []
+        for index in range(self.delivery_workers) if worker is None else [worker]:
+            with self.undelivered_msg_locks.locks[index]:
+                recipients += self.undelivered_msg.partitions[index].recipients()
+        for recipient in recipients:
+            # The recipient's lock keeps its backlog and in flight messages from changing meanwhile, while other
+            # users' requests go on
+            with self.user_locks.hold(recipient):
+                with self.logged_in_lock:
+                    queue = None
+                    if self.logged_in.username_is_logged_in(recipient):
+                        client = self.sessions.client_of(self.logged_in.get_uuid_from_username(recipient))
+                        queue = self.outbound.get(client)
+                        encoder = self.connection_protocols.get(client, self.protocol)
+                # Only the backlogs of recipients logged in from a client of this server are read
+                if queue is None:
+                    continue
+                with self.undelivered_msg_locks.hold(recipient):
+                    queued_ids = self.undelivered_msg.queued_ids(recipient)
+                    next_id = max(self.in_flight.get(recipient, 0), queued_ids.start)
+                    if next_id >= queued_ids.stop:
+                        # Every message has been sent and waits for its acknowledgement
+                        continue
+                    # Only the messages not sent yet are read
+                    message_infos = self.undelivered_msg.get_recipient_messages(recipient, next_id)
+                # Messages are sent in order and in batches once queued for the client, so a slow client never
+                # holds up this loop. A full queue leaves the rest of the backlog for the next pass
+                sent = 0
+                for (count, packed) in self.protocol.pack_messages(message_infos):
+                    if not queue.has_room():
+                        break
+                    response = encoder.encode("RECV_MESSAGES", next(self.msg_counter), {
+                        "recipient": recipient, "first_id": next_id + sent, "messages": packed})
+                    if not queue.put(response):
+                        break
+                    sent += count
+                self.in_flight[recipient] = next_id + sent
+
+    def send_messages(self, worker=None):
         """ Handles undelivered messages in a loop, and sleeps to provide better 
         responsiveness on the client side
+
+        Args:
+            worker (int, optional): Number of the delivery worker, see handle_undelivered_messages.
         """
         while True:
-            self.handle_undelivered_messages()
+            self.handle_undelivered_messages(worker)
             sleep(0.01)
 
     def connect_to_replicas(self, server_socket, num_replicas):
@@ -609,13 +1200,12 @@ class Server:
                 pass
 
     def run(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket = transport.listen(self.host, self.port, reuse_port=bool(self.worker_processes))
         self.socket = server_socket
         server_socket.setblocking(0)
-        server_socket.bind((self.host, self.port))
         print("Server started.")
-        server_socket.listen()
-        num_replicas = len(self.other_server_configs)
+        # Every other server connects twice, for updates and for heartbeats
+        num_replicas = 2 * len(self.other_server_configs)
         # Start thread for listening for other servers
         thread = threading.Thread(target=self.connect_to_replicas, args=(
             server_socket, num_replicas, ), daemon=True)
@@ -628,13 +1218,12 @@ class Server:
         self.other_server_lock.acquire()
         for server_config in self.other_server_configs:
             host = str(server_config["host"])
-            port = int(server_config["port"])
+            port = server_config.get("port")
             id = int(server_config["id"])
-            replica_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            replica_socket.connect((host, port))
-            self.other_server_sockets_connected[id] = (
-                replica_socket, threading.Lock())
-            print(f"Connected to {host}, {port}")
+            for channels in [self.other_server_sockets_connected, self.heartbeat_channels]:
+                channels[id] = ReplicaChannel(transport.connect(host, port), self.protocol, self.storage.identities)
+                channels[id].negotiate()
+            print(f"Connected to {transport.describe(host, port)}")
         print(str(self.other_server_sockets_connected))
         self.other_server_lock.release()
         time.sleep(10)
@@ -648,6 +1237,12 @@ class Server:
                 target=self.check_heartbeat, daemon=True)
             self.heartbeat_thread.start()
 
+        # The workers only start listening once the replicas are connected, so none of them gets a replica's
+        # connection. From then on client connections are spread over this process and the workers
+        if self.worker_processes:
+            self.workers = WorkerProcesses(self, self.worker_processes)
+            self.workers.start(self.host, self.port)
+
         while(True):
             try:
                 clientsocket, addr = server_socket.accept()
@@ -664,18 +1259,15 @@ class Server:
         # Send id to all servers and the one with the lowest id is primary
         # Check to make sure this doesn't deadlock
         alive_server_ids = [self.server_id]
-        self.other_server_lock.acquire()
-        for (server_socket, socket_lock) in self.other_server_sockets_connected.values():
+        with self.other_server_lock:
+            replicas = list(self.heartbeat_channels.values())
+        for replica in replicas:
             print("Assigning primary")
-            value = self.protocol.send(server_socket, self.protocol.encode(
-                "ASSIGN_PRIMARY", self.msg_counter), socket_lock)
-            self.msg_counter += 1
-            ack = self.protocol.read_small_packets(server_socket)
+            ack = replica.request("ASSIGN_PRIMARY")
             if ack is not None:
                 (md, msg) = ack
                 alive_server_ids.append(
                     int(self.protocol.parse_data(md.operation_code, msg)['id']))
-        self.other_server_lock.release()
 
         self.primary_id = min(alive_server_ids)
         print(f"primary is {self.primary_id}")
@@ -684,30 +1276,30 @@ class Server:
     def check_heartbeat(self):
         """Sends a heartbeat check to primary server periodically and if the connection is dropped, determine new primary."""
         while True:
-            self.other_server_lock.acquire()
-            primary_socket, socket_lock = self.other_server_sockets_connected[self.primary_id]
-            self.other_server_lock.release()
-            response = self.protocol.encode("HEARTBEAT", self.msg_counter, {
-                                            "id": str(self.server_id)})
-            self.protocol.send(primary_socket, response, socket_lock)
-            self.msg_counter += 1
-            ack = self.protocol.read_small_packets(primary_socket)
+            with self.other_server_lock:
+                primary = self.heartbeat_channels[self.primary_id]
+            ack = primary.request("HEARTBEAT", {"id": str(self.server_id)})
             if ack is None:
                 self.determine_primary_server()
                 if self.primary_id == self.server_id:
-                    self.clients_lock.acquire()
-                    for client in self.clients.keys():
-                        self.protocol.send(client[0], self.protocol.encode(
-                            "SWITCH_PRIMARY", self.msg_counter, {"id": self.primary_id}), client[1])
-                        self.msg_counter += 1
-                    self.clients_lock.release()
+                    with self.logged_in_lock:
+                        queues = list(self.outbound.items())
+                    for (client, queue) in queues:
+                        queue.put(self.protocol_of(*client).encode(
+                            "SWITCH_PRIMARY", next(self.msg_counter), {"id": self.primary_id}))
                     self.become_primary()
                     return
 
+            # Replicas leave dropping expired messages to the primary, which replicates it
+            self.note_expired_messages()
+            with self.history_lock:
+                self.history.expire_messages()
             sleep(0.5)
 
     def become_primary(self):
-        """Starts the message delivery thread as the primary server."""
-        self.message_delivery_thread = threading.Thread(
-            target=self.send_messages, daemon=True)
-        self.message_delivery_thread.start()
+        """Starts the message delivery workers as the primary server."""
+        for worker in range(self.delivery_workers):
+            thread = threading.Thread(
+                target=self.send_messages, args=(worker,), daemon=True)
+            thread.start()
+            self.message_delivery_threads.append(thread)
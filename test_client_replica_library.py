@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import call, patch, MagicMock
 
 from client_replica_library import ClientReplicaLibrary
+from utils.sharding import shard_of
 
 
 class TestClientReplicaLibrary(unittest.TestCase):
@@ -48,7 +49,29 @@ class TestClientReplicaLibrary(unittest.TestCase):
         mock_send = self.protocol.send
         self.client_replica_library.send(message)
         mock_send.assert_called_with(
-            self.client_replica_library.primary, message)
+            self.client_replica_library.primary, message, self.client_replica_library.send_lock)
+
+    def test_send_routes_by_shard(self):
+        library = ClientReplicaLibrary(self.protocol, [self.server_configs[:2], self.server_configs[2:]])
+        library.primaries = {0: MagicMock(), 1: MagicMock()}
+        for username in ['kevin', 'howie', 'joseph']:
+            library.send(b'message', username)
+            self.protocol.send.assert_called_with(
+                library.primaries[shard_of(username, 2)], b'message', library.send_lock)
+        # Requests of clients not logged in go to the first group
+        library.send(b'message')
+        self.protocol.send.assert_called_with(library.primaries[0], b'message', library.send_lock)
+
+    def test_receive_messages_drops_redeliveries(self):
+        first = [('howie', 'hello'), ('joseph', 'hi')]
+        self.assertEqual(self.client_replica_library.receive_messages('kevin', 0, first), first)
+        # The same messages again, followed by a new one
+        self.assertEqual(self.client_replica_library.receive_messages('kevin', 0, first + [('howie', 'bye')]),
+                         [('howie', 'bye')])
+        self.assertEqual(self.client_replica_library.receive_messages('kevin', 1, [('joseph', 'hi')]), [])
+        self.assertEqual(self.client_replica_library.received_ids['kevin'], 2)
+        # Every account has ids of its own
+        self.assertEqual(self.client_replica_library.receive_messages('joseph', 0, first), first)
 
 
 if __name__ == '__main__':
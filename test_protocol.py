@@ -99,6 +99,74 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(parse['recipient'], 'kevin')
         self.assertEqual(parse['message'], 'hello')
 
+    def test_pack_messages(self):
+        message_infos = [('kevin', 'hello'), ('howie', '12:3:'), ('', ''), ('joseph', 'hi')]
+        [(count, packed)] = self.protocol.pack_messages(message_infos)
+        self.assertEqual(count, 4)
+        self.assertEqual(packed, '5,5,5,5,0,0,6,2:kevinhellohowie12:3:josephhi')
+        self.assertEqual(self.protocol.unpack_messages(packed), message_infos)
+
+    def test_pack_messages_in_batches(self):
+        message_infos = [('kevin', str(i)) for i in range(100)] + [('howie', 'x' * 100)]
+        batches = list(self.protocol.pack_messages(message_infos, 100))
+        self.assertEqual(sum(count for (count, packed) in batches), 101)
+        for (count, packed) in batches[:-1]:
+            self.assertLessEqual(sum(len(sender) + len(message)
+                                     for (sender, message) in self.protocol.unpack_messages(packed)), 100)
+        # A message over the size gets a batch of its own
+        self.assertEqual(batches[-1][0], 1)
+        unpacked = [pair for (count, packed) in batches for pair in self.protocol.unpack_messages(packed)]
+        self.assertEqual(unpacked, message_infos)
+
+    def test_read_packets_recv_messages(self):
+        message_infos = [('kevin', f"message {i}") for i in range(1000)]
+        [(count, packed)] = self.protocol.pack_messages(message_infos)
+        encoding = self.protocol.encode('RECV_MESSAGES', 0, {'recipient': 'howie', 'first_id': 0, 'messages': packed})
+        self.assertGreater(len(encoding), 1)
+        client = MagicMock()
+        processFn = MagicMock(return_value=True)
+        client.recv = MagicMock(side_effect=encoding + [(0).to_bytes(2, 'big')])
+        self.protocol.read_packets(client, processFn)
+        (_, md, msg, _) = processFn.call_args[0]
+        args = self.protocol.parse_data(md.operation_code.value, msg)
+        self.assertEqual(self.protocol.unpack_messages(args['messages']), message_infos)
+
+    def test_send_partial_writes(self):
+        encoding = self.protocol.encode('RECV_MESSAGE', 0, {'sender': 'kevin', 'message': 'x' * 5000})
+        self.assertEqual(len(encoding), 3)
+        written = []
+        client = MagicMock()
+
+        def sendmsg(buffers, *args):
+            # Accept at most 1000 bytes per call
+            data = b''.join(buffers)[:1000]
+            written.append(data)
+            return len(data)
+        client.sendmsg.side_effect = sendmsg
+        socket_lock = MagicMock()
+        self.assertTrue(self.protocol.send(client, encoding, socket_lock))
+        self.assertEqual(b''.join(written), b''.join(encoding))
+        socket_lock.__enter__.assert_called_once()
+
+    def test_send_broken_socket(self):
+        client = MagicMock()
+        client.sendmsg.return_value = 0
+        self.assertFalse(self.protocol.send(client, self.protocol.encode('LIST_ACCOUNTS', 0, {'query': '.*'})))
+        client.sendmsg.side_effect = ConnectionResetError()
+        self.assertFalse(self.protocol.send(client, self.protocol.encode('LIST_ACCOUNTS', 0, {'query': '.*'})))
+
+    def test_send_many(self):
+        (server_socket, client_socket) = socket.socketpair()
+        messages = [self.protocol.encode('RECV_MESSAGE', i, {'sender': 'kevin', 'message': f"hello {i}"})
+                    for i in range(10)]
+        self.assertTrue(self.protocol.send_many(server_socket, messages, timeout=5))
+        for i in range(10):
+            (md, msg) = self.protocol.read_small_packets(client_socket)
+            self.assertEqual(md.message_id, i)
+            self.assertEqual(self.protocol.parse_data(md.operation_code.value, msg)['message'], f"hello {i}")
+        server_socket.close()
+        client_socket.close()
+
     def test_parse_metadata(self):
         encoding = self.protocol.encode(
             'CREATE_ACCOUNT', 0, {'username': 'kevin'})[0]
@@ -112,5 +180,119 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(md.version, 1)
 
 
+    def test_version_2_round_trip(self):
+        v2 = self.protocol.with_version(2)
+        accounts = ','.join(f"user{i}" for i in range(1000))
+        encoding = v2.encode('LIST_ACCOUNTS_RESPONSE', 2 ** 40, {'status': 'Success', 'accounts': accounts})
+        # A whole account list fits one packet, where version 1 needs several
+        self.assertEqual(len(encoding), 1)
+        self.assertGreater(len(self.protocol.encode(
+            'LIST_ACCOUNTS_RESPONSE', 0, {'status': 'Success', 'accounts': accounts})), 3)
+        md = v2.parse_metadata(encoding[0])
+        self.assertEqual((md.version, md.header_length, md.message_id, md.flags), (2, 18, 2 ** 40, 0))
+        self.assertEqual(md.payload_size, len(encoding[0]) - protocol.METADATA_LENGTHS[2])
+        client = MagicMock()
+        processFn = MagicMock(return_value=True)
+        client.recv = MagicMock(side_effect=encoding + [b''])
+        self.protocol.read_packets(client, processFn)
+        (_, md, msg, _) = processFn.call_args[0]
+        self.assertEqual(self.protocol.parse_data(md.operation_code.value, msg)['accounts'], accounts)
+
+    def test_mixed_versions_on_one_connection(self):
+        v2 = self.protocol.with_version(2)
+        messages = [(self.protocol if i % 2 else v2).encode(
+            'RECV_MESSAGE', i, {'sender': 'kevin', 'message': 'x' * i * 500}) for i in range(8)]
+        stream = b''.join(packet for message in messages for packet in message)
+        client = MagicMock()
+        processFn = MagicMock(return_value=True)
+        # Packets of both versions are cut at arbitrary points
+        client.recv = MagicMock(side_effect=[stream[i:i + 777] for i in range(0, len(stream), 777)] + [b''])
+        self.protocol.read_packets(client, processFn)
+        received = [(call[0][1].version, call[0][1].message_id, len(call[0][2])) for call in processFn.call_args_list]
+        self.assertEqual(received, [(1 if i % 2 else 2, i, len('sender=kevin\rmessage=') + i * 500) for i in range(8)])
+
+    def test_read_small_packets_of_both_versions(self):
+        (server_socket, client_socket) = socket.socketpair()
+        v2 = self.protocol.with_version(2)
+        self.assertTrue(self.protocol.send_many(server_socket, [
+            v2.encode('ACK', 70000), self.protocol.encode('ACK', 70000)]))
+        self.assertEqual(self.protocol.read_small_packets(client_socket)[0].message_id, 70000)
+        # Ids wrap around to fit the header of version 1
+        self.assertEqual(self.protocol.read_small_packets(client_socket)[0].message_id, 70000 - 2 ** 16)
+        server_socket.close()
+        self.assertIsNone(self.protocol.read_small_packets(client_socket))
+        client_socket.close()
+
+    def test_negotiate(self):
+        self.assertEqual(self.protocol.negotiate(protocol.ADVERTISED_VERSIONS).version, 2)
+        self.assertIs(self.protocol.negotiate('1,2'), self.protocol.with_version(2))
+        self.assertIs(self.protocol.with_version(2).with_version(1), self.protocol)
+        # Peers that only read version 1, or later versions we don't know, get version 1
+        self.assertIs(self.protocol.negotiate('1'), self.protocol)
+        self.assertIs(self.protocol.negotiate('1,9'), self.protocol)
+        # Old peers ignore the advertisement
+        data = 'uuid=1234\rversions=1,2'
+        self.assertEqual(self.protocol.parse_data(21, data), {'uuid': '1234', 'versions': '1,2'})
+
+    def test_max_frame_size(self):
+        small = protocol.Protocol(2, protocol.METADATA_SIZES_V2, max_frame_size=100)
+        encoding = small.encode('RECV_MESSAGE', 0, {'sender': 'kevin', 'message': 'x' * 1000})
+        self.assertTrue(all(len(packet) <= 100 for packet in encoding))
+        self.assertEqual(len(encoding), 13)
+        with self.assertRaises(ValueError):
+            protocol.Protocol(2, protocol.METADATA_SIZES_V2, max_frame_size=protocol.MAX_FRAME_SIZE_LIMIT + 1)
+
+
+    def read_messages(self, packets):
+        """Return the (metadata, message) of every message read off a connection carrying the packets."""
+        stream = b''.join(packets)
+        client = MagicMock()
+        client.recv = MagicMock(side_effect=[stream[i:i + 1000] for i in range(0, len(stream), 1000)] + [b''])
+        processFn = MagicMock()
+        self.protocol.read_packets(client, processFn)
+        return [(call[0][1], call[0][2]) for call in processFn.call_args_list]
+
+    def test_compression(self):
+        accounts = ','.join(f"user{i}" for i in range(1000))
+        args = {'status': 'Success', 'accounts': accounts}
+        for compression in protocol.COMPRESSION_METHODS:
+            compressed = protocol.Protocol(2, protocol.METADATA_SIZES_V2, max_frame_size=1000,
+                                           compression=compression)
+            encoding = compressed.encode('LIST_ACCOUNTS_RESPONSE', 3, args)
+            # Several compressed packets are still smaller than the message
+            self.assertGreater(len(encoding), 1)
+            self.assertLess(sum(map(len, encoding)), len(accounts) // 2)
+            [(md, msg)] = self.read_messages(encoding)
+            self.assertTrue(md.flags & protocol.FLAG_COMPRESSED)
+            self.assertEqual(bool(md.flags & protocol.FLAG_DICTIONARY), compression == 'zlib-dict')
+            self.assertEqual(self.protocol.parse_data(md.operation_code.value, msg)['accounts'], accounts)
+            # Messages under the threshold and messages that don't shrink are written as they are
+            small = compressed.encode('ACK', 4)
+            noise = compressed.encode('RECV_MESSAGE', 5, {'sender': 'kevin', 'message': bytes(range(32, 127)).decode()})
+            self.assertEqual([(md.flags, msg) for (md, msg) in self.read_messages(small + noise)],
+                             [(0, ''), (0, 'sender=kevin\rmessage=' + bytes(range(32, 127)).decode())])
+            [(md, msg)] = self.read_messages(compressed.encode('ACK', 6, {'compression': compression}))
+            self.assertEqual(msg, f"compression={compression}")
+
+    def test_negotiate_compression(self):
+        self.assertEqual(self.protocol.negotiate('1,2', 'zlib').compression, 'zlib')
+        self.assertEqual(self.protocol.negotiate('1,2', protocol.REPLICATION_COMPRESSION).compression, 'zlib-dict')
+        self.assertIsNone(self.protocol.negotiate('1,2', 'lz4').compression)
+        self.assertIsNone(self.protocol.negotiate('1,2').compression)
+        # Version 1 headers can't flag compressed messages
+        self.assertIsNone(self.protocol.negotiate('1', 'zlib').compression)
+        self.assertIsNone(self.protocol.negotiate('1,2', 'zlib').with_version(1).compression)
+        disabled = protocol.Protocol(1, protocol.METADATA_SIZES, compression_threshold=None)
+        self.assertIsNone(disabled.negotiate('1,2', 'zlib').compression)
+        with self.assertRaises(ValueError):
+            protocol.Protocol(1, protocol.METADATA_SIZES, compression='zlib')
+
+    def test_invalid_compressed_message(self):
+        [packet] = protocol.Protocol(2, protocol.METADATA_SIZES_V2, compression='zlib').encode(
+            'LIST_ACCOUNTS_RESPONSE', 0, {'status': 'Success', 'accounts': 'user,' * 100})
+        corrupted = packet[:protocol.METADATA_LENGTHS[2]] + bytes(len(packet) - protocol.METADATA_LENGTHS[2])
+        self.assertEqual(self.read_messages([corrupted]), [])
+
+
 if __name__ == '__main__':
     unittest.main()
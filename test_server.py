@@ -1,8 +1,20 @@
 
+import os
+import shutil
+import socket
+import tempfile
 import unittest
 import threading
+import time
 from server import Server
-from protocol import protocol_instance
+from utils.file_storage import FileStorage
+from utils.sqlite_storage import SqliteStorage
+from utils.storage import MessageLimits
+from utils.outbound_queue import OutboundLimits
+from utils.request_pool import AdmissionLimits, RequestPool
+from utils.sharding import shard_of
+from protocol import FLAG_COMPRESSED, protocol_instance
+from unittest import mock
 from unittest.mock import MagicMock
 
 TEST_HOST = "127.0.0.1"
@@ -14,11 +26,16 @@ JOSEPH_UUID = str(3)
 
 
 class ServerTest(unittest.TestCase):
+    def make_storage(self):
+        """Storage backend for the server under test, None for the default flat files."""
+        return None
+
     def setUp(self):
-        self.server = Server(TEST_CONFIG, 1, TEST_PROTOCOL)
+        self.server = Server(TEST_CONFIG, 1, TEST_PROTOCOL, self.make_storage())
         self.server.account_list.create_account("kevin")
         self.server.account_list.create_account("howie")
         self.mock_kevin_socket = MagicMock()
+        self.mock_kevin_socket.sendmsg.side_effect = lambda buffers, *args: sum(map(len, buffers))
         self.mock_howie_socket = threading.Lock()
         self.mock_kevin_lock = MagicMock()
         self.mock_howie_lock = threading.Lock()
@@ -31,6 +48,7 @@ class ServerTest(unittest.TestCase):
     def tearDown(self):
         self.server.account_list.clear()
         self.server.undelivered_msg.clear()
+        self.server.history.clear()
 
     def test_create_account_success(self):
         args = {"username": "joseph"}
@@ -118,6 +136,361 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(
             response['status'], 'Error: The recipient of the message does not exist.')
 
+    def test_send_msg_failure_too_many_messages(self):
+        self.server.undelivered_msg.limits = MessageLimits(max_messages_per_recipient=1)
+        args = {'recipient': 'howie', 'message': 'hello'}
+        uuid = self.server.logged_in.logged_in["kevin"]
+        (client_socket, socket_lock) = [k for k, v in self.server.clients.items() if v == uuid][0]
+        self.assertEqual(self.server.process_send_msg(args, client_socket, socket_lock)['status'], 'Success')
+        response = self.server.process_send_msg(args, client_socket, socket_lock)
+        self.assertEqual(
+            response['status'], 'Error: The recipient has too many undelivered messages.')
+        self.assertEqual(len(self.server.undelivered_msg.undelivered_msg['howie']), 1)
+
+    def test_send_group_message_success(self):
+        self.server.account_list.create_account("joseph")
+        args = {'recipients': 'howie;joseph;howie', 'message': 'hello all'}
+        response = self.server.process_send_group_message(args, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(response, {'status': 'Success', 'failed': ''})
+        for recipient in ["howie", "joseph"]:
+            self.assertEqual(self.server.undelivered_msg.undelivered_msg[recipient], [("kevin", "hello all")])
+
+    def test_send_group_message_skips_recipients(self):
+        self.server.undelivered_msg.limits = MessageLimits(max_messages_per_recipient=1)
+        self.server.undelivered_msg.add_message("kevin", "howie", "hello")
+        args = {'recipients': 'howie;joseph;kevin', 'message': 'hello all'}
+        response = self.server.process_send_group_message(args, self.mock_kevin_socket, self.mock_kevin_lock)
+        # Joseph doesn't exist and Kevin's backlog is full
+        self.assertEqual(response, {'status': 'Success', 'failed': 'joseph;kevin'})
+        self.assertEqual(self.server.undelivered_msg.undelivered_msg['howie'], [("kevin", "hello all")])
+        args = {'recipients': 'joseph;kevin', 'message': 'hello again'}
+        response = self.server.process_send_group_message(args, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(response['status'], 'Error: None of the recipients can receive the message.')
+        self.assertEqual(response['failed'], 'joseph;kevin')
+
+    def test_send_group_message_fail_not_logged_in(self):
+        joseph_socket = MagicMock()
+        joseph_lock = threading.Lock()
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, joseph_socket, joseph_lock)
+        response = self.server.process_send_group_message(
+            {'recipients': 'kevin;howie', 'message': 'hello'}, joseph_socket, joseph_lock)
+        self.assertEqual(response['status'], 'Error: Need to be logged in to send a message.')
+
+    def test_handle_undelivered_messages(self):
+        self.server.undelivered_msg.add_message("kevin", "howie", "hello")
+        self.server.undelivered_msg.add_message("joseph", "howie", "hi")
+        self.server.undelivered_msg.add_message("kevin", "joseph", "hello again")
+        first = self.server.undelivered_msg.queued_ids("kevin").start
+        self.server.handle_undelivered_messages()
+        self.assertTrue(self.server.outbound[(self.mock_kevin_socket, self.mock_kevin_lock)].wait_until_empty(5))
+        # Both messages are delivered in one batch
+        self.mock_kevin_socket.sendmsg.assert_called_once()
+        [packet] = map(bytes, self.mock_kevin_socket.sendmsg.call_args[0][0])
+        md = TEST_PROTOCOL.parse_metadata(packet)
+        self.assertEqual(md.operation_code.name, 'RECV_MESSAGES')
+        args = TEST_PROTOCOL.parse_data(md.operation_code.value, packet[10:].decode('ascii')[:-1])
+        self.assertEqual((args['recipient'], args['first_id']), ("kevin", str(first)))
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(args['messages']),
+                         [("howie", "hello"), ("joseph", "hello again")])
+        # The messages stay undelivered until they are acknowledged, without being sent again
+        self.server.handle_undelivered_messages()
+        self.mock_kevin_socket.sendmsg.assert_called_once()
+        self.assertEqual(len(self.server.undelivered_msg.undelivered_msg["kevin"]), 2)
+        # Recipients who aren't logged in keep their messages
+        self.assertIn("joseph", self.server.undelivered_msg.undelivered_msg)
+
+    def test_delivery_workers_split_recipients(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = self.make_storage()
+        server = Server(TEST_CONFIG, 1, TEST_PROTOCOL, storage if storage is not None else FileStorage(directory),
+                        delivery_workers=2)
+        for (username, uuid) in [("kevin", KEVIN_UUID), ("joseph", JOSEPH_UUID)]:
+            client_socket = MagicMock()
+            client_socket.sendmsg.side_effect = lambda buffers, *args: sum(map(len, buffers))
+            server.account_list.create_account(username)
+            server.process_new_client({'uuid': uuid}, client_socket, threading.Lock())
+            server.logged_in.login(username, uuid)
+            server.undelivered_msg.add_message(username, "howie", "hello")
+        workers = {recipient: server.delivery_worker_of(recipient) for recipient in ["kevin", "joseph"]}
+        self.assertEqual(sorted(workers.values()), [0, 1])
+        # Each worker only reads its own partition, so it goes on while the other worker's partition is locked
+        for (recipient, worker) in workers.items():
+            self.assertEqual(server.undelivered_msg.partitions[worker].recipients(), [recipient])
+            with server.undelivered_msg_locks.locks[1 - worker]:
+                delivery = threading.Thread(target=server.handle_undelivered_messages, args=(worker,))
+                delivery.start()
+                delivery.join(5)
+                self.assertFalse(delivery.is_alive())
+            self.assertEqual(server.in_flight.get(recipient), server.undelivered_msg.queued_ids(recipient).stop)
+        self.assertEqual(len(server.in_flight), 2)
+        for delivery_workers in [0, 3]:
+            with self.assertRaises(ValueError):
+                Server(TEST_CONFIG, 1, TEST_PROTOCOL, self.make_storage(), delivery_workers=delivery_workers)
+
+    def test_ack_messages(self):
+        for message in ["first", "second", "third"]:
+            self.server.undelivered_msg.add_message("kevin", "howie", message)
+        first = self.server.undelivered_msg.queued_ids("kevin").start
+        self.server.handle_undelivered_messages()
+        # Acknowledgements for another account are ignored
+        self.assertIsNone(self.server.process_ack_messages(
+            {'recipient': 'howie', 'message_id': str(first + 2)}, self.mock_kevin_socket, self.mock_kevin_lock))
+        self.assertEqual(len(self.server.undelivered_msg.undelivered_msg["kevin"]), 3)
+        self.assertIsNone(self.server.process_ack_messages(
+            {'recipient': 'kevin', 'message_id': str(first + 1)}, self.mock_kevin_socket, self.mock_kevin_lock))
+        self.assertEqual(self.server.undelivered_msg.undelivered_msg["kevin"], [("howie", "third")])
+        # Acknowledging again does nothing
+        self.server.process_ack_messages(
+            {'recipient': 'kevin', 'message_id': str(first)}, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(self.server.undelivered_msg.queued_ids("kevin"), range(first + 2, first + 3))
+        self.server.process_ack_messages(
+            {'recipient': 'kevin', 'message_id': str(first + 2)}, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertNotIn("kevin", self.server.undelivered_msg.undelivered_msg)
+        self.assertNotIn("kevin", self.server.in_flight)
+
+    def test_login_resends_unacknowledged_messages(self):
+        queue = self.server.outbound[(self.mock_kevin_socket, self.mock_kevin_lock)]
+        for message in ["first", "second"]:
+            self.server.undelivered_msg.add_message("kevin", "howie", message)
+        first = self.server.undelivered_msg.queued_ids("kevin").start
+        self.server.handle_undelivered_messages()
+        self.server.process_ack_messages(
+            {'recipient': 'kevin', 'message_id': str(first)}, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertTrue(queue.wait_until_empty(5))
+        self.assertEqual(self.server.process_logoff(self.mock_kevin_socket, self.mock_kevin_lock)['status'], 'Success')
+        response = self.server.process_login({'username': 'kevin'}, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(response['status'], 'Success')
+        self.server.handle_undelivered_messages()
+        self.assertTrue(queue.wait_until_empty(5))
+        self.assertEqual(self.mock_kevin_socket.sendmsg.call_count, 2)
+        [packet] = map(bytes, self.mock_kevin_socket.sendmsg.call_args[0][0])
+        md = TEST_PROTOCOL.parse_metadata(packet)
+        args = TEST_PROTOCOL.parse_data(md.operation_code.value, packet[10:].decode('ascii')[:-1])
+        self.assertEqual(args['first_id'], str(first + 1))
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(args['messages']), [("howie", "second")])
+
+    def test_slow_client_does_not_block_delivery(self):
+        # Kevin's client never accepts any bytes
+        unblock = threading.Event()
+        self.mock_kevin_socket.sendmsg.side_effect = lambda buffers, *args: unblock.wait() and sum(map(len, buffers))
+        joseph_socket = MagicMock()
+        joseph_socket.sendmsg.side_effect = lambda buffers, *args: sum(map(len, buffers))
+        joseph_lock = threading.Lock()
+        self.server.account_list.create_account("joseph")
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, joseph_socket, joseph_lock)
+        self.server.logged_in.login("joseph", JOSEPH_UUID)
+        try:
+            for i in range(3):
+                self.server.undelivered_msg.add_message("kevin", "howie", f"hello {i}")
+                self.server.undelivered_msg.add_message("joseph", "howie", f"hi {i}")
+                self.server.handle_undelivered_messages()
+            self.assertTrue(self.server.outbound[(joseph_socket, joseph_lock)].wait_until_empty(5))
+            self.assertEqual(sum(len(call[0][0]) for call in joseph_socket.sendmsg.call_args_list), 3)
+            self.assertEqual(self.server.in_flight["joseph"], self.server.undelivered_msg.queued_ids("joseph").stop)
+            metrics = self.server.outbound_metrics()
+            self.assertEqual(metrics['connections'], 3)
+            # Kevin's first batch is being written, and the later ones wait in his queue
+            self.assertEqual(metrics['max_depth'], 2)
+        finally:
+            unblock.set()
+
+    def test_full_queue_leaves_messages_undelivered(self):
+        queue = self.server.outbound[(self.mock_kevin_socket, self.mock_kevin_lock)]
+        queue.limits = OutboundLimits(max_queued_messages=1)
+        # Kevin's client never accepts any bytes
+        unblock = threading.Event()
+        self.mock_kevin_socket.sendmsg.side_effect = lambda buffers, *args: unblock.wait() and sum(map(len, buffers))
+        try:
+            self.server.undelivered_msg.add_message("kevin", "howie", "first")
+            self.server.handle_undelivered_messages()
+            # Wait for the writer to take the first batch
+            deadline = time.monotonic() + 5
+            while not queue.writing and time.monotonic() < deadline:
+                time.sleep(0.001)
+            for message in ["second", "third"]:
+                self.server.undelivered_msg.add_message("kevin", "howie", message)
+                self.server.handle_undelivered_messages()
+            # The first batch is being written and the second fills the queue, so the third waits its turn
+            self.assertEqual(self.server.in_flight["kevin"], self.server.undelivered_msg.queued_ids("kevin")[-1])
+            self.assertFalse(queue.closed)
+        finally:
+            unblock.set()
+
+    def test_admitted_request_is_answered(self):
+        done = threading.Semaphore(0)
+        self.mock_kevin_socket.sendmsg.side_effect = lambda buffers, *args: done.release() or sum(map(len, buffers))
+        [packet] = TEST_PROTOCOL.encode('LIST_ACCOUNTS', 0, {'query': 'kev'})
+        self.server.admit_operation_curried(self.mock_kevin_lock)(
+            self.mock_kevin_socket, TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 5)
+        # The request is answered by a worker of the pool
+        self.assertTrue(done.acquire(timeout=5))
+        [packet] = map(bytes, self.mock_kevin_socket.sendmsg.call_args[0][0])
+        self.assertEqual(TEST_PROTOCOL.parse_metadata(packet).operation_code.name, 'LIST_ACCOUNTS_RESPONSE')
+        self.assertEqual(self.server.admission_metrics()['admitted'], 1)
+
+    def test_busy_when_request_pool_is_full(self):
+        self.server.requests = RequestPool(AdmissionLimits(max_workers=1, max_queued_requests=1))
+        unblock = threading.Event()
+        try:
+            self.server.requests.submit("howie", 'SEND_MESSAGE', unblock.wait)
+            while self.server.requests.depth():
+                time.sleep(0.001)
+            self.server.requests.submit("joseph", 'SEND_MESSAGE', unblock.wait)
+            [packet] = TEST_PROTOCOL.encode('LIST_ACCOUNTS', 0, {'query': 'kev'})
+            self.server.admit_operation_curried(self.mock_kevin_lock)(
+                self.mock_kevin_socket, TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 5)
+            # The request is turned away on the connection's thread
+            self.assertTrue(self.server.outbound[(self.mock_kevin_socket, self.mock_kevin_lock)].wait_until_empty(5))
+            [packet] = map(bytes, self.mock_kevin_socket.sendmsg.call_args[0][0])
+            md = TEST_PROTOCOL.parse_metadata(packet)
+            self.assertEqual(md.operation_code.name, 'BUSY')
+            args = TEST_PROTOCOL.parse_data(md.operation_code.value, packet[10:].decode('ascii')[:-1])
+            self.assertEqual(args['operation'], 'LIST_ACCOUNTS')
+            self.assertEqual(args['status'], 'Error: The server is busy, please try again later.')
+            self.assertEqual(self.server.admission_metrics()['queue_full'], 1)
+        finally:
+            unblock.set()
+
+    def test_disconnect_waits_for_running_login(self):
+        self.server.account_list.create_account("joseph")
+        # A real connection, as the response to the login is written to it by the writer thread of its queue
+        (server_socket, client_socket) = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        self.addCleanup(server_socket.close)
+        joseph = (server_socket, threading.Lock())
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, *joseph)
+        replicating = threading.Event()
+        unblock = threading.Event()
+        self.server.replicate = lambda operation, args: replicating.set() or unblock.wait(5)
+        [packet] = TEST_PROTOCOL.encode('LOG_IN', 0, {'username': 'joseph'})
+        self.server.admit_operation_curried(joseph[1])(
+            joseph[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 0)
+        self.assertTrue(replicating.wait(5))
+        # The connection ends while the login is replicated
+        disconnect = threading.Thread(target=self.server.disconnect_client, args=joseph)
+        disconnect.start()
+        disconnect.join(0.1)
+        self.assertTrue(disconnect.is_alive())
+        unblock.set()
+        disconnect.join(5)
+        self.assertFalse(self.server.logged_in.username_is_logged_in("joseph"))
+
+    def test_negotiated_header_version(self):
+        done = threading.Semaphore(0)
+        for (versions, version) in [('1,2', 2), ('1', 1)]:
+            client = (MagicMock(), threading.Lock())
+            client[0].sendmsg.side_effect = lambda buffers, *args: done.release() or sum(map(len, buffers))
+            process_operation = self.server.process_operation_curried(client[1])
+            [packet] = TEST_PROTOCOL.encode('REGISTER_CLIENT_UUID', 0, {'uuid': JOSEPH_UUID, 'versions': versions})
+            process_operation(client[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 0)
+            # Requests stay version 1, and responses to the client come in the version it reads
+            [packet] = TEST_PROTOCOL.encode('LIST_ACCOUNTS', 7, {'query': 'kev'})
+            process_operation(client[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 1)
+            self.assertTrue(done.acquire(timeout=5))
+            [packet] = map(bytes, client[0].sendmsg.call_args[0][0])
+            md = TEST_PROTOCOL.parse_metadata(packet)
+            self.assertEqual((md.version, md.message_id, md.operation_code.name),
+                             (version, 7, 'LIST_ACCOUNTS_RESPONSE'))
+            self.server.disconnect_client(*client)
+            self.assertNotIn(client, self.server.connection_protocols)
+
+    def test_negotiated_compression(self):
+        for i in range(100):
+            self.server.account_list.create_account(f"user{i}")
+        done = threading.Semaphore(0)
+        # Compression needs the flags of version 2 headers
+        for (versions, flags) in [('1,2', FLAG_COMPRESSED), ('1', 0)]:
+            client = (MagicMock(), threading.Lock())
+            client[0].sendmsg.side_effect = lambda buffers, *args: done.release() or sum(map(len, buffers))
+            process_operation = self.server.process_operation_curried(client[1])
+            [packet] = TEST_PROTOCOL.encode('REGISTER_CLIENT_UUID', 0,
+                                            {'uuid': JOSEPH_UUID, 'versions': versions, 'compression': 'zlib'})
+            process_operation(client[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 0)
+            [packet] = TEST_PROTOCOL.encode('LIST_ACCOUNTS', 7, {'query': 'user'})
+            process_operation(client[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 1)
+            self.assertTrue(done.acquire(timeout=5))
+            stream = b''.join(map(bytes, client[0].sendmsg.call_args[0][0]))
+            reader = MagicMock()
+            reader.recv.side_effect = [stream, b'']
+            processFn = MagicMock()
+            TEST_PROTOCOL.read_packets(reader, processFn)
+            (_, md, msg, _) = processFn.call_args[0]
+            self.assertEqual(md.flags, flags)
+            accounts = TEST_PROTOCOL.parse_data(md.operation_code.value, msg)['accounts'].split(';')
+            self.assertEqual(sorted(accounts), sorted(f"user{i}" for i in range(100)))
+            self.server.disconnect_client(*client)
+
+    def test_subscribe_presence(self):
+        joseph = (MagicMock(), threading.Lock())
+        joseph[0].sendmsg.side_effect = lambda buffers, *args: sum(map(len, buffers))
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, *joseph)
+        process_operation = self.server.process_operation_curried(joseph[1])
+        [packet] = TEST_PROTOCOL.encode('SUBSCRIBE_PRESENCE', 4, {'usernames': 'kevin;nobody', 'query': 'ho'})
+        process_operation(joseph[0], TEST_PROTOCOL.parse_metadata(packet), packet[10:].decode('ascii')[:-1], 0)
+        self.server.logged_in.logoff("kevin")
+        self.server.account_list.create_account("hollis")
+        self.server.account_list.create_account("joseph")
+        self.assertTrue(self.server.outbound[joseph].wait_until_empty(5))
+        self.server.disconnect_client(*joseph)
+        self.server.logged_in.logoff("howie")
+        self.assertEqual(self.server.presence.subscriptions, {})
+
+        stream = b''.join(bytes(buffer) for call in joseph[0].sendmsg.call_args_list for buffer in call[0][0])
+        reader = MagicMock()
+        reader.recv.side_effect = [stream, b'']
+        processFn = MagicMock()
+        TEST_PROTOCOL.read_packets(reader, processFn)
+        received = [(md.operation_code.name, md.message_id, TEST_PROTOCOL.parse_data(md.operation_code.value, msg))
+                    for (_, md, msg, _) in (call[0] for call in processFn.call_args_list)]
+        # The accounts watched and the ones logged in, then the events about them
+        self.assertEqual(received[0], ('SUBSCRIBE_PRESENCE_RESPONSE', 4,
+                                       {'status': 'Success', 'accounts': 'howie;kevin', 'online': 'howie;kevin'}))
+        self.assertEqual([(op, args) for (op, _, args) in received[1:]],
+                         [('PRESENCE_EVENT', {'event': 'offline', 'username': 'kevin'}),
+                          ('PRESENCE_EVENT', {'event': 'created', 'username': 'hollis'})])
+
+    def test_subscribe_presence_bad_regex(self):
+        response = self.server.process_subscribe_presence(
+            {'usernames': '', 'query': '('}, self.mock_kevin_socket, self.mock_kevin_lock, 0)
+        [packet] = response
+        md = TEST_PROTOCOL.parse_metadata(packet)
+        self.assertEqual(TEST_PROTOCOL.parse_data(md.operation_code.value, packet[10:].decode('ascii')[:-1])['status'],
+                         'Error: regex is malformed.')
+
+    def test_get_history(self):
+        for message in ["one", "two", "three"]:
+            self.server.process_send_msg({'recipient': 'howie', 'message': message}, self.mock_kevin_socket,
+                                         self.mock_kevin_lock)
+        self.server.process_send_msg({'recipient': 'kevin', 'message': 'four'}, self.mock_howie_socket,
+                                     self.mock_howie_lock)
+        args = {'peer': 'howie', 'before': '', 'limit': '3'}
+        response = self.server.process_get_history(args, self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(response['status'], 'Success')
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(response['messages']),
+                         [('kevin', 'two'), ('kevin', 'three'), ('howie', 'four')])
+        timestamps = [int(timestamp) for timestamp in response['timestamps'].split(',')]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(response['next'], timestamps[0])
+        # The next page is older, and the last one, whichever account of the conversation asks
+        args.update(peer='kevin', before=str(response['next']))
+        response = self.server.process_get_history(args, self.mock_howie_socket, self.mock_howie_lock)
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(response['messages']), [('kevin', 'one')])
+        self.assertEqual(response['next'], '')
+        # Delivering the messages keeps them in the history
+        self.server.undelivered_msg.consume_messages('howie', 3)
+        response = self.server.process_get_history(args, self.mock_howie_socket, self.mock_howie_lock)
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(response['messages']), [('kevin', 'one')])
+
+    def test_get_history_fail(self):
+        joseph = (MagicMock(), threading.Lock())
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, *joseph)
+        response = self.server.process_get_history({'peer': 'howie', 'before': '', 'limit': '10'}, *joseph)
+        self.assertEqual(response['status'], 'Error: Need to be logged in to get message history.')
+        response = self.server.process_get_history({'peer': 'howie', 'before': 'yesterday', 'limit': '10'},
+                                                   self.mock_kevin_socket, self.mock_kevin_lock)
+        self.assertEqual(response['status'], 'Error: before and limit must be integers.')
+
     def test_delete_account_success(self):
         uuid = self.server.logged_in.logged_in["kevin"]
         (client_socket, socket_lock) = [
@@ -176,11 +549,282 @@ class ServerTest(unittest.TestCase):
         response = self.server.process_update_message_state(args)
         self.assertTrue(len(self.server.undelivered_msg.undelivered_msg['kevin']) >0)
         
+    def test_update_message_ack(self):
+        for message in ["first", "second"]:
+            self.server.undelivered_msg.add_message("kevin", "howie", message)
+        first = self.server.undelivered_msg.queued_ids("kevin").start
+        self.server.process_update_message_ack({'recipient': 'kevin', 'message_id': str(first)})
+        self.assertEqual(self.server.undelivered_msg.undelivered_msg['kevin'], [("howie", "second")])
+
+    def test_update_messages_over_limits(self):
+        # A replica queues every message its primary accepted, even past its own limits
+        self.server.undelivered_msg.limits = MessageLimits(max_messages_per_recipient=1)
+        for message in ["first", "second"]:
+            self.server.process_update_message_state(
+                {'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': message})
+        self.server.process_update_group_message_state(
+            {'recipients': 'kevin;howie', 'sender': 'joseph', 'message': 'Hello world!'})
+        self.assertEqual(len(self.server.undelivered_msg.undelivered_msg['kevin']), 3)
+
+    def test_expired_messages_are_dropped_by_the_primary(self):
+        self.server.undelivered_msg.limits = MessageLimits(ttl_seconds=60)
+        for message in ["first", "second"]:
+            self.server.undelivered_msg.add_message("kevin", "howie", message)
+        ids = self.server.undelivered_msg.queued_ids("kevin")
+        self.server.replicate = MagicMock()
+        # Replicas only note the expired messages
+        with mock.patch('time.time', return_value=time.time() + 62):
+            self.assertEqual(self.server.note_expired_messages(), {'kevin': ids[-1]})
+        self.assertEqual(len(self.server.undelivered_msg.undelivered_msg['kevin']), 2)
+        # The primary replicates dropping them
+        self.server.handle_undelivered_messages()
+        self.server.replicate.assert_called_once_with('UPDATE_MESSAGE_ACK', {'recipient': 'kevin',
+                                                                             'message_id': ids[-1]})
+        self.assertNotIn('kevin', self.server.undelivered_msg.undelivered_msg)
+        self.assertEqual(self.server.note_expired_messages(), {})
+
+    def test_replicated_messages_expire_from_their_timestamp(self):
+        self.server.undelivered_msg.limits = MessageLimits(ttl_seconds=60)
+        queued = int((time.time() - 50) * 1_000_000)
+        self.server.process_update_message_state(
+            {'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': 'Hello', 'timestamp': str(queued)})
+        self.server.process_update_group_message_state(
+            {'recipients': 'kevin;howie', 'sender': 'joseph', 'message': 'Hi all', 'timestamp': str(queued + 1)})
+        # The primary queued them 50 seconds ago, so they expire 10 seconds from now on every replica
+        with mock.patch('time.time', return_value=time.time() + 12):
+            self.assertEqual(self.server.note_expired_messages(),
+                             {'kevin': self.server.undelivered_msg.queued_ids('kevin')[-1],
+                              'howie': self.server.undelivered_msg.queued_ids('howie')[-1]})
+
+    def test_update_group_messages(self):
+        args = {'recipients': 'kevin;howie', 'sender': 'joseph', 'message': 'Hello world!'}
+        self.server.process_update_group_message_state(args)
+        for recipient in ["kevin", "howie"]:
+            self.assertEqual(self.server.undelivered_msg.undelivered_msg[recipient], [("joseph", "Hello world!")])
+
+    def test_update_history(self):
+        now = int(time.time() * 1_000_000)
+        self.server.process_update_message_state(
+            {'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': 'Hello', 'timestamp': str(now)})
+        self.server.process_update_group_message_state(
+            {'recipients': 'kevin;howie', 'sender': 'joseph', 'message': 'Hi all', 'timestamp': str(now + 1)})
+        # Updates without a timestamp only queue the message
+        self.server.process_update_message_state(
+            {'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': 'Bye'})
+        self.assertEqual(self.server.history.get_page('kevin', 'howie'), ([(now, 'howie', 'Hello')], None))
+        self.assertEqual(self.server.history.get_page('joseph', 'howie'), ([(now + 1, 'joseph', 'Hi all')], None))
+        # Timestamps assigned after a failover are newer than the replicated ones
+        self.assertGreater(self.server.history.next_timestamp(now=0), now + 1)
+
     def test_update_addall_messages(self):
         args = {'add_one': 'False', 'recipient': 'kevin', 'sender': 'howie\rjoseph', 'message': 'Hello world!\rsup'}
         response = self.server.process_update_message_state(args)
         self.assertTrue(len(self.server.undelivered_msg.undelivered_msg['kevin']) >1)
 
+
+class FailoverTest(unittest.TestCase):
+    """A primary replicating to one replica, which takes over once the primary fails."""
+    def make_storage(self, name):
+        return FileStorage(os.path.join(self.directory, name))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = [{"host": TEST_HOST, "port": 6000, "id": 1}, {"host": TEST_HOST, "port": 6001, "id": 2}]
+        (self.primary, self.replica) = [Server(config, server_id, TEST_PROTOCOL, self.make_storage(str(server_id)))
+                                        for server_id in [1, 2]]
+        handlers = {'UPDATE_ACCOUNT_STATE': self.replica.process_update_accounts,
+                    'UPDATE_LOGIN_STATE': self.replica.process_update_login,
+                    'UPDATE_MESSAGE_STATE': self.replica.process_update_message_state,
+                    'UPDATE_GROUP_MESSAGE_STATE': self.replica.process_update_group_message_state,
+                    'UPDATE_MESSAGE_ACK': self.replica.process_update_message_ack}
+        # Updates reach the replica with their arguments as strings, as they are on the wire
+        self.primary.replicate = lambda operation, args: handlers[operation](
+            {key: str(value) for (key, value) in args.items()})
+        for username in ["kevin", "howie"]:
+            self.primary.wait_for_update_accounts_ack("True", username)
+            self.primary.account_list.create_account(username)
+        self.kevin = (MagicMock(), threading.Lock())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pending_ids_ack_on_new_primary_after_cap_and_expiry(self):
+        ttl = MessageLimits(ttl_seconds=60)
+        self.primary.undelivered_msg.limits = ttl
+        # A replica with a smaller cap still queues every message the primary accepted, as when concurrent
+        # senders take the primary past its cap
+        self.replica.undelivered_msg.limits = MessageLimits(max_messages_per_recipient=2, ttl_seconds=60)
+        start = time.time()
+        with mock.patch('time.time', return_value=start):
+            for message in ["first", "second", "third"]:
+                self.primary.queue_message("kevin", "howie", message)
+        with mock.patch('time.time', return_value=start + 30):
+            self.primary.queue_message("kevin", "howie", "fourth")
+            self.primary.queue_message("kevin", "howie", "fifth")
+        with mock.patch('time.time', return_value=start + 62):
+            self.primary.handle_undelivered_messages()
+        # A replica whose clock is ahead leaves expiring the rest to the primary
+        with mock.patch('time.time', return_value=start + 100):
+            self.replica.note_expired_messages()
+        pending = self.primary.undelivered_msg.queued_ids("kevin")
+        self.assertEqual(self.primary.undelivered_msg.get_recipient_messages("kevin"),
+                         [("howie", "fourth"), ("howie", "fifth")])
+
+        # The primary fails, and the client acknowledges the messages it received to the new primary
+        self.replica.process_new_client({'uuid': KEVIN_UUID}, *self.kevin)
+        self.replica.logged_in.login("kevin", KEVIN_UUID)
+        self.assertEqual(self.replica.undelivered_msg.queued_ids("kevin"), pending)
+        self.replica.process_ack_messages({'recipient': 'kevin', 'message_id': str(pending[0])}, *self.kevin)
+        self.assertEqual(self.replica.undelivered_msg.get_recipient_messages("kevin"), [("howie", "fifth")])
+        # The new primary drops the expired messages its old primary did not
+        self.replica.replicate = MagicMock()
+        with mock.patch('time.time', return_value=start + 100):
+            self.replica.expire_messages()
+        self.replica.replicate.assert_called_once_with('UPDATE_MESSAGE_ACK',
+                                                       {'recipient': 'kevin', 'message_id': pending[-1]})
+        self.assertEqual(self.replica.undelivered_msg.queued_ids("kevin"), range(0))
+
+
+class SqliteFailoverTest(FailoverTest):
+    """Runs the failover tests against the SQLite storage backend."""
+    def make_storage(self, name):
+        return SqliteStorage(os.path.join(self.directory, f"{name}.db"))
+
+    def tearDown(self):
+        for server in [self.primary, self.replica]:
+            server.storage.close()
+        super().tearDown()
+
+
+class ShardedServerTest(unittest.TestCase):
+    """Two replica groups of one server each, with accounts sharded across them."""
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind((TEST_HOST, 0))
+        self.listener.listen()
+        groups = [[{"host": TEST_HOST, "port": 6000, "id": 1}],
+                  [{"host": TEST_HOST, "port": self.listener.getsockname()[1], "id": 2}]]
+        self.directory = tempfile.mkdtemp()
+        self.servers = [Server(groups[shard], shard + 1, TEST_PROTOCOL,
+                               SqliteStorage(os.path.join(self.directory, f"{shard}.db")), groups=groups)
+                        for shard in range(2)]
+        self.servers[1].primary_id = 2
+        threading.Thread(target=self.accept, daemon=True).start()
+        # Accounts of each shard
+        self.local = [name for name in (f"user{i}" for i in range(100)) if shard_of(name, 2) == 0][:2]
+        self.remote = [name for name in (f"user{i}" for i in range(100)) if shard_of(name, 2) == 1][:2]
+        for name in self.local:
+            self.servers[0].account_list.create_account(name)
+        for name in self.remote:
+            self.servers[1].account_list.create_account(name)
+        self.client = (MagicMock(), threading.Lock())
+        self.servers[0].process_new_client({'uuid': KEVIN_UUID}, *self.client)
+        self.servers[0].logged_in.login(self.local[0], KEVIN_UUID)
+
+    def accept(self):
+        while True:
+            try:
+                (connection, _) = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.servers[1].handle_connection, args=(connection, threading.Lock()),
+                             daemon=True).start()
+
+    def close_listener(self):
+        if self.listener.fileno() != -1:
+            self.listener.shutdown(socket.SHUT_RDWR)
+            self.listener.close()
+
+    def tearDown(self):
+        self.close_listener()
+        shutil.rmtree(self.directory)
+
+    def test_accounts_belong_to_their_shard(self):
+        joseph = (MagicMock(), threading.Lock())
+        self.servers[0].process_new_client({'uuid': JOSEPH_UUID}, *joseph)
+        response = self.servers[0].process_create_account({'username': self.remote[1]}, *joseph)
+        self.assertEqual(response['status'], 'Error: The account belongs to another server.')
+
+    def test_send_msg_forwarded_to_other_shard(self):
+        response = self.servers[0].process_send_msg({'recipient': self.remote[0], 'message': 'hello'}, *self.client)
+        self.assertEqual(response['status'], 'Success')
+        self.assertEqual(self.servers[1].undelivered_msg.undelivered_msg[self.remote[0]], [(self.local[0], 'hello')])
+        self.assertNotIn(self.remote[0], self.servers[0].undelivered_msg.undelivered_msg)
+        response = self.servers[0].process_send_msg({'recipient': 'user1000000', 'message': 'hello'}, *self.client)
+        self.assertEqual(response['status'], 'Error: The recipient of the message does not exist.')
+
+    def test_group_message_split_by_shard(self):
+        recipients = [self.local[1], self.remote[0], 'nobody', self.remote[1]]
+        response = self.servers[0].process_send_group_message(
+            {'recipients': ';'.join(recipients), 'message': 'hello all'}, *self.client)
+        self.assertEqual(response, {'status': 'Success', 'failed': 'nobody'})
+        self.assertEqual(self.servers[0].undelivered_msg.undelivered_msg[self.local[1]], [(self.local[0], 'hello all')])
+        for name in self.remote:
+            self.assertEqual(self.servers[1].undelivered_msg.undelivered_msg[name], [(self.local[0], 'hello all')])
+
+    def test_list_accounts_of_every_shard(self):
+        response = self.servers[0].process_list_accounts({'query': 'user'})
+        self.assertEqual(response['status'], 'Success')
+        self.assertEqual(sorted(response['accounts'].split(';')), sorted(self.local + self.remote))
+
+    def test_history_of_conversation_across_shards(self):
+        for message in ["one", "two"]:
+            self.servers[0].process_send_msg({'recipient': self.remote[0], 'message': message}, *self.client)
+        self.servers[0].queue_message(self.local[0], self.remote[0], "three")
+        args = {'peer': self.remote[0], 'before': '', 'limit': '2'}
+        response = self.servers[0].process_get_history(args, *self.client)
+        self.assertEqual(response['status'], 'Success')
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(response['messages']),
+                         [(self.local[0], 'two'), (self.remote[0], 'three')])
+        args['before'] = str(response['next'])
+        response = self.servers[0].process_get_history(args, *self.client)
+        self.assertEqual(TEST_PROTOCOL.unpack_messages(response['messages']), [(self.local[0], 'one')])
+        self.assertEqual(response['next'], '')
+
+    def test_history_pages_across_shards_with_the_same_timestamps(self):
+        now = self.servers[0].history.next_timestamp()
+        for timestamp in [now, now + 1]:
+            self.servers[0].history.add_message([self.local[0]], self.remote[0], f"to local at {timestamp}", timestamp)
+            self.servers[1].history.add_message([self.remote[0]], self.local[0], f"to remote at {timestamp}",
+                                                timestamp)
+        # Pages of one message each end between the messages of both groups with the same timestamp
+        (args, messages) = ({'peer': self.remote[0], 'before': '', 'limit': '1'}, [])
+        while True:
+            response = self.servers[0].process_get_history(args, *self.client)
+            self.assertEqual(response['status'], 'Success')
+            messages = [message for (_, message) in TEST_PROTOCOL.unpack_messages(response['messages'])] + messages
+            if not response['next']:
+                break
+            args['before'] = response['next']
+        self.assertEqual(messages, [f"to {group} at {timestamp}" for timestamp in [now, now + 1]
+                                    for group in ["local", "remote"]])
+
+    def test_unavailable_shard(self):
+        self.close_listener()
+        response = self.servers[0].process_send_msg({'recipient': self.remote[0], 'message': 'hello'}, *self.client)
+        self.assertEqual(response['status'], 'Error: The recipient\'s server is unavailable, please try again later.')
+
+
+class SqliteServerTest(ServerTest):
+    """Runs the server tests against the SQLite storage backend."""
+    def make_storage(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = SqliteStorage(os.path.join(directory, 'state.db'))
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_create_account_is_one_transaction(self):
+        joseph_socket = MagicMock()
+        joseph_lock = threading.Lock()
+        self.server.process_new_client({'uuid': JOSEPH_UUID}, joseph_socket, joseph_lock)
+        statements = []
+        self.server.storage.connection.set_trace_callback(statements.append)
+        response = self.server.process_create_account({"username": "joseph"}, joseph_socket, joseph_lock)
+        self.server.storage.connection.set_trace_callback(None)
+        self.assertEqual(response['status'], 'Success')
+        self.assertEqual(len([statement for statement in statements if statement.startswith('BEGIN')]), 1)
+        self.assertEqual(statements.count('COMMIT'), 1)
     
 
 
@@ -1,46 +1,92 @@
-import os
+from utils.identity_table import IdentityTable
+from utils.record_file import DEFAULT_DURABILITY, Durability, RecordFile
+from utils.storage import ACCOUNT_CREATED, ACCOUNT_REMOVED, AccountStore
 
-class AccountList:
-    """A class to manage the list of existing accounts.  The list is in memory and also in a file for persistence."""
-    def __init__(self, filename: str):
+# Number of records on disk below which the file is never compacted
+MIN_COMPACTION_SIZE = 1024
+
+
+class AccountList(AccountStore):
+    """A class to manage the list of existing accounts.  The list is in memory and also in a file for persistence.
+    The file is a record file of ('+', username) and ('-', username) entries that is compacted once most of its
+    records are stale. In memory, accounts are kept by their id in the identity table."""
+    def __init__(self, filename: str, durability: Durability = DEFAULT_DURABILITY, identities: IdentityTable = None):
         self.filename = filename
-        
-        self.account_list = []
-        if os.path.exists(filename):
-            # Read in file to populate account list
-            with open(self.filename, 'r') as f:
-                lines = f.readlines()
-            self.account_list = [line.strip() for line in lines if line.strip()]
+        self.file = RecordFile(filename, durability)
+        self.identities = identities if identities is not None else IdentityTable()
+
+        # Replay the file to populate the accounts
+        self.live = bytearray()  # Flag of every account id, set if the account exists
+        self.count = 0  # Number of existing accounts
+        self.records_on_disk = 0
+        for op, username in self.file.read():
+            self.records_on_disk += 1
+            self._set_live(username, op == '+')
+
+    @property
+    def account_list(self):
+        """List of the usernames of all accounts in the order their ids were assigned, which is creation order
+        unless an account was deleted and created again."""
+        return [self.identities.name(account_id) for account_id in self.account_ids()]
+
+    def account_ids(self):
+        """Yield the id of every account."""
+        for account_id, live in enumerate(self.live):
+            if live:
+                yield account_id
+
+    def _set_live(self, username: str, live: bool):
+        """Set the flag of an account. An existing account holds a reference to its id."""
+        if live == self.contains(username):
+            return
+        if live:
+            account_id = self.identities.acquire(username)
+            if account_id >= len(self.live):
+                self.live.extend(bytes(account_id + 1 - len(self.live)))
+            self.live[account_id] = True
+            self.count += 1
+        else:
+            account_id = self.identities.get(username)
+            self.live[account_id] = False
+            self.count -= 1
+            self.identities.drop((account_id,))
 
     def create_account(self, username: str):
         """Add an account to the list and write it to the file."""
-        self.account_list.append(username)
-        with open(self.filename, 'a') as f:
-            f.write(f"{username}\n")
-            f.flush()
+        self._set_live(username, True)
+        self.file.append(('+', username))
+        self.records_on_disk += 1
+        self._notify(ACCOUNT_CREATED, username)
 
     def remove(self, username: str):
-        """Remove an account from the list and remove it from the file."""
-        self.account_list.remove(username)
-        with open(self.filename, 'r') as f:
-            lines = f.readlines()
-        with open(self.filename, 'w') as f:
-            f.writelines(filter(lambda line: line.strip() and line.strip().split()[0] != username, lines))
-            f.flush()
+        """Remove an account from the list and record the removal in the file."""
+        self._set_live(username, False)
+        self.file.append(('-', username))
+        self.records_on_disk += 1
+        self._compact_if_stale()
+        self._notify(ACCOUNT_REMOVED, username)
+
+    def _compact_if_stale(self):
+        """Rewrite the file with only the live accounts once most of the records in it are stale."""
+        if self.records_on_disk > max(MIN_COMPACTION_SIZE, 2 * self.count):
+            self.file.rewrite(('+', username) for username in self.account_list)
+            self.records_on_disk = self.count
 
     def contains(self, username: str):
         """Check if an account is in the list."""
-        return username in self.account_list
+        account_id = self.identities.get(username)
+        return account_id is not None and account_id < len(self.live) and self.live[account_id] == 1
 
     def search_accounts(self, pattern):
         """
         Search for accounts that match a pattern.
-        
+
         Args:
             pattern (re.Pattern): A compiled regular expression pattern.
         """
         result = []
-        for account in self.account_list:
+        for account_id in self.account_ids():
+            account = self.identities.name(account_id)
             if pattern.match(account):
                 result.append(account)
         return result
@@ -49,6 +95,8 @@ class AccountList:
         """
         Clears the account list for testing purposes
         """
-        self.account_list = [] # Map of username to uuid
-        open(self.filename, 'w').close() 
-    
\ No newline at end of file
+        self.identities.drop(list(self.account_ids()))
+        self.live = bytearray()
+        self.count = 0
+        self.records_on_disk = 0
+        self.file.clear()
@@ -0,0 +1,104 @@
+import contextlib
+import os
+import re
+import shutil
+from utils.account_list import AccountList
+from utils.identity_table import IdentityTable
+from utils.logged_in_accounts import LoggedInAccounts
+from utils.message_history import MessageHistory
+from utils.record_file import DEFAULT_DURABILITY, Durability
+from utils.session_registry import SessionRegistry
+from utils.storage import DEFAULT_LIMITS, DEFAULT_RETENTION, HistoryRetention, MessageLimits, StorageBackend
+from utils.undelivered_messages import UndeliveredMessages
+
+
+class FileStorage(StorageBackend):
+    """Storage backend keeping each store in its own record files under a directory. Files can't be updated
+    atomically together, so transactions only group writes logically."""
+    def __init__(self, directory: str = 'logs', durability: Durability = DEFAULT_DURABILITY,
+                 limits: MessageLimits = DEFAULT_LIMITS, retention: HistoryRetention = DEFAULT_RETENTION):
+        self.directory = directory
+        self.durability = durability
+        self.limits = limits
+        self.retention = retention
+        self.identities = IdentityTable()  # Account ids shared by the stores
+        self.session_ids = IdentityTable()  # Session ids of the logged in uuids
+        os.makedirs(directory, exist_ok=True)
+
+    def account_list(self, server_id) -> AccountList:
+        return AccountList(os.path.join(self.directory, f"account_list_{server_id}.log"), self.durability,
+                           self.identities)
+
+    def logged_in_accounts(self, server_id) -> LoggedInAccounts:
+        return LoggedInAccounts(os.path.join(self.directory, f"logged_in_accounts_{server_id}.log"), self.durability,
+                                SessionRegistry(self.identities, self.session_ids))
+
+    def undelivered_messages(self, server_id) -> UndeliveredMessages:
+        return UndeliveredMessages(os.path.join(self.directory, f"undelivered_messages_{server_id}"),
+                                   durability=self.durability, limits=self.limits, identities=self.identities)
+
+    def undelivered_message_partitions(self, server_id, num_partitions: int, partition_of) -> list:
+        """Every partition has its own message log, in a directory of the partitions' directory. The number of
+        partitions is kept in a file next to it. When it changed since the last start, the messages are moved to
+        new partitions first, keeping their message ids, and a message sent to a group is stored once for each of
+        its recipients from then on."""
+        counter = os.path.join(self.directory, f"undelivered_messages_{server_id}.partitions")
+        current = 1
+        if os.path.exists(counter):
+            with open(counter) as file:
+                current = int(file.read())
+        if current != num_partitions:
+            self._repartition(server_id, current, num_partitions, partition_of)
+            with open(counter + '.tmp', 'w') as file:
+                file.write(str(num_partitions))
+            os.replace(counter + '.tmp', counter)
+        # Partitions of other counts are left by moves that ended, or were cut short before the count was written
+        for name in os.listdir(self.directory):
+            if (re.fullmatch(rf"undelivered_messages_{server_id}(_x\d+)?(\.tmp)?", name) and
+                    os.path.join(self.directory, name) != self._partitions_directory(server_id, num_partitions)):
+                shutil.rmtree(os.path.join(self.directory, name))
+        return [self._partition(server_id, index, num_partitions) for index in range(num_partitions)]
+
+    def _partitions_directory(self, server_id, num_partitions: int) -> str:
+        """Directory of the partitions of a server. A single partition is the store of undelivered_messages."""
+        if num_partitions == 1:
+            return os.path.join(self.directory, f"undelivered_messages_{server_id}")
+        return os.path.join(self.directory, f"undelivered_messages_{server_id}_x{num_partitions}")
+
+    def _partition(self, server_id, index: int, num_partitions: int, root: str = None, identities=None,
+                   first_seq: int = 0) -> UndeliveredMessages:
+        root = root if root is not None else self._partitions_directory(server_id, num_partitions)
+        return UndeliveredMessages(root if num_partitions == 1 else os.path.join(root, str(index)),
+                                   durability=self.durability, limits=self.limits,
+                                   identities=identities if identities is not None else self.identities,
+                                   first_seq=first_seq)
+
+    def _repartition(self, server_id, current: int, num_partitions: int, partition_of):
+        """Move the messages of current partitions to num_partitions new ones, written next to the partitions'
+        directory and moved in place once complete. Recipients are moved in name order, and the new logs start
+        after every sequence number of the old ones, so the replicas of a server give the moved messages, and
+        later ones, the same ids."""
+        # The stores only live during the move, so they keep their ids out of the shared table
+        identities = IdentityTable()
+        old = [self._partition(server_id, index, current, identities=identities) for index in range(current)]
+        first_seq = max(store.log.next_seq for store in old)
+        target = self._partitions_directory(server_id, num_partitions)
+        for directory in [target, target + '.tmp']:
+            shutil.rmtree(directory, ignore_errors=True)
+        new = [self._partition(server_id, index, num_partitions, target + '.tmp', identities, first_seq)
+               for index in range(num_partitions)]
+        moved = sorted(((recipient, store) for store in old for recipient in store.recipients()),
+                       key=lambda pair: pair[0])
+        for (recipient, store) in moved:
+            new[partition_of(recipient)].import_backlog(recipient, store.queued_messages(recipient),
+                                                        store.queued_ids(recipient).start)
+        for store in old + new:
+            store.close()
+        os.replace(target + '.tmp', target)
+
+    def message_history(self, server_id) -> MessageHistory:
+        return MessageHistory(os.path.join(self.directory, f"message_history_{server_id}"),
+                              durability=self.durability, retention=self.retention)
+
+    def transaction(self):
+        return contextlib.nullcontext()
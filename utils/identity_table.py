@@ -0,0 +1,173 @@
+import threading
+from array import array
+
+# Slots of the hash table of an IdentityTable that hold no id. Deleted slots keep the probe sequences going
+EMPTY = -1
+DELETED = -2
+# Number of arena bytes below which released names are never compacted away
+MIN_COMPACTION_SIZE = 4096
+
+
+class IdentityTable:
+    """Assigns dense integer ids to names, such as usernames or client uuids, so the structures holding server state
+    can be keyed by small integers instead of strings, and every name is stored once.
+
+    Names are packed one after another into a single UTF-8 arena, indexed by id, and found through an open addressing
+    hash table of ids, so an id costs the bytes of its name and about 30 more, instead of a string object, a dict
+    entry and list entries. A released name leaves a hole in the arena, which is compacted once the holes take half
+    of it.
+
+    Ids are assigned in order starting from 0, and the ids of released names are reused so the ids stay dense.
+    Ids only mean something to the table that assigned them, so they are never written to disk, and replication
+    sends a name the first time it refers to its id, see NameEncoder. The generation of an id counts how many times
+    it was released, so an id and its generation stand for one name for good. The table is shared by stores guarded
+    by different locks, so every call takes the lock of the table.
+
+    A table shared by several stores counts the references of every store holding an id with acquire and drop,
+    and releases the id with the last one. A table used by one owner releases ids itself with release."""
+    def __init__(self):
+        self.arena = bytearray()  # UTF-8 names of the ids, one after another
+        self.offsets = array('Q')  # Name of id i is arena[offsets[i]:offsets[i] + lengths[i]]
+        self.lengths = array('i')  # Length of the name of every id, -1 for released ids
+        self.references = array('I')  # Number of references acquired to every id
+        self.generations = array('I')  # Number of times every id was released
+        self.slots = array('i', [EMPTY] * 8)  # Hash table of ids by the hash of their name
+        self.count = 0  # Number of ids with a name
+        self.deleted = 0  # Number of DELETED slots
+        self.holes = 0  # Bytes of the arena taken by released names
+        self.free = array('i')  # Released ids, reused before assigning new ones
+        self.lock = threading.Lock()
+
+    def _find(self, encoded: bytes):
+        """Return the id of an encoded name, or None, and the slot of the hash table holding it or to insert it in."""
+        slots = self.slots
+        lengths = self.lengths
+        length = len(encoded)
+        mask = len(slots) - 1
+        i = hash(encoded) & mask
+        insert_at = None
+        while True:
+            id = slots[i]
+            if id == EMPTY:
+                return None, i if insert_at is None else insert_at
+            if id == DELETED:
+                if insert_at is None:
+                    insert_at = i
+            # Compared in place, without copying the name out of the arena
+            elif lengths[id] == length and self.arena.startswith(encoded, self.offsets[id]):
+                return id, i
+            i = (i + 1) & mask
+
+    def _assign(self, name: str) -> int:
+        encoded = name.encode('utf-8')
+        id, slot = self._find(encoded)
+        if id is None:
+            if self.free:
+                id = self.free.pop()
+                self.offsets[id] = len(self.arena)
+                self.lengths[id] = len(encoded)
+            else:
+                id = len(self.offsets)
+                self.offsets.append(len(self.arena))
+                self.lengths.append(len(encoded))
+                self.references.append(0)
+                self.generations.append(0)
+            self.arena += encoded
+            if self.slots[slot] == DELETED:
+                self.deleted -= 1
+            self.slots[slot] = id
+            self.count += 1
+            # The table is kept at most two thirds full, counting deleted slots, so probes stay short
+            if (self.count + self.deleted) * 3 > len(self.slots) * 2:
+                self._resize(len(self.slots) * 2 if self.count * 3 > len(self.slots) else len(self.slots))
+        return id
+
+    def _resize(self, size: int):
+        """Rebuild the hash table with size slots, dropping the deleted ones."""
+        self.slots = array('i', [EMPTY]) * size
+        self.deleted = 0
+        mask = size - 1
+        for id, length in enumerate(self.lengths):
+            if length >= 0:
+                i = hash(bytes(self.arena[self.offsets[id]:self.offsets[id] + length])) & mask
+                while self.slots[i] != EMPTY:
+                    i = (i + 1) & mask
+                self.slots[i] = id
+
+    def _release(self, id: int):
+        _, slot = self._find(self._encoded(id))
+        self.slots[slot] = DELETED
+        self.deleted += 1
+        self.holes += self.lengths[id]
+        self.lengths[id] = -1
+        self.references[id] = 0
+        self.generations[id] += 1
+        self.free.append(id)
+        self.count -= 1
+        if self.holes * 2 > len(self.arena) > MIN_COMPACTION_SIZE:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the arena without the names of released ids."""
+        arena = bytearray()
+        for id, length in enumerate(self.lengths):
+            if length >= 0:
+                offset = self.offsets[id]
+                self.offsets[id] = len(arena)
+                arena += self.arena[offset:offset + length]
+        self.arena = arena
+        self.holes = 0
+
+    def _encoded(self, id: int) -> bytes:
+        return bytes(self.arena[self.offsets[id]:self.offsets[id] + self.lengths[id]])
+
+    def intern(self, name: str) -> int:
+        """Return the id of a name, assigning the next id if it doesn't have one yet."""
+        with self.lock:
+            return self._assign(name)
+
+    def acquire(self, name: str) -> int:
+        """Return the id of a name, assigning the next id if it doesn't have one yet, and count a reference to it."""
+        with self.lock:
+            id = self._assign(name)
+            self.references[id] += 1
+        return id
+
+    def drop(self, ids):
+        """Drop a reference to each of the given ids, releasing the ids left without references."""
+        with self.lock:
+            for id in ids:
+                self.references[id] -= 1
+                if self.references[id] == 0:
+                    self._release(id)
+
+    def release(self, name: str):
+        """Release the id of a name so it can be reused. Only release a name once nothing refers to its id."""
+        with self.lock:
+            id, _ = self._find(name.encode('utf-8'))
+            if id is not None:
+                self._release(id)
+
+    def get(self, name: str):
+        """Return the id of a name, or None if it has no id."""
+        with self.lock:
+            return self._find(name.encode('utf-8'))[0]
+
+    def get_versioned(self, name: str):
+        """Return (id, generation) of a name, or None if it has no id."""
+        with self.lock:
+            id, _ = self._find(name.encode('utf-8'))
+            return None if id is None else (id, self.generations[id])
+
+    def name(self, id: int) -> str:
+        """Return the name of an id, or None if the id is released."""
+        with self.lock:
+            if self.lengths[id] < 0:
+                return None
+            return self.arena[self.offsets[id]:self.offsets[id] + self.lengths[id]].decode('utf-8')
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return self.count
@@ -1,50 +1,67 @@
-class LoggedInAccounts:
-    """Class to keep track of logged in accounts. A corresponding file keeps track of usernames and uuids that are logged in."""
-    def __init__(self, filename: str):
+from utils.record_file import DEFAULT_DURABILITY, Durability, RecordFile
+from utils.session_registry import SessionRegistry
+from utils.storage import LOGGED_IN, LOGGED_OFF, SessionStore
+
+# Number of records on disk below which the file is never compacted
+MIN_COMPACTION_SIZE = 1024
+
+
+class LoggedInAccounts(SessionStore):
+    """Class to keep track of logged in accounts. A corresponding record file keeps track of usernames and uuids
+    that are logged in, as ('+', username, uuid) and ('-', username) entries. In memory, sessions are kept in the
+    session registry, which the server also uses to find the clients of uuids."""
+    def __init__(self, filename: str, durability: Durability = DEFAULT_DURABILITY, registry: SessionRegistry = None):
+        """
+        Args:
+            filename (str): The record file of the sessions.
+            durability (Durability, optional): Durability setting for writes to the file.
+            registry (SessionRegistry, optional): Registry of the sessions and connected clients of the server.
+        """
         self.filename = filename
-        
-        self.logged_in = {}  # Map of username to uuid
-        open(self.filename, 'w').close()  # Clear the file
+        self.file = RecordFile(filename, durability)
+        self.registry = registry if registry is not None else SessionRegistry()
+
+        self.records_on_disk = 0
+        self.file.clear()  # Clear the file
+
+    @property
+    def logged_in(self):
+        """Map of username to uuid of every session."""
+        return self.registry.logged_in()
 
     def login(self, username: str, uuid: str):
-        """Add a new logged in account to the file and the map."""
-        self.logged_in[username] = uuid
-        with open(self.filename, "a") as f:
-            f.write(f"{username} {uuid}\n")
-            f.flush()
+        """Add a new logged in account to the file and the registry."""
+        self.registry.login(username, uuid)
+        self.file.append(('+', username, uuid))
+        self.records_on_disk += 1
+        self._notify(LOGGED_IN, username)
 
     def is_logged_in(self, uuid: str):
         """Check if a uuid is logged in."""
-        is_logged_in = uuid in self.logged_in.values()
-        return is_logged_in
+        return self.registry.is_logged_in(uuid)
 
     def username_is_logged_in(self, username: str):
         """Check if a username is logged in."""
-        is_logged_in = username in self.logged_in.keys()
-        return is_logged_in
-    
+        return self.registry.username_is_logged_in(username)
+
     def logoff(self, username: str):
-        """Remove a logged in account from the file and the map."""
-        if username in self.logged_in.keys():
-            self.logged_in.pop(username)
-
-            # Remove the username entry from the file by rewriting file with all lines except the one with the username
-            with open(self.filename, 'r') as f:
-                lines = f.readlines()
-            with open(self.filename, 'w') as f:
-                f.writelines(filter(lambda line: line.strip() and line.strip().split()[0] != username, lines))
-                f.flush()
-                    
+        """Remove a logged in account from the registry and record the removal in the file."""
+        if self.registry.logoff(username):
+            self.file.append(('-', username))
+            self.records_on_disk += 1
+
+            # Rewrite the file with only the live sessions once most of the records in it are stale
+            if self.records_on_disk > max(MIN_COMPACTION_SIZE, 2 * self.registry.session_count):
+                self.file.rewrite(('+', username, uuid) for username, uuid in self.logged_in.items())
+                self.records_on_disk = self.registry.session_count
+            self._notify(LOGGED_OFF, username)
             return True
         return False
 
     def get_username(self, uuid: str):
-        # Get the username corresponding to the uuid
-        usernameArr = [k for k, v in self.logged_in.items() if v == uuid]
-        if (len(usernameArr) > 0):
-            return usernameArr[0]
-        return None
-    
+        """Get the username corresponding to the uuid."""
+        return self.registry.get_username(uuid)
+
     def get_uuid_from_username(self, username: str):
         """Get the uuid corresponding to the username."""
-        return self.logged_in[username]
\ No newline at end of file
+        return self.registry.get_uuid(username)
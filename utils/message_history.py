@@ -0,0 +1,162 @@
+import bisect
+import time
+from array import array
+from utils.record_file import DEFAULT_DURABILITY, Durability
+from utils.segmented_log import SegmentedLog
+from utils.storage import DEFAULT_RETENTION, HistoryRetention, HistoryStore, conversation_of
+
+# Separates the timestamp, the sender and the recipients in the first field of a history record
+FIELD_SEPARATOR = '\0'
+
+
+class Conversation:
+    """Index of the messages of one conversation, sorted by timestamp. Message i has timestamps[i] and is the
+    record with sequence number seqs[i] in the history log."""
+    __slots__ = ('timestamps', 'seqs')
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.seqs = array('q')
+
+    def insert(self, timestamp: int, seq: int):
+        """Add a message. Messages nearly always come in timestamp order, so this is nearly always an append."""
+        i = bisect.bisect_right(self.timestamps, timestamp)
+        if i == len(self.timestamps):
+            self.timestamps.append(timestamp)
+            self.seqs.append(seq)
+        else:
+            self.timestamps.insert(i, timestamp)
+            self.seqs.insert(i, seq)
+
+    def trim(self, oldest: int):
+        """Drop the messages with a timestamp up to and including oldest."""
+        count = bisect.bisect_right(self.timestamps, oldest)
+        if count:
+            del self.timestamps[:count]
+            del self.seqs[:count]
+
+
+class MessageHistory(HistoryStore):
+    """Message history stored in a segmented log on disk, with an index of every conversation in memory.
+
+    Every message is one record of the log, whose first field holds its timestamp, sender and recipients so the
+    index is rebuilt on startup without reading the messages. A message sent to a group is written once and
+    indexed in the conversation of every recipient. A page is found by binary search on the conversation's
+    timestamps, and only its messages are read from the log, so reading a page costs the same however many
+    messages are stored. The index takes 16 bytes a message, and the log keeps 8 more for the offsets of the
+    records.
+
+    Retention drops the oldest segment of the log at a time. The timestamps of the dropped messages are then
+    trimmed from the index."""
+    def __init__(self, directory: str, segment_size: int = 65536, durability: Durability = DEFAULT_DURABILITY,
+                 retention: HistoryRetention = DEFAULT_RETENTION):
+        """
+        Args:
+            directory (str): Directory holding the history log.
+            segment_size (int, optional): Number of messages in each log segment, which are dropped together.
+            durability (Durability, optional): Durability setting for appends to the log.
+            retention (HistoryRetention, optional): Bounds on the messages kept.
+        """
+        self.directory = directory
+        self.log = SegmentedLog(directory, segment_size, durability)
+        self.retention = retention
+
+        self.conversations = {}  # Map of conversation key to its Conversation
+        self.newest = {}  # Map of segment start to the newest timestamp in the segment
+        self.oldest = -1  # Newest timestamp of the dropped segments, every message kept is newer
+
+        for seq, (header,) in self.log.index():
+            timestamp, sender, recipients = self._parse_header(header)
+            self._index(seq, timestamp, sender, recipients)
+        self.expire_messages()
+
+    @staticmethod
+    def _parse_header(header: str):
+        timestamp, sender, recipients = header.split(FIELD_SEPARATOR, 2)
+        return int(timestamp), sender, recipients.split(FIELD_SEPARATOR)
+
+    def _index(self, seq: int, timestamp: int, sender: str, recipients):
+        for recipient in recipients:
+            key = conversation_of(sender, recipient)
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = Conversation()
+            conversation.insert(timestamp, seq)
+        start = self.log.segment_of(seq)
+        self.newest[start] = max(timestamp, self.newest.get(start, -1))
+        self.last_timestamp = max(timestamp, self.last_timestamp)
+
+    def add_message(self, recipients, sender: str, message: str, timestamp: int):
+        """Append a message to the log and index it in the conversation of every recipient. This drops the oldest
+        segment when the log holds more than the retention bound."""
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients:
+            return
+        seq = self.log.append((FIELD_SEPARATOR.join([str(timestamp), sender] + recipients), message))
+        self._index(seq, timestamp, sender, recipients)
+        if self.retention.max_messages is not None and self._over_count():
+            self._drop_oldest_segments(self._over_count)
+
+    def get_page(self, username: str, peer: str, before: int = None, limit: int = 50):
+        """Return a page of a conversation, reading only the records of its messages from the log."""
+        conversation = self.conversations.get(conversation_of(username, peer))
+        if conversation is None:
+            return [], None
+        timestamps = conversation.timestamps
+        first = bisect.bisect_right(timestamps, max(self.oldest, self.retention.oldest_kept(time.time())))
+        end = len(timestamps) if before is None else bisect.bisect_left(timestamps, before)
+        start = max(first, end - limit)
+        if start >= end:
+            return [], None
+        # The log reads records in sequence order, which is timestamp order except for messages added out of order
+        seqs = conversation.seqs[start:end]
+        order = sorted(range(len(seqs)), key=seqs.__getitem__)
+        records = [None] * len(seqs)
+        for i, record in zip(order, self.log.read_at([seqs[i] for i in order])):
+            records[i] = record
+        page = []
+        for (header, message) in records:
+            timestamp, sender, _ = header.split(FIELD_SEPARATOR, 2)
+            page.append((int(timestamp), sender, message))
+        return page, (timestamps[start] if start > first else None)
+
+    def expire_messages(self, now: float = None):
+        """Drop the sealed segments whose messages are all older than the age bound, and the oldest segments while
+        the log holds more than the message bound."""
+        oldest_kept = self.retention.oldest_kept(time.time() if now is None else now)
+        self._drop_oldest_segments(lambda: self.newest.get(self.log.segments[0], -1) < oldest_kept or
+                                   self._over_count())
+
+    def _over_count(self) -> bool:
+        """Check if dropping the oldest segment still leaves at least max_messages messages."""
+        if self.retention.max_messages is None or len(self.log.segments) < 2:
+            return False
+        return self.log.next_seq - self.log.segments[1] >= self.retention.max_messages
+
+    def _drop_oldest_segments(self, should_drop):
+        dropped = False
+        while len(self.log.segments) > 1 and should_drop():
+            start = self.log.segments[0]
+            self.oldest = max(self.oldest, self.newest.pop(start, -1))
+            self.log.delete_segment(start)
+            dropped = True
+        if dropped:
+            for key in list(self.conversations):
+                conversation = self.conversations[key]
+                conversation.trim(self.oldest)
+                if not conversation.timestamps:
+                    del self.conversations[key]
+
+    def message_count(self) -> int:
+        """Return the number of messages in the log, including the ones older than the age bound."""
+        return self.log.next_seq - self.log.first_seq()
+
+    def clear(self):
+        """
+        Clears the message history for testing purposes
+        """
+        self.log.clear()
+        self.conversations = {}
+        self.newest = {}
+        self.oldest = -1
+        self.last_timestamp = -1
@@ -0,0 +1,178 @@
+import collections
+import socket
+import threading
+
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect')
+# Queued messages the writer thread sends to the socket at once
+MAX_MESSAGES_PER_WRITE = 64
+
+
+class OutboundLimits:
+    """Limits on the messages queued for a client connection. One instance is shared by every connection of a server.
+
+    Args:
+        max_queued_messages (int, optional): Encoded messages queued for one connection before it counts as a slow
+            consumer.
+        send_timeout_seconds (float, optional): Seconds a write of queued messages may take before the connection is
+            closed. None waits forever.
+        slow_consumer_policy (str, optional): What happens to a message for a connection whose queue is full.
+            'drop' refuses the message, and the connection stays open. 'disconnect' closes the connection.
+    """
+    def __init__(self, max_queued_messages: int = 1024, send_timeout_seconds: float = 5.0,
+                 slow_consumer_policy: str = 'disconnect'):
+        for name, value in [('max_queued_messages', max_queued_messages),
+                            ('send_timeout_seconds', send_timeout_seconds)]:
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}")
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                f"Unknown slow consumer policy {slow_consumer_policy}. Expected one of {SLOW_CONSUMER_POLICIES}")
+        self.max_queued_messages = max_queued_messages
+        self.send_timeout_seconds = send_timeout_seconds
+        self.slow_consumer_policy = slow_consumer_policy
+
+
+DEFAULT_OUTBOUND_LIMITS = OutboundLimits()
+
+
+class OutboundStats:
+    """Counters over every outbound queue of a server."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0  # Messages waiting in every queue
+        self.peak_depth = 0  # Deepest any single queue has been
+        self.sent = 0
+        self.dropped = 0  # Messages refused because their queue was full
+        self.disconnected = 0  # Connections closed as slow consumers or after a failed write
+
+    def snapshot(self) -> dict:
+        """Return the counters as a dict."""
+        with self.lock:
+            return {'queued': self.queued, 'peak_depth': self.peak_depth, 'sent': self.sent,
+                    'dropped': self.dropped, 'disconnected': self.disconnected}
+
+
+class OutboundQueue:
+    """Bounded queue of encoded messages for one client connection, written to its socket by a writer thread of
+    its own. Putting a message never blocks, so a client that doesn't read its socket only holds up its own queue,
+    and the threads delivering messages to everyone else carry on.
+
+    The writer thread starts with the first message, and writes whatever has been queued since its last write
+    in one go. A connection is closed when a write fails or takes longer than the send timeout, since a message
+    may have been partly written, and when its queue is full under the 'disconnect' policy. Closing shuts the
+    socket down, which ends the thread reading it as if the client left. Messages still queued when a connection
+    closes are lost."""
+    def __init__(self, client_socket, socket_lock, protocol, limits: OutboundLimits = DEFAULT_OUTBOUND_LIMITS,
+                 stats: OutboundStats = None, written=None):
+        """
+        Args:
+            client_socket (socket.socket): The socket of the connection.
+            socket_lock (threading.Lock): The socket's associated lock.
+            protocol (Protocol): Protocol used to write the messages.
+            limits (OutboundLimits, optional): Limits of the queue.
+            stats (OutboundStats, optional): Counters shared with the other queues of the server.
+            written (Callable, optional): Called by the writer thread with the number of messages after every
+                successful write.
+        """
+        self.client_socket = client_socket
+        self.socket_lock = socket_lock
+        self.protocol = protocol
+        self.limits = limits
+        self.stats = stats if stats is not None else OutboundStats()
+        self.written = written
+        self.messages = collections.deque()
+        self.condition = threading.Condition()  # Guards the fields below
+        self.writing = False  # Whether the writer thread is writing a message
+        self.closed = False
+        self.writer = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def has_room(self) -> bool:
+        """Check if a message can be queued without the connection counting as a slow consumer. Messages that can
+        wait, like undelivered messages which stay in their backlog, should only be queued when there is room."""
+        return not self.closed and len(self.messages) < self.limits.max_queued_messages
+
+    def put(self, message) -> bool:
+        """Queue an encoded message for the connection.
+
+        Returns:
+            bool: False if the connection is closed or the message was refused under the slow consumer policy.
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.messages) >= self.limits.max_queued_messages:
+                if self.limits.slow_consumer_policy == 'drop':
+                    with self.stats.lock:
+                        self.stats.dropped += 1
+                    return False
+                print("Disconnecting slow client.")
+                self._close()
+                return False
+            self.messages.append(message)
+            with self.stats.lock:
+                self.stats.queued += 1
+                self.stats.peak_depth = max(self.stats.peak_depth, len(self.messages))
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write, daemon=True)
+                self.writer.start()
+            self.condition.notify_all()
+        return True
+
+    def _write(self):
+        while True:
+            with self.condition:
+                while not self.messages and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # Flush the messages queued so far together, so a backlog of small messages takes few writes
+                batch = [self.messages.popleft()
+                         for _ in range(min(len(self.messages), MAX_MESSAGES_PER_WRITE))]
+                self.writing = True
+            status = self.protocol.send_many(self.client_socket, batch, self.socket_lock,
+                                             self.limits.send_timeout_seconds)
+            with self.condition:
+                self.writing = False
+                with self.stats.lock:
+                    self.stats.queued -= len(batch)
+                    if status:
+                        self.stats.sent += len(batch)
+                if not status:
+                    self._close()
+                self.condition.notify_all()
+            if status and self.written is not None:
+                self.written(len(batch))
+
+    def _close(self, disconnect: bool = True):
+        """Close the queue, and shut the connection down if disconnect is set. Call with the condition held."""
+        if self.closed:
+            return
+        self.closed = True
+        with self.stats.lock:
+            self.stats.queued -= len(self.messages)
+            if disconnect:
+                self.stats.disconnected += 1
+        self.messages.clear()
+        self.condition.notify_all()
+        if disconnect:
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """Stop the writer thread and drop the queued messages, once the connection has ended."""
+        with self.condition:
+            self._close(disconnect=False)
+
+    def wait_until_empty(self, timeout: float = None) -> bool:
+        """Wait until every queued message has been written or the connection is closed.
+
+        Returns:
+            bool: False if the timeout passed first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.closed or (not self.messages and not self.writing), timeout)
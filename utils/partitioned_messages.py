@@ -0,0 +1,120 @@
+from typing import Callable, List
+from utils.storage import MessageStore
+from utils.undelivered_messages import BacklogView
+
+
+class PartitionedMessages(MessageStore):
+    """Message store split by recipient into partitions, each a message store of its own. Partitions share no
+    state, so each can be guarded by its own lock and worked on by its own thread, such as one delivery worker per
+    partition. Every call about a recipient goes to the partition of the recipient, and the caller holds the lock
+    of that partition. Calls about every recipient visit every partition, and need every lock.
+
+    A message sent to a group is stored once in every partition holding some of its recipients. The message limits
+    are checked here against the messages of every partition: the cap on all messages reads the other partitions'
+    counts without their locks, so concurrent adds may exceed it by a few messages."""
+    def __init__(self, partitions: List[MessageStore], partition_of: Callable[[str], int]):
+        """
+        Args:
+            partitions (List[MessageStore]): The partitions, each with the recipients partition_of maps to it.
+            partition_of (Callable[[str], int]): Function returning the index of the partition of a recipient.
+        """
+        self.partitions = partitions
+        self.partition_of = partition_of
+
+    @property
+    def limits(self):
+        return self.partitions[0].limits
+
+    @limits.setter
+    def limits(self, limits):
+        for partition in self.partitions:
+            partition.limits = limits
+
+    @property
+    def message_count(self) -> int:
+        """Number of undelivered messages for all recipients."""
+        return sum(partition.message_count for partition in self.partitions)
+
+    @property
+    def undelivered_msg(self):
+        """Read-only map of recipient username to list of (sender, message) for that recipient."""
+        return BacklogView(self)
+
+    def partition(self, recipient: str) -> MessageStore:
+        """Return the partition holding the messages of a recipient."""
+        return self.partitions[self.partition_of(recipient)]
+
+    def add_message(self, recipient: str, sender: str, message: str, enforce_limits: bool = True,
+                    queued_at: float = None):
+        """Add a message to the partition of its recipient. Returns False without adding it if the message
+        limits are reached, unless enforce_limits is False."""
+        if enforce_limits and not self.has_room(recipient):
+            return False
+        return self.partition(recipient).add_message(recipient, sender, message, enforce_limits=False,
+                                                     queued_at=queued_at)
+
+    def add_group_message(self, recipients, sender: str, message: str, enforce_limits: bool = True,
+                          queued_at: float = None):
+        """Add one message for several recipients, stored once in every partition holding some of them.
+
+        Returns:
+            list: The recipients the message was added for, in the given order without duplicates.
+        """
+        added = self.recipients_with_room(recipients) if enforce_limits else list(dict.fromkeys(recipients))
+        groups = {}
+        for recipient in added:
+            groups.setdefault(self.partition_of(recipient), []).append(recipient)
+        for index, group in groups.items():
+            self.partitions[index].add_group_message(group, sender, message, enforce_limits=False,
+                                                     queued_at=queued_at)
+        return added
+
+    def recipients_with_room(self, recipients):
+        """Return the recipients the message limits allow adding one more message for, if it is added for all of
+        them, in the given order without duplicates."""
+        accepted = []
+        message_count = self.message_count
+        for recipient in dict.fromkeys(recipients):
+            if self.limits.has_room(len(self.queued_ids(recipient)), message_count + len(accepted)):
+                accepted.append(recipient)
+        return accepted
+
+    def has_room(self, recipient: str):
+        """Check if the message limits allow adding another message for a recipient."""
+        return self.limits.has_room(len(self.queued_ids(recipient)), self.message_count)
+
+    def expired_messages(self, now: float = None) -> dict:
+        """Return the expired messages of every partition, see MessageStore.expired_messages."""
+        expired = {}
+        for partition in self.partitions:
+            expired.update(partition.expired_messages(now))
+        return expired
+
+    def has_messages(self, recipient: str) -> bool:
+        return self.partition(recipient).has_messages(recipient)
+
+    def recipients(self):
+        """Return a list of the recipients with undelivered messages, partition by partition."""
+        return [recipient for partition in self.partitions for recipient in partition.recipients()]
+
+    def get_recipient_messages(self, recipient: str, first_id: int = 0):
+        return self.partition(recipient).get_recipient_messages(recipient, first_id)
+
+    def get_messages(self):
+        return [message for partition in self.partitions for message in partition.get_messages()]
+
+    def queued_ids(self, recipient: str) -> range:
+        return self.partition(recipient).queued_ids(recipient)
+
+    def consume_messages(self, recipient: str, count: int):
+        self.partition(recipient).consume_messages(recipient, count)
+
+    def acknowledge_messages(self, recipient: str, message_id: int):
+        self.partition(recipient).acknowledge_messages(recipient, message_id)
+
+    def update_messages(self, recipient: str, message_infos):
+        self.partition(recipient).update_messages(recipient, message_infos)
+
+    def clear(self):
+        for partition in self.partitions:
+            partition.clear()
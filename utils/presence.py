@@ -0,0 +1,103 @@
+import threading
+
+
+class Subscription:
+    """The usernames and pattern a client subscribed to, and the queue and protocol its events are written with."""
+    def __init__(self, queue, encoder, usernames: frozenset, pattern=None):
+        self.queue = queue
+        self.encoder = encoder
+        self.usernames = usernames
+        self.pattern = pattern
+
+
+class PresenceHub:
+    """Presence subscriptions of the clients of a server, and the fan-out of account and session events to them.
+
+    A client subscribes to a set of usernames, a pattern, or both, and gets a PRESENCE_EVENT message on its
+    outbound queue for every event about an account it subscribed to. Clients subscribed to a username are found
+    with one lookup, and every distinct pattern is matched once per event however many clients subscribed to it.
+    The message of an event is encoded once for each protocol the connections of its subscribers use.
+
+    publish is the listener of the account and session stores, so it runs while the store's lock is held. The
+    hub's lock comes after the store locks and is never held while queueing, and queueing never blocks. Events
+    refused by a full queue are dropped like any other message under the slow consumer policy."""
+    def __init__(self, message_ids):
+        """
+        Args:
+            message_ids (Iterator[int]): Ids of the messages pushed, shared with the other messages of the server.
+        """
+        self.message_ids = message_ids
+        self.lock = threading.Lock()  # Guards the fields below
+        self.subscriptions = {}  # Map of client to its Subscription
+        self.by_username = {}  # Map of username to the set of clients subscribed to it by name
+        self.by_pattern = {}  # Map of (pattern, flags) to (compiled pattern, set of clients subscribed to it)
+
+    def subscribe(self, client, queue, encoder, usernames, pattern=None):
+        """Replace the subscription of a client. A client subscribing to no usernames and no pattern is
+        unsubscribed.
+
+        Args:
+            client: The (socket, socket_lock) pair of the client.
+            queue (OutboundQueue): The queue of the client's connection.
+            encoder (Protocol): The protocol of the client's connection.
+            usernames (Iterable[str]): Usernames to get the events of.
+            pattern (re.Pattern, optional): Compiled pattern matching the usernames to get the events of.
+        """
+        with self.lock:
+            self._remove(client)
+            subscription = Subscription(queue, encoder, frozenset(usernames), pattern)
+            if not subscription.usernames and pattern is None:
+                return
+            self.subscriptions[client] = subscription
+            for username in subscription.usernames:
+                self.by_username.setdefault(username, set()).add(client)
+            if pattern is not None:
+                self.by_pattern.setdefault((pattern.pattern, pattern.flags), (pattern, set()))[1].add(client)
+
+    def unsubscribe(self, client):
+        """Remove the subscription of a client, if any."""
+        with self.lock:
+            self._remove(client)
+
+    def _remove(self, client):
+        subscription = self.subscriptions.pop(client, None)
+        if subscription is None:
+            return
+        for username in subscription.usernames:
+            clients = self.by_username[username]
+            clients.discard(client)
+            if not clients:
+                del self.by_username[username]
+        if subscription.pattern is not None:
+            key = (subscription.pattern.pattern, subscription.pattern.flags)
+            clients = self.by_pattern[key][1]
+            clients.discard(client)
+            if not clients:
+                del self.by_pattern[key]
+
+    def subscribers(self, username: str):
+        """Return the set of clients subscribed to the events of an account."""
+        with self.lock:
+            return self._subscribers(username)
+
+    def _subscribers(self, username: str):
+        clients = set(self.by_username.get(username, ()))
+        for (pattern, subscribed) in self.by_pattern.values():
+            if pattern.match(username):
+                clients |= subscribed
+        return clients
+
+    def publish(self, event: str, username: str):
+        """Push an event about an account to the clients subscribed to it."""
+        with self.lock:
+            if not self.subscriptions:
+                return
+            targets = [self.subscriptions[client] for client in self._subscribers(username)]
+        messages = {}  # Map of protocol to the event encoded with it
+        for subscription in targets:
+            message = messages.get(subscription.encoder)
+            if message is None:
+                message = subscription.encoder.encode(
+                    'PRESENCE_EVENT', next(self.message_ids), {'event': event, 'username': username})
+                messages[subscription.encoder] = message
+            subscription.queue.put(message)
@@ -0,0 +1,310 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Every record is a header of (payload length, CRC32 of the payload) followed by the payload.
+# The payload is a sequence of fields, each a 4 byte length followed by that many bytes of UTF-8.
+RECORD_HEADER = struct.Struct('>II')
+FIELD_LENGTH = struct.Struct('>I')
+
+DURABILITY_MODES = ('none', 'os-buffered', 'fsync-per-write', 'group-fsync')
+
+
+def encode_record(fields) -> bytes:
+    """Encode a tuple of string fields into a single checksummed record."""
+    payload = bytearray()
+    for field in fields:
+        encoded = field.encode('utf-8')
+        payload += FIELD_LENGTH.pack(len(encoded))
+        payload += encoded
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(buffer, start: int = 0):
+    """Decode records from a buffer, stopping at the first record that is incomplete or fails its checksum.
+
+    Args:
+        buffer (bytes-like): The buffer holding the records, e.g. an mmap of a record file.
+        start (int, optional): Offset of the first record. Defaults to 0.
+
+    Yields:
+        (int, tuple): The offset just past the record, and the record's fields.
+    """
+    view = memoryview(buffer)
+    end = len(buffer)
+    header_size = RECORD_HEADER.size
+    field_size = FIELD_LENGTH.size
+    # Local bindings keep the per-record loop cheap when loading millions of records
+    unpack_header = RECORD_HEADER.unpack_from
+    unpack_field_length = FIELD_LENGTH.unpack_from
+    crc32 = zlib.crc32
+    pos = start
+    try:
+        while pos + header_size <= end:
+            length, crc = unpack_header(buffer, pos)
+            payload_start = pos + header_size
+            payload_end = payload_start + length
+            if payload_end > end or crc32(view[payload_start:payload_end]) != crc:
+                return
+            fields = []
+            field_pos = payload_start
+            while field_pos < payload_end:
+                (field_length,) = unpack_field_length(buffer, field_pos)
+                field_pos += field_size
+                fields.append(buffer[field_pos:field_pos + field_length].decode('utf-8'))
+                field_pos += field_length
+            pos = payload_end
+            yield pos, tuple(fields)
+    finally:
+        view.release()
+
+
+def decode_record(buffer, pos: int):
+    """Decode the single record at an offset of a buffer.
+
+    Returns:
+        tuple: The record's fields, or None if the record is incomplete or fails its checksum.
+    """
+    # Decoded without decode_records, since reading a backlog decodes its records one offset at a time
+    if pos + RECORD_HEADER.size > len(buffer):
+        return None
+    length, crc = RECORD_HEADER.unpack_from(buffer, pos)
+    payload_start = pos + RECORD_HEADER.size
+    payload_end = payload_start + length
+    payload = buffer[payload_start:payload_end]
+    if payload_end > len(buffer) or zlib.crc32(payload) != crc:
+        return None
+    fields = []
+    field_pos = 0
+    while field_pos < length:
+        (field_length,) = FIELD_LENGTH.unpack_from(payload, field_pos)
+        field_pos += FIELD_LENGTH.size
+        fields.append(payload[field_pos:field_pos + field_length].decode('utf-8'))
+        field_pos += field_length
+    return tuple(fields)
+
+
+def index_records(buffer, start: int = 0, positions=(0,)):
+    """Like decode_records, but only decodes the fields at the given positions of every record, which is much
+    cheaper for records with large other fields.
+
+    Yields:
+        (int, (int, tuple)): The offset just past the record, and the record's offset and its fields at the
+            positions, None for the positions past its last field.
+    """
+    view = memoryview(buffer)
+    end = len(buffer)
+    header_size = RECORD_HEADER.size
+    field_size = FIELD_LENGTH.size
+    unpack_header = RECORD_HEADER.unpack_from
+    unpack_field_length = FIELD_LENGTH.unpack_from
+    crc32 = zlib.crc32
+    wanted = {position: i for i, position in enumerate(positions)}
+    last = max(positions)
+    pos = start
+    try:
+        while pos + header_size <= end:
+            length, crc = unpack_header(buffer, pos)
+            payload_start = pos + header_size
+            payload_end = payload_start + length
+            if payload_end > end or crc32(view[payload_start:payload_end]) != crc:
+                return
+            fields = [None] * len(positions)
+            field_pos = payload_start
+            # Fields after the last position, and the ones before it that aren't wanted, are only skipped
+            for position in range(last + 1):
+                if field_pos >= payload_end:
+                    break
+                (field_length,) = unpack_field_length(buffer, field_pos)
+                field_pos += field_size
+                if position in wanted:
+                    fields[wanted[position]] = buffer[field_pos:field_pos + field_length].decode('utf-8')
+                field_pos += field_length
+            yield payload_end, (pos, tuple(fields))
+            pos = payload_end
+    finally:
+        view.release()
+
+
+class Durability:
+    """How record files make appended records durable. One instance is shared by all the stores of a server.
+
+    Modes:
+        'none': Records stay in the file handle's buffer until it fills up or the file is closed.
+        'os-buffered': Every write is flushed to the operating system, which survives a crash of the server process.
+        'fsync-per-write': Every write is flushed and fsynced before returning, which survives a power loss.
+        'group-fsync': Every write is flushed, and a background thread fsyncs all written files every
+            group_interval_ms milliseconds, so a power loss loses at most that window of writes.
+    """
+    def __init__(self, mode: str = 'os-buffered', group_interval_ms: int = 10):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {mode}. Expected one of {DURABILITY_MODES}")
+        self.mode = mode
+        self.group_interval = group_interval_ms / 1000
+
+        self.dirty = set()  # Set of file handles written since the last group fsync
+        self.dirty_lock = threading.Lock()
+        # Held while fsyncing so handles aren't closed mid-sync. Lock order is sync_lock > dirty_lock
+        self.sync_lock = threading.Lock()
+        self.sync_thread = None
+
+    def after_write(self, handle):
+        """Apply the durability mode to a file handle that was just written to."""
+        if self.mode == 'none':
+            return
+        handle.flush()
+        if self.mode == 'fsync-per-write':
+            os.fsync(handle.fileno())
+        elif self.mode == 'group-fsync':
+            with self.dirty_lock:
+                self.dirty.add(handle)
+                if self.sync_thread is None:
+                    self.sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+                    self.sync_thread.start()
+
+    def before_close(self, handle):
+        """Flush a file handle that is about to be closed, and stop tracking it for group fsyncs."""
+        handle.flush()
+        with self.sync_lock:
+            with self.dirty_lock:
+                was_dirty = handle in self.dirty
+                self.dirty.discard(handle)
+            if was_dirty:
+                os.fsync(handle.fileno())
+
+    def syncs_rewrites(self) -> bool:
+        """Check if rewritten files should be fsynced before they replace the old file."""
+        return self.mode in ('fsync-per-write', 'group-fsync')
+
+    def sync(self):
+        """Fsync every file written since the last group fsync."""
+        with self.sync_lock:
+            # Writers only wait for the swap, not for the fsyncs
+            with self.dirty_lock:
+                dirty = self.dirty
+                self.dirty = set()
+            for handle in dirty:
+                os.fsync(handle.fileno())
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.group_interval)
+            self.sync()
+
+
+DEFAULT_DURABILITY = Durability()
+
+
+class RecordFile:
+    """A file of length-prefixed binary records, each protected by a CRC32 checksum. Records are tuples of strings,
+    so usernames and messages may contain any character, including newlines.
+
+    Appends go through one long-lived file handle, and the durability setting decides when they reach the disk."""
+    def __init__(self, filename: str, durability: Durability = DEFAULT_DURABILITY):
+        self.filename = filename
+        self.durability = durability
+        self.handle = None  # Append handle, opened on the first append
+        self.size = 0  # Size of the file while the append handle is open
+
+    def read(self):
+        """Yield the fields of every record in the file through an mmap of the file.
+
+        Reading stops at the first torn or corrupt record, which is what a crash in the middle of an append leaves
+        behind. The file is then truncated there so that records appended later are readable.
+        """
+        return self._scan(decode_records)
+
+    def index(self, positions=(0,)):
+        """Yield (offset, fields at the positions) for every record in the file, see index_records. Stops at a torn
+        record like read."""
+        return self._scan(lambda buffer: index_records(buffer, positions=positions))
+
+    def _scan(self, decoder):
+        if self.handle is not None:
+            self.handle.flush()
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            valid_length = 0
+            if size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    records = decoder(buffer)
+                    try:
+                        for valid_length, item in records:
+                            yield item
+                    finally:
+                        # Release the decoder's view of the mmap before the mmap is closed
+                        records.close()
+            if valid_length < size:
+                f.truncate(valid_length)
+
+    def read_at(self, offsets):
+        """Return the fields of the records at the given offsets, e.g. offsets returned by index or append_many.
+
+        Raises:
+            ValueError: A record is incomplete or fails its checksum.
+        """
+        if not offsets:
+            return []
+        if self.handle is not None:
+            self.handle.flush()
+        with open(self.filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            records = []
+            for offset in offsets:
+                fields = decode_record(buffer, offset)
+                if fields is None:
+                    raise ValueError(f"Corrupt record at offset {offset} of {self.filename}")
+                records.append(fields)
+            return records
+
+    def append(self, fields):
+        """Append one record to the file."""
+        self.append_many([fields])
+
+    def append_many(self, records):
+        """Append several records to the file with a single write.
+
+        Returns:
+            list: The offset of every appended record in the file.
+        """
+        if self.handle is None:
+            self.handle = open(self.filename, 'ab')
+            self.size = self.handle.tell()
+        offsets = []
+        encoded = []
+        for fields in records:
+            record = encode_record(fields)
+            offsets.append(self.size)
+            self.size += len(record)
+            encoded.append(record)
+        if encoded:
+            self.handle.write(b''.join(encoded))
+            self.durability.after_write(self.handle)
+        return offsets
+
+    def rewrite(self, records):
+        """Atomically replace the contents of the file with the given records."""
+        self.close()
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(b''.join(encode_record(fields) for fields in records))
+            f.flush()
+            if self.durability.syncs_rewrites():
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def close(self):
+        """Flush and close the append handle. The next append reopens it."""
+        if self.handle is not None:
+            self.durability.before_close(self.handle)
+            self.handle.close()
+            self.handle = None
+
+    def clear(self):
+        """Empty the file."""
+        self.close()
+        open(self.filename, 'wb').close()
@@ -0,0 +1,135 @@
+import itertools
+import threading
+from protocol import ADVERTISED_VERSIONS, REPLICATION_COMPRESSION
+from utils.identity_table import IdentityTable
+from utils.replicated_names import NameEncoder
+
+
+class PendingRequest:
+    """A request sent on a ReplicaChannel, until its response is taken by the thread that sent it."""
+    def __init__(self):
+        self.answered = threading.Event()
+        self.response = None
+
+
+class ReplicaChannel:
+    """Connection to another server used for requests that get exactly one response, such as replicated updates
+    and their acks, heartbeats and primary assignment.
+
+    Every request carries a correlation id as its message id, which the other server echoes in the message id of
+    its response. Requests are written with header version 1 and uncompressed until negotiate has advertised the
+    later versions and compression methods this side reads, and the other server answers with the ones it picked. A reader thread of the channel reads the responses off the socket as they come and hands each one
+    to the thread waiting on its id, so requests from many threads are in flight at the same time, their responses
+    may come back in any order, and no thread waits on the socket for another's response.
+
+    Given the identity table of this server, negotiate also offers to send the account names of replicated updates
+    as ids, which they are once the other server agreed, see NameEncoder."""
+    def __init__(self, replica_socket, protocol, identities: IdentityTable = None):
+        """
+        Args:
+            replica_socket (socket.socket): Socket connected to the other server.
+            protocol (Protocol): Protocol used to send requests and read responses.
+            identities (IdentityTable, optional): Identity table of this server, whose ids replace the names of
+                the updates sent. Names are sent as they are without it.
+        """
+        self.socket = replica_socket
+        self.protocol = protocol
+        self.identities = identities
+        self.names = None  # NameEncoder of the updates, once the other server agreed to read ids
+        # Correlation ids wrap around to fit the header
+        self.ids = itertools.cycle(range(2 ** (8 * protocol.metadata_sizes['message_id'])))
+        self.send_lock = threading.Lock()  # Keeps requests whole on the socket
+        self.lock = threading.Lock()  # Guards the fields below
+        self.pending = {}  # Map of correlation id to the PendingRequest waiting for its response
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, operation: str, args: dict = {}):
+        """Send a request without waiting for its response.
+
+        Returns:
+            int: Correlation id of the request to pass to wait, or None if sending failed.
+        """
+        with self.send_lock:
+            with self.lock:
+                if self.closed:
+                    return None
+                correlation_id = next(self.ids)
+                # Registered before sending, since the response may be read before send returns
+                self.pending[correlation_id] = PendingRequest()
+            # Encoded under the send lock, so the first update with an id is the first one sent with it
+            if self.names is not None:
+                args = self.names.encode(operation, args)
+            if not self.protocol.send(self.socket, self.protocol.encode(operation, correlation_id, args)):
+                self._close()
+                return None
+        return correlation_id
+
+    def wait(self, correlation_id, timeout: float = None):
+        """Wait for the response to a request. A response that comes after the timeout is dropped.
+
+        Returns:
+            tuple: (metadata, message) of the response, or None if the connection was lost or the timeout passed.
+        """
+        if correlation_id is None:
+            return None
+        with self.lock:
+            pending = self.pending.get(correlation_id)
+        if pending is None:
+            return None
+        pending.answered.wait(timeout)
+        with self.lock:
+            self.pending.pop(correlation_id, None)
+        return pending.response
+
+    def request(self, operation: str, args: dict = {}, timeout: float = None):
+        """Send a request and wait for its response. See wait."""
+        return self.wait(self.send(operation, args), timeout)
+
+    def negotiate(self, timeout: float = None) -> bool:
+        """Advertise the header versions and compression methods this side reads with a heartbeat, and offer to
+        send names as ids. Servers that only read version 1 ignore the advertisement and keep getting version 1
+        without compression, and servers that don't know the offer keep getting names.
+
+        Returns:
+            bool: True if the other server answered.
+        """
+        advertisement = {'versions': ADVERTISED_VERSIONS, 'compression': REPLICATION_COMPRESSION}
+        if self.identities is not None:
+            advertisement['names'] = 'ids'
+        response = self.request('HEARTBEAT', advertisement, timeout)
+        if response is None:
+            return False
+        (md, msg) = response
+        args = self.protocol.parse_data(md.operation_code.value, msg)
+        compression = args.get('compression')
+        if self.identities is not None and args.get('names') == 'ids':
+            self.names = NameEncoder(self.identities)
+        # The reader thread has already moved to the version of the answer
+        self.protocol = self.protocol.with_compression(compression)
+        return True
+
+    def _read(self):
+        # Responses split across several packets, such as long account lists or history pages, are read whole
+        self.protocol.read_packets(self.socket, self._deliver)
+        self._close()
+
+    def _deliver(self, replica_socket, metadata, msg, id_accum):
+        """Hand a response read by read_packets to the thread waiting for it."""
+        # The other server only writes a later version once it read our advertisement, so we can write it too
+        if metadata.version > self.protocol.version:
+            self.protocol = self.protocol.with_version(metadata.version)
+        with self.lock:
+            pending = self.pending.get(metadata.message_id)
+        # Responses to requests whose sender stopped waiting are dropped
+        if pending is not None:
+            pending.response = (metadata, msg)
+            pending.answered.set()
+
+    def _close(self):
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+        for request in pending:
+            request.answered.set()
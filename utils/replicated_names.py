@@ -0,0 +1,84 @@
+from array import array
+from protocol import NAME_ARGS
+from utils.identity_table import IdentityTable
+
+# Starts the names sent as the id they have on the sending server
+REFERENCE = '\0'
+# Entry of NameDecoder.local_ids for the ids the other server hasn't sent a name for
+UNKNOWN = -1
+
+
+def _map_names(args: dict, operation: str, function) -> dict:
+    """Return a copy of the arguments of an operation with function applied to every name of its NAME_ARGS."""
+    args = dict(args)
+    for key, separator in NAME_ARGS.get(operation, {}).items():
+        if key in args:
+            args[key] = function(args[key]) if separator is None else \
+                separator.join(map(function, args[key].split(separator)))
+    return args
+
+
+class NameEncoder:
+    """Replaces the account names in the updates sent on one replication connection with the ids they have in the
+    identity table of this server. The first update with an id sends the name along with it, and later ones only
+    the id, until the id is released and given to another name, whose first update sends it again. The other server
+    reads the updates of a connection in the order they are sent, so it always knows an id before it gets it alone.
+
+    Encoding runs under the send lock of the connection. Names without an id are sent as they are."""
+    def __init__(self, identities: IdentityTable):
+        self.identities = identities
+        self.sent = array('I')  # Generation plus one of the name sent with every id, 0 for ids never sent
+
+    def encode(self, operation: str, args: dict) -> dict:
+        """Return the arguments of an update with its names replaced by references to their ids."""
+        if operation not in NAME_ARGS:
+            return args
+        return _map_names(args, operation, self._encode_name)
+
+    def _encode_name(self, name: str) -> str:
+        versioned = self.identities.get_versioned(name)
+        if versioned is None:
+            return name
+        (id, generation) = versioned
+        if id < len(self.sent) and self.sent[id] == generation + 1:
+            return f"{REFERENCE}{id}"
+        if id >= len(self.sent):
+            self.sent.extend(array('I', [0]) * (id + 1 - len(self.sent)))
+        self.sent[id] = generation + 1
+        return f"{REFERENCE}{id}={name}"
+
+
+class NameDecoder:
+    """Reads back the names of the updates received on one replication connection, see NameEncoder. Every id of
+    the other server is mapped to the id of its name in the identity table of this server, which holds a reference
+    to it until the other server sends another name with the id or the connection ends, so the names are stored
+    once and every id takes 4 bytes."""
+    def __init__(self, identities: IdentityTable):
+        self.identities = identities
+        self.local_ids = array('i')  # Id in this server's table of the name of every id of the other server
+
+    def decode(self, operation: str, args: dict) -> dict:
+        """Return the arguments of an update with the references to ids replaced by their names."""
+        if operation not in NAME_ARGS:
+            return args
+        return _map_names(args, operation, self._decode_name)
+
+    def _decode_name(self, value: str) -> str:
+        if not value.startswith(REFERENCE):
+            return value
+        (id, defines, name) = value[len(REFERENCE):].partition('=')
+        id = int(id)
+        if not defines:
+            return self.identities.name(self.local_ids[id])
+        if id >= len(self.local_ids):
+            self.local_ids.extend(array('i', [UNKNOWN]) * (id + 1 - len(self.local_ids)))
+        previous = self.local_ids[id]
+        self.local_ids[id] = self.identities.acquire(name)
+        if previous != UNKNOWN:
+            self.identities.drop((previous,))
+        return name
+
+    def close(self):
+        """Drop the references to the names of the connection."""
+        self.identities.drop([id for id in self.local_ids if id != UNKNOWN])
+        self.local_ids = array('i')
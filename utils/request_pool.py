@@ -0,0 +1,197 @@
+import collections
+import threading
+import time
+
+
+class RateLimit:
+    """Token bucket rate of one operation.
+
+    Args:
+        rate (float): Requests per second let through on average.
+        burst (int, optional): Requests let through at once after a quiet period. Defaults to one second's worth.
+    """
+    def __init__(self, rate: float, burst: int = None):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if burst is not None and burst <= 0:
+            raise ValueError(f"burst must be positive, got {burst}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(int(rate), 1)
+
+
+class AdmissionLimits:
+    """Limits on the client requests a server runs at once. One instance is shared by every connection of a server.
+
+    Args:
+        max_workers (int, optional): Threads running requests.
+        max_queued_requests (int, optional): Requests waiting for a worker, from every client, before new ones
+            are turned away as busy.
+        max_in_flight_per_client (int, optional): Requests of one client waiting or running before its new ones
+            are turned away as busy.
+        rate_limits (dict, optional): Map of operation name, such as 'SEND_MESSAGE', to its RateLimit or to the
+            keyword arguments of one. Operations without one aren't rate limited.
+    """
+    def __init__(self, max_workers: int = 8, max_queued_requests: int = 256, max_in_flight_per_client: int = 8,
+                 rate_limits: dict = None):
+        for name, value in [('max_workers', max_workers), ('max_queued_requests', max_queued_requests),
+                            ('max_in_flight_per_client', max_in_flight_per_client)]:
+            if value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}")
+        self.max_workers = max_workers
+        self.max_queued_requests = max_queued_requests
+        self.max_in_flight_per_client = max_in_flight_per_client
+        self.rate_limits = {operation: limit if isinstance(limit, RateLimit) else RateLimit(**limit)
+                            for operation, limit in (rate_limits or {}).items()}
+
+
+DEFAULT_ADMISSION_LIMITS = AdmissionLimits()
+
+
+class TokenBucket:
+    """Lets requests through at a rate, allowing bursts up to the bucket's size."""
+    def __init__(self, limit: RateLimit, now: float = None):
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.updated = time.monotonic() if now is None else now
+        self.lock = threading.Lock()
+
+    def take(self, now: float = None) -> bool:
+        """Take a token for a request.
+
+        Returns:
+            bool: False if the bucket is empty and the request should be turned away.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.tokens = min(self.tokens + (now - self.updated) * self.limit.rate, self.limit.burst)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AdmissionStats:
+    """Counters of the requests a RequestPool let in and turned away."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.queue_full = 0  # Requests turned away because every worker was busy and the queue was full
+        self.client_limited = 0  # Requests turned away because their client had too many in flight
+        self.rate_limited = 0  # Requests turned away by the rate limit of their operation
+
+    def snapshot(self) -> dict:
+        """Return the counters as a dict."""
+        with self.lock:
+            return {'admitted': self.admitted, 'queue_full': self.queue_full,
+                    'client_limited': self.client_limited, 'rate_limited': self.rate_limited}
+
+
+class RequestPool:
+    """Bounded pool of threads running client requests. A request is admitted only if its operation's rate limit,
+    its client's in-flight limit and the shared queue all have room, and is turned away otherwise, so under
+    overload the server answers the requests it can take on time and tells the others it is busy instead of
+    letting every request wait.
+
+    The requests of a client run one at a time in the order they were submitted, as they would on the thread
+    reading the client's socket. Clients with requests waiting take turns for the workers, so a client sending
+    many requests only fills its own share of the queue. Workers start with the first request."""
+    def __init__(self, limits: AdmissionLimits = DEFAULT_ADMISSION_LIMITS, stats: AdmissionStats = None):
+        """
+        Args:
+            limits (AdmissionLimits, optional): Limits of the pool.
+            stats (AdmissionStats, optional): Counters of the pool.
+        """
+        self.limits = limits
+        self.stats = stats if stats is not None else AdmissionStats()
+        self.buckets = {operation: TokenBucket(limit) for operation, limit in limits.rate_limits.items()}
+        self.condition = threading.Condition()  # Guards the fields below
+        self.pending = {}  # Map of client to the deque of its requests not started yet
+        self.in_flight = collections.Counter()  # Map of client to its requests waiting or running
+        self.ready = collections.deque()  # Clients with requests waiting and none running, in turn order
+        self.queued = 0  # Requests waiting for a worker
+        self.workers = []
+
+    def submit(self, client, operation: str, request) -> bool:
+        """Admit a request of a client, to be run by a worker.
+
+        Args:
+            client: Key of the client, such as its (socket, socket_lock) pair.
+            operation (str): Name of the operation, for its rate limit.
+            request (Callable): Function running the request.
+
+        Returns:
+            bool: False if the request was turned away and the client should be told the server is busy.
+        """
+        with self.condition:
+            if self.in_flight[client] >= self.limits.max_in_flight_per_client:
+                outcome = 'client_limited'
+            elif self.queued >= self.limits.max_queued_requests:
+                outcome = 'queue_full'
+            elif operation in self.buckets and not self.buckets[operation].take():
+                outcome = 'rate_limited'
+            else:
+                outcome = 'admitted'
+                if client not in self.pending:
+                    self.pending[client] = collections.deque()
+                    # A client with a request running gets its turn back once the request is done
+                    if not self.in_flight[client]:
+                        self.ready.append(client)
+                self.pending[client].append(request)
+                self.in_flight[client] += 1
+                self.queued += 1
+                if len(self.workers) < self.limits.max_workers:
+                    worker = threading.Thread(target=self._work, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+                self.condition.notify()
+        with self.stats.lock:
+            setattr(self.stats, outcome, getattr(self.stats, outcome) + 1)
+        return outcome == 'admitted'
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                client = self.ready.popleft()
+                requests = self.pending[client]
+                request = requests.popleft()
+                if not requests:
+                    del self.pending[client]
+                self.queued -= 1
+            try:
+                request()
+            except Exception as e:
+                # A failed request only ends itself, the worker goes on with the next one
+                print(f"Request failed: {e!r}")
+            finally:
+                with self.condition:
+                    self.in_flight[client] -= 1
+                    if not self.in_flight[client]:
+                        del self.in_flight[client]
+                        # A cancel may be waiting for the client's last request
+                        self.condition.notify_all()
+                    # The client's next request waits for its turn behind the other clients
+                    if client in self.pending:
+                        self.ready.append(client)
+                        self.condition.notify()
+
+    def cancel(self, client):
+        """Drop the requests of a client not started yet, once its connection has ended, and wait for the one
+        running to finish, so that nothing the client asked for happens after cancel returns."""
+        with self.condition:
+            requests = self.pending.pop(client, ())
+            self.queued -= len(requests)
+            self.in_flight[client] -= len(requests)
+            if self.in_flight[client] <= 0:
+                del self.in_flight[client]
+            if client in self.ready:
+                self.ready.remove(client)
+            while client in self.in_flight:
+                self.condition.wait()
+
+    def depth(self) -> int:
+        """Return the number of requests waiting for a worker."""
+        with self.condition:
+            return self.queued
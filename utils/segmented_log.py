@@ -0,0 +1,161 @@
+import bisect
+import os
+from array import array
+from utils.record_file import DEFAULT_DURABILITY, Durability, RecordFile
+
+
+class SegmentedLog:
+    """An append-only log split across numbered segment files in a directory. Every record gets an increasing
+    sequence number, and whole segments are deleted at once when none of their records are needed anymore.
+    Segments are record files named after the sequence number of their first record, so the sequence number of
+    a record is its segment's name plus its position in the segment."""
+    def __init__(self, directory: str, segment_size: int = 4096, durability: Durability = DEFAULT_DURABILITY,
+                 first_seq: int = 0):
+        """
+        Args:
+            directory (str): Directory holding the segment files. Created if it does not exist.
+            segment_size (int, optional): Number of records written to a segment before starting a new one.
+            durability (Durability, optional): Durability setting for appends to the segments.
+            first_seq (int, optional): Sequence number of the first record appended to a log without segments.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.durability = durability
+        os.makedirs(directory, exist_ok=True)
+
+        # Sorted list of the first sequence number of every segment; the segment file is named after it
+        self.segments = sorted(int(name[:-len('.seg')])
+                               for name in os.listdir(directory) if name.endswith('.seg'))
+        # Map of segment start to the byte offsets of its records, filled in when a segment is first scanned
+        self.offsets = {}
+        self.next_seq = self.segments[-1] if self.segments else first_seq
+        self.active_count = 0  # Number of records in the last segment
+        self.active_file = None  # Record file of the last segment, which holds the long-lived append handle
+        if self.segments:
+            self.active_file = RecordFile(self._segment_path(self.segments[-1]), durability)
+            self.active_count = len(self._segment_offsets(self.segments[-1]))
+            self.next_seq = self.segments[-1] + self.active_count
+
+    def _segment_path(self, start: int) -> str:
+        return os.path.join(self.directory, f"{start:020d}.seg")
+
+    def _segment_file(self, start: int) -> RecordFile:
+        if self.is_active(start):
+            return self.active_file
+        return RecordFile(self._segment_path(start))
+
+    def _index_segment(self, start: int, positions=(0,)):
+        offsets = array('Q')
+        for seq, (offset, fields) in enumerate(self._segment_file(start).index(positions), start):
+            offsets.append(offset)
+            yield seq, fields
+        self.offsets[start] = offsets
+
+    def _segment_offsets(self, start: int) -> array:
+        if start not in self.offsets:
+            for _ in self._index_segment(start):
+                pass
+        return self.offsets[start]
+
+    def append(self, fields) -> int:
+        """Append one record to the active segment, rolling over to a new segment when it is full.
+
+        Args:
+            fields (tuple): The string fields of the record.
+
+        Returns:
+            int: The sequence number assigned to the record.
+        """
+        return self.append_many([fields])[0]
+
+    def append_many(self, records) -> list:
+        """Append several records with a single write per segment.
+
+        Returns:
+            list: The sequence numbers assigned to the records, in order.
+        """
+        seqs = []
+        pending = []
+        for fields in records:
+            if not self.segments or self.active_count >= self.segment_size:
+                self._write(pending)
+                pending = []
+                if self.active_file is not None:
+                    self.active_file.close()
+                self.segments.append(self.next_seq)
+                self.offsets[self.next_seq] = array('Q')
+                self.active_file = RecordFile(self._segment_path(self.next_seq), self.durability)
+                self.active_count = 0
+            pending.append(fields)
+            seqs.append(self.next_seq)
+            self.next_seq += 1
+            self.active_count += 1
+        self._write(pending)
+        return seqs
+
+    def _write(self, records):
+        if records:
+            self.offsets[self.segments[-1]].extend(self.active_file.append_many(records))
+
+    def read(self):
+        """Yield (sequence number, fields) for every record in every segment, oldest first."""
+        for start in list(self.segments):
+            yield from enumerate(self._segment_file(start).read(), start)
+
+    def index(self, positions=(0,)):
+        """Yield (sequence number, fields at the positions) for every record in every segment, oldest first.
+        This only decodes the fields at the positions of each record, the first one by default, and remembers
+        where every record is for read_at."""
+        for start in list(self.segments):
+            yield from self._index_segment(start, positions)
+
+    def read_at(self, seqs) -> list:
+        """Return the fields of the records with the given increasing sequence numbers, reading each segment once."""
+        records = []
+        i = 0
+        while i < len(seqs):
+            start = self.segment_of(seqs[i])
+            position = bisect.bisect_right(self.segments, start)
+            end = self.segments[position] if position < len(self.segments) else self.next_seq
+            j = bisect.bisect_left(seqs, end, i)
+            offsets = self._segment_offsets(start)
+            records.extend(self._segment_file(start).read_at([offsets[seq - start] for seq in seqs[i:j]]))
+            i = j
+        return records
+
+    def segment_of(self, seq: int) -> int:
+        """Return the starting sequence number of the segment holding the record with sequence number seq."""
+        return self.segments[bisect.bisect_right(self.segments, seq) - 1]
+
+    def is_active(self, start: int) -> bool:
+        """Check if the segment starting at start is the one currently being appended to."""
+        return bool(self.segments) and self.segments[-1] == start
+
+    def delete_segment(self, start: int):
+        """Delete a sealed segment. The active segment is never deleted."""
+        if not self.is_active(start):
+            self.segments.remove(start)
+            self.offsets.pop(start, None)
+            os.remove(self._segment_path(start))
+
+    def first_seq(self) -> int:
+        """Return the smallest sequence number that may still be stored in the log."""
+        return self.segments[0] if self.segments else self.next_seq
+
+    def clear(self):
+        """
+        Deletes every segment for testing purposes
+        """
+        self.close()
+        for start in self.segments:
+            os.remove(self._segment_path(start))
+        self.segments = []
+        self.offsets = {}
+        self.active_file = None
+        self.next_seq = 0
+        self.active_count = 0
+
+    def close(self):
+        """Flush and close the append handle of the active segment. The next append reopens it."""
+        if self.active_file is not None:
+            self.active_file.close()
@@ -0,0 +1,137 @@
+from array import array
+from utils.identity_table import IdentityTable
+
+# Entry of the session and account arrays of a SessionRegistry for an id without one
+NONE = -1
+
+
+def _set(ids: array, index: int, value: int):
+    """Set an entry of an array indexed by id, growing it with NONE entries as needed."""
+    if index >= len(ids):
+        ids.extend(array('i', [NONE]) * (index + 1 - len(ids)))
+    ids[index] = value
+
+
+def _get(ids: array, index):
+    """Return the entry of an array indexed by id, or None for NONE entries and ids past its end or None."""
+    if index is None or index >= len(ids) or ids[index] == NONE:
+        return None
+    return ids[index]
+
+
+class SessionRegistry:
+    """Index of the connected clients and logged in sessions of a server, with a map in each direction so finding
+    the client of a uuid, the account of a uuid or the session of an account never scans the others.
+
+    Clients are the (socket, socket_lock) pairs of connections, identified by the uuid they sent when connecting.
+    Every uuid gets a session id while it is connected or logged in, and accounts are kept by their account id,
+    holding a reference to it while they are logged in. Both ids are dense, so the session of every account and the
+    account of every session are arrays indexed by id, 4 bytes an id. Sessions of replicas are logged in without a
+    connected client."""
+    def __init__(self, identities: IdentityTable = None, session_ids: IdentityTable = None):
+        """
+        Args:
+            identities (IdentityTable, optional): Table of account ids shared with the stores.
+            session_ids (IdentityTable, optional): Table of session ids of uuids.
+        """
+        self.identities = identities if identities is not None else IdentityTable()
+        self.session_ids = session_ids if session_ids is not None else IdentityTable()
+        self.client_sessions = {}  # Map of client to session id
+        self.clients = {}  # Map of session id to client
+        self.accounts = array('i')  # Account id logged into every session id, NONE for none
+        self.sessions = array('i')  # Session id logged into every account id, NONE for none
+        self.session_count = 0  # Number of logged in sessions
+
+    def _release_if_unused(self, session_id):
+        if session_id not in self.clients and _get(self.accounts, session_id) is None:
+            self.session_ids.release(self.session_ids.name(session_id))
+
+    def connect(self, uuid: str, client):
+        """Register a connected client and the uuid it identified itself with."""
+        session_id = self.session_ids.intern(uuid)
+        self.client_sessions[client] = session_id
+        self.clients[session_id] = client
+
+    def disconnect(self, client):
+        """Remove a client. Its session stays logged in until it is logged off.
+
+        Returns:
+            str: The uuid of the client.
+        """
+        session_id = self.client_sessions.pop(client)
+        uuid = self.session_ids.name(session_id)
+        if self.clients.get(session_id) == client:
+            del self.clients[session_id]
+        self._release_if_unused(session_id)
+        return uuid
+
+    def uuid_of(self, client) -> str:
+        """Return the uuid of a connected client. Raises KeyError if the client isn't connected."""
+        return self.session_ids.name(self.client_sessions[client])
+
+    def client_of(self, uuid: str):
+        """Return the client connected with a uuid, or None."""
+        return self.clients.get(self.session_ids.get(uuid))
+
+    def connected(self):
+        """Return a map of every connected client to its uuid."""
+        return {client: self.session_ids.name(session_id) for client, session_id in self.client_sessions.items()}
+
+    def login(self, username: str, uuid: str):
+        """Record that a uuid is logged into an account."""
+        account_id = self.identities.get(username)
+        if _get(self.sessions, account_id) is None:
+            account_id = self.identities.acquire(username)
+            self.session_count += 1
+        session_id = self.session_ids.intern(uuid)
+        # A uuid is logged into at most one account, and an account into at most one uuid
+        previous_account = _get(self.accounts, session_id)
+        if previous_account is not None and previous_account != account_id:
+            self.sessions[previous_account] = NONE
+            self.session_count -= 1
+            self.identities.drop((previous_account,))
+        previous_session = _get(self.sessions, account_id)
+        if previous_session is not None and previous_session != session_id:
+            self.accounts[previous_session] = NONE
+            self._release_if_unused(previous_session)
+        _set(self.sessions, account_id, session_id)
+        _set(self.accounts, session_id, account_id)
+
+    def logoff(self, username: str) -> bool:
+        """Remove the session of an account. Returns False if the account wasn't logged in."""
+        account_id = self.identities.get(username)
+        session_id = _get(self.sessions, account_id)
+        if session_id is None:
+            return False
+        self.sessions[account_id] = NONE
+        self.session_count -= 1
+        self.identities.drop((account_id,))
+        if _get(self.accounts, session_id) == account_id:
+            self.accounts[session_id] = NONE
+        self._release_if_unused(session_id)
+        return True
+
+    def is_logged_in(self, uuid: str) -> bool:
+        """Check if a uuid is logged into an account."""
+        return _get(self.accounts, self.session_ids.get(uuid)) is not None
+
+    def username_is_logged_in(self, username: str) -> bool:
+        """Check if someone is logged into an account."""
+        return _get(self.sessions, self.identities.get(username)) is not None
+
+    def get_username(self, uuid: str):
+        """Return the username a uuid is logged into, or None."""
+        account_id = _get(self.accounts, self.session_ids.get(uuid))
+        return None if account_id is None else self.identities.name(account_id)
+
+    def get_uuid(self, username: str) -> str:
+        """Return the uuid logged into an account. Raises KeyError if no one is logged in."""
+        session_id = _get(self.sessions, self.identities.get(username))
+        if session_id is None:
+            raise KeyError(username)
+        return self.session_ids.name(session_id)
+
+    def logged_in(self):
+        """Return a map of the username to the uuid of every session."""
+        return {self.identities.name(account_id): self.session_ids.name(session_id)
+                for account_id, session_id in enumerate(self.sessions) if session_id != NONE}
@@ -0,0 +1,106 @@
+import threading
+import uuid
+import zlib
+from protocol import ADVERTISED_COMPRESSION, ADVERTISED_VERSIONS
+from utils import transport
+from utils.replica_channel import ReplicaChannel
+
+
+def shard_of(username: str, num_shards: int) -> int:
+    """Return the index of the replica group holding an account. Unlike hash, the result is the same in every
+    process, so clients and servers agree on it."""
+    return zlib.crc32(username.encode('utf-8')) % num_shards
+
+
+def group_configs(config: dict) -> list:
+    """Return the list of server configs of every replica group in a config file. Accounts are sharded across the
+    groups of the 'shards' entry, and a config with a 'servers' entry instead has a single group."""
+    if 'shards' in config:
+        return config['shards']
+    return [config['servers']]
+
+
+def group_of_server(groups: list, server_id: int) -> int:
+    """Return the index of the replica group of a server. Server ids are unique across every group."""
+    for (shard, servers) in enumerate(groups):
+        if any(int(server['id']) == int(server_id) for server in servers):
+            return shard
+    raise ValueError(f"Server {server_id} isn't in any replica group")
+
+
+class ShardRouter:
+    """Connections from the primary of one replica group to the primaries of the others, for requests about
+    accounts they hold.
+
+    The primary of a group is found by asking its servers, and the connection to it is kept until a request on it
+    fails, after which the next request looks for the primary again. A request that fails is not sent again, since
+    the other primary may have processed it before the connection was lost."""
+    def __init__(self, groups: list, shard: int, protocol):
+        """
+        Args:
+            groups (list): Server configs of every replica group.
+            shard (int): Index of this server's own group.
+            protocol (Protocol): Protocol used to send requests and read responses.
+        """
+        self.groups = groups
+        self.shard = shard
+        self.protocol = protocol
+        self.uuid = f"shard-{shard}-{uuid.uuid4()}"  # Identifies the connections of this server to the others
+        self.lock = threading.Lock()  # Guards channels, and is held while connecting
+        self.channels = {}  # Map of group index to the ReplicaChannel to its primary
+
+    def request(self, shard: int, operation: str, args: dict = {}):
+        """Send a request to the primary of a group and wait for its response.
+
+        Returns:
+            tuple: (metadata, message) of the response, or None if the primary couldn't be reached.
+        """
+        channel = self._channel(shard)
+        response = channel.request(operation, args) if channel is not None else None
+        if response is None:
+            with self.lock:
+                if self.channels.get(shard) is channel:
+                    self.channels.pop(shard, None)
+        return response
+
+    def _channel(self, shard: int):
+        with self.lock:
+            if shard not in self.channels:
+                channel = self._connect_to_primary(shard)
+                if channel is None:
+                    return None
+                self.channels[shard] = channel
+            return self.channels[shard]
+
+    def _connect(self, server: dict):
+        """Return a ReplicaChannel to a server registered as a client, or None if it can't be reached."""
+        try:
+            server_socket = transport.connect(server['host'], server.get('port'))
+        except OSError:
+            return None
+        register = self.protocol.encode(
+            'REGISTER_CLIENT_UUID', 0,
+            {'uuid': self.uuid, 'versions': ADVERTISED_VERSIONS, 'compression': ADVERTISED_COMPRESSION})
+        if not self.protocol.send(server_socket, register):
+            server_socket.close()
+            return None
+        return ReplicaChannel(server_socket, self.protocol)
+
+    def _connect_to_primary(self, shard: int):
+        servers = {int(server['id']): server for server in self.groups[shard]}
+        for server in servers.values():
+            channel = self._connect(server)
+            if channel is None:
+                continue
+            response = channel.request('GET_PRIMARY')
+            primary_id = int(self.protocol.parse_data(response[0].operation_code.value, response[1])['id']) \
+                if response is not None else -1
+            if primary_id == int(server['id']):
+                return channel
+            channel.socket.close()
+            if primary_id in servers:
+                channel = self._connect(servers[primary_id])
+                if channel is not None:
+                    return channel
+        print(f"Couldn't find the primary of shard {shard}.")
+        return None
@@ -0,0 +1,648 @@
+import bisect
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable
+from utils.identity_table import IdentityTable
+from utils.record_file import DEFAULT_DURABILITY, Durability
+from utils.session_registry import SessionRegistry
+from utils.storage import (ACCOUNT_CREATED, ACCOUNT_REMOVED, DEFAULT_LIMITS, DEFAULT_RETENTION, LOGGED_IN, LOGGED_OFF,
+                           AccountStore, HistoryRetention, HistoryStore, MessageLimits, MessageStore, SessionStore,
+                           StorageBackend, conversation_of)
+from utils.timer_wheel import TimerWheel
+from utils.undelivered_messages import Backlog, BacklogView
+
+# PRAGMA synchronous setting used for each durability mode. In WAL mode NORMAL only syncs at checkpoints,
+# which is the closest match to grouping fsyncs.
+SYNCHRONOUS_SETTINGS = {
+    'none': 'OFF',
+    'os-buffered': 'OFF',
+    'fsync-per-write': 'FULL',
+    'group-fsync': 'NORMAL',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    username TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_uuid ON sessions (uuid);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    payload_id INTEGER,
+    queued_at REAL
+);
+CREATE TABLE IF NOT EXISTS payloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id);
+CREATE INDEX IF NOT EXISTS messages_payload ON messages (payload_id) WHERE payload_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS consumed (
+    recipient TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history_messages (
+    timestamp INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    conversation TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (conversation, timestamp)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+"""
+
+
+class SqliteStorage(StorageBackend):
+    """Storage backend keeping all the state of a server in one SQLite database in WAL mode.
+
+    Every store keeps its state in memory for reads and writes through to indexed tables. Writes outside of a
+    transaction commit on their own, and writes inside one commit together."""
+    def __init__(self, filename: str, durability: Durability = DEFAULT_DURABILITY,
+                 limits: MessageLimits = DEFAULT_LIMITS, retention: HistoryRetention = DEFAULT_RETENTION):
+        self.filename = filename
+        self.limits = limits
+        self.retention = retention
+        self.identities = IdentityTable()  # Account ids shared by the stores
+        self.session_ids = IdentityTable()  # Session ids of the logged in uuids
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        # The connection is shared by every thread of the server, lock serializes transactions on it
+        self.connection = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(f'PRAGMA synchronous={SYNCHRONOUS_SETTINGS[durability.mode]}')
+        # Databases created before group messages have no payload_id column, and before messages kept the time
+        # they were queued no queued_at column
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(messages)')]
+        for column, column_type in [('payload_id', 'INTEGER'), ('queued_at', 'REAL')]:
+            if columns and column not in columns:
+                self.connection.execute(f'ALTER TABLE messages ADD COLUMN {column} {column_type}')
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.depth = 0  # Nesting depth of the current transaction
+
+    def account_list(self, server_id) -> 'SqliteAccountList':
+        return SqliteAccountList(self)
+
+    def logged_in_accounts(self, server_id) -> 'SqliteLoggedInAccounts':
+        return SqliteLoggedInAccounts(self)
+
+    def undelivered_messages(self, server_id) -> 'SqliteUndeliveredMessages':
+        return SqliteUndeliveredMessages(self, self.limits)
+
+    def undelivered_message_partitions(self, server_id, num_partitions: int, partition_of) -> list:
+        """The partitions share the tables and the connection, and each loads the rows of its own recipients, so
+        the number of partitions can change between starts."""
+        if num_partitions == 1:
+            return [self.undelivered_messages(server_id)]
+        return [SqliteUndeliveredMessages(self, self.limits,
+                                          lambda recipient, index=index: partition_of(recipient) == index)
+                for index in range(num_partitions)]
+
+    def message_history(self, server_id) -> 'SqliteMessageHistory':
+        return SqliteMessageHistory(self, self.retention)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group the writes made inside the context into one transaction. Nested transactions join the outer one."""
+        with self.lock:
+            if self.depth == 0:
+                self.connection.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield self.connection
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.connection.execute('ROLLBACK')
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
+
+
+class SqliteAccountList(AccountStore):
+    """Account list stored in the accounts table. In memory, accounts are kept by their id in the identity table."""
+    def __init__(self, storage: SqliteStorage):
+        self.storage = storage
+        self.identities = storage.identities
+        self.live = bytearray()  # Flag of every account id, set if the account exists
+        self.count = 0  # Number of existing accounts
+        with storage.lock:
+            for (username,) in storage.connection.execute('SELECT username FROM accounts ORDER BY id'):
+                self._set_live(username, True)
+
+    @property
+    def account_list(self):
+        """List of the usernames of all accounts in the order their ids were assigned, which is creation order
+        unless an account was deleted and created again."""
+        return [self.identities.name(account_id) for account_id in self.account_ids()]
+
+    def account_ids(self):
+        """Yield the id of every account."""
+        for account_id, live in enumerate(self.live):
+            if live:
+                yield account_id
+
+    def _set_live(self, username: str, live: bool):
+        """Set the flag of an account. An existing account holds a reference to its id."""
+        if live == self.contains(username):
+            return
+        if live:
+            account_id = self.identities.acquire(username)
+            if account_id >= len(self.live):
+                self.live.extend(bytes(account_id + 1 - len(self.live)))
+            self.live[account_id] = True
+            self.count += 1
+        else:
+            account_id = self.identities.get(username)
+            self.live[account_id] = False
+            self.count -= 1
+            self.identities.drop((account_id,))
+
+    def create_account(self, username: str):
+        """Add an account to the list and insert it into the table."""
+        with self.storage.transaction() as connection:
+            connection.execute('INSERT INTO accounts (username) VALUES (?)', (username,))
+        self._set_live(username, True)
+        self._notify(ACCOUNT_CREATED, username)
+
+    def remove(self, username: str):
+        """Remove an account from the list and delete it from the table."""
+        with self.storage.transaction() as connection:
+            connection.execute('DELETE FROM accounts WHERE username = ?', (username,))
+        self._set_live(username, False)
+        self._notify(ACCOUNT_REMOVED, username)
+
+    def contains(self, username: str):
+        """Check if an account is in the list."""
+        account_id = self.identities.get(username)
+        return account_id is not None and account_id < len(self.live) and self.live[account_id] == 1
+
+    def search_accounts(self, pattern):
+        """
+        Search for accounts that match a pattern.
+
+        Args:
+            pattern (re.Pattern): A compiled regular expression pattern.
+        """
+        return [account for account in map(self.identities.name, self.account_ids()) if pattern.match(account)]
+
+    def clear(self):
+        """
+        Clears the account list for testing purposes
+        """
+        self.identities.drop(list(self.account_ids()))
+        self.live = bytearray()
+        self.count = 0
+        with self.storage.transaction() as connection:
+            connection.execute('DELETE FROM accounts')
+
+
+class SqliteLoggedInAccounts(SessionStore):
+    """Logged in accounts stored in the sessions table. Sessions don't survive a restart, so the table is
+    cleared on startup. In memory, sessions are kept in the session registry."""
+    def __init__(self, storage: SqliteStorage):
+        self.storage = storage
+        self.registry = SessionRegistry(storage.identities, storage.session_ids)
+        with storage.transaction() as connection:
+            connection.execute('DELETE FROM sessions')
+
+    @property
+    def logged_in(self):
+        """Map of username to uuid of every session."""
+        return self.registry.logged_in()
+
+    def login(self, username: str, uuid: str):
+        """Add a new logged in account to the table and the registry."""
+        with self.storage.transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions (username, uuid) VALUES (?, ?)', (username, uuid))
+        self.registry.login(username, uuid)
+        self._notify(LOGGED_IN, username)
+
+    def is_logged_in(self, uuid: str):
+        """Check if a uuid is logged in."""
+        return self.registry.is_logged_in(uuid)
+
+    def username_is_logged_in(self, username: str):
+        """Check if a username is logged in."""
+        return self.registry.username_is_logged_in(username)
+
+    def logoff(self, username: str):
+        """Remove a logged in account from the table and the registry."""
+        if self.registry.username_is_logged_in(username):
+            with self.storage.transaction() as connection:
+                connection.execute('DELETE FROM sessions WHERE username = ?', (username,))
+            self.registry.logoff(username)
+            self._notify(LOGGED_OFF, username)
+            return True
+        return False
+
+    def get_username(self, uuid: str):
+        """Get the username corresponding to the uuid."""
+        return self.registry.get_username(uuid)
+
+    def get_uuid_from_username(self, username: str):
+        """Get the uuid corresponding to the username."""
+        return self.registry.get_uuid(username)
+
+
+class SqliteUndeliveredMessages(MessageStore):
+    """Undelivered messages stored in the messages table, indexed by recipient so consuming a recipient's
+    oldest messages is a single range delete, and reading them a single range scan. In memory, only the row ids of
+    every recipient's messages are kept. A recipient's messages are read from the table when they are first needed,
+    and the most recently used backlogs stay cached as Backlogs within the byte budget of the message limits, so
+    the memory taken by messages is bounded by the cache rather than by the number of queued messages. Every row
+    keeps the time its message was queued, and expired messages are found by a timer wheel counting from that time.
+
+    Recipients and senders are kept by their id in the identity table. A recipient holds a reference to its id
+    while it has queued messages, and a cached backlog to the id of the sender of every message in it. The consumed
+    table holds the message id of the oldest queued message of every recipient who consumed some of theirs, and
+    its row is deleted once they consumed all of them. A recipient without a row starts over from the row id of
+    their oldest message, which is larger than every id they had before.
+
+    A message sent to a group is stored once in the payloads table, and the messages rows of its recipients refer
+    to it by payload_id. The payload is deleted with the last row referring to it.
+
+    A store may hold only one partition of the recipients, with the other partitions held by stores sharing the
+    tables. Message ids are row ids either way, so they don't depend on the partitions."""
+    def __init__(self, storage: SqliteStorage, limits: MessageLimits = DEFAULT_LIMITS,
+                 holds: Callable[[str], bool] = None, max_cached_recipients: int = 1024):
+        """
+        Args:
+            storage (SqliteStorage): The storage backend holding the tables.
+            limits (MessageLimits, optional): Caps on the queued messages and their time to live.
+            holds (Callable[[str], bool], optional): Function telling if a recipient belongs to the partition of
+                this store. Every recipient does by default.
+            max_cached_recipients (int, optional): Number of recipients whose messages are kept in memory.
+        """
+        self.storage = storage
+        self.identities = storage.identities
+        self.limits = limits
+        self.holds = holds
+        self.max_cached_recipients = max_cached_recipients
+        self.message_count = 0 # Number of undelivered messages for all recipients
+        # Timers of the newest message queued for a recipient in every tick, firing when its time to live is over
+        self.timers = TimerWheel(now=time.time())
+        self.message_ids = {} # Map of recipient id to an array of the row ids of their messages
+        self.first_ids = {} # Map of recipient id with queued messages to the message id of their oldest one
+        self.cache = OrderedDict() # Map of recipient id to their Backlog, least recently used first
+        self.cached_bytes = 0 # Bytes used by the backlogs in the cache
+        with storage.transaction() as connection:
+            # Rows written before they were deleted with the last message of their recipient
+            connection.execute('DELETE FROM consumed WHERE recipient NOT IN (SELECT recipient FROM messages)')
+            connection.execute('DELETE FROM payloads WHERE id NOT IN '
+                               '(SELECT payload_id FROM messages WHERE payload_id IS NOT NULL)')
+        now = time.time()
+        with storage.lock:
+            saved_ids = dict(storage.connection.execute('SELECT recipient, count FROM consumed'))
+            # Only the recipient and the time of each row are read, the messages are read when they are needed
+            for row_id, recipient, queued_at in storage.connection.execute(
+                    'SELECT id, recipient, queued_at FROM messages ORDER BY id'):
+                if self.holds is not None and not self.holds(recipient):
+                    continue
+                recipient_id = self._track(recipient, row_id, saved_ids.get(recipient))
+                # Rows written before the time was kept count from this start
+                self._schedule_expiry(recipient_id, row_id, now if queued_at is None else queued_at)
+
+    @property
+    def undelivered_msg(self):
+        """Read-only map of recipient username to list of (sender, message) for that recipient."""
+        return BacklogView(self)
+
+    def _track(self, recipient: str, row_id: int, first_id: int = None) -> int:
+        """Add the row with id row_id to the messages of a recipient, and return the recipient's id. first_id is
+        the message id of a recipient's oldest message, by default its row id."""
+        recipient_id = self.identities.get(recipient)
+        if recipient_id not in self.message_ids:
+            recipient_id = self.identities.acquire(recipient)
+            self.message_ids[recipient_id] = array('q')
+            self.first_ids[recipient_id] = row_id if first_id is None else first_id
+        self.message_ids[recipient_id].append(row_id)
+        self.message_count += 1
+        return recipient_id
+
+    def _schedule_expiry(self, recipient_id, row_id, queued_at: float):
+        if self.limits.ttl_seconds is not None:
+            self.timers.schedule(queued_at + self.limits.ttl_seconds, recipient_id, row_id)
+
+    def _resize_cached(self, recipient_id, change):
+        """Apply change to a recipient's cached backlog, keeping the cache within its byte budget."""
+        backlog = self.cache.get(recipient_id)
+        if backlog is None:
+            return
+        self.cached_bytes -= backlog.nbytes()
+        change(backlog)
+        self.cached_bytes += backlog.nbytes()
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently used backlogs from memory until the cache is within its limits.
+        They stay in the table and are read again when they are needed."""
+        max_cached_bytes = self.limits.max_cached_bytes
+        while self.cache and (len(self.cache) > self.max_cached_recipients or
+                              (max_cached_bytes is not None and self.cached_bytes > max_cached_bytes)):
+            self._uncache(next(iter(self.cache)))
+
+    def _uncache(self, recipient_id):
+        backlog = self.cache.pop(recipient_id)
+        self.cached_bytes -= backlog.nbytes()
+        self.identities.drop(backlog.sender_ids())
+
+    def _load(self, recipient_id):
+        """Return the cached backlog of a recipient, reading it from the table on a cache miss."""
+        if recipient_id in self.cache:
+            self.cache.move_to_end(recipient_id)
+            return self.cache[recipient_id]
+        with self.storage.lock:
+            rows = self.storage.connection.execute(
+                'SELECT sender, coalesce(payloads.message, messages.message) FROM messages '
+                'LEFT JOIN payloads ON payloads.id = payload_id WHERE recipient = ? ORDER BY messages.id',
+                (self.identities.name(recipient_id),)).fetchall()
+        backlog = Backlog()
+        for sender, message in rows:
+            backlog.append(self.identities.acquire(sender), message.encode('utf-8'))
+        self.cache[recipient_id] = backlog
+        self.cached_bytes += backlog.nbytes()
+        self._evict()
+        return backlog
+
+    def add_message(self, recipient: str, sender: str, message: str, enforce_limits: bool = True,
+                    queued_at: float = None):
+        """Add a message to the list of undelivered messages for a recipient.
+        Returns False without adding it if the message limits are reached, unless enforce_limits is False.
+        queued_at is the time the message was queued, the current time by default."""
+        if enforce_limits and not self.has_room(recipient):
+            return False
+        queued_at = time.time() if queued_at is None else queued_at
+        with self.storage.transaction() as connection:
+            cursor = connection.execute(
+                'INSERT INTO messages (recipient, sender, message, queued_at) VALUES (?, ?, ?, ?)',
+                (recipient, sender, message, queued_at))
+        recipient_id = self._track(recipient, cursor.lastrowid)
+        self._schedule_expiry(recipient_id, cursor.lastrowid, queued_at)
+        self._resize_cached(recipient_id, lambda backlog: backlog.append(self.identities.acquire(sender),
+                                                                         message.encode('utf-8')))
+        return True
+
+    def add_group_message(self, recipients, sender: str, message: str, enforce_limits: bool = True,
+                          queued_at: float = None):
+        """Add one message for several recipients, stored once in the payloads table. Recipients for whom the
+        message limits are reached are skipped, unless enforce_limits is False. queued_at is the time the message
+        was queued, the current time by default.
+
+        Returns:
+            list: The recipients the message was added for, in the given order without duplicates.
+        """
+        added = self.recipients_with_room(recipients) if enforce_limits else list(dict.fromkeys(recipients))
+        if not added:
+            return added
+        queued_at = time.time() if queued_at is None else queued_at
+        with self.storage.transaction() as connection:
+            payload_id = connection.execute('INSERT INTO payloads (message) VALUES (?)', (message,)).lastrowid
+            row_ids = [connection.execute(
+                'INSERT INTO messages (recipient, sender, message, payload_id, queued_at) VALUES (?, ?, ?, ?, ?)',
+                (recipient, sender, '', payload_id, queued_at)).lastrowid for recipient in added]
+        body = message.encode('utf-8')
+        for recipient, row_id in zip(added, row_ids):
+            recipient_id = self._track(recipient, row_id)
+            self._schedule_expiry(recipient_id, row_id, queued_at)
+            self._resize_cached(recipient_id, lambda backlog: backlog.append(self.identities.acquire(sender), body))
+        return added
+
+    def recipients_with_room(self, recipients):
+        """Return the recipients the message limits allow adding one more message for, if it is added for all of
+        them, in the given order without duplicates."""
+        accepted = []
+        for recipient in dict.fromkeys(recipients):
+            recipient_count = len(self.message_ids.get(self.identities.get(recipient), ()))
+            if self.limits.has_room(recipient_count, self.message_count + len(accepted)):
+                accepted.append(recipient)
+        return accepted
+
+    def has_room(self, recipient: str):
+        """Check if the message limits allow adding another message for a recipient."""
+        return self.limits.has_room(len(self.message_ids.get(self.identities.get(recipient), ())),
+                                    self.message_count)
+
+    def expired_messages(self, now: float = None) -> dict:
+        """Return a map of every recipient with messages whose time to live has passed to the id of the newest one,
+        without deleting them."""
+        expired = {}
+        for recipient_id, row_id in self.timers.advance(time.time() if now is None else now):
+            count = bisect.bisect_right(self.message_ids.get(recipient_id, ()), row_id)
+            if count:
+                recipient = self.identities.name(recipient_id)
+                expired[recipient] = max(self.first_ids[recipient_id] + count - 1, expired.get(recipient, -1))
+        return expired
+
+    def has_messages(self, recipient: str) -> bool:
+        """Check if a recipient has undelivered messages, without reading them."""
+        return self.identities.get(recipient) in self.message_ids
+
+    def recipients(self):
+        """Return a list of the recipients with undelivered messages, without reading any messages."""
+        return [self.identities.name(recipient_id) for recipient_id in self.message_ids]
+
+    def get_recipient_messages(self, recipient: str, first_id: int = 0):
+        """Return the list of (sender, message) for a recipient, from the message with id first_id on, reading it
+        from the table if it isn't cached."""
+        recipient_id = self.identities.get(recipient)
+        if recipient_id not in self.message_ids:
+            return []
+        skip = max(first_id - self.first_ids.get(recipient_id, 0), 0)
+        return [(self.identities.name(sender_id), body.decode('utf-8'))
+                for sender_id, body in self._load(recipient_id).items(skip)]
+
+    def get_messages(self):
+        """Return a list of (recipient, [(sender, message)]) for all recipients with undelivered messages."""
+        return [(recipient, self.get_recipient_messages(recipient)) for recipient in self.recipients()]
+
+    def queued_ids(self, recipient: str) -> range:
+        """Return the range of message ids of the messages queued for a recipient."""
+        recipient_id = self.identities.get(recipient)
+        first_id = self.first_ids.get(recipient_id, 0)
+        return range(first_id, first_id + len(self.message_ids.get(recipient_id, ())))
+
+    def consume_messages(self, recipient: str, count: int):
+        """Delete the oldest count messages of a recipient."""
+        recipient_id = self.identities.get(recipient)
+        message_ids = self.message_ids.get(recipient_id, array('q'))[:count]
+        if not message_ids:
+            return
+        drained = len(message_ids) == len(self.message_ids[recipient_id])
+        first_id = self.first_ids[recipient_id] + len(message_ids)
+        with self.storage.transaction() as connection:
+            payload_ids = connection.execute(
+                'SELECT DISTINCT payload_id FROM messages WHERE recipient = ? AND id <= ? AND payload_id IS NOT NULL',
+                (recipient, message_ids[-1])).fetchall()
+            connection.execute('DELETE FROM messages WHERE recipient = ? AND id <= ?', (recipient, message_ids[-1]))
+            # Payloads of group messages are deleted with the last row referring to them, in any partition
+            connection.executemany('DELETE FROM payloads WHERE id = ?1 AND NOT EXISTS '
+                                   '(SELECT 1 FROM messages WHERE payload_id = ?1)', payload_ids)
+            if drained:
+                connection.execute('DELETE FROM consumed WHERE recipient = ?', (recipient,))
+            else:
+                connection.execute('INSERT INTO consumed (recipient, count) VALUES (?, ?) '
+                                   'ON CONFLICT (recipient) DO UPDATE SET count = excluded.count', (recipient, first_id))
+        del self.message_ids[recipient_id][:count]
+        self.message_count -= len(message_ids)
+        self._resize_cached(recipient_id, lambda backlog: self.identities.drop(backlog.consume(count)))
+        if drained:
+            self.message_ids.pop(recipient_id)
+            self.first_ids.pop(recipient_id)
+            if recipient_id in self.cache:
+                self._uncache(recipient_id)
+            self.identities.drop((recipient_id,))
+        else:
+            self.first_ids[recipient_id] = first_id
+
+    def acknowledge_messages(self, recipient: str, message_id: int):
+        """Delete every message of a recipient up to and including message_id."""
+        count = message_id - self.queued_ids(recipient).start + 1
+        if count > 0:
+            self.consume_messages(recipient, count)
+
+    def update_messages(self, recipient: str, message_infos):
+        """Update the messages for a recipient. Replaces the message list for that recipient with the given messages."""
+        message_infos = [(sender, message) for sender, message in message_infos
+                         if not (sender == "" or message == "")]
+        current = self.get_recipient_messages(recipient)
+        delivered = len(current) - len(message_infos)
+        with self.storage.transaction():
+            if delivered >= 0 and current[delivered:] == message_infos:
+                self.consume_messages(recipient, delivered)
+            else:
+                self.consume_messages(recipient, len(current))
+                for sender, message in message_infos:
+                    self.add_message(recipient, sender, message, enforce_limits=False)
+
+    def clear(self):
+        """
+        Clears the undelivered messages for testing purposes
+        """
+        for recipient_id in list(self.cache):
+            self._uncache(recipient_id)
+        recipients = [(self.identities.name(recipient_id),) for recipient_id in self.message_ids]
+        self.identities.drop(list(self.message_ids))
+        with self.storage.transaction() as connection:
+            if self.holds is None:
+                connection.execute('DELETE FROM messages')
+                connection.execute('DELETE FROM payloads')
+                connection.execute('DELETE FROM consumed')
+            else:
+                connection.executemany('DELETE FROM messages WHERE recipient = ?', recipients)
+                connection.executemany('DELETE FROM consumed WHERE recipient = ?', recipients)
+                connection.execute('DELETE FROM payloads WHERE id NOT IN '
+                                   '(SELECT payload_id FROM messages WHERE payload_id IS NOT NULL)')
+        self.message_ids = {}
+        self.first_ids = {}
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.message_count = 0
+        self.timers.clear()
+
+
+class SqliteMessageHistory(HistoryStore):
+    """Message history stored in the history_messages table, one row per message keyed by its timestamp, and
+    indexed by the history table, whose primary key (conversation, timestamp) orders the rows of a conversation
+    by timestamp. A page is one range scan of the index, so reading a page costs the same however many messages
+    are stored, and nothing but the message count is kept in memory.
+
+    Retention deletes the oldest messages through the index of history on timestamp: the messages older than the
+    age bound once there are any, and the messages beyond the message bound in batches of batch_size."""
+    def __init__(self, storage: SqliteStorage, retention: HistoryRetention = DEFAULT_RETENTION,
+                 batch_size: int = 65536):
+        self.storage = storage
+        self.retention = retention
+        self.batch_size = batch_size
+        with storage.lock:
+            (self.message_count, self.first_timestamp, newest) = storage.connection.execute(
+                'SELECT COUNT(*), MIN(timestamp), coalesce(MAX(timestamp), -1) FROM history_messages').fetchone()
+        # first_timestamp is the timestamp of the oldest message stored, None without messages
+        self.last_timestamp = newest
+        self.expire_messages()
+
+    def add_message(self, recipients, sender: str, message: str, timestamp: int):
+        """Insert a message and a history row for the conversation of every recipient. Adding a message with a
+        timestamp that is already stored changes nothing."""
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients:
+            return
+        with self.storage.transaction() as connection:
+            inserted = connection.execute('INSERT OR IGNORE INTO history_messages (timestamp, sender, message) '
+                                          'VALUES (?, ?, ?)', (timestamp, sender, message)).rowcount
+            connection.executemany('INSERT OR IGNORE INTO history (conversation, timestamp) VALUES (?, ?)',
+                                   [(conversation_of(sender, recipient), timestamp) for recipient in recipients])
+        self.message_count += inserted
+        self.last_timestamp = max(timestamp, self.last_timestamp)
+        if inserted and (self.first_timestamp is None or timestamp < self.first_timestamp):
+            self.first_timestamp = timestamp
+        max_messages = self.retention.max_messages
+        if max_messages is not None and self.message_count >= max_messages + self.batch_size:
+            self._delete_oldest(self.message_count - max_messages)
+
+    def get_page(self, username: str, peer: str, before: int = None, limit: int = 50):
+        """Return a page of a conversation with one range scan of the history index."""
+        oldest = self.retention.oldest_kept(time.time())
+        with self.storage.lock:
+            rows = self.storage.connection.execute(
+                'SELECT timestamp, sender, message FROM history JOIN history_messages USING (timestamp) '
+                'WHERE conversation = ? AND timestamp > ? AND timestamp < ? ORDER BY timestamp DESC LIMIT ?',
+                (conversation_of(username, peer), oldest, before if before is not None else 2 ** 63 - 1,
+                 limit + 1)).fetchall()
+        # The extra row only tells if there is an older page
+        page = rows[:limit]
+        page.reverse()
+        return page, (page[0][0] if len(rows) > limit else None)
+
+    def expire_messages(self, now: float = None):
+        """Delete the messages older than the age bound, and the oldest messages beyond the message bound once a
+        batch of them has built up. Nothing is written when there is nothing to delete."""
+        oldest = self.retention.oldest_kept(time.time() if now is None else now)
+        if self.first_timestamp is not None and self.first_timestamp <= oldest:
+            self._delete_through(oldest)
+        max_messages = self.retention.max_messages
+        if max_messages is not None and self.message_count >= max_messages + self.batch_size:
+            self._delete_oldest(self.message_count - max_messages)
+
+    def _delete_oldest(self, count: int):
+        with self.storage.lock:
+            row = self.storage.connection.execute(
+                'SELECT timestamp FROM history_messages ORDER BY timestamp LIMIT 1 OFFSET ?', (count - 1,)).fetchone()
+        if row is not None:
+            self._delete_through(row[0])
+
+    def _delete_through(self, timestamp: int):
+        with self.storage.transaction() as connection:
+            deleted = connection.execute('DELETE FROM history_messages WHERE timestamp <= ?', (timestamp,)).rowcount
+            connection.execute('DELETE FROM history WHERE timestamp <= ?', (timestamp,))
+            (self.first_timestamp,) = connection.execute('SELECT MIN(timestamp) FROM history_messages').fetchone()
+        self.message_count -= deleted
+
+    def clear(self):
+        """
+        Clears the message history for testing purposes
+        """
+        self.message_count = 0
+        self.first_timestamp = None
+        self.last_timestamp = -1
+        with self.storage.transaction() as connection:
+            connection.execute('DELETE FROM history_messages')
+            connection.execute('DELETE FROM history')
@@ -0,0 +1,291 @@
+import time
+
+
+class MessageLimits:
+    """Limits on the undelivered messages a server keeps. One instance is shared by the message store of a server.
+    A limit of None means unlimited.
+
+    Args:
+        max_messages_per_recipient (int, optional): Messages queued for one recipient before new ones are refused.
+        max_messages (int, optional): Messages queued for all recipients before new ones are refused.
+        ttl_seconds (float, optional): Seconds after which an undelivered message is dropped, counted from the
+            time it was queued, which is stored with it.
+        max_cached_bytes (int, optional): Bytes of message backlogs kept in memory by stores that read backlogs
+            from disk on demand. The least recently used backlogs are dropped from memory first.
+    """
+    def __init__(self, max_messages_per_recipient: int = None, max_messages: int = None, ttl_seconds: float = None,
+                 max_cached_bytes: int = 64 * 1024 * 1024):
+        for name, value in [('max_messages_per_recipient', max_messages_per_recipient),
+                            ('max_messages', max_messages), ('ttl_seconds', ttl_seconds),
+                            ('max_cached_bytes', max_cached_bytes)]:
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}")
+        self.max_messages_per_recipient = max_messages_per_recipient
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self.max_cached_bytes = max_cached_bytes
+
+    def has_room(self, recipient_count: int, total_count: int) -> bool:
+        """Check if a message can be queued for a recipient who has recipient_count messages queued, when
+        total_count messages are queued in total."""
+        if self.max_messages_per_recipient is not None and recipient_count >= self.max_messages_per_recipient:
+            return False
+        return self.max_messages is None or total_count < self.max_messages
+
+
+DEFAULT_LIMITS = MessageLimits()
+
+
+class HistoryRetention:
+    """Bounds on the message history a server keeps. The oldest messages are dropped first, in batches, so a
+    store may hold up to one batch more than max_messages until the next batch is dropped. A bound of None means
+    unbounded.
+
+    Args:
+        max_messages (int, optional): Messages kept in the history. A message sent to a group counts once.
+        max_age_seconds (float, optional): Seconds after which a message is dropped from the history. Older
+            messages are never returned, even before their batch is dropped.
+    """
+    def __init__(self, max_messages: int = 10_000_000, max_age_seconds: float = 30 * 24 * 60 * 60):
+        for name, value in [('max_messages', max_messages), ('max_age_seconds', max_age_seconds)]:
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}")
+        self.max_messages = max_messages
+        self.max_age_seconds = max_age_seconds
+
+    def oldest_kept(self, now: float) -> int:
+        """Return the timestamp in microseconds of the oldest message the age bound keeps at time now."""
+        if self.max_age_seconds is None:
+            return -1
+        return int((now - self.max_age_seconds) * 1_000_000)
+
+
+DEFAULT_RETENTION = HistoryRetention()
+
+
+def conversation_of(username: str, peer: str) -> str:
+    """Return the key of the conversation between two accounts, the same whichever of them is asking."""
+    return '\0'.join(sorted((username, peer)))
+
+
+# Events of the stores, passed to their listeners with the username they are about
+ACCOUNT_CREATED = 'created'
+ACCOUNT_REMOVED = 'removed'
+LOGGED_IN = 'online'
+LOGGED_OFF = 'offline'
+
+
+class StoreEvents:
+    """Listeners of the changes to a store. They are called with (event, username) after every change, by the
+    thread making it and while it holds the store's lock, so they must not block."""
+    listeners = ()
+
+    def add_listener(self, listener):
+        """Call listener(event, username) after every change to the store."""
+        self.listeners = self.listeners + (listener,)
+
+    def _notify(self, event: str, username: str):
+        for listener in self.listeners:
+            listener(event, username)
+
+
+class AccountStore(StoreEvents):
+    """Interface for the set of existing accounts. account_list holds the usernames in creation order. Listeners
+    get ACCOUNT_CREATED and ACCOUNT_REMOVED events."""
+    def create_account(self, username: str):
+        """Add an account."""
+        raise NotImplementedError
+
+    def remove(self, username: str):
+        """Remove an account."""
+        raise NotImplementedError
+
+    def contains(self, username: str):
+        """Check if an account exists."""
+        raise NotImplementedError
+
+    def search_accounts(self, pattern):
+        """Return the usernames of the accounts matching a compiled regular expression pattern."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every account, for testing purposes."""
+        raise NotImplementedError
+
+
+class SessionStore(StoreEvents):
+    """Interface for the set of logged in accounts. logged_in maps the username of every session to its uuid, and
+    registry is the SessionRegistry indexing the sessions, which also holds the connected clients of the server.
+    Listeners get LOGGED_IN and LOGGED_OFF events."""
+    def login(self, username: str, uuid: str):
+        """Record that the client with the given uuid is logged into an account."""
+        raise NotImplementedError
+
+    def is_logged_in(self, uuid: str):
+        """Check if a client uuid is logged in."""
+        raise NotImplementedError
+
+    def username_is_logged_in(self, username: str):
+        """Check if someone is logged into an account."""
+        raise NotImplementedError
+
+    def logoff(self, username: str):
+        """Remove the session of an account. Returns False if the account wasn't logged in."""
+        raise NotImplementedError
+
+    def get_username(self, uuid: str):
+        """Return the username a client uuid is logged into, or None."""
+        raise NotImplementedError
+
+    def get_uuid_from_username(self, username: str):
+        """Return the uuid of the client logged into an account. Raises KeyError if no one is logged in."""
+        raise NotImplementedError
+
+
+class MessageStore:
+    """Interface for the queue of undelivered messages. undelivered_msg maps every recipient with queued messages
+    to their list of (sender, message), oldest first.
+
+    Every message of a recipient has a message id, one more than the id of the recipient's message before it. Once
+    every message of a recipient is consumed, the store forgets the recipient, and its next message gets an id
+    larger than every id it had before. Ids are never reused, and every server applying the same updates gives a
+    message the same id."""
+    def add_message(self, recipient: str, sender: str, message: str, enforce_limits: bool = True,
+                    queued_at: float = None):
+        """Queue a message for a recipient. Returns False if the message limits refused it. Replicas pass
+        enforce_limits=False to queue every message their primary accepted. queued_at is the time the message was
+        queued, which its time to live counts from, the current time by default. It is stored with the message."""
+        raise NotImplementedError
+
+    def add_group_message(self, recipients, sender: str, message: str, enforce_limits: bool = True,
+                          queued_at: float = None):
+        """Queue one message for several recipients, storing it once. Returns the recipients it was queued for,
+        in the given order without duplicates, skipping the ones the message limits refused it for unless
+        enforce_limits is False. queued_at is as for add_message."""
+        raise NotImplementedError
+
+    def recipients_with_room(self, recipients):
+        """Return the recipients add_group_message would queue a message for."""
+        raise NotImplementedError
+
+    def has_room(self, recipient: str):
+        """Check if the message limits allow queueing another message for a recipient."""
+        raise NotImplementedError
+
+    def expired_messages(self, now: float = None) -> dict:
+        """Return a map of every recipient with messages whose time to live has passed at time now, by default the
+        current time, to the id of its newest expired message. Expired messages stay queued until they are
+        acknowledged, so that a primary can replicate dropping them before it drops them itself."""
+        raise NotImplementedError
+
+    def has_messages(self, recipient: str) -> bool:
+        """Check if a recipient has undelivered messages."""
+        raise NotImplementedError
+
+    def recipients(self):
+        """Return a list of the recipients with undelivered messages."""
+        raise NotImplementedError
+
+    def get_recipient_messages(self, recipient: str, first_id: int = 0):
+        """Return the list of (sender, message) queued for a recipient, oldest first, starting from the message
+        with id first_id if it is still queued."""
+        raise NotImplementedError
+
+    def get_messages(self):
+        """Return a list of (recipient, [(sender, message)]) for all recipients with undelivered messages."""
+        raise NotImplementedError
+
+    def queued_ids(self, recipient: str) -> range:
+        """Return the range of message ids of the messages queued for a recipient, oldest first."""
+        raise NotImplementedError
+
+    def consume_messages(self, recipient: str, count: int):
+        """Remove the oldest count messages of a recipient once they have been delivered."""
+        raise NotImplementedError
+
+    def acknowledge_messages(self, recipient: str, message_id: int):
+        """Remove every message of a recipient up to and including message_id, once the recipient has received
+        them. Acknowledging messages that were already removed does nothing."""
+        raise NotImplementedError
+
+    def update_messages(self, recipient: str, message_infos):
+        """Replace the message list of a recipient with the given list of (sender, message)."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every queued message, for testing purposes."""
+        raise NotImplementedError
+
+
+class HistoryStore:
+    """Interface for the append-only history of the messages sent to the accounts of a server, indexed by
+    conversation and timestamp. Messages stay in the history after they are delivered, until the retention bounds
+    drop them.
+
+    Every message has a timestamp in microseconds, assigned by the primary with next_timestamp and replicated with
+    the message, so every server pages through a conversation the same way. Timestamps only increase, so the
+    timestamp of a message is unique within its conversation and serves as the cursor of a page."""
+    last_timestamp = -1  # Newest timestamp assigned or stored
+
+    def next_timestamp(self, now: float = None) -> int:
+        """Return a timestamp newer than every timestamp assigned or stored. now defaults to the current time."""
+        self.last_timestamp = max(int((time.time() if now is None else now) * 1_000_000), self.last_timestamp + 1)
+        return self.last_timestamp
+
+    def add_message(self, recipients, sender: str, message: str, timestamp: int):
+        """Append a message to the conversations between its sender and each of its recipients."""
+        raise NotImplementedError
+
+    def get_page(self, username: str, peer: str, before: int = None, limit: int = 50):
+        """Return a page of the conversation between two accounts.
+
+        Args:
+            username (str): One account of the conversation.
+            peer (str): The other account of the conversation.
+            before (int, optional): Only return messages older than this timestamp. Defaults to the newest ones.
+            limit (int, optional): Most messages returned.
+
+        Returns:
+            (list, int): The (timestamp, sender, message) of the newest limit messages before the cursor, oldest
+                first, and the cursor of the next older page, or None if there are no older messages.
+        """
+        raise NotImplementedError
+
+    def expire_messages(self, now: float = None):
+        """Drop the messages the retention bounds no longer keep. now defaults to the current time."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every message, for testing purposes."""
+        raise NotImplementedError
+
+
+class StorageBackend:
+    """Interface for a storage backend, which creates the stores holding a server's state and groups writes
+    made while handling one request into a single transaction. identities is the IdentityTable of account ids
+    shared by its stores."""
+    def account_list(self, server_id) -> AccountStore:
+        raise NotImplementedError
+
+    def logged_in_accounts(self, server_id) -> SessionStore:
+        raise NotImplementedError
+
+    def undelivered_messages(self, server_id) -> MessageStore:
+        raise NotImplementedError
+
+    def undelivered_message_partitions(self, server_id, num_partitions: int, partition_of) -> list:
+        """Return the message stores of a server split into num_partitions stores, where partition_of(recipient)
+        is the index of the store holding a recipient's messages. partition_of must give the same index in every
+        process. Every server of a replica group must use the same number of partitions, since message ids may
+        depend on them."""
+        raise NotImplementedError
+
+    def message_history(self, server_id) -> HistoryStore:
+        raise NotImplementedError
+
+    def transaction(self):
+        """Return a context manager. Writes made to this backend's stores inside it are committed together.
+
+        The transaction must be entered after every server lock it needs, since it may hold a lock of its own.
+        """
+        raise NotImplementedError
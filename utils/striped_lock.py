@@ -0,0 +1,47 @@
+import contextlib
+import hashlib
+import threading
+
+# Number of locks of a StripedLock unless given
+DEFAULT_STRIPES = 64
+
+
+def stable_hash(key: str) -> int:
+    """Hash a string the same way in every process, unlike hash, so that state split by it can be kept on disk.
+    It is unrelated to the crc32 of shard_of, so the accounts of one shard spread over every stripe."""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class StripedLock:
+    """Fixed set of locks shared by keys, such as usernames, by hashing each key to one of them. Requests about
+    different keys usually take different locks and run in parallel, while requests about the same key are
+    serialized, without keeping a lock per key.
+
+    A request touching several keys takes their locks together with hold, which always acquires them in stripe
+    order so two requests can't deadlock by taking the same stripes in opposite orders."""
+    def __init__(self, num_stripes: int = DEFAULT_STRIPES):
+        """
+        Args:
+            num_stripes (int, optional): Number of locks. Unrelated keys share a lock with probability 1 / num_stripes.
+        """
+        if num_stripes <= 0:
+            raise ValueError("num_stripes must be positive")
+        self.locks = [threading.Lock() for _ in range(num_stripes)]
+
+    def stripe(self, key) -> int:
+        """Return the index of the lock of a key. Strings get the same stripe in every process."""
+        if isinstance(key, str):
+            return stable_hash(key) % len(self.locks)
+        return hash(key) % len(self.locks)
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        """Hold the locks of every key, acquired in stripe order and released in reverse."""
+        locks = [self.locks[stripe] for stripe in sorted({self.stripe(key) for key in keys})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -2,19 +2,15 @@ import os
 import tempfile
 import unittest
 import re
-from account_list import AccountList
+from utils.account_list import AccountList
+from utils.record_file import RecordFile
 
 
-class TestAccountList(unittest.TestCase):
-    def setUp(self):
-        # Create a temporary file for testing
-        self.tmpfile = tempfile.NamedTemporaryFile(mode='w', delete=False)
-
-        self.account_list = AccountList(self.tmpfile.name)
-
-    def tearDown(self):
-        # Remove the temporary file after testing
-        os.remove(self.tmpfile.name)
+class AccountListTests:
+    """Tests every account store must pass. Subclasses set self.account_list and implement reopen."""
+    def reopen(self):
+        """Load a new account store from what the current one persisted."""
+        raise NotImplementedError
 
     def test_create_account(self):
         self.account_list.create_account("user1")
@@ -35,27 +31,12 @@ class TestAccountList(unittest.TestCase):
         self.assertTrue(self.account_list.contains("user1"))
         self.assertFalse(self.account_list.contains("user2"))
 
-    def test_create_account_writes_file(self):
-        # Create an account list and add an account
-        self.account_list.create_account("user1")
-
-        # Read the contents of the file and check that it matches the account list
-        with open(self.tmpfile.name, 'r') as f:
-            lines = f.readlines()
-        expected_lines = ["user1\n"]
-        self.assertEqual(lines, expected_lines)
-
-    def test_remove_account_updates_file(self):
-        # Create an account list and add two accounts
+    def test_accounts_persist(self):
         self.account_list.create_account("user1")
-        self.account_list.create_account("user2")
-
-        # Remove an account and check that it was removed from the file
+        self.account_list.create_account("user 2\nwith newline")
+        self.account_list.create_account("user3")
         self.account_list.remove("user1")
-        with open(self.tmpfile.name, 'r') as f:
-            lines = f.readlines()
-        expected_lines = ["user2\n"]
-        self.assertEqual(lines, expected_lines)
+        self.assertEqual(self.reopen().account_list, ["user 2\nwith newline", "user3"])
 
     def test_search_accounts(self):
         self.account_list.create_account("user1")
@@ -70,5 +51,50 @@ class TestAccountList(unittest.TestCase):
             re.compile("something.*")), [])
 
 
+class TestAccountList(AccountListTests, unittest.TestCase):
+    def setUp(self):
+        # Create a temporary file for testing
+        self.tmpfile = tempfile.NamedTemporaryFile(mode='w', delete=False)
+
+        self.account_list = AccountList(self.tmpfile.name)
+
+    def tearDown(self):
+        # Remove the temporary file after testing
+        os.remove(self.tmpfile.name)
+
+    def reopen(self):
+        return AccountList(self.tmpfile.name)
+
+    def test_create_account_writes_file(self):
+        # Create an account list and add an account
+        self.account_list.create_account("user1")
+
+        # Read the records in the file and check that it matches the account list
+        records = list(RecordFile(self.tmpfile.name).read())
+        expected_records = [('+', "user1")]
+        self.assertEqual(records, expected_records)
+
+    def test_remove_account_updates_file(self):
+        # Create an account list and add two accounts
+        self.account_list.create_account("user1")
+        self.account_list.create_account("user2")
+
+        # Remove an account and check that it was removed from the file
+        self.account_list.remove("user1")
+        self.assertEqual(AccountList(self.tmpfile.name).account_list, ["user2"])
+
+    def test_reload_after_torn_write(self):
+        self.account_list.create_account("user1")
+        self.account_list.create_account("user\n2")
+        # Simulate a crash in the middle of appending a record
+        with open(self.tmpfile.name, 'ab') as f:
+            f.write(b'\x00\x00\x00\x10\x12')
+
+        reloaded = AccountList(self.tmpfile.name)
+        self.assertEqual(reloaded.account_list, ["user1", "user\n2"])
+        reloaded.create_account("user3")
+        self.assertEqual(AccountList(self.tmpfile.name).account_list, ["user1", "user\n2", "user3"])
+
+
 if __name__ == '__main__':
     unittest.main()
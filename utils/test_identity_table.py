@@ -0,0 +1,119 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from utils.file_storage import FileStorage
+from utils.identity_table import IdentityTable
+
+
+class TestIdentityTable(unittest.TestCase):
+    def setUp(self):
+        self.identities = IdentityTable()
+
+    def test_intern_assigns_dense_ids(self):
+        self.assertEqual(self.identities.intern("alice"), 0)
+        self.assertEqual(self.identities.intern("bob"), 1)
+        self.assertEqual(self.identities.intern("alice"), 0)
+        self.assertEqual(self.identities.get("bob"), 1)
+        self.assertIsNone(self.identities.get("charlie"))
+        self.assertEqual(self.identities.name(1), "bob")
+        self.assertEqual(len(self.identities), 2)
+
+    def test_released_ids_are_reused(self):
+        self.identities.intern("alice")
+        self.identities.intern("bob")
+        self.identities.release("alice")
+        self.assertNotIn("alice", self.identities)
+        self.assertEqual(self.identities.intern("charlie"), 0)
+        self.assertEqual(self.identities.intern("alice"), 2)
+
+    def test_ids_are_released_with_their_last_reference(self):
+        alice = self.identities.acquire("alice")
+        self.assertEqual(self.identities.acquire("alice"), alice)
+        self.identities.drop((alice,))
+        self.assertEqual(self.identities.get("alice"), alice)
+        self.identities.drop((alice,))
+        self.assertNotIn("alice", self.identities)
+        self.assertEqual(self.identities.acquire("bob"), alice)
+
+    def test_names_are_packed_into_the_arena(self):
+        ids = [self.identities.intern(f"user{i}") for i in range(1000)]
+        self.assertEqual(ids, list(range(1000)))
+        self.assertEqual([self.identities.get(f"user{i}") for i in range(1000)], ids)
+        self.assertEqual(self.identities.name(999), "user999")
+        self.assertEqual(len(self.identities.arena), sum(len(f"user{i}") for i in range(1000)))
+        # Released names are compacted away once they take half of the arena
+        for i in range(0, 1000, 3):
+            self.identities.release(f"user{i}")
+        with mock.patch('utils.identity_table.MIN_COMPACTION_SIZE', 0):
+            for i in range(1, 1000, 3):
+                self.identities.release(f"user{i}")
+        kept = sum(len(f"user{i}") for i in range(2, 1000, 3))
+        self.assertEqual(len(self.identities.arena) - self.identities.holes, kept)
+        self.assertLess(len(self.identities.arena), 2 * kept)
+        self.assertEqual([self.identities.get(f"user{i}") for i in range(2, 1000, 3)], list(range(2, 1000, 3)))
+        self.assertIsNone(self.identities.get("user0"))
+        self.assertIsNone(self.identities.name(0))
+        reused = self.identities.intern("ünïcode")
+        self.assertEqual(reused % 3, 1)
+        self.assertEqual(self.identities.name(reused), "ünïcode")
+
+    def test_generations_tell_reused_ids_apart(self):
+        self.identities.intern("alice")
+        alice = self.identities.get_versioned("alice")
+        self.identities.release("alice")
+        self.identities.intern("bob")
+        bob = self.identities.get_versioned("bob")
+        self.assertEqual(alice[0], bob[0])
+        self.assertNotEqual(alice, bob)
+
+
+class TestSharedIdentities(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stores_share_account_ids(self):
+        storage = FileStorage(self.directory)
+        account_list = storage.account_list(1)
+        logged_in = storage.logged_in_accounts(1)
+        undelivered_messages = storage.undelivered_messages(1)
+        account_list.create_account("alice")
+        logged_in.login("alice", "1234")
+        undelivered_messages.add_message("alice", "bob", "hello")
+
+        alice = storage.identities.get("alice")
+        self.assertTrue(account_list.live[alice])
+        self.assertEqual(logged_in.registry.sessions[alice], storage.session_ids.get("1234"))
+        self.assertIn(alice, undelivered_messages.sequence_numbers)
+        # Senders only get an id once their messages are read into memory
+        self.assertEqual(len(storage.identities), 1)
+        undelivered_messages.get_recipient_messages("alice")
+        self.assertEqual(len(storage.identities), 2)
+
+        # Session ids are released on logoff
+        logged_in.logoff("alice")
+        self.assertNotIn("1234", storage.session_ids)
+
+        # Account ids are released once no store refers to them
+        account_list.remove("alice")
+        self.assertIn("alice", storage.identities)
+        undelivered_messages.consume_messages("alice", 1)
+        self.assertEqual(len(storage.identities), 0)
+
+    def test_drained_accounts_are_released(self):
+        storage = FileStorage(self.directory)
+        undelivered_messages = storage.undelivered_messages(1)
+        for i in range(100):
+            undelivered_messages.add_message(f"user{i}", "bob", "hello")
+            undelivered_messages.get_recipient_messages(f"user{i}")
+            undelivered_messages.consume_messages(f"user{i}", 1)
+        self.assertEqual(len(storage.identities), 0)
+        self.assertEqual(undelivered_messages.first_ids, {})
+        self.assertLessEqual(len(storage.identities.offsets), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
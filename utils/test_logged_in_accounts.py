@@ -1,27 +1,18 @@
 import os
 import unittest
 import tempfile
-from logged_in_accounts import LoggedInAccounts
+from utils.logged_in_accounts import LoggedInAccounts
+from utils.record_file import RecordFile
 
 
-class TestLoggedInAccounts(unittest.TestCase):
-    def setUp(self):
-        self.test_file = tempfile.NamedTemporaryFile(delete=False)
-        self.test_filename = self.test_file.name
-        self.accounts = LoggedInAccounts(self.test_filename)
-
-    def tearDown(self):
-        os.remove(self.test_filename)
-
+class LoggedInAccountsTests:
+    """Tests every session store must pass. Subclasses set self.accounts."""
     def test_login(self):
         username = 'testuser'
         uuid = '1234'
         self.accounts.login(username, uuid)
         self.assertTrue(username in self.accounts.logged_in.keys())
         self.assertTrue(uuid in self.accounts.logged_in.values())
-        with open(self.test_filename, 'r') as f:
-            contents = f.read()
-            self.assertTrue(f"{username} {uuid}\n" in contents)
 
     def test_is_logged_in(self):
         uuid = '1234'
@@ -42,9 +33,7 @@ class TestLoggedInAccounts(unittest.TestCase):
         self.assertTrue(self.accounts.logoff(username))
         self.assertFalse(username in self.accounts.logged_in.keys())
         self.assertFalse(uuid in self.accounts.logged_in.values())
-        with open(self.test_filename, 'r') as f:
-            contents = f.read()
-            self.assertFalse(f"{username} {uuid}\n" in contents)
+        self.assertFalse(self.accounts.logoff(username))
 
     def test_get_username(self):
         uuid = '1234'
@@ -62,5 +51,26 @@ class TestLoggedInAccounts(unittest.TestCase):
         self.assertEqual(self.accounts.get_uuid_from_username(username), uuid)
 
 
+class TestLoggedInAccounts(LoggedInAccountsTests, unittest.TestCase):
+    def setUp(self):
+        self.test_file = tempfile.NamedTemporaryFile(delete=False)
+        self.test_filename = self.test_file.name
+        self.accounts = LoggedInAccounts(self.test_filename)
+
+    def tearDown(self):
+        os.remove(self.test_filename)
+
+    def test_login_writes_file(self):
+        self.accounts.login('testuser', '1234')
+        records = list(RecordFile(self.test_filename).read())
+        self.assertTrue(('+', 'testuser', '1234') in records)
+
+    def test_logoff_writes_file(self):
+        self.accounts.login('testuser', '1234')
+        self.accounts.logoff('testuser')
+        records = list(RecordFile(self.test_filename).read())
+        self.assertEqual(records[-1], ('-', 'testuser'))
+
+
 if __name__ == '__main__':
     unittest.main()
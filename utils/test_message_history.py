@@ -0,0 +1,147 @@
+import shutil
+import tempfile
+import time
+import unittest
+from utils.message_history import MessageHistory
+from utils.storage import HistoryRetention
+
+UNBOUNDED = HistoryRetention(max_messages=None, max_age_seconds=None)
+
+
+class MessageHistoryTests:
+    """Tests every history store must pass. Subclasses implement make_history, which drops the oldest messages two
+    at a time, and reopen."""
+    def make_history(self, retention: HistoryRetention):
+        """Create a history store with the given retention, replacing self.history."""
+        raise NotImplementedError
+
+    def reopen(self):
+        """Load a new history store from what the current one persisted."""
+        raise NotImplementedError
+
+    def add(self, recipients, sender, message, timestamp=None):
+        self.history.add_message(recipients, sender, message,
+                                 self.history.next_timestamp() if timestamp is None else timestamp)
+
+    def messages(self, page):
+        return [(sender, message) for (_, sender, message) in page]
+
+    def test_pages(self):
+        self.make_history(UNBOUNDED)
+        for i in range(5):
+            self.add(["Bob"], "Alice", f"to Bob {i}")
+            self.add(["Alice"], "Bob", f"to Alice {i}")
+        self.add(["Charlie"], "Alice", "to Charlie")
+        (page, before) = self.history.get_page("Alice", "Bob", limit=4)
+        self.assertEqual(self.messages(page), [("Alice", "to Bob 3"), ("Bob", "to Alice 3"),
+                                               ("Alice", "to Bob 4"), ("Bob", "to Alice 4")])
+        self.assertEqual(before, page[0][0])
+        # Either account of the conversation gets the same pages
+        self.assertEqual(self.history.get_page("Bob", "Alice", limit=4), (page, before))
+        (page, before) = self.history.get_page("Bob", "Alice", before, limit=4)
+        self.assertEqual(len(page), 4)
+        (page, before) = self.history.get_page("Bob", "Alice", before, limit=4)
+        self.assertEqual(self.messages(page), [("Alice", "to Bob 0"), ("Bob", "to Alice 0")])
+        self.assertIsNone(before)
+        self.assertEqual(self.history.get_page("Bob", "Charlie"), ([], None))
+
+    def test_group_message(self):
+        self.make_history(UNBOUNDED)
+        self.add(["Bob", "Charlie", "Bob"], "Alice", "hi all")
+        for recipient in ["Bob", "Charlie"]:
+            self.assertEqual(self.messages(self.history.get_page(recipient, "Alice")[0]), [("Alice", "hi all")])
+        self.assertEqual(self.history.get_page("Bob", "Charlie"), ([], None))
+
+    def test_timestamps_out_of_order(self):
+        self.make_history(UNBOUNDED)
+        now = int(time.time() * 1_000_000)
+        for offset in [30, 10, 20]:
+            self.add(["Bob"], "Alice", str(offset), now + offset)
+        (page, _) = self.history.get_page("Alice", "Bob")
+        self.assertEqual([timestamp - now for (timestamp, _, _) in page], [10, 20, 30])
+        self.assertEqual(self.messages(page), [("Alice", "10"), ("Alice", "20"), ("Alice", "30")])
+        self.assertEqual(self.messages(self.history.get_page("Alice", "Bob", now + 30, limit=1)[0]),
+                         [("Alice", "20")])
+        # Timestamps assigned later are newer than every stored one, whatever the clock says
+        self.assertGreater(self.history.next_timestamp(now=0), now + 30)
+
+    def test_reopen(self):
+        self.make_history(UNBOUNDED)
+        for i in range(3):
+            self.add(["Bob"], "Alice", f"message {i}\nwith a newline")
+        self.add(["Bob", "Charlie"], "Alice", "hi all")
+        pages = [self.history.get_page(recipient, "Alice", limit=3) for recipient in ["Bob", "Charlie"]]
+        last_timestamp = self.history.last_timestamp
+        reopened = self.reopen()
+        self.assertEqual([reopened.get_page(recipient, "Alice", limit=3) for recipient in ["Bob", "Charlie"]], pages)
+        self.assertGreater(reopened.next_timestamp(now=0), last_timestamp)
+
+    def test_retention_by_count(self):
+        self.make_history(HistoryRetention(max_messages=4, max_age_seconds=None))
+        for i in range(10):
+            self.add(["Bob"], "Alice", str(i))
+        self.history.expire_messages()
+        (page, _) = self.history.get_page("Alice", "Bob", limit=10)
+        # The oldest messages are dropped a batch at a time, so one batch more than the bound may be kept
+        self.assertTrue(4 <= len(page) <= 6)
+        self.assertEqual(self.messages(page), [("Alice", str(i)) for i in range(10 - len(page), 10)])
+        self.assertEqual(self.reopen().get_page("Alice", "Bob", limit=10), (page, None))
+
+    def test_retention_by_age(self):
+        self.make_history(HistoryRetention(max_messages=None, max_age_seconds=60))
+        now = time.time()
+        for age in [300, 200, 100, 30, 20, 10]:
+            self.add(["Bob"], "Alice", str(age), self.history.next_timestamp(now - age))
+        # Messages older than the bound are never returned, even before they are dropped
+        self.assertEqual(self.messages(self.history.get_page("Alice", "Bob")[0]),
+                         [("Alice", "30"), ("Alice", "20"), ("Alice", "10")])
+        # Dropping them keeps the ones the bound keeps, and at most a batch of older ones
+        self.history.expire_messages(now + 25)
+        self.retention = UNBOUNDED
+        kept = [message for (_, message) in self.messages(self.reopen().get_page("Alice", "Bob")[0])]
+        self.assertIn(kept, [["30", "20", "10"], ["100", "30", "20", "10"]])
+
+    def test_clear(self):
+        self.make_history(UNBOUNDED)
+        self.add(["Bob"], "Alice", "hello")
+        self.history.clear()
+        self.assertEqual(self.history.get_page("Alice", "Bob"), ([], None))
+        self.assertEqual(self.reopen().get_page("Alice", "Bob"), ([], None))
+
+
+class TestMessageHistory(MessageHistoryTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.history.log.close()
+        shutil.rmtree(self.directory)
+
+    def make_history(self, retention):
+        self.retention = retention
+        self.history = MessageHistory(self.directory, segment_size=2, retention=retention)
+
+    def reopen(self):
+        self.history.log.close()
+        return MessageHistory(self.directory, segment_size=2, retention=self.retention)
+
+    def test_group_message_is_written_once(self):
+        self.make_history(UNBOUNDED)
+        self.add(["Bob", "Charlie"], "Alice", "hi all")
+        self.assertEqual(self.history.message_count(), 1)
+
+    def test_retention_drops_segments(self):
+        self.make_history(HistoryRetention(max_messages=4, max_age_seconds=None))
+        for i in range(10):
+            self.add(["Bob"] if i % 2 else ["Charlie"], "Alice", str(i))
+        # Whole segments are dropped once the ones after them hold the bound
+        self.assertEqual(self.history.log.segments, [6, 8])
+        self.assertEqual(self.history.message_count(), 4)
+        # Conversations whose messages were all dropped are removed from the index
+        for i in range(10, 14):
+            self.add(["Bob"], "Alice", str(i))
+        self.assertEqual(list(self.history.conversations), ["Alice\0Bob"])
+
+
+if __name__ == '__main__':
+    unittest.main()
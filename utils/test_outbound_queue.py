@@ -0,0 +1,99 @@
+import socket
+import threading
+import unittest
+from unittest.mock import MagicMock
+from protocol import protocol_instance
+from utils.outbound_queue import OutboundLimits, OutboundQueue
+
+
+def message(text):
+    return protocol_instance.encode('RECV_MESSAGE', 0, {'sender': 'kevin', 'message': text})
+
+
+class BlockedSocket:
+    """Socket which accepts no bytes until it is unblocked."""
+    def __init__(self):
+        self.unblocked = threading.Event()
+        self.packets = []
+        self.shutdown = MagicMock()
+
+    def sendmsg(self, buffers, *args):
+        self.unblocked.wait()
+        self.packets.extend(bytes(packet) for packet in buffers)
+        return sum(map(len, buffers))
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def make_queue(self, client_socket, **limits):
+        return OutboundQueue(client_socket, threading.Lock(), protocol_instance, OutboundLimits(**limits))
+
+    def test_messages_written_in_order(self):
+        (server_socket, client_socket) = socket.socketpair()
+        queue = self.make_queue(server_socket)
+        for i in range(10):
+            self.assertTrue(queue.put(message(f"hello {i}")))
+        self.assertTrue(queue.wait_until_empty(5))
+        for i in range(10):
+            (md, msg) = protocol_instance.read_small_packets(client_socket)
+            self.assertEqual(protocol_instance.parse_data(md.operation_code.value, msg)['message'], f"hello {i}")
+        self.assertEqual(queue.stats.snapshot()['sent'], 10)
+        server_socket.close()
+        client_socket.close()
+
+    def test_drop_policy(self):
+        client_socket = BlockedSocket()
+        queue = self.make_queue(client_socket, max_queued_messages=2, slow_consumer_policy='drop')
+        # The first message is taken by the writer, which is stuck writing it
+        self.assertTrue(queue.put(message("1")))
+        self.assertFalse(queue.wait_until_empty(0.1))
+        self.assertTrue(queue.put(message("2")))
+        self.assertTrue(queue.put(message("3")))
+        self.assertFalse(queue.put(message("4")))
+        stats = queue.stats.snapshot()
+        self.assertEqual((stats['dropped'], stats['queued'], stats['peak_depth']), (1, 3, 2))
+        self.assertFalse(queue.closed)
+        client_socket.unblocked.set()
+        self.assertTrue(queue.wait_until_empty(5))
+        self.assertEqual(len(client_socket.packets), 3)
+        self.assertEqual(queue.stats.snapshot()['queued'], 0)
+
+    def test_disconnect_policy(self):
+        client_socket = BlockedSocket()
+        queue = self.make_queue(client_socket, max_queued_messages=1)
+        self.assertTrue(queue.put(message("1")))
+        self.assertFalse(queue.wait_until_empty(0.1))
+        self.assertTrue(queue.put(message("2")))
+        self.assertFalse(queue.put(message("3")))
+        self.assertTrue(queue.closed)
+        client_socket.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        self.assertFalse(queue.put(message("4")))
+        self.assertEqual(queue.stats.snapshot()['disconnected'], 1)
+        client_socket.unblocked.set()
+
+    def test_send_timeout_disconnects(self):
+        (server_socket, client_socket) = socket.socketpair()
+        queue = self.make_queue(server_socket, send_timeout_seconds=0.1)
+        # The client never reads, so the socket buffer fills up
+        while queue.put(message("x" * 1000)):
+            if queue.wait_until_empty(0.5) and queue.closed:
+                break
+        self.assertTrue(queue.wait_until_empty(5))
+        self.assertTrue(queue.closed)
+        self.assertEqual(queue.stats.snapshot()['disconnected'], 1)
+        server_socket.close()
+        client_socket.close()
+
+    def test_close(self):
+        client_socket = BlockedSocket()
+        queue = self.make_queue(client_socket)
+        queue.put(message("1"))
+        queue.put(message("2"))
+        queue.close()
+        self.assertFalse(queue.put(message("3")))
+        client_socket.shutdown.assert_not_called()
+        client_socket.unblocked.set()
+        self.assertEqual(queue.stats.snapshot()['disconnected'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
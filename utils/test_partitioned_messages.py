@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from utils.file_storage import FileStorage
+from utils.partitioned_messages import PartitionedMessages
+from utils.sqlite_storage import SqliteStorage
+from utils.storage import MessageLimits
+from utils.striped_lock import StripedLock
+
+# Recipients of every one of 4 partitions
+RECIPIENTS = ["Alice", "Bob", "Erin", "Frank"]
+
+
+class PartitionedMessagesTests:
+    """Tests of a message store split into partitions. Subclasses implement make_storage."""
+    def make_storage(self):
+        raise NotImplementedError
+
+    def open(self, num_partitions=4):
+        """Open the message store of a new storage backend, split into num_partitions partitions."""
+        self.storage = self.make_storage()
+        partition_of = StripedLock(num_partitions).stripe
+        return PartitionedMessages(self.storage.undelivered_message_partitions(1, num_partitions, partition_of),
+                                   partition_of)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.undelivered_messages = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recipients_are_split(self):
+        self.undelivered_messages.add_group_message(RECIPIENTS, "Bob", "hi all")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+        for (index, partition) in enumerate(self.undelivered_messages.partitions):
+            self.assertEqual(sorted(partition.recipients()),
+                             sorted(recipient for recipient in RECIPIENTS + ["Charlie"]
+                                    if self.undelivered_messages.partition_of(recipient) == index))
+            self.assertTrue(partition.recipients())
+        self.assertEqual(self.undelivered_messages.message_count, 5)
+        self.assertEqual(self.undelivered_messages.undelivered_msg["Bob"], [("Bob", "hi all")])
+        self.assertEqual(self.open().undelivered_msg["Charlie"], [("Bob", "hello")])
+
+    def test_limits_count_every_partition(self):
+        self.undelivered_messages.limits = MessageLimits(max_messages=3)
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "one"))
+        self.assertEqual(self.undelivered_messages.add_group_message(["Bob", "Erin", "Frank"], "Bob", "two"),
+                         ["Bob", "Erin"])
+        self.assertFalse(self.undelivered_messages.add_message("Frank", "Bob", "three"))
+        # Replicated messages are queued anyway
+        self.assertTrue(self.undelivered_messages.add_message("Frank", "Bob", "three", enforce_limits=False))
+
+    def test_ids_survive_new_partition_counts(self):
+        for recipient in RECIPIENTS:
+            for message in ["one", "two"]:
+                self.undelivered_messages.add_message(recipient, "Bob", message)
+        self.undelivered_messages.acknowledge_messages("Erin", self.undelivered_messages.queued_ids("Erin")[0])
+        queued_ids = {recipient: self.undelivered_messages.queued_ids(recipient) for recipient in RECIPIENTS}
+        newest = max(ids.stop for ids in queued_ids.values())
+        for num_partitions in [1, 2, 4]:
+            self.undelivered_messages = self.open(num_partitions)
+            self.assertEqual({recipient: self.undelivered_messages.queued_ids(recipient)
+                              for recipient in RECIPIENTS}, queued_ids)
+            self.assertEqual(self.undelivered_messages.undelivered_msg["Erin"], [("Bob", "two")])
+        # A recipient drained meanwhile gets new ids, still above the old ones
+        self.undelivered_messages.acknowledge_messages("Erin", queued_ids["Erin"][-1])
+        self.undelivered_messages.add_message("Erin", "Bob", "three")
+        self.assertGreaterEqual(self.undelivered_messages.queued_ids("Erin").start, newest)
+
+
+class TestFilePartitionedMessages(PartitionedMessagesTests, unittest.TestCase):
+    def make_storage(self):
+        return FileStorage(self.directory)
+
+    def test_partitions_have_their_own_logs(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, "undelivered_messages_1_x4"))),
+                         ["0", "1", "2", "3"])
+        # The logs of the old count are removed once the messages are moved
+        self.open(2)
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.startswith("undelivered")),
+                         ["undelivered_messages_1.partitions", "undelivered_messages_1_x2"])
+
+    def test_moved_messages_keep_their_time(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "old", queued_at=time.time() - 50)
+        self.undelivered_messages.add_message("Alice", "Bob", "new")
+        self.storage = FileStorage(self.directory, limits=MessageLimits(ttl_seconds=60))
+        partition_of = StripedLock(2).stripe
+        moved = PartitionedMessages(self.storage.undelivered_message_partitions(1, 2, partition_of), partition_of)
+        self.assertEqual(moved.expired_messages(time.time() + 30), {"Alice": moved.queued_ids("Alice")[0]})
+
+
+class TestSqlitePartitionedMessages(PartitionedMessagesTests, unittest.TestCase):
+    def make_storage(self):
+        storage = SqliteStorage(os.path.join(self.directory, 'state.db'))
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_clear_only_removes_its_recipients(self):
+        self.undelivered_messages.add_group_message(RECIPIENTS, "Bob", "hi all")
+        self.undelivered_messages.partitions[self.undelivered_messages.partition_of("Alice")].clear()
+        self.assertEqual(sorted(self.open().recipients()), sorted(set(RECIPIENTS) - {"Alice"}))
@@ -0,0 +1,108 @@
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from protocol import protocol_instance
+from utils.account_list import AccountList
+from utils.logged_in_accounts import LoggedInAccounts
+from utils.presence import PresenceHub
+
+ALICE_CLIENT = ("alice socket", "alice lock")
+BOB_CLIENT = ("bob socket", "bob lock")
+
+
+class Queue:
+    """Stands in for the outbound queue of a client."""
+    def __init__(self):
+        self.messages = []
+
+    def put(self, message):
+        self.messages.append(message)
+        return True
+
+    def events(self):
+        events = []
+        for [packet] in self.messages:
+            md = protocol_instance.parse_metadata(packet)
+            args = protocol_instance.parse_data(md.operation_code.value, packet[10:].decode('ascii')[:-1])
+            events.append((args['event'], args['username']))
+        return events
+
+
+class TestPresenceHub(unittest.TestCase):
+    def setUp(self):
+        self.hub = PresenceHub(itertools.count())
+        self.alice = Queue()
+        self.bob = Queue()
+
+    def test_usernames(self):
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, ["kevin", "howie"])
+        self.hub.subscribe(BOB_CLIENT, self.bob, protocol_instance, ["kevin"])
+        self.hub.publish('online', "kevin")
+        self.hub.publish('online', "howie")
+        self.hub.publish('online', "joseph")
+        self.assertEqual(self.alice.events(), [('online', "kevin"), ('online', "howie")])
+        self.assertEqual(self.bob.events(), [('online', "kevin")])
+        # Every subscriber gets the same encoded event
+        self.assertIs(self.alice.messages[0], self.bob.messages[0])
+
+    def test_pattern(self):
+        pattern = re.compile("user", flags=re.IGNORECASE)
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, [], pattern)
+        self.hub.subscribe(BOB_CLIENT, self.bob, protocol_instance, ["kevin"], re.compile("user", flags=re.IGNORECASE))
+        # Subscribers to the same pattern share its entry
+        self.assertEqual(len(self.hub.by_pattern), 1)
+        self.hub.publish('created', "User1")
+        self.hub.publish('created', "kevin")
+        self.assertEqual(self.alice.events(), [('created', "User1")])
+        self.assertEqual(self.bob.events(), [('created', "User1"), ('created', "kevin")])
+        self.assertEqual(self.hub.subscribers("user2"), {ALICE_CLIENT, BOB_CLIENT})
+
+    def test_resubscribe_and_unsubscribe(self):
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, ["kevin"], re.compile("user"))
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, ["howie"])
+        self.hub.publish('online', "kevin")
+        self.hub.publish('online', "user1")
+        self.hub.publish('online', "howie")
+        self.assertEqual(self.alice.events(), [('online', "howie")])
+        self.hub.unsubscribe(ALICE_CLIENT)
+        self.hub.unsubscribe(BOB_CLIENT)
+        self.assertEqual((self.hub.subscriptions, self.hub.by_username, self.hub.by_pattern), ({}, {}, {}))
+        # Subscribing to nothing unsubscribes
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, [])
+        self.assertEqual(self.hub.subscriptions, {})
+
+    def test_encoded_per_protocol(self):
+        v2 = protocol_instance.with_version(2)
+        self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, ["kevin"])
+        self.hub.subscribe(BOB_CLIENT, self.bob, v2, ["kevin"])
+        self.hub.publish('offline', "kevin")
+        [[alice_packet]] = self.alice.messages
+        [[bob_packet]] = self.bob.messages
+        self.assertEqual(protocol_instance.parse_metadata(alice_packet).version, 1)
+        self.assertEqual(protocol_instance.parse_metadata(bob_packet).version, 2)
+
+    def test_store_events(self):
+        directory = tempfile.mkdtemp()
+        try:
+            accounts = AccountList(os.path.join(directory, "accounts.txt"))
+            logged_in = LoggedInAccounts(os.path.join(directory, "logged_in.txt"))
+            accounts.add_listener(self.hub.publish)
+            logged_in.add_listener(self.hub.publish)
+            self.hub.subscribe(ALICE_CLIENT, self.alice, protocol_instance, ["kevin"])
+            accounts.create_account("kevin")
+            logged_in.login("kevin", "1")
+            logged_in.logoff("kevin")
+            # Logging off an account that isn't logged in changes nothing
+            logged_in.logoff("kevin")
+            accounts.remove("kevin")
+            self.assertEqual(self.alice.events(), [('created', "kevin"), ('online', "kevin"),
+                                                   ('offline', "kevin"), ('removed', "kevin")])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
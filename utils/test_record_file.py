@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from utils.record_file import DURABILITY_MODES, Durability, RecordFile, decode_records, encode_record
+
+
+class TestRecordFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpfile = tempfile.NamedTemporaryFile(delete=False)
+        self.tmpfile.close()
+        self.file = RecordFile(self.tmpfile.name)
+
+    def tearDown(self):
+        os.remove(self.tmpfile.name)
+
+    def test_encode_decode(self):
+        buffer = encode_record(('a', 'b c\nd')) + encode_record(('',))
+        records = [fields for _, fields in decode_records(buffer)]
+        self.assertEqual(records, [('a', 'b c\nd'), ('',)])
+
+    def test_append_and_read(self):
+        self.file.append(('user1', 'hello'))
+        self.file.append_many([('user2', 'hi\r\nthere'), ('user3', 'héllo')])
+        self.assertEqual(list(self.file.read()),
+                         [('user1', 'hello'), ('user2', 'hi\r\nthere'), ('user3', 'héllo')])
+
+    def test_read_empty_file(self):
+        self.assertEqual(list(self.file.read()), [])
+        self.assertEqual(list(RecordFile(self.tmpfile.name + '.missing').read()), [])
+
+    def test_read_stops_at_torn_record(self):
+        self.file.append(('user1',))
+        self.file.append(('user2',))
+        with open(self.tmpfile.name, 'r+b') as f:
+            f.truncate(os.path.getsize(self.tmpfile.name) - 1)
+        self.assertEqual(list(self.file.read()), [('user1',)])
+        # The torn record is truncated away so new records are readable
+        self.file.append(('user3',))
+        self.assertEqual(list(self.file.read()), [('user1',), ('user3',)])
+
+    def test_read_stops_at_corrupt_record(self):
+        self.file.append(('user1',))
+        self.file.append(('user2',))
+        self.file.append(('user3',))
+        with open(self.tmpfile.name, 'r+b') as f:
+            f.seek(len(encode_record(('user1',))) + 9)
+            f.write(b'X')
+        self.assertEqual(list(self.file.read()), [('user1',)])
+
+    def test_rewrite(self):
+        self.file.append(('user1',))
+        self.file.rewrite([('user2',)])
+        self.assertEqual(list(self.file.read()), [('user2',)])
+
+    def test_unknown_durability_mode(self):
+        self.assertRaises(ValueError, Durability, 'sometimes')
+
+    def test_durability_modes(self):
+        for mode in DURABILITY_MODES:
+            record_file = RecordFile(self.tmpfile.name, Durability(mode))
+            record_file.clear()
+            record_file.append(('user1',))
+            record_file.append(('user2',))
+            self.assertEqual(list(record_file.read()), [('user1',), ('user2',)])
+            record_file.close()
+            self.assertEqual(list(RecordFile(self.tmpfile.name).read()), [('user1',), ('user2',)])
+
+    def test_os_buffered_flushes_each_write(self):
+        self.file.append(('user1',))
+        self.assertEqual(list(RecordFile(self.tmpfile.name).read()), [('user1',)])
+
+    def test_group_fsync(self):
+        durability = Durability('group-fsync', group_interval_ms=60000)
+        record_file = RecordFile(self.tmpfile.name, durability)
+        record_file.append(('user1',))
+        self.assertEqual(durability.dirty, {record_file.handle})
+        durability.sync()
+        self.assertEqual(durability.dirty, set())
+        record_file.append(('user2',))
+        record_file.close()
+        self.assertEqual(durability.dirty, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import random
+import socket
+import threading
+import time
+import unittest
+from protocol import protocol_instance
+from server import Server
+from utils.identity_table import IdentityTable
+from utils.replica_channel import ReplicaChannel
+
+
+class TestReplicaChannel(unittest.TestCase):
+    def setUp(self):
+        (self.primary_socket, self.replica_socket) = socket.socketpair()
+        self.channel = ReplicaChannel(self.primary_socket, protocol_instance)
+        threading.Thread(target=protocol_instance.read_packets,
+                         args=(self.replica_socket, self.echo), daemon=True).start()
+
+    def tearDown(self):
+        self.primary_socket.close()
+        self.replica_socket.close()
+
+    def echo(self, client_socket, metadata, msg, id_accum):
+        """Answer every update with the username it carries, slowly enough for requests to pile up."""
+        time.sleep(0.001)
+        args = protocol_instance.parse_data(metadata.operation_code.value, msg)
+        protocol_instance.send(client_socket, protocol_instance.encode(
+            'GET_PRIMARY_RESPONSE', metadata.message_id, {'id': args['username']}))
+
+    def update(self, id):
+        return ('UPDATE_ACCOUNT_STATE', {'add_flag': 'True', 'username': id})
+
+    def response_id(self, response):
+        (md, msg) = response
+        return protocol_instance.parse_data(md.operation_code.value, msg)['id']
+
+    def test_request(self):
+        self.assertEqual(self.response_id(self.channel.request(*self.update(1))), '1')
+
+    def test_responses_go_to_their_senders(self):
+        results = {}
+        def worker(worker_id):
+            for i in range(20):
+                id = f"{worker_id}-{i}"
+                results[id] = self.response_id(self.channel.request(*self.update(id)))
+        threads = [threading.Thread(target=worker, args=(worker_id,)) for worker_id in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 160)
+        for id, response_id in results.items():
+            self.assertEqual(id, response_id)
+
+    def test_pipelined_requests(self):
+        tickets = [self.channel.send(*self.update(i)) for i in range(5)]
+        self.assertEqual([self.response_id(self.channel.wait(ticket)) for ticket in reversed(tickets)],
+                         ['4', '3', '2', '1', '0'])
+
+    def test_lost_connection(self):
+        self.replica_socket.shutdown(socket.SHUT_RDWR)
+        self.assertIsNone(self.channel.request(*self.update(1)))
+        self.assertIsNone(self.channel.request(*self.update(2)))
+
+    def test_responses_in_any_order(self):
+        (primary_socket, replica_socket) = socket.socketpair()
+        channel = ReplicaChannel(primary_socket, protocol_instance)
+        correlation_ids = [channel.send(*self.update(i)) for i in range(3)]
+        # The other server answers the last request first
+        requests = [protocol_instance.read_small_packets(replica_socket) for _ in range(3)]
+        for (md, msg) in reversed(requests):
+            protocol_instance.send(replica_socket, protocol_instance.encode('GET_PRIMARY_RESPONSE', md.message_id, {
+                'id': protocol_instance.parse_data(md.operation_code.value, msg)['username']}))
+        self.assertEqual([self.response_id(channel.wait(correlation_id)) for correlation_id in correlation_ids],
+                         ['0', '1', '2'])
+        primary_socket.close()
+        replica_socket.close()
+
+    def test_response_of_several_packets(self):
+        (primary_socket, replica_socket) = socket.socketpair()
+        channel = ReplicaChannel(primary_socket, protocol_instance)
+        # Random names compress to more than one frame of version 2
+        accounts = ';'.join(random.randbytes(8).hex() for _ in range(20000))
+        for protocol in [protocol_instance, protocol_instance.with_version(2).with_compression('zlib')]:
+            correlation_id = channel.send('LIST_LOCAL_ACCOUNTS', {'query': '.*'})
+            (md, msg) = protocol_instance.read_small_packets(replica_socket)
+            packets = protocol.encode('LIST_ACCOUNTS_RESPONSE', md.message_id,
+                                      {'status': 'Success', 'accounts': accounts})
+            self.assertGreater(len(packets), 1)
+            threading.Thread(target=protocol.send, args=(replica_socket, packets), daemon=True).start()
+            (md, msg) = channel.wait(correlation_id)
+            self.assertEqual(protocol_instance.parse_data(md.operation_code.value, msg)['accounts'], accounts)
+        primary_socket.close()
+        replica_socket.close()
+
+    def test_timeout(self):
+        (primary_socket, replica_socket) = socket.socketpair()
+        channel = ReplicaChannel(primary_socket, protocol_instance)
+        self.assertIsNone(channel.request(*self.update(1), timeout=0.05))
+        # A late response is dropped, and later requests get their own
+        (md, msg) = protocol_instance.read_small_packets(replica_socket)
+        protocol_instance.send(replica_socket, protocol_instance.encode('GET_PRIMARY_RESPONSE', md.message_id,
+                                                                        {'id': 'late'}))
+        correlation_id = channel.send(*self.update(2))
+        (md, msg) = protocol_instance.read_small_packets(replica_socket)
+        protocol_instance.send(replica_socket, protocol_instance.encode('GET_PRIMARY_RESPONSE', md.message_id,
+                                                                        {'id': '2'}))
+        self.assertEqual(self.response_id(channel.wait(correlation_id)), '2')
+        primary_socket.close()
+        replica_socket.close()
+
+
+    def test_negotiate(self):
+        replica = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance)
+        (primary_socket, replica_socket) = socket.socketpair()
+        threading.Thread(target=replica.handle_replica, args=(replica_socket, threading.Lock()), daemon=True).start()
+        channel = ReplicaChannel(primary_socket, protocol_instance)
+        self.assertEqual(channel.protocol.version, 1)
+        self.assertTrue(channel.negotiate())
+        # Both sides write version 2 from the answer to the advertisement on, and updates are compressed with the
+        # replication dictionary
+        self.assertEqual((channel.protocol.version, channel.protocol.compression), (2, 'zlib-dict'))
+        (md, msg) = channel.request('ASSIGN_PRIMARY')
+        self.assertEqual(md.version, 2)
+        self.assertEqual(protocol_instance.parse_data(md.operation_code.value, msg), {'id': '1'})
+        message = 'hello there, how are you? ' * 100
+        self.assertIsNotNone(channel.request('UPDATE_MESSAGE_STATE', {
+            'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': message}))
+        self.assertEqual(replica.undelivered_msg.get_recipient_messages('kevin'), [('howie', message)])
+        replica.undelivered_msg.clear()
+        primary_socket.close()
+
+    def test_names_sent_as_ids(self):
+        replica = Server([{"host": "127.0.0.1", "port": 6000, "id": 1}], 1, protocol_instance)
+        (primary_socket, replica_socket) = socket.socketpair()
+        threading.Thread(target=replica.handle_replica, args=(replica_socket, threading.Lock()), daemon=True).start()
+        identities = IdentityTable()
+        channel = ReplicaChannel(primary_socket, protocol_instance, identities)
+        self.assertTrue(channel.negotiate())
+        self.assertIsNotNone(channel.names)
+        kevin = identities.intern('kevin')
+        identities.intern('howie')
+        for message in ['hi', 'again']:
+            self.assertIsNotNone(channel.request('UPDATE_MESSAGE_STATE', {
+                'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': message}))
+        self.assertEqual(channel.names.sent[kevin], 1)
+        self.assertEqual(replica.undelivered_msg.get_recipient_messages('kevin'), [('howie', 'hi'), ('howie', 'again')])
+        replica.undelivered_msg.clear()
+        primary_socket.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from utils.identity_table import IdentityTable
+from utils.replicated_names import NameDecoder, NameEncoder
+
+
+class TestReplicatedNames(unittest.TestCase):
+    def setUp(self):
+        self.primary = IdentityTable()
+        self.replica = IdentityTable()
+        self.encoder = NameEncoder(self.primary)
+        self.decoder = NameDecoder(self.replica)
+
+    def send(self, operation, args):
+        """Encode an update on the primary and decode it on the replica, returning (sent args, decoded args)."""
+        sent = self.encoder.encode(operation, args)
+        return sent, self.decoder.decode(operation, sent)
+
+    def test_names_are_sent_once(self):
+        self.primary.intern("kevin")
+        howie = self.primary.intern("howie")
+        args = {'add_one': 'True', 'recipient': 'kevin', 'sender': 'howie', 'message': 'hi'}
+        (sent, decoded) = self.send('UPDATE_MESSAGE_STATE', args)
+        self.assertEqual(sent['sender'], f"\0{howie}=howie")
+        self.assertEqual(decoded, args)
+        (sent, decoded) = self.send('UPDATE_MESSAGE_STATE', args)
+        self.assertEqual((sent['recipient'], sent['sender']), ("\x000", f"\0{howie}"))
+        self.assertEqual(decoded, args)
+        # Names without an id, and operations without names, are sent as they are
+        self.assertEqual(self.send('UPDATE_ACCOUNT_STATE', {'username': 'erin'})[0], {'username': 'erin'})
+        self.assertEqual(self.send('ASSIGN_PRIMARY', {'id': '1'})[0], {'id': '1'})
+
+    def test_lists_of_names(self):
+        for name in ["alice", "bob"]:
+            self.primary.intern(name)
+        args = {'recipients': 'alice;bob;carol', 'sender': 'alice', 'message': 'hi all'}
+        (sent, decoded) = self.send('UPDATE_GROUP_MESSAGE_STATE', args)
+        self.assertEqual(sent['recipients'], "\x000=alice;\x001=bob;carol")
+        self.assertEqual(sent['sender'], "\x000")
+        self.assertEqual(decoded, args)
+
+    def test_reused_ids_are_sent_again(self):
+        alice = self.primary.intern("alice")
+        self.send('UPDATE_LOGIN_STATE', {'username': 'alice'})
+        self.primary.release("alice")
+        self.assertEqual(self.primary.intern("bob"), alice)
+        (sent, decoded) = self.send('UPDATE_LOGIN_STATE', {'username': 'bob'})
+        self.assertEqual(sent['username'], f"\0{alice}=bob")
+        self.assertEqual(decoded['username'], 'bob')
+        # The replica dropped alice with her id on the primary, and holds bob until the connection ends
+        self.assertEqual((self.replica.get("alice"), len(self.replica)), (None, 1))
+        self.decoder.close()
+        self.assertEqual(len(self.replica), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+from utils.request_pool import AdmissionLimits, RateLimit, RequestPool, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(RateLimit(rate=10, burst=2), now=0)
+        self.assertTrue(bucket.take(now=0))
+        self.assertTrue(bucket.take(now=0))
+        self.assertFalse(bucket.take(now=0))
+        # One token every 0.1 seconds, up to the burst
+        self.assertTrue(bucket.take(now=0.1))
+        self.assertFalse(bucket.take(now=0.1))
+        self.assertTrue(bucket.take(now=10))
+        self.assertTrue(bucket.take(now=10))
+        self.assertFalse(bucket.take(now=10))
+
+    def test_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            RateLimit(rate=0)
+        with self.assertRaises(ValueError):
+            AdmissionLimits(max_workers=0)
+
+
+class TestRequestPool(unittest.TestCase):
+    def setUp(self):
+        self.unblock = threading.Event()
+        self.done = threading.Semaphore(0)
+        self.order = []
+
+    def tearDown(self):
+        self.unblock.set()
+
+    def request(self, name, block=False):
+        def run():
+            if block:
+                self.unblock.wait()
+            self.order.append(name)
+            self.done.release()
+        return run
+
+    def wait_until_started(self, pool):
+        """Wait for the workers to take every queued request."""
+        while pool.depth():
+            time.sleep(0.001)
+
+    def wait_for(self, count):
+        for _ in range(count):
+            self.assertTrue(self.done.acquire(timeout=5))
+
+    def test_client_requests_run_in_order(self):
+        pool = RequestPool(AdmissionLimits(max_workers=4, max_in_flight_per_client=20))
+        for i in range(20):
+            self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(i)))
+        self.wait_for(20)
+        self.assertEqual(self.order, list(range(20)))
+        self.assertEqual(pool.stats.snapshot()['admitted'], 20)
+
+    def test_client_in_flight_limit(self):
+        pool = RequestPool(AdmissionLimits(max_in_flight_per_client=2))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(1, block=True)))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(2)))
+        self.assertFalse(pool.submit("kevin", 'SEND_MESSAGE', self.request(3)))
+        # Other clients aren't held up by kevin's requests
+        self.assertTrue(pool.submit("howie", 'SEND_MESSAGE', self.request("howie")))
+        self.wait_for(1)
+        self.assertEqual(self.order, ["howie"])
+        self.unblock.set()
+        self.wait_for(2)
+        self.assertEqual(self.order, ["howie", 1, 2])
+        self.assertEqual(pool.stats.snapshot()['client_limited'], 1)
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(4)))
+        self.wait_for(1)
+
+    def test_queue_full(self):
+        pool = RequestPool(AdmissionLimits(max_workers=1, max_queued_requests=1))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(1, block=True)))
+        # Wait for the worker to take the first request, so the next one waits in the queue
+        self.wait_until_started(pool)
+        self.assertTrue(pool.submit("howie", 'SEND_MESSAGE', self.request(2)))
+        self.assertFalse(pool.submit("joseph", 'SEND_MESSAGE', self.request(3)))
+        self.assertEqual(pool.stats.snapshot()['queue_full'], 1)
+        self.unblock.set()
+        self.wait_for(2)
+        self.assertEqual(self.order, [1, 2])
+
+    def test_rate_limit(self):
+        pool = RequestPool(AdmissionLimits(rate_limits={'SEND_MESSAGE': {'rate': 0.001, 'burst': 1}}))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(1)))
+        self.assertFalse(pool.submit("howie", 'SEND_MESSAGE', self.request(2)))
+        # Other operations have no limit
+        self.assertTrue(pool.submit("howie", 'LIST_ACCOUNTS', self.request(3)))
+        self.wait_for(2)
+        self.assertEqual(pool.stats.snapshot()['rate_limited'], 1)
+
+    def test_failed_request_does_not_stop_worker(self):
+        pool = RequestPool(AdmissionLimits(max_workers=1))
+
+        def fail():
+            raise ValueError("bad request")
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', fail))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(1)))
+        self.wait_for(1)
+        self.assertEqual(self.order, [1])
+
+    def test_cancel(self):
+        pool = RequestPool(AdmissionLimits(max_workers=1))
+        self.assertTrue(pool.submit("howie", 'SEND_MESSAGE', self.request("howie", block=True)))
+        self.wait_until_started(pool)
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(1)))
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(2)))
+        pool.cancel("kevin")
+        self.assertEqual(pool.depth(), 0)
+        self.unblock.set()
+        self.wait_for(1)
+        self.assertTrue(pool.submit("kevin", 'SEND_MESSAGE', self.request(3)))
+        self.wait_for(1)
+        self.assertEqual(self.order, ["howie", 3])
+
+    def test_cancel_waits_for_running_request(self):
+        pool = RequestPool(AdmissionLimits(max_workers=1))
+        self.assertTrue(pool.submit("kevin", 'LOG_IN', self.request(1, block=True)))
+        self.wait_until_started(pool)
+        cancelled = threading.Event()
+        threading.Thread(target=lambda: pool.cancel("kevin") or cancelled.set(), daemon=True).start()
+        self.assertFalse(cancelled.wait(0.05))
+        self.unblock.set()
+        self.assertTrue(cancelled.wait(5))
+        self.assertEqual(self.order, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
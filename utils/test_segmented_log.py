@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from utils.segmented_log import SegmentedLog
+
+
+class TestSegmentedLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = SegmentedLog(self.directory, segment_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_assigns_sequence_numbers(self):
+        self.assertEqual(self.log.append(("a",)), 0)
+        self.assertEqual(self.log.append(("b", "x\ny")), 1)
+        self.assertEqual(self.log.append_many([("c",), ("d",)]), [2, 3])
+        self.assertEqual(list(self.log.read()), [(0, ("a",)), (1, ("b", "x\ny")), (2, ("c",)), (3, ("d",))])
+
+    def test_segments_roll_over(self):
+        self.log.append_many([("a",), ("b",), ("c",), ("d",), ("e",)])
+        self.assertEqual(self.log.segments, [0, 2, 4])
+        self.assertEqual(self.log.segment_of(3), 2)
+        self.assertTrue(self.log.is_active(4))
+
+    def test_reopen(self):
+        self.log.append_many([("a",), ("b",), ("c",)])
+        reopened = SegmentedLog(self.directory, segment_size=2)
+        self.assertEqual(reopened.append(("d",)), 3)
+        self.assertEqual(reopened.segments, [0, 2])
+
+    def test_delete_segment(self):
+        self.log.append_many([("a",), ("b",), ("c",)])
+        self.log.delete_segment(0)
+        # The active segment is never deleted
+        self.log.delete_segment(2)
+        self.assertEqual(self.log.segments, [2])
+        self.assertEqual(self.log.first_seq(), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
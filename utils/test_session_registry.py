@@ -0,0 +1,64 @@
+import unittest
+from utils.session_registry import SessionRegistry
+
+ALICE_CLIENT = ("alice socket", "alice lock")
+BOB_CLIENT = ("bob socket", "bob lock")
+
+
+class TestSessionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = SessionRegistry()
+        self.registry.connect("1", ALICE_CLIENT)
+        self.registry.connect("2", BOB_CLIENT)
+
+    def test_connect(self):
+        self.assertEqual(self.registry.uuid_of(ALICE_CLIENT), "1")
+        self.assertEqual(self.registry.client_of("2"), BOB_CLIENT)
+        self.assertIsNone(self.registry.client_of("3"))
+        self.assertEqual(self.registry.connected(), {ALICE_CLIENT: "1", BOB_CLIENT: "2"})
+
+    def test_login(self):
+        self.registry.login("alice", "1")
+        self.assertTrue(self.registry.is_logged_in("1"))
+        self.assertFalse(self.registry.is_logged_in("2"))
+        self.assertTrue(self.registry.username_is_logged_in("alice"))
+        self.assertEqual(self.registry.get_username("1"), "alice")
+        self.assertIsNone(self.registry.get_username("2"))
+        self.assertEqual(self.registry.get_uuid("alice"), "1")
+        self.assertEqual(self.registry.logged_in(), {"alice": "1"})
+
+    def test_logoff(self):
+        self.registry.login("alice", "1")
+        self.assertTrue(self.registry.logoff("alice"))
+        self.assertFalse(self.registry.logoff("alice"))
+        self.assertFalse(self.registry.is_logged_in("1"))
+        self.assertRaises(KeyError, self.registry.get_uuid, "alice")
+        # The client stays connected
+        self.assertEqual(self.registry.client_of("1"), ALICE_CLIENT)
+
+    def test_disconnect_releases_session_id(self):
+        self.assertEqual(self.registry.disconnect(ALICE_CLIENT), "1")
+        self.assertIsNone(self.registry.client_of("1"))
+        self.assertNotIn("1", self.registry.session_ids)
+        self.assertRaises(KeyError, self.registry.uuid_of, ALICE_CLIENT)
+
+    def test_session_without_client(self):
+        # Replicas log in sessions whose clients are connected to the primary
+        self.registry.login("charlie", "3")
+        self.assertTrue(self.registry.is_logged_in("3"))
+        self.assertIsNone(self.registry.client_of("3"))
+        self.registry.logoff("charlie")
+        self.assertNotIn("3", self.registry.session_ids)
+
+    def test_login_replaces_previous_session(self):
+        self.registry.login("alice", "1")
+        self.registry.login("alice", "2")
+        self.assertFalse(self.registry.is_logged_in("1"))
+        self.assertEqual(self.registry.get_username("2"), "alice")
+        self.registry.login("bob", "2")
+        self.assertFalse(self.registry.username_is_logged_in("alice"))
+        self.assertEqual(self.registry.logged_in(), {"bob": "2"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+from utils.sharding import group_configs, group_of_server, shard_of
+
+GROUPS = [[{"host": "127.0.0.1", "port": 6000, "id": 1}, {"host": "127.0.0.1", "port": 6001, "id": 2}],
+          [{"host": "127.0.0.1", "port": 6002, "id": 3}, {"host": "127.0.0.1", "port": 6003, "id": 4}]]
+
+
+class TestSharding(unittest.TestCase):
+    def test_shard_of(self):
+        shards = [shard_of(f"user{i}", 4) for i in range(1000)]
+        self.assertTrue(all(0 <= shard < 4 for shard in shards))
+        # Accounts spread over every shard, and always land on the same one
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertEqual(shards, [shard_of(f"user{i}", 4) for i in range(1000)])
+        self.assertEqual(shard_of("kevin", 1), 0)
+
+    def test_group_configs(self):
+        self.assertEqual(group_configs({'shards': GROUPS}), GROUPS)
+        self.assertEqual(group_configs({'servers': GROUPS[0]}), [GROUPS[0]])
+
+    def test_group_of_server(self):
+        self.assertEqual(group_of_server(GROUPS, 2), 0)
+        self.assertEqual(group_of_server(GROUPS, "3"), 1)
+        with self.assertRaises(ValueError):
+            group_of_server(GROUPS, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
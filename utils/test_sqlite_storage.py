@@ -0,0 +1,170 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+from utils.sqlite_storage import SqliteStorage
+from utils.storage import DEFAULT_LIMITS, HistoryRetention, MessageLimits
+from utils.test_account_list import AccountListTests
+from utils.test_logged_in_accounts import LoggedInAccountsTests
+from utils.test_message_history import MessageHistoryTests
+from utils.test_undelivered_messages import UndeliveredMessagesTests
+
+
+class SqliteStorageTestCase(unittest.TestCase):
+    """Runs a store test suite against a store of a fresh SQLite database."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state.db')
+        self.storage = SqliteStorage(self.filename)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+
+class TestSqliteAccountList(AccountListTests, SqliteStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.account_list = self.storage.account_list(1)
+
+    def reopen(self):
+        return SqliteStorage(self.filename).account_list(1)
+
+
+class TestSqliteLoggedInAccounts(LoggedInAccountsTests, SqliteStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.accounts = self.storage.logged_in_accounts(1)
+
+
+class TestSqliteUndeliveredMessages(UndeliveredMessagesTests, SqliteStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.undelivered_messages = self.storage.undelivered_messages(1)
+
+    def reopen(self, limits=DEFAULT_LIMITS):
+        storage = SqliteStorage(self.filename, limits=limits)
+        self.addCleanup(storage.close)
+        return storage.undelivered_messages(1)
+
+    def test_group_message_payload_is_stored_once(self):
+        self.undelivered_messages.add_group_message(["Alice", "Charlie"], "Bob", "hi all")
+        count_payloads = 'SELECT count(*) FROM payloads'
+        self.assertEqual(self.storage.connection.execute(count_payloads).fetchone(), (1,))
+        self.assertEqual(self.reopen().undelivered_msg["Charlie"], [("Bob", "hi all")])
+
+        self.undelivered_messages.consume_messages("Alice", 1)
+        self.assertEqual(self.storage.connection.execute(count_payloads).fetchone(), (1,))
+        self.undelivered_messages.consume_messages("Charlie", 1)
+        self.assertEqual(self.storage.connection.execute(count_payloads).fetchone(), (0,))
+
+
+    def test_messages_are_loaded_on_demand(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_group_message(["Alice", "Charlie"], "Bob", "hi all")
+
+        reopened = self.reopen()
+        # Startup only reads the recipients of the messages
+        self.assertEqual(reopened.recipients(), ["Alice", "Charlie"])
+        self.assertEqual(len(reopened.cache), 0)
+        self.assertEqual(reopened.get_recipient_messages("Alice", reopened.queued_ids("Alice")[2]),
+                         [("Bob", "message 2"), ("Bob", "hi all")])
+        self.assertEqual(list(reopened.cache), [reopened.identities.get("Alice")])
+
+        # Cached backlogs are kept up to date
+        reopened.add_message("Alice", "Bob", "message 3")
+        reopened.consume_messages("Alice", 3)
+        self.assertEqual(reopened.get_recipient_messages("Alice"), [("Bob", "hi all"), ("Bob", "message 3")])
+
+    def test_cache_stays_within_byte_budget(self):
+        self.undelivered_messages.limits = MessageLimits(max_cached_bytes=1000)
+        for recipient in ["Alice", "Bob", "Charlie"]:
+            for i in range(10):
+                self.undelivered_messages.add_message(recipient, "David", f"message {i} " + "x" * 30)
+            self.undelivered_messages.get_recipient_messages(recipient)
+            self.assertLessEqual(self.undelivered_messages.cached_bytes, 1000)
+        self.assertEqual(list(self.undelivered_messages.cache), [self.undelivered_messages.identities.get("Charlie")])
+        # The other backlogs are read from the table again
+        self.assertEqual(len(self.undelivered_messages.get_recipient_messages("Alice")), 10)
+
+    def test_old_databases_get_the_new_columns(self):
+        self.storage.close()
+        os.remove(self.filename)
+        connection = sqlite3.connect(self.filename)
+        connection.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, '
+                           'sender TEXT NOT NULL, message TEXT NOT NULL)')
+        connection.execute("INSERT INTO messages (recipient, sender, message) VALUES ('Alice', 'Bob', 'hello')")
+        connection.commit()
+        connection.close()
+        self.storage = SqliteStorage(self.filename)
+        undelivered_messages = self.storage.undelivered_messages(1)
+        self.assertEqual(undelivered_messages.undelivered_msg["Alice"], [("Bob", "hello")])
+        undelivered_messages.add_group_message(["Alice", "Charlie"], "Bob", "hi all")
+        self.assertEqual(undelivered_messages.undelivered_msg["Charlie"], [("Bob", "hi all")])
+
+
+class TestSqliteMessageHistory(MessageHistoryTests, SqliteStorageTestCase):
+    def make_history(self, retention):
+        self.retention = retention
+        self.history = self.storage.message_history(1)
+        self.history.retention = retention
+        self.history.batch_size = 2
+
+    def reopen(self):
+        storage = SqliteStorage(self.filename, retention=self.retention)
+        return storage.message_history(1)
+
+    def test_page_is_one_index_scan(self):
+        self.make_history(self.storage.retention)
+        self.add(["Bob"], "Alice", "hello")
+        (plan,) = [row[-1] for row in self.storage.connection.execute(
+            'EXPLAIN QUERY PLAN SELECT timestamp FROM history '
+            'WHERE conversation = ? AND timestamp > ? AND timestamp < ? ORDER BY timestamp DESC', ('', 0, 0))]
+        self.assertIn('PRIMARY KEY (conversation=? AND timestamp>? AND timestamp<?)', plan)
+
+    def test_expiry_only_writes_to_delete(self):
+        self.make_history(HistoryRetention(max_messages=2, max_age_seconds=60))
+        for i in range(3):
+            self.add(["Bob"], "Alice", f"hello {i}")
+        # Nothing is old enough, and the messages beyond the bound are less than a batch
+        with mock.patch.object(self.storage, 'transaction', wraps=self.storage.transaction) as transaction:
+            self.history.expire_messages()
+        transaction.assert_not_called()
+        self.assertEqual(self.history.message_count, 3)
+        self.history.expire_messages(time.time() + 61)
+        self.assertEqual(self.history.message_count, 0)
+        self.assertIsNone(self.history.first_timestamp)
+
+
+class TestSqliteTransactions(SqliteStorageTestCase):
+    def test_wal_mode(self):
+        (mode,) = self.storage.connection.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual(mode, 'wal')
+
+    def test_transaction_commits_together(self):
+        account_list = self.storage.account_list(1)
+        logged_in = self.storage.logged_in_accounts(1)
+        with self.storage.transaction():
+            account_list.create_account("user1")
+            logged_in.login("user1", "1234")
+            # Nothing is visible to other connections until the outer transaction commits
+            self.assertEqual(SqliteStorage(self.filename).account_list(1).account_list, [])
+        self.assertEqual(SqliteStorage(self.filename).account_list(1).account_list, ["user1"])
+
+    def test_transaction_rolls_back(self):
+        account_list = self.storage.account_list(1)
+        try:
+            with self.storage.transaction():
+                account_list.create_account("user1")
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(SqliteStorage(self.filename).account_list(1).account_list, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
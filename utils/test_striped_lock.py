@@ -0,0 +1,74 @@
+import threading
+import unittest
+from utils.sharding import shard_of
+from utils.striped_lock import StripedLock, stable_hash
+
+
+class TestStripedLock(unittest.TestCase):
+    def setUp(self):
+        self.locks = StripedLock(num_stripes=8)
+        # Keys on two different stripes
+        self.first = 0
+        self.second = next(key for key in range(1, 100) if self.locks.stripe(key) != self.locks.stripe(0))
+
+    def try_hold(self, *keys):
+        """Return whether another thread can take the locks of the keys right now."""
+        result = []
+        def hold():
+            locks = [self.locks.locks[self.locks.stripe(key)] for key in keys]
+            acquired = [lock.acquire(blocking=False) for lock in locks]
+            result.append(all(acquired))
+            for lock, ok in zip(locks, acquired):
+                if ok:
+                    lock.release()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_same_key_is_exclusive(self):
+        with self.locks.hold(self.first):
+            self.assertFalse(self.try_hold(self.first))
+        self.assertTrue(self.try_hold(self.first))
+
+    def test_other_keys_are_free(self):
+        with self.locks.hold(self.first):
+            self.assertTrue(self.try_hold(self.second))
+
+    def test_hold_several_keys(self):
+        with self.locks.hold(self.second, self.first, self.first):
+            self.assertFalse(self.try_hold(self.first))
+            self.assertFalse(self.try_hold(self.second))
+        self.assertTrue(self.try_hold(self.first, self.second))
+
+    def test_released_on_error(self):
+        with self.assertRaises(KeyError):
+            with self.locks.hold(self.first, self.second):
+                raise KeyError()
+        self.assertTrue(self.try_hold(self.first, self.second))
+
+    def test_opposite_orders_do_not_deadlock(self):
+        def worker(keys):
+            for _ in range(1000):
+                with self.locks.hold(*keys):
+                    pass
+        threads = [threading.Thread(target=worker, args=(keys,))
+                   for keys in [(self.first, self.second), (self.second, self.first)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive())
+
+    def test_string_stripes_are_stable(self):
+        # Stripes of strings split state kept on disk, so they must not change between processes
+        self.assertEqual([self.locks.stripe(name) for name in ["alice", "bob", "charlie"]],
+                         [stable_hash(name) % 8 for name in ["alice", "bob", "charlie"]])
+        self.assertEqual(stable_hash("alice"), 0x89da54ce0cecea4d)
+        # The accounts of one shard use every stripe
+        accounts = [f"user{i}" for i in range(1000) if shard_of(f"user{i}", 2) == 0]
+        self.assertEqual({self.locks.stripe(account) for account in accounts}, set(range(8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from utils.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick_seconds=1, num_slots=8)
+
+    def test_timers_fire_at_their_tick(self):
+        self.wheel.schedule(2, "a", 1)
+        self.wheel.schedule(3.5, "b", 2)
+        self.assertEqual(self.wheel.advance(1.9), [])
+        self.assertEqual(self.wheel.advance(2), [("a", 1)])
+        self.assertEqual(self.wheel.advance(3.5), [])
+        self.assertEqual(self.wheel.advance(4), [("b", 2)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_same_key_and_tick_keeps_latest_value(self):
+        self.wheel.schedule(2, "a", 1)
+        self.wheel.schedule(1.5, "a", 2)
+        self.wheel.schedule(3, "a", 3)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertEqual(self.wheel.advance(10), [("a", 2), ("a", 3)])
+
+    def test_timers_beyond_one_turn(self):
+        self.wheel.schedule(3, "near", 1)
+        self.wheel.schedule(11, "far", 2)
+        # Both timers share a slot, but the far one waits for its own tick
+        self.assertEqual(self.wheel.advance(5), [("near", 1)])
+        self.assertEqual(self.wheel.advance(10), [])
+        self.assertEqual(self.wheel.advance(11), [("far", 2)])
+
+    def test_advance_past_several_turns(self):
+        for deadline in [30, 5, 17]:
+            self.wheel.schedule(deadline, deadline, deadline)
+        self.assertEqual(self.wheel.advance(100), [(5, 5), (17, 17), (30, 30)])
+        self.assertEqual(self.wheel.current_tick, 100)
+
+    def test_past_deadlines_fire_on_next_tick(self):
+        self.wheel.advance(5)
+        self.wheel.schedule(1, "late", 1)
+        self.assertEqual(self.wheel.advance(6), [("late", 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
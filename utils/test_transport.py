@@ -0,0 +1,64 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from protocol import protocol_instance
+from server import Server
+from utils import transport
+from utils.replica_channel import ReplicaChannel
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.host = transport.UNIX_PREFIX + os.path.join(self.directory, "server.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_socket_address(self):
+        self.assertEqual(transport.socket_address("127.0.0.1", "6000"), ("127.0.0.1", 6000))
+        self.assertEqual(transport.socket_address("unix:/tmp/server.sock"), "/tmp/server.sock")
+        self.assertTrue(transport.is_unix("unix:/tmp/server.sock"))
+        self.assertFalse(transport.is_unix("127.0.0.1"))
+        self.assertEqual(transport.describe("127.0.0.1", 6000), "127.0.0.1:6000")
+
+    def test_replica_over_unix_socket(self):
+        replica = Server([{"host": self.host, "id": 1}, {"host": "127.0.0.1", "port": 6000, "id": 2}], 1,
+                         protocol_instance)
+        listener = transport.listen(self.host)
+        self.assertEqual(listener.family, socket.AF_UNIX)
+
+        def accept():
+            (connection, _) = listener.accept()
+            replica.handle_replica(connection, threading.Lock())
+        threading.Thread(target=accept, daemon=True).start()
+        channel = ReplicaChannel(transport.connect(self.host), protocol_instance)
+        (md, msg) = channel.request('ASSIGN_PRIMARY')
+        self.assertEqual(protocol_instance.parse_data(md.operation_code.value, msg), {'id': '1'})
+        channel.socket.close()
+        listener.close()
+
+    def test_listen_replaces_stale_socket(self):
+        transport.listen(self.host).close()
+        # The file is left behind, as by a server that is gone
+        self.assertTrue(os.path.exists(transport.socket_address(self.host)))
+        listener = transport.listen(self.host)
+        transport.connect(self.host).close()
+        listener.close()
+
+    def test_unix_socket_without_reuse_port(self):
+        with self.assertRaises(ValueError):
+            transport.listen(self.host, reuse_port=True)
+        with self.assertRaises(ValueError):
+            Server([{"host": self.host, "id": 1}], 1, protocol_instance, worker_processes=2)
+
+    def test_connect_failure(self):
+        with self.assertRaises(OSError):
+            transport.connect(self.host)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,20 +1,23 @@
 import os
+import shutil
 import tempfile
+import time
 import unittest
-from undelivered_messages import UndeliveredMessages
+from unittest import mock
+from utils.storage import DEFAULT_LIMITS, MessageLimits
+from utils.undelivered_messages import Backlog, UndeliveredMessages
 
 
-class TestUndeliveredMessages(unittest.TestCase):
-    def setUp(self):
-        # Create a temporary file for testing
-        self.temp_file = tempfile.NamedTemporaryFile(delete=False)
-        self.filename = self.temp_file.name
+def cached_recipients(undelivered_messages):
+    """Usernames of the recipients whose backlog is cached, least recently used first."""
+    return [undelivered_messages.identities.name(recipient_id) for recipient_id in undelivered_messages.cache]
 
-        self.undelivered_messages = UndeliveredMessages(self.filename)
 
-    def tearDown(self):
-        # Delete the temporary file
-        os.remove(self.filename)
+class UndeliveredMessagesTests:
+    """Tests every message store must pass. Subclasses set self.undelivered_messages and implement reopen."""
+    def reopen(self, limits=DEFAULT_LIMITS):
+        """Load a new message store from what the current one persisted, with the given message limits."""
+        raise NotImplementedError
 
     def test_add_message(self):
         # Add a message for a recipient
@@ -27,12 +30,7 @@ class TestUndeliveredMessages(unittest.TestCase):
         expected_messages = [(sender, message)]
         actual_messages = self.undelivered_messages.undelivered_msg[recipient]
         self.assertEqual(actual_messages, expected_messages)
-
-        # Check that the message was added to the file
-        with open(self.filename, 'r') as f:
-            actual_line = f.readline().strip()
-        expected_line = f"{recipient} {sender} {message}"
-        self.assertEqual(actual_line, expected_line)
+        self.assertEqual(self.reopen().undelivered_msg[recipient], expected_messages)
 
     def test_get_messages(self):
         # Add messages for two recipients
@@ -70,12 +68,337 @@ class TestUndeliveredMessages(unittest.TestCase):
         actual_messages = self.undelivered_messages.undelivered_msg[recipient]
         self.assertEqual(actual_messages, expected_messages)
 
-        # Check that the messages were updated in the file
-        with open(self.filename, 'r') as f:
-            actual_lines = f.readlines()
-        expected_lines = [
-            f"{recipient} {sender} {message}\n" for sender, message in new_messages]
-        self.assertEqual(actual_lines, expected_lines)
+        # Check that the messages were updated on disk
+        self.assertEqual(self.reopen().undelivered_msg[recipient], expected_messages)
+
+    def test_consume_messages(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello\nthere")
+
+        self.undelivered_messages.consume_messages("Alice", 2)
+        self.assertEqual(self.undelivered_messages.undelivered_msg["Alice"], [("Bob", "message 2")])
+        reopened = self.reopen()
+        self.assertEqual(reopened.undelivered_msg["Alice"], [("Bob", "message 2")])
+        self.assertEqual(reopened.undelivered_msg["Charlie"], [("Bob", "hello\nthere")])
+
+    def test_get_recipient_messages(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hi")
+        self.undelivered_messages.add_message("Alice", "David", "hey")
+
+        self.assertEqual(self.undelivered_messages.recipients(), ["Alice", "Charlie"])
+        self.assertEqual(self.undelivered_messages.get_recipient_messages("Alice"),
+                         [("Bob", "hello"), ("David", "hey")])
+        self.assertEqual(self.undelivered_messages.get_recipient_messages("Eve"), [])
+
+    def test_consume_all_messages(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        self.undelivered_messages.consume_messages("Alice", 1)
+        self.assertNotIn("Alice", self.undelivered_messages.undelivered_msg)
+        self.assertNotIn("Alice", self.reopen().undelivered_msg)
+
+    def test_acknowledge_messages(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        first = self.undelivered_messages.queued_ids("Alice").start
+        self.assertEqual(self.undelivered_messages.queued_ids("Alice"), range(first, first + 3))
+        self.assertEqual(len(self.undelivered_messages.queued_ids("Charlie")), 0)
+
+        self.undelivered_messages.acknowledge_messages("Alice", first + 1)
+        self.assertEqual(self.undelivered_messages.undelivered_msg["Alice"], [("Bob", "message 2")])
+        self.assertEqual(self.undelivered_messages.queued_ids("Alice"), range(first + 2, first + 3))
+        self.undelivered_messages.add_message("Alice", "Bob", "message 3")
+        # Reading from an id skips the messages before it
+        self.assertEqual(self.undelivered_messages.get_recipient_messages("Alice", first + 3),
+                         [("Bob", "message 3")])
+        self.assertEqual(self.undelivered_messages.get_recipient_messages("Alice", 0),
+                         [("Bob", "message 2"), ("Bob", "message 3")])
+        self.undelivered_messages.acknowledge_messages("Alice", first + 2)
+        self.assertEqual(self.undelivered_messages.queued_ids("Alice"), range(first + 3, first + 4))
+        # Acknowledging again does nothing
+        self.undelivered_messages.acknowledge_messages("Alice", first)
+        self.assertEqual(self.undelivered_messages.queued_ids("Alice"), range(first + 3, first + 4))
+
+        # Ids go on increasing after every message is consumed and the store is reopened
+        self.undelivered_messages.acknowledge_messages("Alice", first + 3)
+        reopened = self.reopen()
+        self.assertEqual(len(reopened.queued_ids("Alice")), 0)
+        reopened.add_message("Alice", "Bob", "message 4")
+        self.assertEqual(len(reopened.queued_ids("Alice")), 1)
+        self.assertGreater(reopened.queued_ids("Alice").start, first + 3)
+
+    def test_drained_recipients_are_forgotten(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+        last = self.undelivered_messages.queued_ids("Alice")[-1]
+        self.undelivered_messages.acknowledge_messages("Alice", last)
+        self.assertEqual(list(self.undelivered_messages.first_ids),
+                         [self.undelivered_messages.identities.get("Charlie")])
+
+        # The next message of a drained recipient gets a larger id, which stays the same once reopened
+        self.undelivered_messages.add_message("Alice", "Bob", "message 3")
+        self.undelivered_messages.add_message("Alice", "Bob", "message 4")
+        ids = self.undelivered_messages.queued_ids("Alice")
+        self.assertGreater(ids.start, last)
+        self.assertEqual(len(ids), 2)
+        reopened = self.reopen()
+        self.assertEqual(reopened.queued_ids("Alice"), ids)
+        self.assertEqual(reopened.get_recipient_messages("Alice", ids.start + 1), [("Bob", "message 4")])
+        reopened.acknowledge_messages("Alice", ids.start)
+        self.assertEqual(self.reopen().queued_ids("Alice"), range(ids.start + 1, ids.stop))
+
+    def test_add_group_message(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        added = self.undelivered_messages.add_group_message(["Alice", "Charlie", "Alice"], "Bob", "hi all")
+        self.assertEqual(added, ["Alice", "Charlie"])
+        self.assertEqual(self.undelivered_messages.undelivered_msg["Alice"], [("Bob", "hello"), ("Bob", "hi all")])
+        self.assertEqual(len(self.undelivered_messages.queued_ids("Charlie")), 1)
+
+        self.undelivered_messages.consume_messages("Alice", 2)
+        reopened = self.reopen()
+        self.assertNotIn("Alice", reopened.undelivered_msg)
+        self.assertEqual(reopened.undelivered_msg["Charlie"], [("Bob", "hi all")])
+
+    def test_group_message_limits(self):
+        self.undelivered_messages.limits = MessageLimits(max_messages_per_recipient=1, max_messages=3)
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        self.assertEqual(self.undelivered_messages.recipients_with_room(["Alice", "Charlie", "David", "Eve"]),
+                         ["Charlie", "David"])
+        self.assertEqual(self.undelivered_messages.add_group_message(["Alice", "Charlie", "David", "Eve"], "Bob", "hi"),
+                         ["Charlie", "David"])
+        self.assertEqual(self.undelivered_messages.add_group_message(["Eve"], "Bob", "hi"), [])
+        self.assertEqual(self.undelivered_messages.recipients(), ["Alice", "Charlie", "David"])
+
+    def test_per_recipient_limit(self):
+        self.undelivered_messages.limits = MessageLimits(max_messages_per_recipient=2)
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "message 0"))
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "message 1"))
+        self.assertFalse(self.undelivered_messages.has_room("Alice"))
+        self.assertFalse(self.undelivered_messages.add_message("Alice", "Bob", "message 2"))
+        self.assertTrue(self.undelivered_messages.add_message("Charlie", "Bob", "hello"))
+        self.assertEqual(len(self.undelivered_messages.undelivered_msg["Alice"]), 2)
+
+        # Delivering messages makes room again
+        self.undelivered_messages.consume_messages("Alice", 1)
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "message 3"))
+
+    def test_global_limit(self):
+        self.undelivered_messages.limits = MessageLimits(max_messages=2)
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "hello"))
+        self.assertTrue(self.undelivered_messages.add_message("Charlie", "Bob", "hello"))
+        self.assertFalse(self.undelivered_messages.add_message("David", "Bob", "hello"))
+        self.assertEqual(self.undelivered_messages.recipients(), ["Alice", "Charlie"])
+
+    def test_limits_can_be_skipped(self):
+        self.undelivered_messages.limits = MessageLimits(max_messages_per_recipient=1)
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "message 0"))
+        self.assertTrue(self.undelivered_messages.add_message("Alice", "Bob", "message 1", enforce_limits=False))
+        self.assertEqual(self.undelivered_messages.add_group_message(
+            ["Alice", "Charlie", "Alice"], "Bob", "hi all", enforce_limits=False), ["Alice", "Charlie"])
+        self.assertEqual(len(self.undelivered_messages.undelivered_msg["Alice"]), 3)
+
+    def test_expired_messages(self):
+        self.undelivered_messages.limits = MessageLimits(ttl_seconds=60)
+        self.undelivered_messages.add_message("Alice", "Bob", "message 0")
+        self.undelivered_messages.add_message("Alice", "Bob", "message 1")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+        alice = self.undelivered_messages.queued_ids("Alice")
+        charlie = self.undelivered_messages.queued_ids("Charlie")
+
+        self.assertEqual(self.undelivered_messages.expired_messages(time.time() + 30), {})
+        # Expired messages stay queued until they are acknowledged
+        expired = self.undelivered_messages.expired_messages(time.time() + 62)
+        self.assertEqual(expired, {"Alice": alice[-1], "Charlie": charlie[-1]})
+        self.assertEqual(self.undelivered_messages.recipients(), ["Alice", "Charlie"])
+        self.assertEqual(self.undelivered_messages.expired_messages(time.time() + 62), {})
+        for recipient, message_id in expired.items():
+            self.undelivered_messages.acknowledge_messages(recipient, message_id)
+        self.assertEqual(self.undelivered_messages.recipients(), [])
+        self.assertEqual(self.reopen().recipients(), [])
+
+    def test_time_to_live_counts_from_queued_time(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "old", queued_at=time.time() - 50)
+        self.undelivered_messages.add_group_message(["Alice", "Charlie"], "Bob", "new")
+        # Restarting doesn't give the messages a new time to live
+        reopened = self.reopen(MessageLimits(ttl_seconds=60))
+        (old, new) = reopened.queued_ids("Alice")
+        self.assertEqual(reopened.expired_messages(time.time() + 30), {"Alice": old})
+        self.assertEqual(reopened.expired_messages(time.time() + 62),
+                         {"Alice": new, "Charlie": reopened.queued_ids("Charlie")[0]})
+
+
+class TestUndeliveredMessages(UndeliveredMessagesTests, unittest.TestCase):
+    def setUp(self):
+        # Create a temporary directory for the message log
+        self.directory = tempfile.mkdtemp()
+
+        self.undelivered_messages = UndeliveredMessages(self.directory, segment_size=2)
+
+    def tearDown(self):
+        # Delete the temporary directory
+        shutil.rmtree(self.directory)
+
+    def reopen(self, limits=DEFAULT_LIMITS):
+        return UndeliveredMessages(self.directory, segment_size=2, limits=limits)
+
+    def test_add_message_writes_log(self):
+        self.undelivered_messages.add_message("Alice", "Bob", "Hello Alice!", queued_at=1.5)
+        records = list(self.undelivered_messages.log.read())
+        self.assertEqual(records, [(0, ("Alice", "Bob", "Hello Alice!", "1.5"))])
+
+    def test_records_without_time_are_read(self):
+        self.undelivered_messages.log.append(("Alice", "Bob", "Hello Alice!"))
+        reopened = self.reopen(MessageLimits(ttl_seconds=60))
+        self.assertEqual(reopened.undelivered_msg["Alice"], [("Bob", "Hello Alice!")])
+        # They count from the start of the store
+        self.assertEqual(reopened.expired_messages(time.time() + 30), {})
+        self.assertEqual(reopened.expired_messages(time.time() + 62), {"Alice": 0})
+
+    def test_group_message_is_written_once(self):
+        self.undelivered_messages.add_group_message(["Alice", "Charlie"], "Bob", "hi all")
+        self.undelivered_messages.add_message("Alice", "Bob", "hello")
+        self.undelivered_messages.add_message("Alice", "Bob", "hello again")
+        self.assertEqual(len(list(self.undelivered_messages.log.read())), 3)
+        self.assertEqual(len(self.undelivered_messages.log.segments), 2)
+
+        # The segment of the group message stays until every recipient consumed it
+        self.undelivered_messages.consume_messages("Alice", 3)
+        self.assertEqual(len(self.undelivered_messages.log.segments), 2)
+        self.undelivered_messages.consume_messages("Charlie", 1)
+        self.assertEqual(len(self.undelivered_messages.log.segments), 1)
+
+    def test_update_messages_advances_cursor(self):
+        recipient = "Alice"
+        undelivered_messages = UndeliveredMessages(self.directory)
+        for i in range(3):
+            undelivered_messages.add_message(recipient, "Bob", f"message {i}")
+
+        # Delivering the two oldest messages only moves the cursor
+        undelivered_messages.update_messages(recipient, [("Bob", "message 2")])
+        self.assertEqual(undelivered_messages.cursors[recipient], 1)
+        self.assertEqual(len(list(undelivered_messages.log.read())), 3)
+
+        reloaded = UndeliveredMessages(self.directory)
+        self.assertEqual(reloaded.undelivered_msg[recipient], [("Bob", "message 2")])
+
+    def test_consumed_segments_are_deleted(self):
+        for i in range(5):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+        self.assertEqual(len(self.undelivered_messages.log.segments), 3)
+
+        self.undelivered_messages.consume_messages("Alice", 4)
+        # The first two segments only held consumed messages
+        self.assertEqual(self.undelivered_messages.log.segments, [4])
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        reloaded = self.reopen()
+        self.assertEqual(reloaded.undelivered_msg["Alice"], [("Bob", "message 4")])
+        self.assertEqual(reloaded.undelivered_msg["Charlie"], [("Bob", "hello")])
+
+    def test_cursor_file_keeps_live_recipients(self):
+        with mock.patch('utils.undelivered_messages.MIN_COMPACTION_SIZE', 0):
+            for i in range(10):
+                self.undelivered_messages.add_message(f"user{i}", "Bob", "hello")
+                self.undelivered_messages.consume_messages(f"user{i}", 1)
+            self.undelivered_messages.add_message("Alice", "Bob", "message 0")
+            self.undelivered_messages.add_message("Alice", "Bob", "message 1")
+            self.undelivered_messages.add_message("Alice", "Bob", "message 2")
+            self.undelivered_messages.consume_messages("Alice", 2)
+            # Once their segments are deleted, the drained recipients are dropped from the cursor file
+            self.assertEqual([recipient for (recipient, *_) in self.undelivered_messages.cursor_file.read()],
+                             ["Alice"])
+        reopened = self.reopen()
+        self.assertEqual(reopened.queued_ids("Alice"), self.undelivered_messages.queued_ids("Alice"))
+        self.assertEqual(reopened.undelivered_msg["Alice"], [("Bob", "message 2")])
+
+    def test_messages_are_loaded_on_demand(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+
+        reloaded = self.reopen()
+        # Startup only indexes the recipients of the messages
+        self.assertEqual(reloaded.recipients(), ["Alice", "Charlie"])
+        self.assertEqual(len(reloaded.cache), 0)
+
+        self.assertEqual(reloaded.get_recipient_messages("Alice"), [("Bob", f"message {i}") for i in range(3)])
+        self.assertEqual(cached_recipients(reloaded), ["Alice"])
+
+        # Cached backlogs are kept up to date
+        reloaded.add_message("Alice", "Bob", "message 3")
+        reloaded.consume_messages("Alice", 2)
+        self.assertEqual(reloaded.get_recipient_messages("Alice"), [("Bob", "message 2"), ("Bob", "message 3")])
+
+    def test_cache_evicts_least_recently_used(self):
+        undelivered_messages = UndeliveredMessages(self.directory, segment_size=2, max_cached_recipients=2)
+        for recipient in ["Alice", "Bob", "Charlie"]:
+            undelivered_messages.add_message(recipient, "David", f"hello {recipient}")
+
+        undelivered_messages.get_recipient_messages("Alice")
+        undelivered_messages.get_recipient_messages("Bob")
+        undelivered_messages.get_recipient_messages("Alice")
+        undelivered_messages.get_recipient_messages("Charlie")
+        self.assertEqual(cached_recipients(undelivered_messages), ["Alice", "Charlie"])
+
+        # Evicted backlogs are read from the log again
+        self.assertEqual(undelivered_messages.get_recipient_messages("Bob"), [("David", "hello Bob")])
+
+    def test_cache_stays_within_byte_budget(self):
+        undelivered_messages = UndeliveredMessages(self.directory, limits=MessageLimits(max_cached_bytes=1000))
+        for recipient in ["Alice", "Bob", "Charlie"]:
+            for i in range(10):
+                undelivered_messages.add_message(recipient, "David", f"message {i} " + "x" * 30)
+            undelivered_messages.get_recipient_messages(recipient)
+            self.assertLessEqual(undelivered_messages.cached_bytes, 1000)
+        # The older backlogs were spilled from memory and are read from disk again
+        self.assertEqual(cached_recipients(undelivered_messages), ["Charlie"])
+        self.assertEqual(len(undelivered_messages.get_recipient_messages("Alice")), 10)
+
+        undelivered_messages.consume_messages("Alice", 10)
+        self.assertEqual(undelivered_messages.cached_bytes, sum(backlog.nbytes()
+                                                                for backlog in undelivered_messages.cache.values()))
+
+    def test_cached_senders_are_account_ids(self):
+        for i in range(3):
+            self.undelivered_messages.add_message("Alice", "Bob", f"message {i}")
+        self.undelivered_messages.add_message("Charlie", "Bob", "hello")
+        self.undelivered_messages.get_recipient_messages("Alice")
+        self.undelivered_messages.get_recipient_messages("Charlie")
+        bob = self.undelivered_messages.identities.get("Bob")
+        alice = self.undelivered_messages.identities.get("Alice")
+        self.assertEqual(list(self.undelivered_messages.cache[alice].senders), [bob, bob, bob])
+
+
+class TestBacklog(unittest.TestCase):
+    def test_append_and_items(self):
+        backlog = Backlog()
+        backlog.append(0, "hello".encode('utf-8'))
+        backlog.append(1, "".encode('utf-8'))
+        backlog.append(0, "h\u00e9llo".encode('utf-8'))
+        self.assertEqual(len(backlog), 3)
+        self.assertEqual(list(backlog.items()), [(0, b"hello"), (1, b""), (0, "h\u00e9llo".encode('utf-8'))])
+
+    def test_consume_compacts(self):
+        backlog = Backlog()
+        for i in range(4):
+            backlog.append(i, f"message {i}".encode('utf-8'))
+        backlog.consume(1)
+        self.assertEqual(backlog.start, 1)
+        self.assertEqual([sender for sender, _ in backlog.items()], [1, 2, 3])
+
+        # Once half the messages are consumed, they are dropped from the buffers
+        backlog.consume(1)
+        self.assertEqual(backlog.start, 0)
+        self.assertEqual(bytes(backlog.bodies), b"message 2message 3")
+        self.assertEqual(list(backlog.items()), [(2, b"message 2"), (3, b"message 3")])
+
+        backlog.append(4, b"message 4")
+        backlog.consume(10)
+        self.assertEqual(len(backlog), 0)
+        self.assertEqual(list(backlog.items()), [])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from protocol import protocol_instance
+from server import Server
+from utils.sqlite_storage import SqliteStorage
+from unittest.mock import MagicMock
+from utils.outbound_queue import OutboundLimits
+from utils.worker_processes import RemoteClient, RemoteQueue, WorkerProcesses
+
+TEST_HOST = "127.0.0.1"
+
+
+class TestWorkerProcesses(unittest.TestCase):
+    def setUp(self):
+        # Holds the port without listening on it, so every connection goes to a worker
+        self.port_holder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port_holder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.port_holder.bind((TEST_HOST, 0))
+        port = self.port_holder.getsockname()[1]
+        self.directory = tempfile.mkdtemp()
+        self.server = Server([{"host": TEST_HOST, "port": port, "id": 1}], 1, protocol_instance,
+                             SqliteStorage(os.path.join(self.directory, "1.db")))
+        self.server.primary_id = 1
+        self.server.become_primary()
+        self.workers = WorkerProcesses(self.server, 2)
+        self.workers.start(TEST_HOST, port)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.workers.stop()
+        self.port_holder.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self, uuid):
+        client = socket.create_connection(self.port_holder.getsockname())
+        self.clients.append(client)
+        protocol_instance.send(client, protocol_instance.encode('REGISTER_CLIENT_UUID', 0, {'uuid': uuid}))
+        return client
+
+    def request(self, client, operation, args={}):
+        protocol_instance.send(client, protocol_instance.encode(operation, 0, args))
+        (md, msg) = protocol_instance.read_small_packets(client)
+        return (md.operation_code.name, protocol_instance.parse_data(md.operation_code.value, msg))
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_requests_of_worker_connections(self):
+        kevin = self.connect('1')
+        howie = self.connect('2')
+        # Creating an account logs the client into it
+        for (client, username) in [(kevin, 'kevin'), (howie, 'howie')]:
+            self.assertEqual(self.request(client, 'CREATE_ACCOUNT', {'username': username}),
+                             ('CREATE_ACCOUNT_RESPONSE', {'status': 'Success', 'username': username}))
+        self.assertEqual(self.request(kevin, 'SEND_MESSAGE', {'recipient': 'howie', 'message': 'hello'})[1]['status'],
+                         'Success')
+        # Messages are delivered to the connection through its worker
+        (md, msg) = protocol_instance.read_small_packets(howie)
+        self.assertEqual(md.operation_code.name, 'RECV_MESSAGES')
+        self.assertEqual(protocol_instance.unpack_messages(
+            protocol_instance.parse_data(md.operation_code.value, msg)['messages']), [('kevin', 'hello')])
+        # The account is logged off once its connection ends
+        kevin.close()
+        self.wait_until(lambda: not self.server.logged_in.username_is_logged_in('kevin'))
+        self.assertTrue(self.server.logged_in.username_is_logged_in('howie'))
+
+    def test_account_searches_of_workers(self):
+        kevin = self.connect('1')
+        howie = self.connect('2')
+        self.assertEqual(self.request(kevin, 'CREATE_ACCOUNT', {'username': 'kevin'})[1]['status'], 'Success')
+        # Every worker knows of the account once its creation is answered, whichever worker reads the search
+        for client in [kevin, howie]:
+            self.assertEqual(self.request(client, 'LIST_ACCOUNTS', {'query': 'k.*'}),
+                             ('LIST_ACCOUNTS_RESPONSE', {'status': 'Success', 'accounts': 'kevin'}))
+        self.assertEqual(self.request(howie, 'LIST_ACCOUNTS', {'query': '('})[1]['status'], 'Error: regex is malformed.')
+        self.assertEqual(self.request(kevin, 'DELETE_ACCOUNT')[1]['status'], 'Success')
+        self.assertEqual(self.request(howie, 'LIST_ACCOUNTS', {'query': '.*'})[1]['accounts'], '')
+        # The searches never reached the server process
+        self.assertEqual(self.server.requests.stats.snapshot()['admitted'], 2)
+        # and only the responses of the server process count against its queues
+        self.wait_until(lambda: self.server.outbound_stats.snapshot()['queued'] == 0)
+        self.assertEqual(self.server.outbound_stats.snapshot()['sent'], 2)
+
+    def test_workers_negotiate_with_their_clients(self):
+        client = socket.create_connection(self.port_holder.getsockname())
+        self.clients.append(client)
+        protocol_instance.send(client, protocol_instance.encode(
+            'REGISTER_CLIENT_UUID', 0, {'uuid': '1', 'versions': '1,2', 'compression': 'zlib'}))
+        self.assertEqual(self.request(client, 'CREATE_ACCOUNT', {'username': 'kevin'})[1]['status'], 'Success')
+        # The response was encoded by the worker, with the version it negotiated
+        protocol_instance.send(client, protocol_instance.encode('LIST_ACCOUNTS', 5, {'query': '.*'}))
+        (md, msg) = protocol_instance.read_small_packets(client)
+        self.assertEqual((md.version, md.message_id), (2, 5))
+
+    def test_remote_queue_limits(self):
+        link = MagicMock()
+        link.send.return_value = True
+        client = RemoteClient(link, 7)
+        queue = RemoteQueue(client, OutboundLimits(max_queued_messages=2, slow_consumer_policy='drop'))
+        self.assertTrue(queue.put([b'a', b'b']))
+        link.send.assert_called_with(('send', 7, b'ab'))
+        self.assertTrue(queue.put([b'c']))
+        # Messages the worker hasn't written count against the limit
+        self.assertFalse(queue.has_room())
+        self.assertFalse(queue.put([b'd']))
+        self.assertEqual(queue.stats.snapshot()['dropped'], 1)
+        queue.written(2)
+        self.assertEqual(len(queue), 0)
+        self.assertTrue(queue.put([b'd']))
+        queue = RemoteQueue(RemoteClient(link, 8), OutboundLimits(max_queued_messages=1))
+        self.assertTrue(queue.put([b'a']))
+        self.assertFalse(queue.put([b'b']))
+        link.send.assert_called_with(('close', 8))
+        self.assertFalse(queue.has_room())
+
+    def test_count_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            WorkerProcesses(self.server, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel. Time is cut into ticks, and every timer is stored in the slot of the tick it expires at,
+    so scheduling is O(1) and advancing only visits the slots of the ticks that passed, instead of scanning every
+    timer. Timers further away than one turn of the wheel share slots and are skipped until their tick comes.
+
+    Timers are keyed: scheduling a key that already has a timer on the same tick replaces its value, so a queue
+    that schedules one timer per item only keeps one timer per key and tick."""
+    def __init__(self, tick_seconds: float = 1.0, num_slots: int = 256, now: float = 0.0):
+        """
+        Args:
+            tick_seconds (float, optional): Resolution of the wheel. Timers fire up to one tick late.
+            num_slots (int, optional): Number of ticks in one turn of the wheel.
+            now (float, optional): The current time.
+        """
+        if tick_seconds <= 0 or num_slots <= 0:
+            raise ValueError("tick_seconds and num_slots must be positive")
+        self.tick_seconds = tick_seconds
+        self.slots = [{} for _ in range(num_slots)]  # Every slot maps a tick to a map of key to value
+        self.current_tick = self._tick(now)
+
+    def _tick(self, time: float) -> int:
+        return math.floor(time / self.tick_seconds)
+
+    def schedule(self, deadline: float, key, value):
+        """Schedule a timer for key firing at the first tick at or after the deadline."""
+        tick = max(math.ceil(deadline / self.tick_seconds), self.current_tick + 1)
+        self.slots[tick % len(self.slots)].setdefault(tick, {})[key] = value
+
+    def advance(self, now: float) -> list:
+        """Move the wheel to the current time.
+
+        Returns:
+            list: (key, value) of every timer that fired, in tick order.
+        """
+        target = self._tick(now)
+        fired = []
+        # Past one full turn every slot has been visited, so later ticks would only revisit them
+        last_tick = min(target, self.current_tick + len(self.slots))
+        for tick in range(self.current_tick + 1, last_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for due in [slot_tick for slot_tick in slot if slot_tick <= target]:
+                fired.append((due, slot.pop(due)))
+        self.current_tick = max(self.current_tick, target)
+        fired.sort(key=lambda timers: timers[0])
+        return [timer for _, timers in fired for timer in timers.items()]
+
+    def clear(self):
+        """Cancel every timer."""
+        for slot in self.slots:
+            slot.clear()
+
+    def __len__(self):
+        return sum(len(timers) for slot in self.slots for timers in slot.values())
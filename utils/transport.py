@@ -0,0 +1,74 @@
+import os
+import socket
+import stat
+
+# Prefix of the host of a server listening on a Unix domain socket, followed by the path of the socket
+UNIX_PREFIX = 'unix:'
+
+
+def is_unix(host: str) -> bool:
+    """Check if a host is the path of a Unix domain socket rather than a TCP host."""
+    return str(host).startswith(UNIX_PREFIX)
+
+
+def socket_address(host: str, port=None):
+    """Return the address to bind or connect a socket of create_socket(host) to. A 'unix:' host is the path of a
+    Unix domain socket and has no port."""
+    if is_unix(host):
+        return host[len(UNIX_PREFIX):]
+    return (host, int(port))
+
+
+def describe(host: str, port=None) -> str:
+    """Return a readable address for messages."""
+    return host if is_unix(host) else f"{host}:{port}"
+
+
+def create_socket(host: str) -> socket.socket:
+    """Return an unconnected stream socket of the family of the host. The protocol frames messages the same way
+    over either family."""
+    family = socket.AF_UNIX if is_unix(host) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def connect(host: str, port=None) -> socket.socket:
+    """Return a socket connected to a server.
+
+    Raises:
+        OSError: If the server can't be reached.
+    """
+    connection = create_socket(host)
+    try:
+        connection.connect(socket_address(host, port))
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def listen(host: str, port=None, reuse_port: bool = False) -> socket.socket:
+    """Return a socket listening on the address of a server. The file of a Unix domain socket left behind by a
+    server that is gone is removed first.
+
+    Args:
+        host (str): Host to listen on, or 'unix:' and the path of the socket.
+        port (int, optional): Port to listen on, for TCP hosts.
+        reuse_port (bool, optional): Let other sockets listen on the same port with SO_REUSEPORT, which only TCP
+            supports.
+    """
+    server_socket = create_socket(host)
+    try:
+        if is_unix(host):
+            if reuse_port:
+                raise ValueError("Unix domain sockets can't share their address with SO_REUSEPORT")
+            path = socket_address(host)
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        elif reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind(socket_address(host, port))
+        server_socket.listen()
+    except (OSError, ValueError):
+        server_socket.close()
+        raise
+    return server_socket
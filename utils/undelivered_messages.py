@@ -1,50 +1,433 @@
+import bisect
 import os
-from collections import defaultdict
-
-class UndeliveredMessages:
-    """Class to store undelivered messages. The messages are stored in memory and in a file."""
-    def __init__(self, filename: str):
-        self.filename = filename
-        
-        self.undelivered_msg = defaultdict(list) # Map of recipient username to list of (sender, message) for that recipient
-        if os.path.exists(filename):
-            # Read the file and store the messages in a dictionary by recipient
-            with open(self.filename, 'r') as f:
-                lines = f.readlines()
-            for line in lines:
-                if line.strip():
-                    recipient, sender, message = line.strip().split(' ', 2)
-                    self.undelivered_msg[recipient].append((sender, message))
-
-    def add_message(self, recipient: str, sender: str, message: str):
-        """Add a message to the list of undelivered messages for a recipient."""
-        self.undelivered_msg[recipient] += [
-            (sender, message)]
-        with open(self.filename, 'a') as f:
-            f.write(f"{recipient} {sender} {message}\n")
-            f.flush()
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from utils.identity_table import IdentityTable
+from utils.record_file import DEFAULT_DURABILITY, Durability, RecordFile
+from utils.segmented_log import SegmentedLog
+from utils.storage import DEFAULT_LIMITS, MessageLimits, MessageStore
+from utils.timer_wheel import TimerWheel
+
+# Separates the recipients of a group message in the recipient field of its log record
+GROUP_SEPARATOR = '\0'
+# Position of the time a message was queued in its log record, after the recipients, the sender and the message
+QUEUED_AT_FIELD = 3
+# Number of records in the cursor file below which it is never compacted
+MIN_COMPACTION_SIZE = 1024
+
+
+class UndeliveredMessages(MessageStore):
+    """Class to store undelivered messages. The messages are stored in a segmented log on disk.
+    Each recipient has a delivery cursor, so consuming messages only records how far the recipient has read,
+    and log segments are deleted once every message in them has been consumed.
+
+    In memory, only the log sequence numbers of every recipient's messages are kept. A recipient's messages are
+    read from the log when they are first needed, and the most recently used backlogs stay cached as Backlogs
+    within the byte budget of the message limits. Every record keeps the time its message was queued, and expired
+    messages are found by a timer wheel counting from that time, so restarts don't give messages a new time to
+    live.
+    Recipients and senders are kept by their id in the identity table. A recipient holds a reference to its id while
+    it has queued messages, and a cached backlog to the id of the sender of every message in it.
+
+    Every message of a recipient has a message id, one more than the id of the recipient's message before it. The
+    id of a recipient's oldest queued message is kept with its cursor. Once every message of a recipient is
+    consumed, its id is dropped, and its next message gets the log sequence number of the message as its id. No
+    message has an id larger than its sequence number, so that id is larger than every id the recipient had
+    before, and ids are never reused while only the recipients with queued messages are kept.
+
+    A message sent to a group is written to the log once, with every recipient in its record, and each recipient
+    keeps the sequence number of the shared record. Its segment is deleted once every recipient consumed it."""
+    def __init__(self, directory: str, segment_size: int = 4096, durability: Durability = DEFAULT_DURABILITY,
+                 max_cached_recipients: int = 1024, limits: MessageLimits = DEFAULT_LIMITS,
+                 identities: IdentityTable = None, first_seq: int = 0):
+        """
+        Args:
+            directory (str): Directory holding the message log and the cursor file.
+            segment_size (int, optional): Number of messages in each log segment.
+            durability (Durability, optional): Durability setting for writes to the log and the cursor file.
+            max_cached_recipients (int, optional): Number of recipients whose messages are kept in memory.
+            limits (MessageLimits, optional): Caps on the queued messages and their time to live.
+            identities (IdentityTable, optional): Table of account ids shared with the other stores.
+            first_seq (int, optional): Sequence number of the first message of a new log, larger than every
+                message id of the messages imported into it.
+        """
+        self.directory = directory
+        self.log = SegmentedLog(directory, segment_size, durability, first_seq)
+        self.cursor_file = RecordFile(os.path.join(directory, 'cursors.log'), durability)
+        self.max_cached_recipients = max_cached_recipients
+        self.limits = limits
+        self.identities = identities if identities is not None else IdentityTable()
+
+        self.sequence_numbers = {} # Map of recipient id to an array of the log sequence numbers of their messages
+        self.cache = OrderedDict() # Map of recipient id to their Backlog, least recently used first
+        self.cached_bytes = 0 # Bytes used by the backlogs in the cache
+        self.message_count = 0 # Number of undelivered messages for all recipients
+        # Timers of the newest message queued for a recipient in every tick, firing when its time to live is over
+        self.timers = TimerWheel(now=time.time())
+        self.cursors = {} # Map of recipient username to the sequence number of the last consumed message
+        self.first_ids = {} # Map of recipient id with queued messages to the message id of their oldest one
+        self.live_counts = defaultdict(int) # Map of segment start to the number of unconsumed messages in it
+        self.cursor_records = 0 # Number of records in the cursor file
+
+        now = time.time()
+        saved_ids = {} # Map of recipient username to the message id in their last cursor
+        for recipient, seq, *first_id in self.cursor_file.read():
+            self.cursor_records += 1
+            self.cursors[recipient] = max(int(seq), self.cursors.get(recipient, -1))
+            # Cursors written once every message of the recipient was consumed, or before message ids existed,
+            # have none, and the recipient's ids start over
+            saved_ids[recipient] = int(first_id[0]) if first_id else None
+        # Only the recipients and the time of each record are decoded, the messages are read when they are needed
+        for seq, (recipients, queued_at) in self.log.index((0, QUEUED_AT_FIELD)):
+            # Records written before the time was kept count from this start
+            queued_at = now if queued_at is None else float(queued_at)
+            for recipient in recipients.split(GROUP_SEPARATOR):
+                if seq > self.cursors.get(recipient, -1):
+                    recipient_id = self._track(recipient, seq)
+                    if saved_ids.get(recipient) is not None:
+                        self.first_ids[recipient_id] = saved_ids[recipient]
+                    self._schedule_expiry(recipient_id, seq, queued_at)
+        self.collect_garbage()
+
+    @property
+    def undelivered_msg(self):
+        """Read-only map of recipient username to list of (sender, message) for that recipient."""
+        return BacklogView(self)
+
+    def _track(self, recipient: str, seq: int) -> int:
+        """Add the record with sequence number seq to the messages of a recipient, and return the recipient's id."""
+        recipient_id = self.identities.get(recipient)
+        if recipient_id not in self.sequence_numbers:
+            recipient_id = self.identities.acquire(recipient)
+            self.sequence_numbers[recipient_id] = array('q')
+            self.first_ids[recipient_id] = seq
+        self.sequence_numbers[recipient_id].append(seq)
+        self.live_counts[self.log.segment_of(seq)] += 1
+        self.message_count += 1
+        return recipient_id
+
+    def _schedule_expiry(self, recipient_id, seq, queued_at: float):
+        if self.limits.ttl_seconds is not None:
+            self.timers.schedule(queued_at + self.limits.ttl_seconds, recipient_id, seq)
+
+    def _resize_cached(self, recipient_id, change):
+        """Apply change to a recipient's cached backlog, keeping the cache within its byte budget."""
+        backlog = self.cache.get(recipient_id)
+        if backlog is None:
+            return
+        self.cached_bytes -= backlog.nbytes()
+        change(backlog)
+        self.cached_bytes += backlog.nbytes()
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently used backlogs from memory until the cache is within its limits.
+        They stay on disk and are read again when they are needed."""
+        max_cached_bytes = self.limits.max_cached_bytes
+        while self.cache and (len(self.cache) > self.max_cached_recipients or
+                              (max_cached_bytes is not None and self.cached_bytes > max_cached_bytes)):
+            self._uncache(next(iter(self.cache)))
+
+    def _uncache(self, recipient_id):
+        backlog = self.cache.pop(recipient_id)
+        self.cached_bytes -= backlog.nbytes()
+        self.identities.drop(backlog.sender_ids())
+
+    def _load(self, recipient_id):
+        """Return the cached backlog of a recipient, reading it from the log on a cache miss."""
+        if recipient_id in self.cache:
+            self.cache.move_to_end(recipient_id)
+            return self.cache[recipient_id]
+        backlog = Backlog()
+        for (_, sender, message, *_) in self.log.read_at(self.sequence_numbers.get(recipient_id, [])):
+            backlog.append(self.identities.acquire(sender), message.encode('utf-8'))
+        self.cache[recipient_id] = backlog
+        self.cached_bytes += backlog.nbytes()
+        self._evict()
+        return backlog
+
+    def add_message(self, recipient: str, sender: str, message: str, enforce_limits: bool = True,
+                    queued_at: float = None):
+        """Add a message to the list of undelivered messages for a recipient.
+        Returns False without adding it if the message limits are reached, unless enforce_limits is False.
+        queued_at is the time the message was queued, the current time by default."""
+        if enforce_limits and not self.has_room(recipient):
+            return False
+        queued_at = time.time() if queued_at is None else queued_at
+        seq = self.log.append((recipient, sender, message, str(queued_at)))
+        recipient_id = self._track(recipient, seq)
+        self._schedule_expiry(recipient_id, seq, queued_at)
+        self._resize_cached(recipient_id, lambda backlog: backlog.append(self.identities.acquire(sender),
+                                                                         message.encode('utf-8')))
+        return True
+
+    def add_group_message(self, recipients, sender: str, message: str, enforce_limits: bool = True,
+                          queued_at: float = None):
+        """Add one message for several recipients, stored once and shared by their backlogs. Recipients for whom
+        the message limits are reached are skipped, unless enforce_limits is False. queued_at is the time the
+        message was queued, the current time by default.
+
+        Returns:
+            list: The recipients the message was added for, in the given order without duplicates.
+        """
+        added = self.recipients_with_room(recipients) if enforce_limits else list(dict.fromkeys(recipients))
+        if not added:
+            return added
+        queued_at = time.time() if queued_at is None else queued_at
+        seq = self.log.append((GROUP_SEPARATOR.join(added), sender, message, str(queued_at)))
+        body = message.encode('utf-8')
+        for recipient in added:
+            recipient_id = self._track(recipient, seq)
+            self._schedule_expiry(recipient_id, seq, queued_at)
+            self._resize_cached(recipient_id, lambda backlog: backlog.append(self.identities.acquire(sender), body))
+        return added
+
+    def recipients_with_room(self, recipients):
+        """Return the recipients the message limits allow adding one more message for, if it is added for all of
+        them, in the given order without duplicates."""
+        accepted = []
+        for recipient in dict.fromkeys(recipients):
+            recipient_count = len(self.sequence_numbers.get(self.identities.get(recipient), ()))
+            if self.limits.has_room(recipient_count, self.message_count + len(accepted)):
+                accepted.append(recipient)
+        return accepted
+
+    def has_room(self, recipient: str):
+        """Check if the message limits allow adding another message for a recipient."""
+        return self.limits.has_room(len(self.sequence_numbers.get(self.identities.get(recipient), ())),
+                                    self.message_count)
+
+    def expired_messages(self, now: float = None) -> dict:
+        """Return a map of every recipient with messages whose time to live has passed to the id of the newest one,
+        without dropping them. Messages of a recipient expire oldest first, so every timer expires the recipient's
+        messages up to the one it was scheduled for. Every timer fires once."""
+        expired = {}
+        for recipient_id, seq in self.timers.advance(time.time() if now is None else now):
+            count = bisect.bisect_right(self.sequence_numbers.get(recipient_id, ()), seq)
+            if count:
+                recipient = self.identities.name(recipient_id)
+                expired[recipient] = max(self.first_ids[recipient_id] + count - 1, expired.get(recipient, -1))
+        return expired
+
+    def has_messages(self, recipient: str) -> bool:
+        """Check if a recipient has undelivered messages, without reading them."""
+        return self.identities.get(recipient) in self.sequence_numbers
+
+    def recipients(self):
+        """Return a list of the recipients with undelivered messages, without reading any messages."""
+        return [self.identities.name(recipient_id) for recipient_id in self.sequence_numbers]
+
+    def get_recipient_messages(self, recipient: str, first_id: int = 0):
+        """Return the list of (sender, message) for a recipient, reading it from the log if it isn't cached.
+        Only the messages from first_id on are decoded."""
+        recipient_id = self.identities.get(recipient)
+        if recipient_id not in self.sequence_numbers:
+            return []
+        skip = max(first_id - self.first_ids.get(recipient_id, 0), 0)
+        return [(self.identities.name(sender_id), body.decode('utf-8'))
+                for sender_id, body in self._load(recipient_id).items(skip)]
 
     def get_messages(self):
-        """Return a list of (recipient, [(sender, message)]) for all recipients with undelivered messages."""
-        return self.undelivered_msg.items()
-    
+        """Return a list of (recipient, [(sender, message)]) for all recipients with undelivered messages.
+        This reads every backlog, so the delivery loop uses recipients and get_recipient_messages instead."""
+        return [(recipient, self.get_recipient_messages(recipient)) for recipient in self.recipients()]
+
+    def queued_ids(self, recipient: str) -> range:
+        """Return the range of message ids of the messages queued for a recipient, without reading them."""
+        recipient_id = self.identities.get(recipient)
+        first_id = self.first_ids.get(recipient_id, 0)
+        return range(first_id, first_id + len(self.sequence_numbers.get(recipient_id, ())))
+
+    def consume_messages(self, recipient, count):
+        """Mark the oldest count messages of a recipient as delivered by advancing the recipient's cursor."""
+        self._consume(self.identities.get(recipient), count)
+
+    def acknowledge_messages(self, recipient: str, message_id: int):
+        """Consume every message of a recipient up to and including message_id."""
+        count = message_id - self.queued_ids(recipient).start + 1
+        if count > 0:
+            self.consume_messages(recipient, count)
+
+    def _consume(self, recipient_id, count):
+        seqs = self.sequence_numbers.get(recipient_id, array('q'))[:count]
+        if not seqs:
+            return
+        recipient = self.identities.name(recipient_id)
+        self.cursors[recipient] = seqs[-1]
+        self.first_ids[recipient_id] += len(seqs)
+
+        del self.sequence_numbers[recipient_id][:count]
+        self.message_count -= len(seqs)
+        self._resize_cached(recipient_id, lambda backlog: self.identities.drop(backlog.consume(count)))
+        if not self.sequence_numbers[recipient_id]:
+            self.sequence_numbers.pop(recipient_id)
+            self.first_ids.pop(recipient_id)
+            if recipient_id in self.cache:
+                self._uncache(recipient_id)
+            self.identities.drop((recipient_id,))
+        self.cursor_file.append(self._cursor_record(recipient))
+        self.cursor_records += 1
+
+        emptied_segment = False
+        for seq in seqs:
+            start = self.log.segment_of(seq)
+            self.live_counts[start] -= 1
+            if self.live_counts[start] == 0 and not self.log.is_active(start):
+                emptied_segment = True
+        if emptied_segment:
+            self.collect_garbage()
+
     def update_messages(self, recipient, message_infos):
-        """Update the messages for a recipient. Replaces the message list for that recipient with the given messages."""
-        self.undelivered_msg[recipient] = message_infos
-        with open(self.filename, 'r') as f:
-            lines = f.readlines()
-        with open(self.filename, 'w') as f:
-            f.writelines(filter(lambda line: line.strip() and line.strip().split()[0] != recipient, lines))
-            f.flush()
+        """Update the messages for a recipient. Replaces the message list for that recipient with the given messages.
+
+        When the new list is what remains of the current list after delivering its oldest messages,
+        this only advances the recipient's cursor."""
+        message_infos = [(sender, message) for sender, message in message_infos
+                         if not (sender == "" or message == "")]
+        current = self.get_recipient_messages(recipient)
+        delivered = len(current) - len(message_infos)
+        if delivered >= 0 and current[delivered:] == message_infos:
+            self.consume_messages(recipient, delivered)
+        else:
+            self.consume_messages(recipient, len(current))
             for sender, message in message_infos:
-                if (not (sender == "" or message == "")):
-                    f.write(f"{recipient} {sender} {message}\n")
-                    f.flush()
+                self.add_message(recipient, sender, message, enforce_limits=False)
+
+    def queued_messages(self, recipient: str):
+        """Return the list of (sender, message, time queued) of a recipient, read from the log."""
+        now = time.time()
+        return [(sender, message, float(queued_at[0]) if queued_at else now)
+                for (_, sender, message, *queued_at) in self.log.read_at(
+                    self.sequence_numbers.get(self.identities.get(recipient), []))]
+
+    def import_backlog(self, recipient: str, messages, first_id: int):
+        """Queue the list of (sender, message, time queued) of a recipient moved from another store, keeping their
+        message ids and times. The recipient must have no messages queued, and first_id must be smaller than the
+        next sequence number of the log, so that later ids stay larger."""
+        for sender, message, queued_at in messages:
+            self.add_message(recipient, sender, message, enforce_limits=False, queued_at=queued_at)
+        if messages:
+            self.first_ids[self.identities.get(recipient)] = first_id
+            self.cursor_file.append(self._cursor_record(recipient))
+            self.cursor_records += 1
+
+    def _cursor_record(self, recipient: str):
+        """Return the cursor file record of a recipient, with the message id of its oldest queued message if it
+        has any."""
+        record = (recipient, str(self.cursors.get(recipient, -1)))
+        recipient_id = self.identities.get(recipient)
+        if recipient_id in self.first_ids:
+            record += (str(self.first_ids[recipient_id]),)
+        return record
+
+    def collect_garbage(self):
+        """Delete every sealed segment whose messages have all been consumed, and drop the cursors that no longer
+        filter records on disk. Once most of the records in the cursor file are stale, it is rewritten with the
+        cursors left and the recipients with queued messages."""
+        for start in list(self.log.segments):
+            if self.live_counts.get(start, 0) == 0 and not self.log.is_active(start):
+                self.log.delete_segment(start)
+                self.live_counts.pop(start, None)
+
+        first_seq = self.log.first_seq()
+        self.cursors = {recipient: seq for recipient, seq in self.cursors.items() if seq >= first_seq}
+        live = self.cursors.keys() | set(map(self.identities.name, self.first_ids))
+        if self.cursor_records > max(MIN_COMPACTION_SIZE, 2 * len(live)):
+            self.cursor_file.rewrite(self._cursor_record(recipient) for recipient in live)
+            self.cursor_records = len(live)
+
+    def close(self):
+        """Close the files of the store. Later writes reopen them."""
+        self.log.close()
+        self.cursor_file.close()
 
     def clear(self):
         """
         Clears the undelivered messages for testing purposes
         """
-        self.undelivered_msg = defaultdict(list) 
-        open(self.filename, 'w').close() 
-    
\ No newline at end of file
+        for recipient_id in list(self.cache):
+            self._uncache(recipient_id)
+        self.identities.drop(list(self.sequence_numbers))
+        self.sequence_numbers = {}
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.message_count = 0
+        self.timers.clear()
+        self.cursors = {}
+        self.first_ids = {}
+        self.live_counts = defaultdict(int)
+        self.cursor_records = 0
+        self.log.clear()
+        self.cursor_file.clear()
+
+
+class Backlog:
+    """Compact in-memory list of the messages of one recipient. Senders are stored as account ids and the message
+    bodies are packed one after another into a single UTF-8 arena, so a message costs a few bytes plus its body
+    instead of a tuple and two strings."""
+    __slots__ = ('senders', 'offsets', 'bodies', 'start')
+
+    def __init__(self):
+        self.senders = array('I') # Account id of the sender of every message
+        self.offsets = array('Q', [0]) # Message i is bodies[offsets[i]:offsets[i + 1]]
+        self.bodies = bytearray()
+        self.start = 0 # Number of consumed messages still at the front of the arrays
+
+    def append(self, sender_id: int, body: bytes):
+        self.senders.append(sender_id)
+        self.bodies += body
+        self.offsets.append(len(self.bodies))
+
+    def items(self, skip: int = 0):
+        """Yield (sender id, body) for every unconsumed message after the first skip ones, oldest first."""
+        bodies = memoryview(self.bodies)
+        for i in range(self.start + skip, len(self.senders)):
+            yield self.senders[i], bytes(bodies[self.offsets[i]:self.offsets[i + 1]])
+
+    def sender_ids(self) -> array:
+        """Return the sender ids of the unconsumed messages, oldest first."""
+        return self.senders[self.start:]
+
+    def consume(self, count: int) -> array:
+        """Drop the oldest count messages, and return their sender ids. The arrays are compacted once at least half
+        of them is consumed."""
+        consumed = self.senders[self.start:self.start + count]
+        self.start = min(self.start + count, len(self.senders))
+        if self.start * 2 >= len(self.senders):
+            base = self.offsets[self.start]
+            self.senders = self.senders[self.start:]
+            self.offsets = array('Q', (offset - base for offset in self.offsets[self.start:]))
+            del self.bodies[:base]
+            self.start = 0
+        return consumed
+
+    def nbytes(self) -> int:
+        """Return the number of bytes used by the buffers of the backlog."""
+        return (self.senders.buffer_info()[1] * self.senders.itemsize +
+                self.offsets.buffer_info()[1] * self.offsets.itemsize + len(self.bodies))
+
+    def __len__(self):
+        return len(self.senders) - self.start
+
+
+class BacklogView(Mapping):
+    """Read-only map of recipient username to their list of (sender, message). A recipient's messages are only
+    read from the store when they are looked up, so checking for or listing recipients stays cheap."""
+    def __init__(self, undelivered_messages: MessageStore):
+        self.undelivered_messages = undelivered_messages
+
+    def __getitem__(self, recipient):
+        if not self.undelivered_messages.has_messages(recipient):
+            raise KeyError(recipient)
+        return self.undelivered_messages.get_recipient_messages(recipient)
+
+    def __iter__(self):
+        return iter(self.undelivered_messages.recipients())
+
+    def __len__(self):
+        return len(self.undelivered_messages.recipients())
+
+    def __contains__(self, recipient):
+        return self.undelivered_messages.has_messages(recipient)
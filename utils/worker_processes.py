@@ -0,0 +1,391 @@
+import collections
+import itertools
+import multiprocessing
+import pickle
+import re
+import socket
+import threading
+from typing import List
+from utils import transport
+from utils.outbound_queue import DEFAULT_OUTBOUND_LIMITS, OutboundLimits, OutboundQueue, OutboundStats
+from utils.storage import ACCOUNT_CREATED
+
+# Requests about the accounts of the server's replica group, which a worker answers from its copy of the account
+# list. LIST_ACCOUNTS also asks the other groups, so it is only answered by the worker when there are none
+LOCAL_OPERATIONS = {'LIST_ACCOUNTS', 'LIST_LOCAL_ACCOUNTS'}
+# Matches every username, to take a snapshot of the account list
+EVERY_ACCOUNT = re.compile('')
+
+
+class RemoteMetadata:
+    """Metadata of a request read by a worker process. Only the OperationCode and message id cross the pipe, since
+    that is all the server reads from the metadata of a request."""
+    def __init__(self, operation_code, message_id: int):
+        self.operation_code = operation_code
+        self.message_id = message_id
+
+
+class RemoteEncoder:
+    """Stands in, in the server process, for the Protocol of a connection held by a worker process. Encoding a
+    message only pickles its operation and arguments, which the worker encodes with the header version and
+    compression it negotiated with the client, so the server process never builds the packets of the connection."""
+    def encode(self, operation: str, message_id: int, operation_args={}) -> List[bytes]:
+        return [pickle.dumps((operation, message_id, operation_args))]
+
+
+class RemoteClient:
+    """Stands in, in the server process, for the socket of a client connection held by a worker process. Whatever
+    the server writes to it is passed to the worker, which writes it to the client's socket."""
+    def __init__(self, link, connection_id: int):
+        """
+        Args:
+            link (WorkerLink): The link to the worker process holding the connection.
+            connection_id (int): Number of the connection in the worker process.
+        """
+        self.link = link
+        self.connection_id = connection_id
+
+    def sendmsg(self, buffers, *args) -> int:
+        data = b''.join(buffers)
+        if not self.link.send(('send', self.connection_id, data)):
+            raise BrokenPipeError("The worker process is gone")
+        return len(data)
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self.link.send(('close', self.connection_id))
+
+    def close(self):
+        pass
+
+
+class RemoteQueue:
+    """Outbound queue of a connection held by a worker process, in place of an OutboundQueue in the server process.
+
+    The messages are written to the connection by an OutboundQueue of the worker, so rather than a writer thread
+    of its own, putting a message passes it straight to the worker. The worker reports the messages it has written,
+    and the ones it hasn't count against the same limits as an OutboundQueue's."""
+    def __init__(self, client: RemoteClient, limits: OutboundLimits = DEFAULT_OUTBOUND_LIMITS,
+                 stats: OutboundStats = None):
+        """
+        Args:
+            client (RemoteClient): The connection.
+            limits (OutboundLimits, optional): Limits of the queue.
+            stats (OutboundStats, optional): Counters shared with the other queues of the server.
+        """
+        self.client = client
+        self.limits = limits
+        self.stats = stats if stats is not None else OutboundStats()
+        self.lock = threading.Lock()  # Guards the fields below
+        self.unwritten = 0  # Messages passed to the worker and not written yet
+        self.closed = False
+
+    def __len__(self):
+        return self.unwritten
+
+    def has_room(self) -> bool:
+        """See OutboundQueue.has_room."""
+        return not self.closed and self.unwritten < self.limits.max_queued_messages
+
+    def put(self, message) -> bool:
+        """See OutboundQueue.put."""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.unwritten >= self.limits.max_queued_messages:
+                if self.limits.slow_consumer_policy == 'drop':
+                    with self.stats.lock:
+                        self.stats.dropped += 1
+                    return False
+                print("Disconnecting slow client.")
+                self._close()
+                self.client.shutdown()
+                return False
+            # Sent with the lock held, so messages reach the worker in the order they were put
+            if not self.client.link.send(('send', self.client.connection_id, b''.join(message))):
+                self._close()
+                return False
+            self.unwritten += 1
+            with self.stats.lock:
+                self.stats.queued += 1
+                self.stats.peak_depth = max(self.stats.peak_depth, self.unwritten)
+        return True
+
+    def written(self, count: int):
+        """Count messages the worker has written to the connection."""
+        with self.lock:
+            if self.closed:
+                return
+            self.unwritten -= count
+            with self.stats.lock:
+                self.stats.queued -= count
+                self.stats.sent += count
+
+    def _close(self):
+        """Close the queue. Call with the lock held."""
+        self.closed = True
+        with self.stats.lock:
+            self.stats.queued -= self.unwritten
+        self.unwritten = 0
+
+    def close(self):
+        """Drop the unwritten messages, once the connection has ended."""
+        with self.lock:
+            if not self.closed:
+                self._close()
+
+
+class WorkerLink:
+    """Pipe between the server process and one worker process, which any thread may send on."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, message) -> bool:
+        try:
+            with self.lock:
+                self.connection.send(message)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def recv(self):
+        try:
+            return self.connection.recv()
+        except (EOFError, OSError):
+            return None
+
+
+class WorkerProcesses:
+    """Worker processes sharing the server's listening port through SO_REUSEPORT, which own the connections the
+    kernel gives them, while the server process owns the state.
+
+    A worker reads, frames and parses the requests of its connections, and encodes and writes their responses and
+    messages, which is most of the work of a request besides the request itself. Requests that change or need the
+    state of the server, such as creating accounts, logging in and sending messages, go to the server process,
+    which keeps the single authoritative copy of the accounts, sessions and messages and replicates it. It runs
+    them through the same request pool and delivers messages through the same delivery workers as for its own
+    connections: a connection of a worker is a RemoteClient with a RemoteQueue and a RemoteEncoder there, and a
+    thread of the server process serves each worker.
+
+    Workers answer the account list searches of LOCAL_OPERATIONS themselves, from a copy of the usernames that the
+    server process keeps up to date with every account created or removed. The changes are sent on the same pipe
+    as the responses, so a client that created an account finds it in its next search. Searches run on the worker,
+    so they bypass the request pool of the server."""
+    def __init__(self, server, count: int):
+        """
+        Args:
+            server (Server): The server running the requests the workers pass on.
+            count (int): Number of worker processes.
+        """
+        if count <= 0:
+            raise ValueError("count must be positive")
+        self.server = server
+        self.count = count
+        self.processes = []
+        self.links = ()  # Links to the started workers, replaced rather than changed so publish can iterate them
+
+    def start(self, host: str, port: int):
+        """Start the workers listening on the port, and return once every one of them is listening. The workers
+        are spawned rather than forked, since the server process already runs threads holding locks."""
+        context = multiprocessing.get_context('spawn')
+        self.server.account_list.add_listener(self.publish)
+        for _ in range(self.count):
+            (ours, theirs) = context.Pipe()
+            process = context.Process(target=serve_connections, daemon=True, args=(
+                host, port, theirs, self.server.protocol, self.server.outbound_limits, self.server.num_shards == 1))
+            process.start()
+            theirs.close()
+            link = WorkerLink(ours)
+            if link.recv() != ('ready',):
+                raise RuntimeError("A worker process failed to listen")
+            # The snapshot is taken under the lock the account list changes under, so the worker gets every change
+            # after it and none before
+            with self.server.account_list_lock:
+                link.send(('accounts', self.server.account_list.search_accounts(EVERY_ACCOUNT)))
+                self.links = self.links + (link,)
+            self.processes.append(process)
+            threading.Thread(target=self._serve, args=(link,), daemon=True).start()
+
+    def stop(self):
+        """Stop the workers, which closes their connections."""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        for link in self.links:
+            link.connection.close()
+        self.links = ()
+
+    def publish(self, event: str, username: str):
+        """Listener of the account list, which passes its changes on to the copy of every worker. Sending only
+        waits while a worker is behind on reading its pipe."""
+        for link in self.links:
+            link.send(('account', event, username))
+
+    def _serve(self, link: WorkerLink):
+        """Run the requests passed on by a worker, until it is gone."""
+        clients = {}  # Map of connection number to the (RemoteClient, socket_lock) standing in for it
+        queues = {}  # Map of connection number to its RemoteQueue
+        processors = {}  # Map of connection number to its admit_operation function
+        encoder = RemoteEncoder()
+        while (message := link.recv()) is not None:
+            match message:
+                case ('open', connection_id):
+                    socket_lock = threading.Lock()
+                    client = RemoteClient(link, connection_id)
+                    clients[connection_id] = (client, socket_lock)
+                    queues[connection_id] = RemoteQueue(client, self.server.outbound_limits,
+                                                        self.server.outbound_stats)
+                    self.server.attach_connection(client, socket_lock, queues[connection_id], encoder)
+                    processors[connection_id] = self.server.admit_operation_curried(socket_lock, parsed=True)
+                case ('request', connection_id, operation_code, message_id, args):
+                    processors[connection_id](clients[connection_id][0], RemoteMetadata(operation_code, message_id),
+                                              args, None)
+                case ('written', connection_id, count):
+                    # The last write of a connection may be reported after it closed
+                    if connection_id in queues:
+                        queues[connection_id].written(count)
+                case ('closed', connection_id):
+                    processors.pop(connection_id)
+                    queues.pop(connection_id)
+                    self.server.disconnect_client(*clients.pop(connection_id))
+        for client in clients.values():
+            self.server.disconnect_client(*client)
+
+
+class WorkerConnection:
+    """A client connection owned by a worker process, with the queue writing to its socket and the Protocol its
+    messages are encoded with. The queue holds the responses of the worker itself along with what the server
+    process sends, and only the writes of the latter are reported to the server, whose RemoteQueue counts them."""
+    def __init__(self, client_socket, protocol, outbound_limits: OutboundLimits, report_written):
+        """
+        Args:
+            client_socket (socket.socket): The socket of the connection.
+            protocol (Protocol): Protocol the messages are encoded with until the client negotiates another.
+            outbound_limits (OutboundLimits): Limits of the queue.
+            report_written (Callable): Called with the number of messages of the server process written after
+                every write that had any.
+        """
+        self.protocol = protocol
+        self.report_written = report_written
+        self.lock = threading.Lock()  # Keeps forwarded in the order of the queue
+        self.forwarded = collections.deque()  # Whether each message in the queue came from the server process
+        self.queue = OutboundQueue(client_socket, threading.Lock(), protocol, outbound_limits, written=self._written)
+
+    def put(self, message, forwarded: bool):
+        """Queue a message encoded by the worker, forwarded if the server process sent it."""
+        with self.lock:
+            if self.queue.put(message):
+                self.forwarded.append(forwarded)
+                return
+        # A message of the server process that is refused counts as done, so it doesn't take room for good
+        if forwarded:
+            self.report_written(1)
+
+    def _written(self, count: int):
+        with self.lock:
+            forwarded = sum(self.forwarded.popleft() for _ in range(count))
+        if forwarded:
+            self.report_written(forwarded)
+
+
+def search_accounts(accounts, args: dict) -> dict:
+    """Answer an account list search from a collection of usernames, as Server.process_list_local_accounts does."""
+    try:
+        pattern = re.compile(fr"{args['query']}", flags=re.IGNORECASE)
+    except (KeyError, re.error):
+        return {'status': 'Error: regex is malformed.', 'accounts': ''}
+    return {'status': 'Success', 'accounts': ";".join(account for account in accounts if pattern.match(account))}
+
+
+def serve_connections(host: str, port: int, link, protocol, outbound_limits=DEFAULT_OUTBOUND_LIMITS,
+                      holds_every_account: bool = True):
+    """Main function of a worker process. Accepts connections on the shared port, answers the account searches of
+    LOCAL_OPERATIONS and passes the other requests to the server process, and encodes and writes what it sends
+    back to the connections.
+
+    Args:
+        host (str): Host the server listens on.
+        port (int): Port the server listens on.
+        link (multiprocessing.connection.Connection): The worker's end of the pipe to the server process.
+        protocol (Protocol): Protocol used to read requests and write responses.
+        outbound_limits (OutboundLimits, optional): Limits of the queue of every connection.
+        holds_every_account (bool, optional): Whether the server's replica group is the only one, so its account
+            list answers LIST_ACCOUNTS.
+    """
+    link = WorkerLink(link)
+    server_socket = transport.listen(host, port, reuse_port=True)
+    connections = {}  # Map of connection number to its WorkerConnection
+    connections_lock = threading.Lock()
+    accounts = {}  # Usernames of the server's accounts, in the order the worker learned of them
+    accounts_lock = threading.Lock()
+
+    def read_link():
+        while (message := link.recv()) is not None:
+            match message:
+                case ('account', event, username):
+                    with accounts_lock:
+                        if event == ACCOUNT_CREATED:
+                            accounts[username] = None
+                        else:
+                            accounts.pop(username, None)
+                case ('send', connection_id, data):
+                    with connections_lock:
+                        connection = connections.get(connection_id)
+                    if connection is not None:
+                        connection.put(connection.protocol.encode(*pickle.loads(data)), True)
+                case ('close', connection_id):
+                    with connections_lock:
+                        connection = connections.get(connection_id)
+                    if connection is not None:
+                        try:
+                            connection.queue.client_socket.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+        # The server process is gone, and shutting the listening socket down ends the accept loop
+        server_socket.shutdown(socket.SHUT_RDWR)
+        server_socket.close()
+
+    def process_operation(connection, connection_id, metadata, msg):
+        operation = metadata.operation_code.name
+        args = protocol.parse_data(metadata.operation_code.value, msg)
+        if 'versions' in args:
+            # The worker writes to the connection, so it negotiates the header version and compression itself
+            connection.protocol = protocol.negotiate(args.pop('versions'), args.pop('compression', ''))
+        if operation == 'LIST_LOCAL_ACCOUNTS' or (operation in LOCAL_OPERATIONS and holds_every_account):
+            with accounts_lock:
+                response = search_accounts(accounts, args)
+            connection.put(connection.protocol.encode('LIST_ACCOUNTS_RESPONSE', metadata.message_id, response), False)
+        else:
+            link.send(('request', connection_id, metadata.operation_code, metadata.message_id, args))
+
+    def read_connection(connection_id, client_socket):
+        with connections_lock:
+            connection = connections[connection_id]
+        protocol.read_packets(client_socket, lambda client, metadata, msg, id_accum: process_operation(
+            connection, connection_id, metadata, msg))
+        with connections_lock:
+            connections.pop(connection_id)
+        connection.queue.close()
+        client_socket.close()
+        link.send(('closed', connection_id))
+
+    link.send(('ready',))
+    # Connections wait in the backlog of the socket until the worker has the snapshot of the account list
+    message = link.recv()
+    if message is None:
+        return
+    accounts.update(dict.fromkeys(message[1]))
+    threading.Thread(target=read_link, daemon=True).start()
+    for connection_id in itertools.count():
+        try:
+            (client_socket, _) = server_socket.accept()
+        except OSError:
+            return
+        # The server process bounds the messages it passes on, so the queue only enforces the send timeout
+        with connections_lock:
+            connections[connection_id] = WorkerConnection(
+                client_socket, protocol, outbound_limits,
+                lambda count, connection_id=connection_id: link.send(('written', connection_id, count)))
+        link.send(('open', connection_id))
+        threading.Thread(target=read_connection, args=(connection_id, client_socket), daemon=True).start()